@@ -1,13 +1,30 @@
+import fcntl
+import hashlib
 import os
-from contextlib import chdir
+import socket
+import shutil
+import stat
+import tarfile
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
 from typing import Any
 from os.path import join
-from subprocess import DEVNULL, Popen
 
 # ----8<----
-from libgit import (ObjectType, git_get_object_type, git_ls_remote_guess_ref,
-                    git_verify, is_sha1, git_init_bare, git_fetch)
+from libgit import (ObjectType, git_get_object_type, git_ls_remote, git_ls_remote_guess_ref,
+                    git_verify, is_sha1, git_init_bare, git_fetch, git_get_common_dir,
+                    git_fetch_objects, git_fetch_object_id, git_config_get,
+                    git_config_set, TransportInfo, downgrade_transport, GitError, git_get_sha1,
+                    git_get_object_reader, git_close_object_reader, git_has_promisor_packs, git_rev_list_missing,
+                    git_fetch_missing_objects, git_commit_exists_locally, git_add_alternate, git_fsck_connectivity,
+                    git_has_alternates, git_update_ref, guess_ref, git_bundle_create,
+                    git_bundle_list_heads, git_bundle_unbundle, git_get_commit_parents, git_mark_shallow,
+                    GitObjectWriter, TreeEntry, serialize_tree_object, sort_tree_entries, git_gc_auto,
+                    tree_remove_gitlinks)
 from util import AppException, ErrorCode, URLTypes, get_url_type
 
 # ----8<----
@@ -18,6 +35,15 @@ from util import AppException, ErrorCode, URLTypes, get_url_type
 class DownloadConfig:
     url: Any
     revision: Any | None = None
+    # Only this subdirectory of the upstream repository is needed. If the
+    # remote supports it, the blobs of other directories are not downloaded.
+    subdir: bytes | None = None
+    # The object id of the revision that is already integrated in the
+    # superproject. E.g. the old revision when updating a subproject.
+    integrated_object_id: bytes | None = None
+    # Path to a git bundle file. If it's set, the objects are taken from the
+    # bundle instead of the remote repository. The URL is not contacted.
+    bundle_path: bytes | None = None
 
 
 @dataclass(frozen=True)
@@ -25,9 +51,12 @@ class CloneConfig:
     full_clone: bool
     object_id: str | None = None
     ref: bytes | None = None
+    # The object id that the revision points to in the remote repository. It's
+    # None if it's unknown.
+    remote_object_id: bytes | None = None
 
 
-def git_resolve_to_clone_config(url: str, revision: str | None) -> CloneConfig:
+def git_resolve_to_clone_config(url: str, revision: str | None, refs_cache: "RefsCache | None" = None) -> CloneConfig:
     # Some heuristics to sort out branch, commit/tag id or tag
     if revision is not None:
 
@@ -41,21 +70,333 @@ def git_resolve_to_clone_config(url: str, revision: str | None) -> CloneConfig:
             # is in there!
             # TODO Handle tag ids special. They can be looked up by "git
             # ls-remote".
-            return CloneConfig(full_clone=True, object_id=revision)
+            return CloneConfig(full_clone=True, object_id=revision, remote_object_id=revision_bytes)
         else:
             # It looks like a ref to a branch or tag. Try to resolve it
-            ref_resolved = git_ls_remote_guess_ref(url, revision)
+            if refs_cache is None:
+                ref_resolved = git_ls_remote_guess_ref(url, revision)
+            else:
+                ref_resolved = refs_cache.resolve(url, revision, lambda: git_ls_remote_guess_ref(url, revision))
             if ref_resolved is None:
                 raise AppException(ErrorCode.INVALID_ARGUMENT,
                                    "The reference '%s' cannot be resolved to a branch or tag!" % (revision,))
-            return CloneConfig(full_clone=False, ref=ref_resolved)
+            ref, remote_object_id = ref_resolved
+            return CloneConfig(full_clone=False, ref=ref, remote_object_id=remote_object_id)
     else:
         # Use HEAD of remote repository
         # TODO optimize this by looking at the output of "git ls-remote".
-        return CloneConfig(full_clone=True)
+        def query_head() -> tuple[bytes, bytes] | None:
+            object_id = git_ls_remote(url, ["HEAD"]).get(b"HEAD")
+            return None if object_id is None else (b"HEAD", object_id)
+
+        if refs_cache is None:
+            head_resolved = query_head()
+        else:
+            head_resolved = refs_cache.resolve(url, None, query_head)
+        return CloneConfig(full_clone=True, remote_object_id=None if head_resolved is None else head_resolved[1])
+
+
+# Returns the directory that contains the persistent caches of all upstream
+# repositories. The default location is inside the git directory of the
+# superproject. With the environment variable SUBPATCH_CACHE_DIR the caches can
+# be shared between multiple superprojects, e.g. "$XDG_CACHE_HOME/subpatch".
+def get_cache_root_abspath(super_abspath: bytes) -> bytes:
+    if is_cache_root_shared():
+        return os.path.abspath(os.fsencode(os.environ["SUBPATCH_CACHE_DIR"]))
+    return join(git_get_common_dir(cwd=super_abspath), b"subpatch-cache")
+
+
+# Returns True if the caches are shared between multiple superprojects
+def is_cache_root_shared() -> bool:
+    return len(os.environ.get("SUBPATCH_CACHE_DIR", "")) > 0
+
+
+# Normalize the URL, so the same upstream repository always results in the
+# same cache directory.
+# NOTE: Local relative paths are relative to the current work directory.
+def normalize_url(url: str) -> str:
+    url_type = get_url_type(url)
+    if url_type in (URLTypes.LOCAL_RELATIVE, URLTypes.LOCAL_ABSOLUTE):
+        return os.path.normpath(os.path.abspath(url))
+    return url.rstrip("/")
+
+
+def get_cache_key(url: str) -> bytes:
+    return hashlib.sha1(normalize_url(url).encode("utf8")).hexdigest().encode("ascii")
+
+
+# Returns the time in seconds that resolved refs are reused from the
+# RefsCache. It's configured with the environment variable SUBPATCH_REFS_TTL.
+# The default is 0. Then every revision is resolved in the remote repository.
+def get_refs_ttl() -> float:
+    value = os.environ.get("SUBPATCH_REFS_TTL", "0").strip()
+    try:
+        ttl = float(value)
+    except ValueError:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "SUBPATCH_REFS_TTL must be a number, but it's '%s'" % (value,))
+    return ttl
+
+
+# Returns the time in seconds to wait for the lock of a cache. It's configured
+# with the environment variable SUBPATCH_LOCK_TIMEOUT. The default is 600.
+def get_lock_timeout() -> float:
+    value = os.environ.get("SUBPATCH_LOCK_TIMEOUT", "600").strip()
+    try:
+        timeout = float(value)
+    except ValueError:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "SUBPATCH_LOCK_TIMEOUT must be a number, but it's '%s'" % (value,))
+    return timeout
+
+
+# Exclusive lock of a cache. Multiple subpatch processes on the same machine
+# can share the caches, e.g. parallel CI jobs with SUBPATCH_CACHE_DIR. The
+# lock file is located next to the cache directory. So it also protects the
+# creation and the removal of the cache.
+# NOTE: The lock is a fcntl lock on the lock file. The kernel releases it when
+# the process exits or crashes. So a lock file that is left over is never
+# stale. It's just reused. The lock file contains the pid and the hostname of
+# the last owner for the error message.
+# NOTE: The lock is not reentrant. Also two threads of the same process must
+# not lock the same cache.
+class CacheLock:
+    def __init__(self, cache_abspath: bytes, timeout: float | None = None):
+        self._path = cache_abspath + b".lock"
+        self._timeout = get_lock_timeout() if timeout is None else timeout
+        self._fd: int | None = None
+
+    # Returns False, if the lock is held by another process and 'blocking' is
+    # False.
+    def acquire(self, blocking: bool = True) -> bool:
+        assert self._fd is None
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self._timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not blocking:
+                    os.close(fd)
+                    return False
+                if time.monotonic() >= deadline:
+                    owner = os.pread(fd, 256, 0).decode("utf8", errors="replace").strip()
+                    os.close(fd)
+                    raise AppException(ErrorCode.INVALID_STATE,
+                                       "Timeout while waiting for the lock '%s'. It's held by '%s'."
+                                       % (os.fsdecode(self._path), owner))
+                time.sleep(0.1)
+
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, b"pid %d on %s\n" % (os.getpid(), socket.gethostname().encode("utf8")), 0)
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        assert self._fd is not None
+        # NOTE: Closing the file descriptor releases the lock. The lock file is
+        # not removed. Another process may already wait for it.
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self) -> "CacheLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+# Locks multiple caches. The locks are taken in a fixed order. So two processes
+# that need some of the same caches cannot deadlock.
+# NOTE: The caches must not be locked again in the same process while the locks
+# are held. The locks of two file descriptors exclude each other.
+@contextmanager
+def lock_caches(cache_abspaths: list[bytes], timeout: float | None = None):
+    with ExitStack() as stack:
+        for cache_abspath in sorted(set(cache_abspaths)):
+            stack.enter_context(CacheLock(cache_abspath, timeout))
+        yield
+
+
+# Returns the maximum size in bytes of all caches in the cache root directory.
+# It's configured with the environment variable SUBPATCH_CACHE_MAX_SIZE. The
+# default is None. Then the size is not bounded.
+def get_cache_max_size() -> int | None:
+    value = os.environ.get("SUBPATCH_CACHE_MAX_SIZE", "").strip()
+    if value == "":
+        return None
+    return check_and_parse_cache_max_size(value)
+
+
+def check_and_parse_cache_max_size(value: str) -> int:
+    try:
+        max_size = int(value)
+    except ValueError:
+        max_size = -1
+    if max_size < 0:
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "The maximum cache size must be a number of bytes, but it's '%s'" % (value,))
+    return max_size
+
+
+# The modification time of this file in a cache directory is the time of the
+# last use of the cache.
+LAST_USE_FILENAME = b"subpatch-last-use"
+
+
+def mark_cache_used(cache_abspath: bytes) -> None:
+    path = join(cache_abspath, LAST_USE_FILENAME)
+    with open(path, "ab"):
+        pass
+    os.utime(path)
+
+
+def get_cache_last_use(cache_abspath: bytes) -> float:
+    try:
+        return os.stat(join(cache_abspath, LAST_USE_FILENAME)).st_mtime
+    except FileNotFoundError:
+        # The cache was created before the file was introduced
+        return os.stat(cache_abspath).st_mtime
+
+
+# Returns the disk usage of all files in the directory in bytes
+def get_dir_size(dir_abspath: bytes) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(dir_abspath):
+        for filename in filenames:
+            size += os.lstat(join(dirpath, filename)).st_size
+    return size
+
+
+# Returns the paths of all caches in the cache root directory. The names of
+# the cache directories are the cache keys.
+def list_caches(root_abspath: bytes) -> list[bytes]:
+    try:
+        names = sorted(os.listdir(root_abspath))
+    except FileNotFoundError:
+        return []
+    return [join(root_abspath, name) for name in names if is_sha1(name) and os.path.isdir(join(root_abspath, name))]
+
+
+# Removes the least recently used caches until all caches together are not
+# bigger than 'max_size' bytes. The caches in 'keep' are never removed, e.g.
+# the caches that are used by the current command. Caches that are locked by
+# other processes are also not removed. Returns the removed caches as tuples
+# (path, size).
+def evict_caches(root_abspath: bytes, max_size: int, keep: list[bytes] | None = None) -> list[tuple[bytes, int]]:
+    keep = [] if keep is None else keep
+    caches = [(get_cache_last_use(path), path, get_dir_size(path)) for path in list_caches(root_abspath)]
+    total_size = sum(size for _, _, size in caches)
+
+    removed = []
+    for _, path, size in sorted(caches):
+        if total_size <= max_size:
+            break
+        if path in keep:
+            continue
+        lock = CacheLock(path)
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            # Another process may have removed the cache in the meantime
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            # Also forget the resolved refs of the URL. See RefsCache.
+            try:
+                os.unlink(path + b".refs")
+            except FileNotFoundError:
+                pass
+        finally:
+            lock.release()
+        total_size -= size
+        removed.append((path, size))
+    return removed
+
+
+# On-disk cache for the resolution of revisions in remote repositories. So
+# multiple 'add' and 'update' calls in a short time do not query the remote
+# again and again. There is a file per URL next to the cache repositories.
+# Every line contains a resolved revision:
+#    <time stamp> <tab> <revision> <tab> <ref> <tab> <object id> <newline>
+# For the HEAD of the remote repository the revision is empty.
+# NOTE: Only successful resolutions are cached.
+class RefsCache:
+    def __init__(self, root_abspath: bytes, ttl: float, refresh: bool = False):
+        self._root_abspath = root_abspath
+        self._ttl = ttl
+        # Ignore existing entries, but store the new results
+        self._refresh = refresh
+
+    def _get_path(self, url: str) -> bytes:
+        return join(self._root_abspath, get_cache_key(url) + b".refs")
+
+    def _read(self, url: str) -> dict[bytes, tuple[float, bytes, bytes]]:
+        entries = {}
+        try:
+            with open(self._get_path(url), "rb") as f:
+                for line in f.read().splitlines():
+                    parts = line.split(b"\t")
+                    if len(parts) != 4 or not is_sha1(parts[3]):
+                        continue  # Ignore broken lines
+                    timestamp, revision, ref, object_id = parts
+                    entries[revision] = (float(timestamp), ref, object_id)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _write(self, url: str, entries: dict[bytes, tuple[float, bytes, bytes]]) -> None:
+        os.makedirs(self._root_abspath, exist_ok=True)
+        path = self._get_path(url)
+        # Write the new file first and rename it. So a reader never sees a
+        # partial file.
+        tmp_path = path + b".tmp%d" % (os.getpid(),)
+        with open(tmp_path, "wb") as f:
+            for revision, (timestamp, ref, object_id) in entries.items():
+                f.write(b"%f\t%s\t%s\t%s\n" % (timestamp, revision, ref, object_id))
+        os.replace(tmp_path, path)
+
+    # Returns the cached tuple (ref, object id) for the revision if it's not
+    # older than the TTL. Otherwise 'query' is called to resolve the revision
+    # in the remote repository and the result is stored.
+    def resolve(self, url: str, revision: str | None, query) -> tuple[bytes, bytes] | None:
+        if self._ttl <= 0:
+            return query()
+
+        revision_bytes = b"" if revision is None else revision.encode("utf8")
+        now = time.time()
+        entries = self._read(url)
+        if not self._refresh and revision_bytes in entries:
+            timestamp, ref, object_id = entries[revision_bytes]
+            if 0 <= now - timestamp < self._ttl:
+                return ref, object_id
+
+        result = query()
+        if result is not None:
+            entries[revision_bytes] = (now, result[0], result[1])
+            self._write(url, entries)
+        return result
+
+
+# Name of the remote in the cache repository for partial clones
+PROMISOR_REMOTE_NAME = "origin"
+
+# Ref in the cache repository that points to the revision that is integrated
+# in the superproject. See DownloadConfig.integrated_object_id.
+INTEGRATED_REF = b"refs/subpatch/integrated"
+
+# Ref in the cache repository that points to the last fetched revision. The
+# fetched objects are not referenced otherwise. Then "git gc" would prune
+# them.
+FETCHED_REF = b"refs/subpatch/fetched"
 
 
 class CacheHelperGit:
+    def __init__(self, refs_cache: RefsCache | None = None, refresh: bool = False):
+        self._refs_cache = refs_cache
+        # Ignore the stored capabilities of the remote. See get_transport_info().
+        self._refresh = refresh
+
     def get_revision_as_str(self, revision: str | None) -> str:
         # The revision is of type Optional<str>. It's either None or a str.
         # Convert to a printable string for stdout
@@ -65,83 +406,626 @@ class CacheHelperGit:
 
     # TODO allow to use bare and non-bare git repositories
     # NOTE "git submodule init" creates a bare repository in ".git/modules"
-    def create(self, cwd_to_cache_relpath: bytes) -> None:
-        assert os.path.isdir(cwd_to_cache_relpath)
-        with chdir(cwd_to_cache_relpath):
-            git_init_bare()
+    def create(self, cache_abspath: bytes) -> None:
+        assert os.path.isdir(cache_abspath)
+        git_init_bare(cwd=cache_abspath)
         # TODO add are enfore that there is a cache-subpatch config file
 
-    def isCreated(self, cwd_to_cache_relpath: bytes) -> bool:
+    def isCreated(self, cache_abspath: bytes) -> bool:
         # Very simple check to test whether the cache directory contains a bare
         # git repository.
         # TODO also check for cache subpatch config file
-        return os.path.isfile(join(cwd_to_cache_relpath, b"config"))
+        return os.path.isfile(join(cache_abspath, b"config"))
+
+    # Resolve the revision in the remote repository without fetching anything
+    def resolve(self, download_config: DownloadConfig) -> CloneConfig:
+        if download_config.bundle_path is not None:
+            return self.resolve_bundle(download_config.bundle_path, download_config.revision)
+        return git_resolve_to_clone_config(download_config.url, download_config.revision, self._refs_cache)
+
+    # Same as git_resolve_to_clone_config(), but the refs are taken from the
+    # bundle file instead of the remote repository.
+    def resolve_bundle(self, bundle_path: bytes, revision: str | None) -> CloneConfig:
+        refs_sha1 = git_bundle_list_heads(bundle_path)
+        if revision is None:
+            if b"HEAD" not in refs_sha1:
+                raise AppException(ErrorCode.INVALID_ARGUMENT, "The bundle does not contain 'HEAD'!")
+            return CloneConfig(full_clone=False, ref=b"HEAD", remote_object_id=refs_sha1[b"HEAD"])
+
+        revision_bytes = revision.encode("utf8")
+        if is_sha1(revision_bytes):
+            # NOTE: The object id does not need to be a ref of the bundle. It
+            # can also be an object that is reachable from a ref.
+            return CloneConfig(full_clone=True, object_id=revision, remote_object_id=revision_bytes)
+
+        ref_resolved = guess_ref(refs_sha1, revision)
+        if ref_resolved is None:
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "The reference '%s' cannot be resolved to a branch or tag in the bundle!" % (revision,))
+        ref, remote_object_id = ref_resolved
+        return CloneConfig(full_clone=False, ref=ref, remote_object_id=remote_object_id)
 
     # TODO return the object id here is maybe not correct, because it's not
     # agnostic to other cache types.
     # NOTE: return value is either a object_id of a tag or of a commit!
-    def fetch(self, cwd_to_cache_relpath: bytes, download_config: DownloadConfig) -> bytes:
+    # NOTE: The 'clone_config' of a previous resolve() call can be passed to
+    # avoid querying the remote repository again.
+    def fetch(self, cache_abspath: bytes, download_config: DownloadConfig,
+              clone_config: CloneConfig | None = None) -> bytes:
         # TODO clone only a single branch and maybe use --depth 1
         #  - that is already partially implemented
         url = download_config.url
-        revision = download_config.revision  # Can be None
 
-        clone_config = git_resolve_to_clone_config(url, revision)
+        if clone_config is None:
+            clone_config = self.resolve(download_config)
+
+        assert os.path.isabs(cache_abspath)
 
-        assert not os.path.isabs(cwd_to_cache_relpath)
-        assert b"//" not in cwd_to_cache_relpath  # sanitze path
-        folder_count = cwd_to_cache_relpath.rstrip(b"/").count(b"/") + 1
+        if download_config.bundle_path is not None:
+            object_id = self.fetch_from_bundle(cache_abspath, download_config.bundle_path, clone_config)
+            git_update_ref(FETCHED_REF, object_id, cwd=cache_abspath)
+            return object_id
 
-        # TODO Not work with relative paths, because a subdir is used!
+        # The cache is persistent and not located next to the current work
+        # directory. So relative local paths must be made absolute.
         if get_url_type(url) == URLTypes.LOCAL_RELATIVE:
-            # This is ugly!
-            # TODO fix str bs byte missmatch. encode should not be needed here!
-            url_tmp = b"../" * folder_count + url.encode("utf8")
+            url = os.path.abspath(url)
+
+        try:
+            object_id = self.fetch_with_transport(cache_abspath, url, download_config, clone_config)
+            is_complete = self.has_all_objects(cache_abspath, object_id)
+        except GitError:
+            # The missing objects of the alternate can also break the fetch.
+            # git fails in its connectivity check.
+            if not git_has_alternates(cache_abspath) or git_fsck_connectivity(cwd=cache_abspath):
+                raise
+            is_complete = False
+
+        # The cache uses the objects of the superproject. See
+        # use_superproject_objects(). If the superproject has removed some of
+        # them, e.g. by "git gc", they are missing in the cache. git does not
+        # fetch them again, because it assumes that the objects of the refs
+        # are complete. So the cache is created again without the alternate.
+        if not is_complete:
+            git_close_object_reader(cache_abspath)
+            shutil.rmtree(cache_abspath)
+            os.mkdir(cache_abspath)
+            self.create(cache_abspath)
+            mark_cache_used(cache_abspath)
+            object_id = self.fetch_with_transport(cache_abspath, url, download_config, clone_config)
+
+        git_update_ref(FETCHED_REF, object_id, cwd=cache_abspath)
+        return object_id
+
+    # The capabilities of the remote are not probed upfront. The fetch just
+    # uses them. If the remote rejects one, the fetch is retried without it.
+    def fetch_with_transport(self, cache_abspath: bytes, url: str, download_config: DownloadConfig,
+                             clone_config: CloneConfig) -> bytes:
+        transport = self.get_transport_info(cache_abspath)
+        while True:
+            try:
+                object_id = self.fetch_from_remote(cache_abspath, url, download_config, clone_config, transport)
+                break
+            except GitError as e:
+                downgraded_transport = downgrade_transport(transport, e.stderr)
+                if downgraded_transport == transport:
+                    # The fetch failed for another reason, e.g. a network
+                    # error. Keep the stored capabilities.
+                    raise
+                transport = downgraded_transport
+        self.set_transport_info(cache_abspath, transport)
+        return object_id
+
+    # Fetches the revision with the given capabilities of the remote. Returns
+    # the object id.
+    def fetch_from_remote(self, cache_abspath: bytes, url: str, download_config: DownloadConfig,
+                          clone_config: CloneConfig, transport: TransportInfo) -> bytes:
+        depth = 1 if transport.shallow else None
+        # For a subdirectory use a partial clone without blobs. The blobs of
+        # the subdirectory are fetched afterwards. This needs the fetch of
+        # objects by id.
+        filter = None
+        if download_config.subdir is not None and transport.filter and transport.fetch_by_object_id:
+            filter = b"blob:none"
+            # git needs a named remote to lazily fetch the missing objects.
+            # So from now on the cache fetches from the promisor remote.
+            url = self.configure_promisor_remote(url, cache_abspath)
+
+        # The files of the integrated revision are already in the object store
+        # of the superproject. If the cache uses it as an alternate, fetch
+        # only the commit of the integrated revision without trees and blobs.
+        # Objects that are not in the superproject anymore are fetched from
+        # the promisor remote later.
+        integrated_object_id = download_config.integrated_object_id
+        if integrated_object_id is not None:
+            if not self.has_commit(cache_abspath, integrated_object_id) and transport.shallow \
+                    and transport.filter and transport.fetch_by_object_id and git_has_alternates(cache_abspath):
+                remote = self.configure_promisor_remote(url, cache_abspath)
+                try:
+                    git_fetch_object_id(remote, integrated_object_id, cwd=cache_abspath, depth=1, filter=b"tree:0")
+                except GitError:
+                    # NOTE: A failure is not an error. It's just an optimization.
+                    pass
+
+            # git only uses commits as 'have' in the negotiation, if a ref
+            # points to them. Then the remote only sends the objects that are
+            # new in the requested revision.
+            if self.has_commit(cache_abspath, integrated_object_id):
+                git_update_ref(INTEGRATED_REF, integrated_object_id, cwd=cache_abspath)
+
+        # There are three cases:
+        #   - full clone + with object id
+        #   - full clone + without object id
+        #   - fetch + with ref
+
+        if clone_config.full_clone:
+            if clone_config.object_id is None:
+                object_id = self.fetch_all_refs(url, cache_abspath, depth, filter)
+            else:
+                # If the remote allows it, fetch only the requested commit/tag.
+                # Otherwise fetch all refs and hope that the object id is in
+                # there.
+                object_id_bytes = clone_config.object_id.encode("ascii")
+                if not self.has_commit(cache_abspath, object_id_bytes):
+                    if transport.fetch_by_object_id:
+                        git_fetch_object_id(url, object_id_bytes, cwd=cache_abspath, depth=depth, filter=filter)
+                    else:
+                        self.fetch_all_refs(url, cache_abspath, depth, filter)
+
+                if not git_verify(clone_config.object_id, cwd=cache_abspath):
+                    raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                       "Object id '%s' does not point to a valid object!" % (clone_config.object_id,))
+
+                object_type = git_get_object_type(clone_config.object_id, cwd=cache_abspath)
+                if object_type not in (ObjectType.COMMIT, ObjectType.TAG):
+                    raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                       "Object id '%s' does not point to a commit or tag object!" % (clone_config.object_id,))
+                # The requested object_id exists and is a tag or commit. We can use it!
+                object_id = clone_config.object_id.encode("ascii")
         else:
-            url_tmp = url
-
-        with chdir(cwd_to_cache_relpath):
-            # There are three cases:
-            #   - full clone + with object id
-            #   - full clone + without object id
-            #   - fetch + with ref
-            if clone_config.full_clone:
-                # We have to fetch all remote refs (heads and tags), because we
-                # don't know in which refs the commit/tag(=object id) exists.
-                object_id = git_fetch(url_tmp, '*:*')
-
-                if clone_config.object_id is not None:
-                    if not git_verify(clone_config.object_id):
-                        raise AppException(ErrorCode.INVALID_ARGUMENT,
-                                           "Object id '%s' does not point to a valid object!" % (clone_config.object_id,))
+            # TODO Rework DownloadConfig to avoid extra asser here
+            assert clone_config.ref is not None
+            remote_object_id = clone_config.remote_object_id
+            if remote_object_id is not None and self.has_commit(cache_abspath, remote_object_id):
+                # The object was already fetched into the persistent cache
+                # earlier. E.g. by another subproject with the same upstream.
+                object_id = remote_object_id
+            else:
+                object_id = git_fetch(url, clone_config.ref, cwd=cache_abspath, depth=depth, filter=filter)
 
-                    object_type = git_get_object_type(clone_config.object_id)
-                    if object_type not in (ObjectType.COMMIT, ObjectType.TAG):
+        # The cache may be a partial clone. Either by this fetch or by an
+        # earlier fetch for a subproject with a subdirectory. Then fetch the
+        # missing blobs that are needed for the extraction in one go.
+        if git_has_promisor_packs(cache_abspath):
+            tree_id = self.get_tree_id(cache_abspath, object_id, download_config.subdir)
+            missing_object_ids = git_rev_list_missing(tree_id, cwd=cache_abspath)
+            if len(missing_object_ids) > 0:
+                git_fetch_missing_objects(PROMISOR_REMOTE_NAME, missing_object_ids, cwd=cache_abspath)
+
+        return object_id
+
+    # Imports the objects of the bundle into the cache. Nothing is fetched from
+    # the remote repository. So this works offline.
+    def fetch_from_bundle(self, cache_abspath: bytes, bundle_path: bytes, clone_config: CloneConfig) -> bytes:
+        assert clone_config.remote_object_id is not None
+        object_id = clone_config.remote_object_id
+
+        if not self.has_commit(cache_abspath, object_id):
+            refs_sha1 = git_bundle_unbundle(bundle_path, cwd=cache_abspath)
+            # The bundle may be exported from a shallow cache. Then the
+            # parents of the commits are missing and git must not look for
+            # them.
+            for ref_object_id in set(refs_sha1.values()):
+                commit_id = git_get_sha1(ref_object_id + b"^{commit}", cwd=cache_abspath)
+                parents = git_get_commit_parents(commit_id, cwd=cache_abspath)
+                if any(not git_commit_exists_locally(parent, cwd=cache_abspath) for parent in parents):
+                    git_mark_shallow(cache_abspath, commit_id)
+
+            if not git_commit_exists_locally(object_id, cwd=cache_abspath):
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "Object id '%s' is not contained in the bundle!" % (object_id.decode("ascii"),))
+
+        object_type = git_get_object_type(object_id, cwd=cache_abspath)
+        if object_type not in (ObjectType.COMMIT, ObjectType.TAG):
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "Object id '%s' does not point to a commit or tag object!" % (object_id.decode("ascii"),))
+        return object_id
+
+    # Writes a bundle file that contains the revision 'object_id'. The bundle
+    # can be used with fetch() on a machine without access to the remote
+    # repository. The name of the ref in the bundle is derived from the
+    # 'revision'. So it can be resolved with the same revision later.
+    # NOTE: If the cache is shallow, the bundle contains only the objects of
+    # the revision and not its history.
+    def export_bundle(self, cache_abspath: bytes, bundle_path: bytes, revision: str | None, object_id: bytes) -> None:
+        if revision is None:
+            ref = b"HEAD"
+        elif is_sha1(revision.encode("utf8")):
+            ref = b"refs/subpatch/" + object_id
+        elif revision.startswith("refs/"):
+            ref = revision.encode("utf8")
+        elif git_get_object_type(object_id, cwd=cache_abspath) == ObjectType.TAG:
+            ref = b"refs/tags/" + revision.encode("utf8")
+        else:
+            ref = b"refs/heads/" + revision.encode("utf8")
+
+        # In a partial clone the objects outside of the subdirectory are
+        # missing. They are not needed for the subproject.
+        git_bundle_create(bundle_path, [(ref, object_id)], cwd=cache_abspath,
+                          allow_missing=git_has_promisor_packs(cache_abspath))
+
+    # We have to fetch all remote refs (heads and tags), because we don't know
+    # in which refs the commit/tag(=object id) exists.
+    def fetch_all_refs(self, url: str, cache_abspath: bytes, depth: int | None, filter: bytes | None) -> bytes:
+        # NOTE: Use '+' to force the update of the refs. The cache is
+        # persistent and the remote refs can be rewritten since the last
+        # fetch.
+        return git_fetch(url, '+*:*', cwd=cache_abspath, depth=depth, filter=filter)
+
+    # Returns True if the commit or tag exists in the cache.
+    # NOTE: In a partial clone git would fetch a missing commit lazily with
+    # its whole history. So use a check without a lazy fetch.
+    def has_commit(self, cache_abspath: bytes, object_id: bytes) -> bool:
+        if git_has_promisor_packs(cache_abspath):
+            return git_commit_exists_locally(object_id, cwd=cache_abspath)
+        return git_verify(object_id, cwd=cache_abspath)
+
+    # Returns False if objects of the revision are missing in the cache. Only a
+    # cache with an alternate is checked. A partial clone fetches the missing
+    # objects from the promisor remote anyway.
+    def has_all_objects(self, cache_abspath: bytes, object_id: bytes) -> bool:
+        if not git_has_alternates(cache_abspath) or git_has_promisor_packs(cache_abspath):
+            return True
+        try:
+            return len(git_rev_list_missing(object_id + b"^{tree}", cwd=cache_abspath)) == 0
+        except GitError:
+            # E.g. the tree object itself is missing
+            return False
+
+    # Packs the objects of the cache, if there are too many loose objects or
+    # packs. Old objects that are not referenced anymore are pruned.
+    def compact(self, cache_abspath: bytes) -> None:
+        git_gc_auto(cwd=cache_abspath)
+
+    # Make the objects of the superproject available in the cache. See
+    # DownloadConfig.integrated_object_id.
+    # NOTE: The path is stored relative to the cache. So the superproject can
+    # be moved.
+    # NOTE: The cache depends on the objects of the superproject now. Nothing
+    # in the superproject keeps them alive. "git gc" in the superproject can
+    # remove them, e.g. after a rewrite of the history. Then fetch() detects
+    # the missing objects and creates the cache again.
+    def use_superproject_objects(self, cache_abspath: bytes, super_objects_abspath: bytes) -> None:
+        git_add_alternate(cache_abspath, os.path.relpath(super_objects_abspath, join(cache_abspath, b"objects")))
+
+    # Configures the remote repository as the promisor remote of a partial
+    # clone. Returns the name of the remote.
+    # NOTE: The name of the remote cannot be the URL itself. git cannot use
+    # local paths as names of promisor remotes.
+    def configure_promisor_remote(self, url: str, cache_abspath: bytes) -> str:
+        if git_config_get("remote.%s.url" % (PROMISOR_REMOTE_NAME,), cwd=cache_abspath) != url.encode("utf8"):
+            git_config_set("core.repositoryformatversion", b"1", cwd=cache_abspath)
+            git_config_set("extensions.partialClone", PROMISOR_REMOTE_NAME.encode("ascii"), cwd=cache_abspath)
+            git_config_set("remote.%s.url" % (PROMISOR_REMOTE_NAME,), url.encode("utf8"), cwd=cache_abspath)
+            git_config_set("remote.%s.promisor" % (PROMISOR_REMOTE_NAME,), b"true", cwd=cache_abspath)
+        return PROMISOR_REMOTE_NAME
+
+    # Returns the capabilities of the remote repository that worked for the
+    # last fetch. They are stored in the config of the cache repository as the
+    # value of 'subpatch.transport', e.g. "shallow fetch-by-object-id". For a
+    # new cache and with '--refresh' all capabilities are tried again.
+    def get_transport_info(self, cache_abspath: bytes) -> TransportInfo:
+        value = git_config_get("subpatch.transport", cwd=cache_abspath)
+        if value is None or self._refresh:
+            return TransportInfo(shallow=True, fetch_by_object_id=True, filter=True)
+
+        flags = value.split(b" ")
+        return TransportInfo(shallow=b"shallow" in flags, fetch_by_object_id=b"fetch-by-object-id" in flags,
+                             filter=b"filter" in flags)
+
+    def set_transport_info(self, cache_abspath: bytes, transport: TransportInfo) -> None:
+        flags = []
+        if transport.shallow:
+            flags.append(b"shallow")
+        if transport.fetch_by_object_id:
+            flags.append(b"fetch-by-object-id")
+        if transport.filter:
+            flags.append(b"filter")
+        git_config_set("subpatch.transport", b" ".join(flags), cwd=cache_abspath)
+
+    # Returns the object id of the tree of 'object_id' or of its subdirectory
+    # 'subdir'.
+    def get_tree_id(self, cache_abspath: bytes, object_id: bytes, subdir: bytes | None) -> bytes:
+        if subdir is None:
+            return git_get_sha1(object_id + b"^{tree}", cwd=cache_abspath)
+
+        info = git_get_object_reader(cache_abspath).info(object_id + b":" + subdir)
+        if info is None or info.object_type != ObjectType.TREE:
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "The subdirectory '%s' does not exist in the upstream revision!" % (subdir.decode("utf8"),))
+        return info.object_id
+
+    # Extracts all files of 'object_id' into the object store of the
+    # superproject. Returns the object id of the tree object that contains the
+    # files. The files are not checked out and the tree is not staged. If
+    # 'subdir' is given, only the files of this subdirectory are extracted.
+    # NOTE: Only the tree is imported, not the commit. The cache is a shallow
+    # repository and the superproject should not become one.
+    def extract(self, cache_abspath: bytes, object_id: bytes, super_abspath: bytes,
+                subdir: bytes | None = None) -> bytes:
+        tree_id = self.get_tree_id(cache_abspath, object_id, subdir)
+
+        git_fetch_objects(cache_abspath, [tree_id], cwd=super_abspath)
+
+        # The submodules of the upstream are not integrated. The superproject
+        # has no ".gitmodules" entries for them. So a gitlink in the index
+        # would be broken.
+        writer = GitObjectWriter(cwd=super_abspath)
+        stripped_tree_id = tree_remove_gitlinks(git_get_object_reader(super_abspath), writer, tree_id)
+        if stripped_tree_id is None:
+            stripped_tree_id = writer.add(ObjectType.TREE, b"")
+        writer.flush()
+        return stripped_tree_id
+
+
+# Returns the cache helper for an existing cache directory
+def get_cache_helper_for_cache(cache_abspath: bytes) -> "CacheHelperGit | CacheHelperArchive":
+    if CacheHelperArchive().isCreated(cache_abspath):
+        return CacheHelperArchive()
+    return CacheHelperGit()
+
+
+# File name suffixes of the supported archive types. Longer suffixes first,
+# because ".tar.gz" also ends with ".gz".
+ARCHIVE_SUFFIXES = (".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2", ".tar", ".zip")
+
+
+# Returns the archive suffix of the URL, e.g. ".tar.gz", or None if the URL
+# does not point to an archive.
+def get_archive_suffix(url: str) -> str | None:
+    for suffix in ARCHIVE_SUFFIXES:
+        if url.endswith(suffix):
+            return suffix
+    return None
+
+
+# Returns the cache helper for the type of the upstream URL. For now there are
+# only git repositories and archives.
+def get_cache_helper(url: str, refs_cache: RefsCache | None = None,
+                     refresh: bool = False) -> "CacheHelperGit | CacheHelperArchive":
+    if get_archive_suffix(url) is not None:
+        return CacheHelperArchive()
+    return CacheHelperGit(refs_cache, refresh)
+
+
+# Writes the blobs in batches. So the memory usage is bounded for big
+# archives.
+ARCHIVE_FLUSH_SIZE = 64 * 1024 * 1024
+
+
+# Cache for upstream projects that are released as archives, e.g. tarballs.
+# The cache contains the downloaded archive files. The object id of a
+# revision is the SHA-256 checksum of the archive file. A revision can be
+# given to pin the checksum. Then a changed archive is an error.
+class CacheHelperArchive:
+    def get_revision_as_str(self, revision: str | None) -> str:
+        if revision is None:
+            return "latest"
+        return revision
+
+    def create(self, cache_abspath: bytes) -> None:
+        assert os.path.isdir(cache_abspath)
+        os.makedirs(join(cache_abspath, b"archives"), exist_ok=True)
+
+    def isCreated(self, cache_abspath: bytes) -> bool:
+        return os.path.isdir(join(cache_abspath, b"archives"))
+
+    # The objects of the superproject are not useful for archives
+    def use_superproject_objects(self, cache_abspath: bytes, super_objects_abspath: bytes) -> None:
+        pass
+
+    # The archives are already compressed
+    def compact(self, cache_abspath: bytes) -> None:
+        pass
+
+    # Without a download the checksum is only known if it's pinned by the
+    # revision.
+    def resolve(self, download_config: DownloadConfig) -> CloneConfig:
+        revision = download_config.revision
+        if revision is None:
+            return CloneConfig(full_clone=True)
+        if not is_sha256(revision.encode("utf8")):
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "The revision of an archive must be its SHA-256 checksum, but it's '%s'!" % (revision,))
+        return CloneConfig(full_clone=True, object_id=revision, remote_object_id=revision.encode("ascii"))
+
+    def fetch(self, cache_abspath: bytes, download_config: DownloadConfig,
+              clone_config: CloneConfig | None = None) -> bytes:
+        if download_config.bundle_path is not None:
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "Bundles can only be used for git repositories!")
+
+        if clone_config is None:
+            clone_config = self.resolve(download_config)
+
+        assert os.path.isabs(cache_abspath)
+
+        expected_object_id = clone_config.remote_object_id
+        if expected_object_id is not None and self.get_archive_path(cache_abspath, expected_object_id) is not None:
+            return expected_object_id
+
+        url = download_config.url
+        suffix = get_archive_suffix(url)
+        assert suffix is not None
+
+        # Hash the archive while downloading it. Write it to a temporary file
+        # first. So the cache never contains a partial archive.
+        h = hashlib.sha256()
+        tmp_path = join(cache_abspath, b"archives", b"download.tmp%d" % (os.getpid(),))
+        try:
+            with self.open_url(url) as src, open(tmp_path, "wb") as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if len(chunk) == 0:
+                        break
+                    h.update(chunk)
+                    dst.write(chunk)
+            object_id = h.hexdigest().encode("ascii")
+            if expected_object_id is not None and object_id != expected_object_id:
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "The checksum of the archive is '%s', but '%s' is expected!" %
+                                   (object_id.decode("ascii"), expected_object_id.decode("ascii")))
+            os.replace(tmp_path, join(cache_abspath, b"archives", object_id + suffix.encode("ascii")))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        return object_id
+
+    # Opens a local file or a HTTP(S) URL for reading
+    def open_url(self, url: str):
+        try:
+            if get_url_type(url) == URLTypes.REMOTE:
+                if not url.startswith(("http://", "https://")):
+                    raise AppException(ErrorCode.NOT_IMPLEMENTED_YET,
+                                       "Archives can only be downloaded with HTTP or HTTPS!")
+                return urllib.request.urlopen(url)
+            return open(url, "rb")
+        except (OSError, urllib.error.URLError) as e:
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "Cannot download the archive '%s': %s" % (url, e))
+
+    # Returns the path of the archive in the cache or None if it's not
+    # downloaded yet.
+    def get_archive_path(self, cache_abspath: bytes, object_id: bytes) -> bytes | None:
+        for suffix in ARCHIVE_SUFFIXES:
+            path = join(cache_abspath, b"archives", object_id + suffix.encode("ascii"))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    # Streams the files of the archive into the object store of the
+    # superproject. The archive is not extracted to the filesystem. Returns the
+    # object id of the tree object that contains the files.
+    # NOTE: If all files are in a single toplevel directory, e.g.
+    # "project-1.0/", this directory is stripped. That is the common layout of
+    # release tarballs.
+    def extract(self, cache_abspath: bytes, object_id: bytes, super_abspath: bytes,
+                subdir: bytes | None = None) -> bytes:
+        archive_path = self.get_archive_path(cache_abspath, object_id)
+        if archive_path is None:
+            raise AppException(ErrorCode.INVALID_STATE,
+                               "The archive '%s' is not in the cache!" % (object_id.decode("ascii"),))
+
+        writer = GitObjectWriter(cwd=super_abspath)
+        if archive_path.endswith(b".zip"):
+            files = self.read_zip(archive_path, writer)
+        else:
+            files = self.read_tar(archive_path, writer)
+
+        toplevel_names = set(path.split(b"/", 1)[0] for path in files)
+        if len(toplevel_names) == 1 and all(b"/" in path for path in files):
+            files = {path.split(b"/", 1)[1]: entry for path, entry in files.items()}
+
+        if subdir is not None:
+            prefix = subdir + b"/"
+            files = {path[len(prefix):]: entry for path, entry in files.items() if path.startswith(prefix)}
+            if len(files) == 0:
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "The subdirectory '%s' does not exist in the upstream revision!" % (subdir.decode("utf8"),))
+
+        tree_id = self.write_tree(files, writer)
+        writer.flush()
+        return tree_id
+
+    # Returns a dict from the path of every file to a tuple (mode, blob id).
+    # The blobs are added to the 'writer'.
+    def read_tar(self, archive_path: bytes, writer: GitObjectWriter) -> dict[bytes, tuple[bytes, bytes]]:
+        files: dict[bytes, tuple[bytes, bytes]] = {}
+        pending_size = 0
+        # NOTE: The mode "r|*" reads the archive as a stream. The compression
+        # is detected automatically.
+        with tarfile.open(os.fsdecode(archive_path), mode="r|*") as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                path = check_and_normalize_archive_path(member.name)
+                if member.issym():
+                    files[path] = (b"120000", writer.add(ObjectType.BLOB, os.fsencode(member.linkname)))
+                elif member.islnk():
+                    # A hard link points to a file that is earlier in the archive
+                    target = check_and_normalize_archive_path(member.linkname)
+                    if target not in files:
                         raise AppException(ErrorCode.INVALID_ARGUMENT,
-                                           "Object id '%s' does not point to a commit or tag object!" % (clone_config.object_id,))
-                    # The requested object_id exists and is a tag or commit. We can use it!
-                    object_id = clone_config.object_id.encode("ascii")
+                                           "The archive contains an invalid link '%s'!" % (member.name,))
+                    files[path] = files[target]
+                elif member.isfile():
+                    f = tar.extractfile(member)
+                    assert f is not None
+                    data = f.read()
+                    mode = b"100755" if member.mode & 0o111 else b"100644"
+                    files[path] = (mode, writer.add(ObjectType.BLOB, data))
+                    pending_size += len(data)
+                # Other types, e.g. device files, cannot be stored in git.
+
+                if pending_size >= ARCHIVE_FLUSH_SIZE:
+                    writer.flush()
+                    pending_size = 0
+        return files
+
+    def read_zip(self, archive_path: bytes, writer: GitObjectWriter) -> dict[bytes, tuple[bytes, bytes]]:
+        files: dict[bytes, tuple[bytes, bytes]] = {}
+        pending_size = 0
+        with zipfile.ZipFile(os.fsdecode(archive_path)) as zip_file:
+            for info in zip_file.infolist():
+                if info.is_dir():
+                    continue
+                path = check_and_normalize_archive_path(info.filename)
+                data = zip_file.read(info)
+                # The upper 16 bits contain the unix mode, if the archive was
+                # created on a unix system.
+                unix_mode = info.external_attr >> 16
+                if stat.S_ISLNK(unix_mode):
+                    mode = b"120000"
+                elif unix_mode & 0o111:
+                    mode = b"100755"
+                else:
+                    mode = b"100644"
+                files[path] = (mode, writer.add(ObjectType.BLOB, data))
+                pending_size += len(data)
+
+                if pending_size >= ARCHIVE_FLUSH_SIZE:
+                    writer.flush()
+                    pending_size = 0
+        return files
+
+    # Adds the tree objects for the files to the 'writer'. Returns the object
+    # id of the toplevel tree.
+    def write_tree(self, files: dict[bytes, tuple[bytes, bytes]], writer: GitObjectWriter) -> bytes:
+        entries = []
+        subdirs: dict[bytes, dict[bytes, tuple[bytes, bytes]]] = {}
+        for path, (mode, blob_id) in files.items():
+            name, sep, rest = path.partition(b"/")
+            if sep == b"":
+                entries.append(TreeEntry(mode, ObjectType.BLOB, blob_id, name))
             else:
-                # TODO Rework DownloadConfig to avoid extra asser here
-                assert clone_config.ref is not None
-                object_id = git_fetch(url_tmp, clone_config.ref)
+                subdirs.setdefault(name, {})[rest] = (mode, blob_id)
+
+        for name, subdir_files in subdirs.items():
+            if name in files:
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "The archive contains '%s' as a file and a directory!" % (name.decode("utf8"),))
+            entries.append(TreeEntry(b"40000", ObjectType.TREE, self.write_tree(subdir_files, writer), name))
+
+        return writer.add(ObjectType.TREE, serialize_tree_object(sort_tree_entries(entries)))
+
+
+def is_sha256(checksum: bytes) -> bool:
+    return len(checksum) == 64 and all(c in b"0123456789abcdef" for c in checksum)
 
-        return object_id
 
-    # Extracts all files into the folder "dest_relpath" inside the cache.
-    def extract(self, cwd_to_cache_relpath: bytes, object_id: bytes, dest_relpath: bytes) -> bytes:
-        # TODO clean this up! and add tests!
-        # For now very ugly and just get it done
-        with chdir(cwd_to_cache_relpath):
-            p = Popen(["git", "worktree", "add", "-q", "--detach", dest_relpath, object_id], stdout=DEVNULL)
-            p.communicate()
-            if p.returncode != 0:
-                raise Exception("error here")
-
-            # Very ugly. Afterwards the repo is in a invalid state. The work
-            # tree is broken! Only works because the cache is removed anyway
-            # afterwards!
-            with chdir(dest_relpath):
-                # Remove the link to the git directory, to make the directory a clean checkout!
-                assert os.path.isfile(".git")
-                os.remove(".git")
+# Paths in archives must be relative and must not leave the subproject.
+# Returns the normalized path, e.g. without "./".
+def check_and_normalize_archive_path(name: str) -> bytes:
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if name.startswith("/") or ".." in parts or len(parts) == 0 or ".git" in parts:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "The archive contains an invalid path '%s'!" % (name,))
+    return "/".join(parts).encode("utf8")
@@ -1,3 +1,5 @@
+import bisect
+import re
 from collections.abc import Generator
 from dataclasses import dataclass
 from enum import Enum
@@ -20,7 +22,9 @@ def split_with_ts(s):
         pos = new_pos + 1
 
 
-def split_with_ts_bytes(s: bytes) -> Generator[bytes, None, None]:
+# Same as split_with_ts_bytes(), but yields the tuple (offset, length) of
+# every line instead of copying the line into a new bytes object.
+def split_with_ts_offsets(s: bytes) -> Generator[tuple[int, int], None, None]:
     len_s = len(s)
     pos = 0
     while pos < len_s:
@@ -28,10 +32,15 @@ def split_with_ts_bytes(s: bytes) -> Generator[bytes, None, None]:
         if new_pos == -1:
             # newline character not found anymore
             new_pos = len_s - 1
-        yield s[pos:new_pos + 1]
+        yield pos, new_pos + 1 - pos
         pos = new_pos + 1
 
 
+def split_with_ts_bytes(s: bytes) -> Generator[bytes, None, None]:
+    for offset, length in split_with_ts_offsets(s):
+        yield s[offset:offset + length]
+
+
 class LineType(Enum):
     EMPTY = 1
     COMMENT = 2
@@ -71,6 +80,34 @@ class ConfigLine:
 GeneratorConfigLine: TypeAlias = Generator[ConfigLine, None, None]
 
 
+# Same as the whitespace characters of bytes.lstrip()
+_whitespace_re = re.compile(b"[ \t\n\r\x0b\x0c]*")
+
+
+# Returns the type of the line data[offset:end] without copying the line
+def config_get_line_type(data: bytes, offset: int, end: int) -> LineType:
+    match = _whitespace_re.match(data, offset, end)
+    assert match is not None
+    pos = match.end()
+    if pos == end:
+        return LineType.EMPTY
+    first_char = data[pos]
+    if first_char in (ord(b'#'), ord(b';')):
+        return LineType.COMMENT
+    elif first_char == ord(b'['):
+        return LineType.HEADER
+    # This is mostly a variable line
+    return LineType.KEY_VALUE
+
+
+# Scan the config file in 'data' and yield the tuple (offset, length,
+# line_type) for every line. The lines are not copied. Use
+# config_parse_line() to parse only the lines that are interesting.
+def config_scan(data: bytes) -> Generator[tuple[int, int, LineType], None, None]:
+    for offset, length in split_with_ts_offsets(data):
+        yield offset, length, config_get_line_type(data, offset, offset + length)
+
+
 # config format of git is descriped here
 #   https://git-scm.com/docs/git-config#_configuration_file
 #
@@ -87,41 +124,42 @@ GeneratorConfigLine: TypeAlias = Generator[ConfigLine, None, None]
 #   Only the last line may not have a trailing "\n" character.
 # TODO add errors on invalid syntax
 def config_parse2(lines: Generator[bytes, None, None]) -> GeneratorConfigLine:
-    def get_first(b: bytes) -> int | None:
-        if len(b) == 0:
-            return None
-        return b[0]
-
     for line in lines:
-        first_char = get_first(line.lstrip())
-        if first_char is None:
-            # It's an empty line
-            yield ConfigLine(line, LineType.EMPTY, LineDataEmpty())
+        yield config_parse_line(line, config_get_line_type(line, 0, len(line)))
+
+
+def config_parse_line(line: bytes, line_type: LineType) -> ConfigLine:
+    if line_type == LineType.HEADER:
+        # section start, like: "[section]\n"
+        # Parse section name
+        # TODO Check for valid section characters
+        inner_part = line.split(b'[', 1)[1].split(b']')[0]
+        if ord(b'"') in inner_part:
+            # There is a subsection:
+            #     [section  "subsection"]
+            section_name = inner_part.split(b'"')[0].strip()
+            subsection_name = inner_part.split(b'"', 2)[1]
         else:
-            if first_char in (ord(b'#'), ord(b';')):
-                yield ConfigLine(line, LineType.COMMENT, LineDataEmpty())
-            elif first_char == ord(b'['):
-                # section start, like: "[section]\n"
-                # Parse section name
-                # TODO Check for valid section characters
-                inner_part = line.split(b'[', 1)[1].split(b']')[0]
-                if ord(b'"') in inner_part:
-                    # There is a subsection:
-                    #     [section  "subsection"]
-                    section_name = inner_part.split(b'"')[0].strip()
-                    subsection_name = inner_part.split(b'"', 2)[1]
-                else:
-                    section_name = inner_part
-                    subsection_name = None
+            section_name = inner_part
+            subsection_name = None
 
-                yield ConfigLine(line, LineType.HEADER, LineDataHeader(section_name, subsection_name))
-            else:
-                # This is mostly a variable line
-                #     key = value
-                parts = line.split(b"=", 1)
-                key = parts[0].strip()
-                value = parts[1].strip()
-                yield ConfigLine(line, LineType.KEY_VALUE, LineDataKeyValue(key, value))
+        return ConfigLine(line, LineType.HEADER, LineDataHeader(section_name, subsection_name))
+    elif line_type == LineType.KEY_VALUE:
+        #     key = value
+        parts = line.split(b"=", 1)
+        key = parts[0].strip()
+        value = parts[1].strip()
+        return ConfigLine(line, LineType.KEY_VALUE, LineDataKeyValue(key, value))
+
+    return ConfigLine(line, line_type, LineDataEmpty())
+
+
+# Same as config_parse2(), but only yields the header and key value lines.
+# Empty and comment lines are skipped without copying them.
+def config_parse_sections_and_keys(data: bytes) -> GeneratorConfigLine:
+    for offset, length, line_type in config_scan(data):
+        if line_type in (LineType.HEADER, LineType.KEY_VALUE):
+            yield config_parse_line(data[offset:offset + length], line_type)
 
 
 # Small hepler to get type rights for pyright
@@ -131,12 +169,9 @@ def empty_config_lines() -> GeneratorConfigLine:
 
 
 def config_unparse2(config_lines: GeneratorConfigLine) -> bytes:
-    s = b""
-    for config_line in config_lines:
-        # TODO: This is really strange here. The data structure ConfigLine contains
-        # redundant information
-        s += config_line.line_orig
-    return s
+    # TODO: This is really strange here. The data structure ConfigLine contains
+    # redundant information
+    return b"".join(config_line.line_orig for config_line in config_lines)
 
 
 # TODO add support for subsection
@@ -298,3 +333,194 @@ def config_add_section2(config_lines: GeneratorConfigLine, section_name: bytes)
             yield config_line
 
     yield from emit()
+
+
+# A section in a ConfigDocument: The header line and all following lines up to
+# the next header. The lines before the first header are in a section without
+# a header.
+# Every key value line is stored as an entry together with the following
+# other lines, e.g. comments, up to the next key value line. The tuples (key,
+# value) of the entries are kept in a separate list. If the entries are
+# sorted, like in files that subpatch writes, the list is searched with
+# bisect. Otherwise, e.g. for files written by hand, the list is searched
+# linearly.
+class ConfigSection:
+    def __init__(self, header: ConfigLine | None):
+        self.header = header
+        # The lines before the first key value line
+        self._leading_lines: list[ConfigLine] = []
+        self._entries: list[list[ConfigLine]] = []
+        self._sort_keys: list[tuple[bytes, bytes]] = []
+        self._is_sorted = True
+
+    # Only used while parsing
+    def append_line(self, config_line: ConfigLine) -> None:
+        if config_line.line_type == LineType.KEY_VALUE:
+            line_data = config_line.line_data
+            assert isinstance(line_data, LineDataKeyValue)
+            sort_key = (line_data.key, line_data.value)
+            if len(self._sort_keys) > 0 and self._sort_keys[-1] > sort_key:
+                self._is_sorted = False
+            self._entries.append([config_line])
+            self._sort_keys.append(sort_key)
+        elif len(self._entries) > 0:
+            self._entries[-1].append(config_line)
+        else:
+            self._leading_lines.append(config_line)
+
+    def is_empty(self) -> bool:
+        return len(self._entries) == 0
+
+    # Returns the indexes of the entries with the key
+    def find_key(self, key: bytes) -> list[int]:
+        if self._is_sorted:
+            start = bisect.bisect_left(self._sort_keys, key, key=lambda sort_key: sort_key[0])
+            end = bisect.bisect_right(self._sort_keys, key, lo=start, key=lambda sort_key: sort_key[0])
+            return list(range(start, end))
+        return [i for i, (other_key, _) in enumerate(self._sort_keys) if other_key == key]
+
+    def get_value(self, index: int) -> bytes:
+        return self._sort_keys[index][1]
+
+    # Insert before the first bigger key or bigger value of the same key.
+    # Otherwise at the end of the section.
+    def insert(self, key: bytes, value: bytes, config_line: ConfigLine) -> None:
+        if self._is_sorted:
+            index = bisect.bisect_right(self._sort_keys, (key, value))
+        else:
+            index = len(self._sort_keys)
+            for i, (other_key, other_value) in enumerate(self._sort_keys):
+                if other_key > key or (other_key == key and other_value > value):
+                    index = i
+                    break
+        self._entries.insert(index, [config_line])
+        self._sort_keys.insert(index, (key, value))
+
+    # The caller must keep the order of the entries. So the value can only be
+    # replaced if it's the only entry of the key.
+    def replace(self, index: int, key: bytes, value: bytes, config_line: ConfigLine) -> None:
+        self._entries[index][0] = config_line
+        self._sort_keys[index] = (key, value)
+
+    # The other lines of a dropped entry are kept. They are moved to the
+    # previous entry.
+    def drop(self, indexes: list[int]) -> None:
+        for index in sorted(indexes, reverse=True):
+            other_lines = self._entries[index][1:]
+            del self._entries[index]
+            del self._sort_keys[index]
+            if index > 0:
+                self._entries[index - 1].extend(other_lines)
+            else:
+                self._leading_lines.extend(other_lines)
+
+    def config_lines(self) -> GeneratorConfigLine:
+        if self.header is not None:
+            yield self.header
+        yield from self._leading_lines
+        for entry in self._entries:
+            yield from entry
+
+
+# Parsed config file for multiple modifications. Unlike the generator
+# functions above, the file is parsed once into sections and there is an
+# index from the section name to the sections. Inside a section the keys are
+# found with bisect. See ConfigSection. So every modification only touches a
+# single section and the file is serialized once with unparse().
+# NOTE: The modifications have the same semantics as the generator functions
+# with two exceptions: An existing key is replaced at its position. And a
+# value is appended after all equal values.
+# TODO add support for subsection
+class ConfigDocument:
+    def __init__(self, data: bytes = b""):
+        self._sections = [ConfigSection(None)]
+        for config_line in config_parse2(split_with_ts_bytes(data)):
+            if config_line.line_type == LineType.HEADER:
+                self._sections.append(ConfigSection(config_line))
+            else:
+                self._sections[-1].append_line(config_line)
+        self._rebuild_section_index()
+
+    def _rebuild_section_index(self) -> None:
+        self._section_index: dict[bytes, list[ConfigSection]] = {}
+        for section in self._sections:
+            if section.header is None:
+                continue
+            line_data = section.header.line_data
+            assert isinstance(line_data, LineDataHeader)
+            if line_data.subsection_name is None:
+                self._section_index.setdefault(line_data.section_name, []).append(section)
+
+    def has_section(self, section_name: bytes) -> bool:
+        return section_name in self._section_index
+
+    def get_values(self, section_name: bytes, key: bytes) -> list[bytes]:
+        values = []
+        for section in self._section_index.get(section_name, []):
+            values.extend(section.get_value(index) for index in section.find_key(key))
+        return values
+
+    # Same as config_add_section2()
+    def add_section(self, section_name: bytes) -> None:
+        if section_name in self._section_index:
+            return
+
+        section = ConfigSection(ConfigLine(b"[%s]\n" % (section_name,), LineType.HEADER,
+                                           LineDataHeader(section_name, None)))
+        # Keep the sections sorted. Insert before the first bigger section.
+        pos = len(self._sections)
+        for i, other in enumerate(self._sections):
+            if other.header is None:
+                continue
+            line_data = other.header.line_data
+            assert isinstance(line_data, LineDataHeader)
+            if line_data.section_name > section_name and line_data.subsection_name is None:
+                pos = i
+                break
+        self._sections.insert(pos, section)
+        self._section_index[section_name] = [section]
+
+    # Same as config_set_key_value2(). The section must exist.
+    def set_key_value(self, section_name: bytes, key: bytes, value: bytes, append: bool = False) -> None:
+        sections = self._section_index.get(section_name)
+        if sections is None:
+            raise Exception("Error: No section with name '%s' found!" % (section_name.decode("utf8"),))
+
+        # TODO sanitize 'key' and 'value'
+        config_line = ConfigLine(b"\t%s = %s\n" % (key, value), LineType.KEY_VALUE, LineDataKeyValue(key, value))
+        section = sections[0]
+
+        if not append:
+            # Replace the first line of the key and drop all other lines of
+            # the key
+            for other in sections[1:]:
+                other.drop(other.find_key(key))
+            indexes = section.find_key(key)
+            if len(indexes) > 0:
+                section.drop(indexes[1:])
+                section.replace(indexes[0], key, value, config_line)
+                return
+
+        section.insert(key, value, config_line)
+
+    # Same as config_drop_key2()
+    def drop_key(self, section_name: bytes, key: bytes) -> None:
+        for section in self._section_index.get(section_name, []):
+            section.drop(section.find_key(key))
+
+    # Same as config_drop_section_if_empty(). Only the header line is dropped.
+    # Other lines, e.g. comments, are kept.
+    def drop_section_if_empty(self, section_name: bytes) -> None:
+        sections = self._section_index.get(section_name, [])
+        for section in sections:
+            if section.is_empty():
+                section.header = None
+        if any(section.header is None for section in sections):
+            self._rebuild_section_index()
+
+    def config_lines(self) -> GeneratorConfigLine:
+        for section in self._sections:
+            yield from section.config_lines()
+
+    def unparse(self) -> bytes:
+        return b"".join(config_line.line_orig for config_line in self.config_lines())
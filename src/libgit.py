@@ -1,4 +1,12 @@
+import atexit
+import hashlib
+import struct
+import threading
+import zlib
+from bisect import bisect_left
+from dataclasses import dataclass, replace
 from enum import Enum
+from os.path import abspath, join
 from subprocess import PIPE
 # ----8<----
 import os
@@ -17,6 +25,14 @@ from subprocess import Popen, DEVNULL
 #     E.g. a <sha1>, "HEAD", "x..y" or "main:file"
 
 
+# Raised if a git command fails, i.e. it exits with a non-zero status. If the
+# error output of git is captured, it's in 'stderr'.
+class GitError(Exception):
+    def __init__(self, message: str, stderr: bytes = b""):
+        super().__init__(message)
+        self.stderr = stderr
+
+
 def git_add(args):
     assert len(args) >= 1
     # NOTE: use "-f" here otherwise git honors ignored files and does not add
@@ -25,7 +41,7 @@ def git_add(args):
     p = Popen(["git", "add", "-f"] + args)
     p.communicate()
     if p.returncode != 0:
-        raise Exception("git failure")
+        raise GitError("git failure")
 
 
 # TODO make staged an argument!
@@ -33,7 +49,7 @@ def git_diff_staged_shortstat() -> bytes:
     p = Popen(["git", "diff", "--staged", "--shortstat"], stdout=PIPE)
     stdout, _ = p.communicate()
     if p.returncode != 0:
-        raise Exception("git failure")
+        raise GitError("git failure")
 
     return stdout.rstrip(b"\n")
 
@@ -46,7 +62,7 @@ def git_diff_relative(staged=False) -> bytes:
     p = Popen(cmd, stdout=PIPE)
     stdout, _ = p.communicate()
     if p.returncode != 0:
-        raise Exception("git failure")
+        raise GitError("git failure")
 
     return stdout
 
@@ -62,25 +78,257 @@ class ObjectType(Enum):
     TAG = b"tag"
 
 
+@dataclass(frozen=True)
+class ObjectInfo:
+    object_id: bytes
+    object_type: ObjectType
+    size: int
+
+
+@dataclass(frozen=True)
+class TreeEntry:
+    mode: bytes
+    object_type: ObjectType
+    object_id: bytes
+    name: bytes
+
+
+# The binary format of a tree object is a list of entries without any
+# separation character. Every entry looks like
+#    <mode in octal> <one space> <filename> <NULL byte> <SHA1 as 20 bytes>
+def parse_tree_object(tree_data: bytes) -> list[TreeEntry]:
+    entries = []
+    pos = 0
+    while pos < len(tree_data):
+        space = tree_data.index(b" ", pos)
+        null = tree_data.index(b"\0", space)
+        mode = tree_data[pos:space]
+        name = tree_data[space + 1:null]
+        object_id = tree_data[null + 1:null + 21].hex().encode("ascii")
+        if mode == b"40000":
+            object_type = ObjectType.TREE
+        elif mode == b"160000":
+            object_type = ObjectType.COMMIT
+        else:
+            object_type = ObjectType.BLOB
+        entries.append(TreeEntry(mode, object_type, object_id, name))
+        pos = null + 21
+    return entries
+
+
+# Sort the entries in the order git requires for tree objects. Directories are
+# compared as if they have a trailing slash.
+def sort_tree_entries(entries: list[TreeEntry]) -> list[TreeEntry]:
+    def key(entry: TreeEntry) -> bytes:
+        if entry.object_type == ObjectType.TREE:
+            return entry.name + b"/"
+        return entry.name
+    return sorted(entries, key=key)
+
+
+# Inverse of parse_tree_object(). The entries must be already sorted.
+# NOTE: The mode must not be zero padded. It's not the same as the pretty
+# output! Use "40000" instead of "040000".
+def serialize_tree_object(entries: list[TreeEntry]) -> bytes:
+    return b"".join(entry.mode + b" " + entry.name + b"\0" + bytes.fromhex(entry.object_id.decode("ascii"))
+                    for entry in entries)
+
+
+# Compute the object id like "git hash-object" without writing the object
+def hash_object(object_type: ObjectType, data: bytes) -> bytes:
+    h = hashlib.sha1(b"%s %d\0" % (object_type.value, len(data)))
+    h.update(data)
+    return h.hexdigest().encode("ascii")
+
+
+# Type numbers of the objects in the pack format. See "man gitformat-pack"
+PACK_OBJECT_TYPES = {
+    ObjectType.COMMIT: 1,
+    ObjectType.TREE: 2,
+    ObjectType.BLOB: 3,
+    ObjectType.TAG: 4,
+}
+
+
+# Create a pack file (version 2) without any deltas
+def create_pack(objects: list[tuple[ObjectType, bytes]]) -> bytes:
+    parts = [b"PACK", (2).to_bytes(4, "big"), len(objects).to_bytes(4, "big")]
+    for object_type, data in objects:
+        # Header: type and size as a variable length integer. The first byte
+        # holds the type and the lower four bits of the size.
+        size = len(data)
+        header = bytearray()
+        byte = (PACK_OBJECT_TYPES[object_type] << 4) | (size & 0x0f)
+        size >>= 4
+        while size != 0:
+            header.append(byte | 0x80)
+            byte = size & 0x7f
+            size >>= 7
+        header.append(byte)
+        parts.append(bytes(header))
+        parts.append(zlib.compress(data))
+    pack = b"".join(parts)
+    return pack + hashlib.sha1(pack).digest()
+
+
+# Writer for objects into the object store of a git repository. The object
+# ids are computed in python. Objects are only collected and written with a
+# single "git unpack-objects" process on flush(). Objects that already exist in
+# the repository are skipped.
+class GitObjectWriter:
+    def __init__(self, cwd: bytes | None = None):
+        self._cwd = cwd
+        self._objects: dict[bytes, tuple[ObjectType, bytes]] = {}
+
+    def add(self, object_type: ObjectType, data: bytes) -> bytes:
+        object_id = hash_object(object_type, data)
+        if object_id not in self._objects:
+            self._objects[object_id] = (object_type, data)
+        return object_id
+
+    def flush(self) -> None:
+        reader = git_get_object_reader(self._cwd)
+        missing = [obj for object_id, obj in self._objects.items() if reader.info(object_id) is None]
+        self._objects.clear()
+        if len(missing) == 0:
+            return
+
+        p = Popen(["git", "unpack-objects", "-q"], stdin=PIPE, cwd=self._cwd)
+        p.communicate(create_pack(missing))
+        if p.returncode != 0:
+            raise GitError("git failure")
+
+
+# Reader for objects in the object store of a git repository. It keeps a
+# single "git cat-file --batch-command" process open. So reading multiple
+# objects costs one process and not one process per object.
+# NOTE: The process is started in 'cwd'. So revisions like "HEAD:./file" are
+# resolved relative to it.
+# NOTE: A reader must not be used by multiple threads at the same time.
+class GitObjectReader:
+    def __init__(self, cwd: bytes):
+        self._cwd = cwd
+        self._p: Popen | None = None
+
+    def _start(self) -> None:
+        # A process that has terminated, e.g. because the directory was not a
+        # git repository at the time, is just restarted.
+        if self._p is not None and self._p.poll() is None:
+            return
+        self._p = Popen(["git", "cat-file", "--batch-command"], stdin=PIPE, stdout=PIPE,
+                        stderr=DEVNULL, cwd=self._cwd)
+
+    def close(self) -> None:
+        if self._p is None:
+            return
+        try:
+            self._p.stdin.close()
+        except BrokenPipeError:
+            # The process has already terminated
+            pass
+        self._p.wait()
+        self._p.stdout.close()
+        self._p = None
+
+    # Returns the header line of the response or None if the object does not
+    # exist or the name is ambiguous.
+    def _request(self, command: bytes, rev: str | bytes) -> bytes | None:
+        if isinstance(rev, str):
+            rev = rev.encode("utf8")
+        if b"\n" in rev:
+            raise ValueError("Revision contains a newline character: %r" % (rev,))
+
+        self._start()
+        assert self._p is not None
+        try:
+            self._p.stdin.write(command + b" " + rev + b"\n")
+            self._p.stdin.flush()
+        except BrokenPipeError:
+            pass
+        header = self._p.stdout.readline()
+        if header == b"":
+            # Example stderr output:
+            #   fatal: not a git repository (or any of the parent directories): .git
+            self.close()
+            raise GitError("git failure")
+
+        header = header.rstrip(b"\n")
+        if header.endswith(b" missing") or header.endswith(b" ambiguous"):
+            return None
+        return header
+
+    def info(self, rev: str | bytes) -> ObjectInfo | None:
+        header = self._request(b"info", rev)
+        if header is None:
+            return None
+        object_id, object_type, size = header.split(b" ")
+        return ObjectInfo(object_id, ObjectType(object_type), int(size))
+
+    def contents(self, rev: str | bytes) -> tuple[ObjectInfo, bytes] | None:
+        header = self._request(b"contents", rev)
+        if header is None:
+            return None
+        object_id, object_type, size = header.split(b" ")
+        info = ObjectInfo(object_id, ObjectType(object_type), int(size))
+        assert self._p is not None
+        data = self._p.stdout.read(info.size + 1)
+        # The content is terminated by a newline character
+        assert len(data) == info.size + 1
+        return info, data[:-1]
+
+    def tree_entries(self, rev: str | bytes) -> list[TreeEntry]:
+        result = self.contents(rev)
+        if result is None:
+            raise GitError("git failure")
+        info, data = result
+        if info.object_type != ObjectType.TREE:
+            raise Exception("Object %s is not a tree object" % (info.object_id,))
+        return parse_tree_object(data)
+
+
+_object_readers: dict[bytes, GitObjectReader] = {}
+_object_readers_lock = threading.Lock()
+
+
+# Return the object reader for the repository in 'cwd'. If it's None, the
+# current work directory is used. The reader and its process is reused for all
+# later calls.
+def git_get_object_reader(cwd: bytes | None = None) -> GitObjectReader:
+    cwd = abspath(os.getcwdb() if cwd is None else cwd)
+    with _object_readers_lock:
+        reader = _object_readers.get(cwd)
+        if reader is None:
+            reader = GitObjectReader(cwd)
+            _object_readers[cwd] = reader
+    return reader
+
+
+# Closes the object reader of the repository in 'cwd', e.g. before the
+# repository is removed. A later git_get_object_reader() call starts a new one.
+def git_close_object_reader(cwd: bytes | None = None) -> None:
+    cwd = abspath(os.getcwdb() if cwd is None else cwd)
+    with _object_readers_lock:
+        reader = _object_readers.pop(cwd, None)
+    if reader is not None:
+        reader.close()
+
+
+@atexit.register
+def _close_object_readers() -> None:
+    for reader in _object_readers.values():
+        reader.close()
+    _object_readers.clear()
+
+
 # Returns the type of the git object
-# TODO not used yet. Implement sanity check
 # TODO naming 'rev' is incorrect. 'rev' is only for commit objects.
-def git_get_object_type(rev: str) -> ObjectType:
-    p = Popen(["git", "cat-file", "-t", rev], stdout=PIPE, stderr=DEVNULL)
-    stdout, _ = p.communicate()
-    if p.returncode != 0:
+def git_get_object_type(rev: str | bytes, cwd: bytes | None = None) -> ObjectType:
+    info = git_get_object_reader(cwd).info(rev)
+    if info is None:
         # TODO Create a generic git error exception
         raise Exception("failed here")
 
-    stdout = stdout.rstrip(b"\n")
-    assert stdout in OBJECT_TYPES
-    if stdout == b"blob":
-        return ObjectType.BLOB
-    elif stdout == b"tree":
-        return ObjectType.TREE
-    elif stdout == b"commit":
-        return ObjectType.COMMIT
-    return ObjectType.TAG
+    return info.object_type
 
 
 # Convert URLs. Examples:
@@ -101,19 +349,8 @@ def get_name_from_repository_url(url: str):
 # Check whether the 'rev' can be resolved to a valid object in the repository
 # NOTE:
 # - If this command is not exectued in a git repo, it raises an exception.
-def git_verify(rev: str) -> bool:
-    p = Popen(["git", "rev-parse", "--quiet", "--verify", rev + "^{object}"],
-              stdout=DEVNULL, stderr=DEVNULL)
-    p.communicate()
-    if p.returncode == 1:
-        return False
-    if p.returncode != 0:
-        # Example stderr output:
-        #   fatal: not a git repository (or any of the parent directories): .git
-        # TODO replace with git specific exception
-        raise Exception("todo")
-
-    return True
+def git_verify(rev: str | bytes, cwd: bytes | None = None) -> bool:
+    return git_get_object_reader(cwd).info(rev) is not None
 
 
 def is_valid_revision(revision: str) -> bool:
@@ -149,53 +386,73 @@ def parse_sha1_names(lines: bytes, sep=b' ') -> dict[bytes, bytes]:
     return dict(lines2)
 
 
-def git_get_sha1(rev):
+def git_get_sha1(rev, cwd: bytes | None = None):
     # NOTE: Special case for valid SHA1 sums. Even if the object for the
     # SHA1 does not exist in the repo, it's return as a valid SHA1 If the
     # rev is a too short SHA1, it's extend to a full SHA1 if a object with
     # the short SHA1 exists in the repo.
-    p = Popen(["git", "rev-parse", "-q", "--verify", rev], stdout=PIPE)
-    stdout, _ = p.communicate()
-    if p.returncode != 0:
+    if isinstance(rev, str):
+        rev = rev.encode("utf8")
+    if is_sha1(rev):
+        return rev
+
+    info = git_get_object_reader(cwd).info(rev)
+    if info is None:
         raise Exception("error here TODO")
 
-    return stdout.rstrip(b"\n")
+    return info.object_id
 
 
-# The binary (not text/"cat-file -p") format of a tree object is
-#    <mode in octal> <one space> <filename> <NULL byte> <SHA1 as bytes>
-# And if there are more entries, there is no seperation character!
-# NOTE
-# - Use bytearray.fromhex() to convert from SHA1 as ASCII/HEX to SHA1 as bytes
-# - The mode should not be zero padded a front. It's not the same as the pretty output!
-#    Use "40000" instead of "040000"
+# Write the tree object into the repository and return the object id.
+# NOTE: See serialize_tree_object() for the binary format.
 def git_hash_object_tree(tree_data: bytes) -> bytes:
-    p = Popen(["git", "hash-object", "-w", "-t", "tree", "--stdin"], stdout=PIPE, stdin=PIPE)
-    stdout, _ = p.communicate(tree_data)
-    if p.returncode != 0:
-        raise Exception("error here")
-
-    return stdout.rstrip(b"\n")
+    writer = GitObjectWriter()
+    object_id = writer.add(ObjectType.TREE, tree_data)
+    writer.flush()
+    return object_id
 
 
+# Same output as "git cat-file -p". Only the filenames of tree entries are
+# never quoted.
 def git_cat_file_pretty(rev: bytes) -> bytes:
-    p = Popen(["git", "cat-file", "-p", rev], stderr=DEVNULL, stdout=PIPE)
-    stdout, _ = p.communicate()
-    if p.returncode != 0:
+    result = git_get_object_reader().contents(rev)
+    if result is None:
         raise Exception("error here")
-    return stdout.rstrip(b"")
+    info, data = result
+    if info.object_type != ObjectType.TREE:
+        return data
+
+    return b"".join(b"%06d %s %s\t%s\n" % (int(entry.mode), entry.object_type.value, entry.object_id, entry.name)
+                    for entry in parse_tree_object(data))
 
 
 # git_ls_remote ::  string(url) -> dict<ref_name, sha1>
 # Output contains branches, tags, tag-commitisch "^{}" and the HEAD.
-def git_ls_remote(url: str) -> dict[bytes, bytes]:
+# With 'patterns' only the matching refs are listed. A pattern matches the
+# tail of a ref name, e.g. "main" matches "refs/heads/main". The patterns are
+# applied by git on the client side. They are not sent to the remote.
+# With 'heads' and/or 'tags' only the refs in "refs/heads/" and/or
+# "refs/tags/" are listed. With the git protocol v2 these are sent as the
+# 'ref-prefix' arguments to the remote. So the remote does not advertise other
+# refs, e.g. the "refs/pull/" or "refs/changes/" refs of code review systems.
+def git_ls_remote(url: str, patterns: list[str] | None = None,
+                  heads: bool = False, tags: bool = False) -> dict[bytes, bytes]:
     # NOTE Subpress stderr output of 'ls-remote'. In case of a fetch failure
     # stuff is written to stderr.
 
-    p = Popen(["git", "ls-remote", url], stdout=PIPE)
+    # NOTE: The options must be given before the url.
+    cmd = ["git", "ls-remote"]
+    if heads:
+        cmd += ["--heads"]
+    if tags:
+        cmd += ["--tags"]
+    cmd += [url]
+    if patterns is not None:
+        cmd += ["--"] + patterns
+    p = Popen(cmd, stdout=PIPE)
     stdout, _ = p.communicate()
     if p.returncode != 0:
-        raise Exception("git ls-remote failed")
+        raise GitError("git ls-remote failed")
 
     # Parse output
     # The output of ls-remote uses the tab character as the separator. The
@@ -203,32 +460,78 @@ def git_ls_remote(url: str) -> dict[bytes, bytes]:
     return parse_sha1_names(stdout, sep=b'\t')
 
 
+# The capabilities of the remote repository that are relevant for fetching.
+#  - shallow: The remote supports shallow fetches, e.g. "--depth 1". For the
+#    dumb http transport git fails with
+#       fatal: dumb http transport does not support shallow capabilities
+#  - fetch_by_object_id: The remote allows to request objects by id that are
+#    not advertised by a ref. It's always the case for protocol v2. For
+#    protocol v0 the server must be configured with
+#    'uploadpack.allowReachableSHA1InWant' or 'uploadpack.allowAnySHA1InWant'.
+#  - filter: The remote supports partial clones, e.g. "--filter=blob:none".
+#    The server must be configured with 'uploadpack.allowFilter'. Otherwise
+#    git ignores the filter with a warning and fetches all objects.
+@dataclass(frozen=True)
+class TransportInfo:
+    shallow: bool
+    fetch_by_object_id: bool
+    filter: bool
+
+
+# Returns 'transport' without the capabilities that the remote has rejected
+# according to the error output 'stderr' of a failed "git fetch". It's
+# unchanged if the fetch failed for another reason, e.g. a network error.
+# Examples:
+#    fatal: dumb http transport does not support shallow capabilities
+#    fatal: Server does not support shallow clients
+#    error: Server does not allow request for unadvertised object <object id>
+#    fatal: remote error: upload-pack: not our ref <object id>
+# NOTE: The dumb http transport supports none of the capabilities. With a
+# filter git even starts lazy fetches recursively.
+# NOTE: A remote without filter support does not fail. git ignores the filter
+# with the warning "filtering not recognized by server, ignoring".
+def downgrade_transport(transport: TransportInfo, stderr: bytes) -> TransportInfo:
+    if b"dumb http transport does not support" in stderr:
+        return TransportInfo(shallow=False, fetch_by_object_id=False, filter=False)
+    if b"does not support shallow" in stderr:
+        transport = replace(transport, shallow=False)
+    if b"request for unadvertised object" in stderr or b"not our ref" in stderr:
+        transport = replace(transport, fetch_by_object_id=False)
+    return transport
+
+
 # Query the remote git repo and try to resolve the 'ref'.
 # E.g.
 #  - "main" -> "refs/heads/main"
 #  - "v1" -> "refs/tags/v1"
 # Notes:
 #  - function accepts ref as string, but returns a byte Object!
+#  - Only the candidate refs are listed. For a short name, e.g. "main", the
+#    remote advertises only the branches and tags.
 # Returns
 #  - None if ref could not be resolved
-# TODO also return the matched object
-def git_ls_remote_guess_ref(url: str, ref_str: str) -> bytes | None:
-    # TODO "git ls-remote" also allows to query a single ref or a pattern of
-    # refs!
-    refs_sha1 = git_ls_remote(url)
+#  - Otherwise the tuple of the full ref name and the object id it points to.
+#    For annotated tags it's the object id of the tag object.
+def git_ls_remote_guess_ref(url: str, ref_str: str) -> tuple[bytes, bytes] | None:
+    # A full ref name or "HEAD" can be outside of "refs/heads/" and
+    # "refs/tags/". Then the remote cannot filter by the prefixes.
+    short_name = ref_str != "HEAD" and not ref_str.startswith("refs/")
+    refs_sha1 = git_ls_remote(url, get_guess_ref_candidates(ref_str), heads=short_name, tags=short_name)
+    return guess_ref(refs_sha1, ref_str)
 
-    ref = ref_str.encode("utf8")
 
-    if ref in refs_sha1:
-        return ref  # Direct match
+def get_guess_ref_candidates(ref_str: str) -> list[str]:
+    return [ref_str, "refs/tags/" + ref_str, "refs/heads/" + ref_str]
 
-    ref_as_tag = b"refs/tags/" + ref
-    if ref_as_tag in refs_sha1:
-        return ref_as_tag
 
-    ref_as_branch = b"refs/heads/" + ref
-    if ref_as_branch in refs_sha1:
-        return ref_as_branch
+# Same as git_ls_remote_guess_ref(), but for already known refs, e.g. the refs
+# of a bundle.
+def guess_ref(refs_sha1: dict[bytes, bytes], ref_str: str) -> tuple[bytes, bytes] | None:
+    # The order of the candidates is the priority: Direct match, tag, branch
+    for candidate in get_guess_ref_candidates(ref_str):
+        ref = candidate.encode("utf8")
+        if ref in refs_sha1:
+            return ref, refs_sha1[ref]
 
     return None
 
@@ -256,7 +559,7 @@ def git_diff_in_dir(top_dir, subdir, staged=False):
     p = Popen(cmd, stdout=PIPE, cwd=top_dir)
     stdout, _ = p.communicate()
     if p.returncode != 0:
-        raise Exception("error here")
+        raise GitError("error here")
 
     return len(stdout) != 0
 
@@ -273,11 +576,36 @@ def git_ls_tree_in_dir(subdir):
               stdout=PIPE)
     stdout, _ = p.communicate()
     if p.returncode != 0:
-        raise Exception("TODO error here")
+        raise GitError("TODO error here")
 
     return parse_z(stdout)
 
 
+# Remove the given paths from the index. The files in the working tree are
+# not touched. All paths are streamed to a single git process. So there is no
+# limit on the number of paths.
+# NOTE: The paths are relative to the directory 'cwd'.
+def git_update_index_remove(paths: list[bytes], cwd: bytes | None = None) -> None:
+    if len(paths) == 0:
+        return
+    p = Popen(["git", "update-index", "-z", "--force-remove", "--stdin"], stdin=PIPE, cwd=cwd)
+    p.communicate(b"".join(path + b"\0" for path in paths))
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
+# Stage all entries of the tree object in the index below the directory
+# 'prefix' and write the files into the working tree. The objects are not
+# rehashed. Other files in the working tree are not touched.
+# NOTE: The prefix is relative to the toplevel directory.
+# NOTE: The index must not contain any entries below 'prefix'.
+def git_read_tree_prefix(tree_id: bytes, prefix: bytes) -> None:
+    p = Popen(["git", "read-tree", "-u", b"--prefix=" + prefix + b"/", tree_id])
+    p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
 # NOTE:
 # * The 'git ls-files' is cmd aware. The caller should go into the right
 #   directory first.
@@ -287,7 +615,7 @@ def git_ls_files() -> list[bytes]:
     p = Popen(["git", "ls-files", "-z"], stdout=PIPE)
     stdout, _ = p.communicate()
     if p.returncode != 0:
-        raise Exception("TODO error here")
+        raise GitError("TODO error here")
 
     return parse_z(stdout)
 
@@ -301,7 +629,7 @@ def git_diff_name_only(staged=False):
     p = Popen(cmd, stdout=PIPE)
     stdout, _ = p.communicate()
     if p.returncode != 0:
-        raise Exception("error here")
+        raise GitError("error here")
 
     return parse_z(stdout)
 
@@ -321,11 +649,334 @@ def git_ls_files_untracked():
     stdout, _ = p.communicate()
 
     if p.returncode != 0:
-        raise Exception("error here")
+        raise GitError("error here")
 
     return parse_z(stdout)
 
 
+class StatusType(Enum):
+    CHANGED = b"1"
+    RENAMED_OR_COPIED = b"2"
+    UNMERGED = b"u"
+    UNTRACKED = b"?"
+    IGNORED = b"!"
+
+
+@dataclass(frozen=True)
+class StatusEntry:
+    status_type: StatusType
+    # Two characters. The first one is the status in the index, the second one
+    # is the status in the working tree. A "." means unmodified. It's None for
+    # untracked and ignored files.
+    xy: bytes | None
+    # Relative to the toplevel directory. Untracked directories have a
+    # trailing slash.
+    path: bytes
+
+
+# Number of space separated fields before the path in the porcelain v2 format
+STATUS_FIELDS_BEFORE_PATH = {
+    StatusType.CHANGED: 8,
+    StatusType.RENAMED_OR_COPIED: 9,
+    StatusType.UNMERGED: 10,
+    StatusType.UNTRACKED: 1,
+    StatusType.IGNORED: 1,
+}
+
+
+# Run "git status --porcelain=v2 -z" for the given pathspecs and yield the
+# entries while git is still running. So the whole output is never in memory.
+# Untracked directories are reported as a single entry like "git ls-files -o
+# --directory" does.
+def git_status_porcelain_v2(pathspecs: list[bytes], cwd: bytes | None = None):
+    cmd = ["git", "status", "--porcelain=v2", "-z", "--untracked-files=normal", "--"] + pathspecs
+    p = Popen(cmd, stdout=PIPE, cwd=cwd)
+    assert p.stdout is not None
+
+    def records():
+        rest = b""
+        while True:
+            chunk = p.stdout.read(64 * 1024)
+            if chunk == b"":
+                break
+            records = (rest + chunk).split(b"\0")
+            rest = records.pop()
+            yield from records
+        assert rest == b""
+
+    try:
+        it = records()
+        for record in it:
+            status_type = StatusType(record[0:1])
+            fields = record.split(b" ", STATUS_FIELDS_BEFORE_PATH[status_type])
+            xy = None if status_type in (StatusType.UNTRACKED, StatusType.IGNORED) else fields[1]
+            if status_type == StatusType.RENAMED_OR_COPIED:
+                # The original path follows as the next record
+                next(it)
+            yield StatusEntry(status_type, xy, fields[-1])
+    finally:
+        p.stdout.close()
+        p.wait()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
+# Returns the absolute path to the git directory that is shared by all
+# worktrees of the repository. For a normal repository it's the ".git" folder.
+def git_get_common_dir(cwd: bytes | None = None) -> bytes:
+    p = Popen(["git", "rev-parse", "--path-format=absolute", "--git-common-dir"], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+    return stdout.rstrip(b"\n")
+
+
+# Returns the path of the index file. It honors GIT_INDEX_FILE.
+# NOTE: The path is relative to the current work directory.
+def git_get_index_path() -> bytes:
+    p = Popen(["git", "rev-parse", "--git-path", "index"], stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+    return stdout.rstrip(b"\n")
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    path: bytes
+    mode: int
+    object_id: bytes
+    stage: int
+    intent_to_add: bool
+
+
+@dataclass(frozen=True)
+class GitIndex:
+    # Sorted by path like in the index file
+    entries: list[IndexEntry]
+    # The valid entries of the cached-tree extension. It maps the path of a
+    # directory to the object id of its tree. The toplevel directory is b"".
+    cache_tree: dict[bytes, bytes]
+
+
+INDEX_ENTRY_HEADER = struct.Struct(">10I20sH")
+INDEX_FLAG_EXTENDED = 0x4000
+INDEX_FLAG_STAGE_MASK = 0x3000
+INDEX_FLAG_STAGE_SHIFT = 12
+INDEX_EXTENDED_FLAG_INTENT_TO_ADD = 0x2000
+
+
+# Parse the "TREE" extension. The data is a list of directories in pre-order.
+# Every directory looks like
+#    <name> <NULL byte> <entry count> <space> <subtree count> <newline> <SHA1 as 20 bytes>
+# An entry count of -1 marks an invalid entry. Then there is no SHA1.
+def parse_index_cache_tree(data: bytes) -> dict[bytes, bytes]:
+    cache_tree = {}
+    # Stack of (path, remaining subtrees) of the parent directories
+    stack: list[list] = []
+    pos = 0
+    while pos < len(data):
+        null = data.index(b"\0", pos)
+        newline = data.index(b"\n", null)
+        name = data[pos:null]
+        entry_count, subtree_count = data[null + 1:newline].split(b" ")
+        pos = newline + 1
+
+        while len(stack) != 0 and stack[-1][1] == 0:
+            stack.pop()
+        if len(stack) == 0:
+            path = name  # The toplevel directory
+        else:
+            stack[-1][1] -= 1
+            path = name if stack[-1][0] == b"" else stack[-1][0] + b"/" + name
+
+        if int(entry_count) >= 0:
+            cache_tree[path] = data[pos:pos + 20].hex().encode("ascii")
+            pos += 20
+        stack.append([path, int(subtree_count)])
+    return cache_tree
+
+
+# Parse the index file of git. Supported are the versions 2, 3 and 4 and the
+# cached-tree extension. Other extensions are ignored.
+# Returns None for an index that is not supported, e.g. a split index. The
+# caller must fallback to a git command then.
+# See "man gitformat-index" for the format.
+def parse_index(data: bytes) -> GitIndex | None:
+    signature, version, count = struct.unpack_from(">4sII", data, 0)
+    if signature != b"DIRC":
+        raise Exception("Invalid index file")
+    if version not in (2, 3, 4):
+        return None
+
+    entries = []
+    pos = 12
+    path = b""
+    for _ in range(count):
+        fields = INDEX_ENTRY_HEADER.unpack_from(data, pos)
+        mode = fields[6]
+        object_id = fields[10].hex().encode("ascii")
+        flags = fields[11]
+        entry_start = pos
+        pos += INDEX_ENTRY_HEADER.size
+        extended_flags = 0
+        if version >= 3 and flags & INDEX_FLAG_EXTENDED:
+            extended_flags, = struct.unpack_from(">H", data, pos)
+            pos += 2
+
+        if version == 4:
+            # The path is prefix compressed. A variable length integer tells
+            # how many bytes of the previous path must be removed.
+            byte = data[pos]
+            pos += 1
+            strip = byte & 0x7f
+            while byte & 0x80:
+                byte = data[pos]
+                pos += 1
+                strip = ((strip + 1) << 7) | (byte & 0x7f)
+            null = data.index(b"\0", pos)
+            path = path[:len(path) - strip] + data[pos:null]
+            pos = null + 1
+        else:
+            null = data.index(b"\0", pos)
+            path = data[pos:null]
+            # Entries are padded with NULL bytes to a multiple of eight bytes
+            pos = entry_start + ((null - entry_start + 8) & ~7)
+
+        entries.append(IndexEntry(path, mode, object_id,
+                                  (flags & INDEX_FLAG_STAGE_MASK) >> INDEX_FLAG_STAGE_SHIFT,
+                                  bool(extended_flags & INDEX_EXTENDED_FLAG_INTENT_TO_ADD)))
+
+    cache_tree: dict[bytes, bytes] = {}
+    # The last 20 bytes are the checksum of the file
+    while pos < len(data) - 20:
+        signature, size = struct.unpack_from(">4sI", data, pos)
+        pos += 8
+        if signature == b"TREE":
+            cache_tree = parse_index_cache_tree(data[pos:pos + size])
+        elif signature in (b"link", b"sdir"):
+            # Split index and sparse index are not supported yet
+            return None
+        pos += size
+
+    return GitIndex(entries, cache_tree)
+
+
+# Read the index file of the repository in the current work directory.
+# Returns None if the index is not supported by parse_index().
+def git_read_index() -> GitIndex | None:
+    try:
+        with open(git_get_index_path(), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        # No file was added to the index yet
+        return GitIndex([], {})
+    return parse_index(data)
+
+
+# Build the tree object for the directory 'dir_path' from the index entries
+# in the range [start, end). All these entries are inside the directory.
+# Entries with a name in 'exclude_names' are skipped, but only in the directory
+# itself and not in the subdirectories.
+# Returns None if the tree is empty.
+def _build_tree_from_index(index: GitIndex, start: int, end: int, dir_path: bytes,
+                           writer: GitObjectWriter, exclude_names: tuple[bytes, ...]) -> bytes | None:
+    prefix_len = len(dir_path) + 1 if dir_path != b"" else 0
+    tree_entries = []
+    i = start
+    while i < end:
+        entry = index.entries[i]
+        relpath = entry.path[prefix_len:]
+        slash = relpath.find(b"/")
+        if slash == -1:
+            i += 1
+            if entry.intent_to_add:
+                # Like 'git write-tree'. These files are not in the tree.
+                continue
+            if entry.stage != 0:
+                raise Exception("The index contains unmerged entries")
+            if relpath in exclude_names:
+                continue
+            if entry.mode == 0o160000:
+                object_type = ObjectType.COMMIT
+            else:
+                object_type = ObjectType.BLOB
+            tree_entries.append(TreeEntry(b"%o" % (entry.mode,), object_type, entry.object_id, relpath))
+            continue
+
+        name = relpath[:slash]
+        subdir_path = entry.path[:prefix_len + slash]
+        # All entries of the subdirectory are in a row. The character "0" is
+        # the next character after "/".
+        subdir_end = bisect_left(index.entries, subdir_path + b"0", i, end, key=lambda e: e.path)
+        if name not in exclude_names:
+            tree_id = index.cache_tree.get(subdir_path)
+            if tree_id is None:
+                tree_id = _build_tree_from_index(index, i, subdir_end, subdir_path, writer, ())
+            if tree_id is not None:
+                tree_entries.append(TreeEntry(b"40000", ObjectType.TREE, tree_id, name))
+        i = subdir_end
+
+    if len(tree_entries) == 0:
+        return None
+    return writer.add(ObjectType.TREE, serialize_tree_object(sort_tree_entries(tree_entries)))
+
+
+# Returns the tree 'tree_id' without the gitlinks, i.e. the entries of
+# submodules. Trees that are empty afterwards are removed, too. Returns None if
+# nothing is left. Only the changed trees are added to the 'writer'.
+def tree_remove_gitlinks(reader: GitObjectReader, writer: GitObjectWriter, tree_id: bytes) -> bytes | None:
+    entries = []
+    changed = False
+    for entry in reader.tree_entries(tree_id):
+        if entry.object_type == ObjectType.COMMIT:
+            changed = True
+            continue
+        if entry.object_type == ObjectType.TREE:
+            subtree_id = tree_remove_gitlinks(reader, writer, entry.object_id)
+            if subtree_id is None:
+                changed = True
+                continue
+            if subtree_id != entry.object_id:
+                changed = True
+                entry = TreeEntry(entry.mode, entry.object_type, subtree_id, entry.name)
+        entries.append(entry)
+
+    if not changed:
+        return tree_id
+    if len(entries) == 0:
+        return None
+    # NOTE: The order of the entries is unchanged. So they are still sorted.
+    return writer.add(ObjectType.TREE, serialize_tree_object(entries))
+
+
+# Compute the tree object ids for the directories 'dir_paths' from the index.
+# It's like "git write-tree --prefix=<dir>" for every directory, but the index
+# is read only once. Valid entries of the cached-tree extension are reused.
+# The names in 'exclude_names' are skipped in the toplevel of every
+# directory. Missing tree objects are written by the 'writer'.
+# NOTE: The paths are relative to the toplevel directory of the repository.
+def index_get_tree_ids(index: GitIndex, dir_paths: list[bytes], writer: GitObjectWriter,
+                       exclude_names: tuple[bytes, ...] = ()) -> dict[bytes, bytes]:
+    tree_ids = {}
+    for dir_path in dir_paths:
+        if dir_path == b"":
+            start, end = 0, len(index.entries)
+        else:
+            start = bisect_left(index.entries, dir_path + b"/", key=lambda e: e.path)
+            end = bisect_left(index.entries, dir_path + b"0", start, key=lambda e: e.path)
+        if len(exclude_names) == 0 and dir_path in index.cache_tree:
+            tree_ids[dir_path] = index.cache_tree[dir_path]
+            continue
+        tree_id = _build_tree_from_index(index, start, end, dir_path, writer, exclude_names)
+        if tree_id is None:
+            tree_id = writer.add(ObjectType.TREE, b"")
+        tree_ids[dir_path] = tree_id
+    return tree_ids
+
+
 # :: void -> None or byte object (or raises an exception)
 # TODO currently unused. Maybe remove this function
 def git_get_toplevel():
@@ -338,7 +989,7 @@ def git_get_toplevel():
         return None
     else:
         # TODO Create a generic git error exception
-        raise Exception("git failure")
+        raise GitError("git failure")
 
 
 # NOTE This is cwd aware
@@ -346,14 +997,14 @@ def git_clone(url, directory):
     p = Popen(["git", "clone", "-q", url, directory])
     p.communicate()
     if p.returncode != 0:
-        raise Exception("git failure")
+        raise GitError("git failure")
 
 
 def git_reset_hard(sha1):
     p = Popen(["git", "reset", "-q", "--hard", sha1])
     p.communicate()
     if p.returncode != 0:
-        raise Exception("git failure")
+        raise GitError("git failure")
 
 
 def is_sha1(sha1: bytes) -> bool:
@@ -363,42 +1014,270 @@ def is_sha1(sha1: bytes) -> bool:
     return all(0x30 <= c <= 0x39 or 0x61 <= c <= 0x66 for c in sha1)
 
 
-def git_init_bare() -> None:
-    p = Popen(["git", "init", "-q", "--bare"])
+def git_init_bare(cwd: bytes | None = None) -> None:
+    p = Popen(["git", "init", "-q", "--bare"], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
+# Returns the object ids of all objects that are reachable from 'object_id',
+# but are missing in the repository. In a partial clone these are the objects
+# that were omitted by the filter.
+# NOTE: The missing objects are not fetched lazily from the promisor remote.
+def git_rev_list_missing(object_id: bytes, cwd: bytes | None = None) -> list[bytes]:
+    p = Popen([b"git", b"rev-list", b"--objects", b"--missing=print", object_id], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+    return [line[1:] for line in stdout.splitlines() if line.startswith(b"?")]
+
+
+# Returns True if all objects that are reachable from the refs exist in the
+# repository. In a partial clone the objects that were omitted by the filter
+# are not missing.
+def git_fsck_connectivity(cwd: bytes | None = None) -> bool:
+    p = Popen(["git", "fsck", "--connectivity-only", "--no-dangling"], stdout=DEVNULL, stderr=DEVNULL, cwd=cwd)
     p.communicate()
+    return p.returncode == 0
+
+
+# Fetch the missing objects of a partial clone from the promisor 'remote'.
+# It's the same command that git uses to fetch missing objects lazily, but
+# for all objects in one go. The object ids are passed on stdin, because
+# there can be a lot of them.
+# NOTE: The filter is needed. Otherwise the fetch of blobs fails in the
+# connectivity check.
+def git_fetch_missing_objects(remote: str, object_ids: list[bytes], cwd: bytes | None = None) -> None:
+    p = Popen(["git", "-c", "fetch.negotiationAlgorithm=noop", "fetch", "-q", "--no-tags",
+               "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin", remote],
+              stdin=PIPE, stderr=PIPE, cwd=cwd)
+    _, stderr = p.communicate(b"".join(object_id + b"\n" for object_id in object_ids))
     if p.returncode != 0:
-        raise Exception("git failure")
+        raise GitError("git failure", stderr)
+
+
+# Write a bundle file that contains the 'refs' and all objects that are
+# reachable from them. 'refs' is a list of tuples (ref name, object id).
+# NOTE: The bundle is written by hand instead of "git bundle create", because
+# it does not need refs in the repository. And in a shallow repository "git
+# bundle create" works, but "git fetch" from the bundle fails. So use
+# git_bundle_unbundle() to read the bundle.
+# NOTE: In a partial clone missing objects are left out with
+# 'allow_missing'.
+def git_bundle_create(bundle_path: bytes, refs: list[tuple[bytes, bytes]], cwd: bytes | None = None,
+                      allow_missing: bool = False) -> None:
+    cmd = ["git", "pack-objects", "--stdout", "--revs", "-q"]
+    if allow_missing:
+        cmd.append("--missing=allow-promisor")
+    with open(bundle_path, "wb") as f:
+        f.write(b"# v2 git bundle\n")
+        for ref, object_id in refs:
+            f.write(b"%s %s\n" % (object_id, ref))
+        f.write(b"\n")
+        f.flush()
+        p = Popen(cmd, stdin=PIPE, stdout=f, cwd=cwd)
+        p.communicate(b"".join(object_id + b"\n" for _, object_id in refs))
+    if p.returncode != 0:
+        raise GitError("git failure")
+
 
+# Store the objects of the bundle in the repository. Returns the refs of the
+# bundle. The refs are not created in the repository.
+# NOTE: Unlike "git fetch" there is no connectivity check. So commits of a
+# shallow repository can be imported. See git_mark_shallow().
+def git_bundle_unbundle(bundle_path: bytes, cwd: bytes | None = None) -> dict[bytes, bytes]:
+    p = Popen([b"git", b"bundle", b"unbundle", bundle_path], stdout=PIPE, stderr=DEVNULL, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+    return parse_sha1_names(stdout)
 
-def git_fetch(url: str, ref: bytes | None = None) -> bytes:
+
+# Returns the refs of the bundle. No repository is needed.
+def git_bundle_list_heads(bundle_path: bytes) -> dict[bytes, bytes]:
+    p = Popen([b"git", b"bundle", b"list-heads", bundle_path], stdout=PIPE, stderr=DEVNULL)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+    return parse_sha1_names(stdout)
+
+
+# Returns the object ids of the parents of the commit. The parent commits
+# itself do not need to exist.
+def git_get_commit_parents(commit_id: bytes, cwd: bytes | None = None) -> list[bytes]:
+    p = Popen([b"git", b"cat-file", b"commit", commit_id], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+    header, _, _ = stdout.partition(b"\n\n")
+    return [line[len(b"parent "):] for line in header.split(b"\n") if line.startswith(b"parent ")]
+
+
+# Marks the commit as shallow. Then git does not look for the parents of the
+# commit. This is needed for commits that are imported without their history.
+# NOTE: The argument is the path to the git directory, e.g. of a bare
+# repository.
+def git_mark_shallow(git_dir: bytes, commit_id: bytes) -> None:
+    shallow_path = join(git_dir, b"shallow")
+    try:
+        with open(shallow_path, "rb") as f:
+            shallow_commits = f.read().splitlines()
+    except FileNotFoundError:
+        shallow_commits = []
+    if commit_id in shallow_commits:
+        return
+    with open(shallow_path, "ab") as f:
+        f.write(commit_id + b"\n")
+
+
+# Create or overwrite the 'ref', e.g. b"refs/heads/main".
+def git_update_ref(ref: bytes, object_id: bytes, cwd: bytes | None = None) -> None:
+    p = Popen([b"git", b"update-ref", ref, object_id], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
+# Runs "git gc --auto". git only packs and prunes objects if there are too many
+# loose objects or packs.
+# NOTE: The gc runs in the foreground. So the caller can measure the size of
+# the repository afterwards.
+def git_gc_auto(cwd: bytes | None = None) -> None:
+    p = Popen([b"git", b"-c", b"gc.autoDetach=false", b"gc", b"--auto", b"--quiet"], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
+# Returns True if the commit or tag 'object_id' exists in the repository.
+# Unlike git_verify() a missing object is not fetched lazily from the promisor
+# remote in a partial clone.
+def git_commit_exists_locally(object_id: bytes, cwd: bytes | None = None) -> bool:
+    p = Popen([b"git", b"rev-list", b"--missing=print", b"--no-walk", object_id], stdout=DEVNULL, stderr=DEVNULL,
+              cwd=cwd)
+    p.communicate()
+    return p.returncode == 0
+
+
+# Adds the object directory 'objects_path' of another repository as an
+# alternate. Then all objects of the other repository are also available in
+# this repository. Nothing is done if the alternate already exists.
+# NOTE: The argument 'git_dir' is the path to the git directory, e.g. of a
+# bare repository. A relative 'objects_path' is relative to the object
+# directory of this repository.
+def git_add_alternate(git_dir: bytes, objects_path: bytes) -> None:
+    alternates_path = join(git_dir, b"objects", b"info", b"alternates")
+    try:
+        with open(alternates_path, "rb") as f:
+            alternates = f.read().splitlines()
+    except FileNotFoundError:
+        alternates = []
+    if objects_path in alternates:
+        return
+    with open(alternates_path, "ab") as f:
+        f.write(objects_path + b"\n")
+
+
+# Returns True if the repository uses the objects of other repositories.
+def git_has_alternates(git_dir: bytes) -> bool:
+    return os.path.isfile(join(git_dir, b"objects", b"info", b"alternates"))
+
+
+# Returns True if the repository is a partial clone. Then some objects can be
+# missing. See git_rev_list_missing().
+# NOTE: Objects that are fetched from a promisor remote are stored in packs
+# with an additional ".promisor" file.
+# NOTE: The argument is the path to the git directory, e.g. of a bare
+# repository.
+def git_has_promisor_packs(git_dir: bytes) -> bool:
+    try:
+        names = os.listdir(join(git_dir, b"objects", b"pack"))
+    except FileNotFoundError:
+        return False
+    return any(name.endswith(b".promisor") for name in names)
+
+
+# Returns the value of the config 'key' of the repository. Returns None if the
+# key is not set.
+def git_config_get(key: str, cwd: bytes | None = None) -> bytes | None:
+    p = Popen(["git", "config", "--get", key], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode == 1:
+        return None
+    if p.returncode != 0:
+        raise GitError("git failure")
+    return stdout.rstrip(b"\n")
+
+
+# Sets the config 'key' in the config file of the repository.
+def git_config_set(key: str, value: bytes, cwd: bytes | None = None) -> None:
+    p = Popen([b"git", b"config", b"--local", key.encode("ascii"), value], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
+# Fetch the objects with the given object ids from the repository at 'url'
+# into the repository in 'cwd'. The object ids can also point to tree objects.
+# No refs and no FETCH_HEAD are written. So the objects stay unreferenced until
+# the index or a commit references them.
+def git_fetch_objects(url: str | bytes, object_ids: list[bytes], cwd: bytes | None = None) -> None:
+    p = Popen(["git", "fetch", "-q", "--no-tags", "--no-write-fetch-head", url] + object_ids,
+              stderr=DEVNULL, cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure")
+
+
+# Fetch only the commit or tag 'object_id' from the remote repository. Not
+# all servers allow to request an object by id if it's not advertised by a
+# ref. See TransportInfo.fetch_by_object_id and downgrade_transport().
+def git_fetch_object_id(url: str, object_id: bytes, cwd: bytes | None = None, depth: int | None = 1,
+                        filter: bytes | None = None) -> None:
+    cmd = [b"git", b"fetch", b"-q", url.encode("utf8"), object_id]
+    if depth is not None:
+        cmd += [b"--depth", b"%d" % (depth,)]
+    if filter is not None:
+        cmd.append(b"--filter=" + filter)
+    p = Popen(cmd, stderr=PIPE, cwd=cwd)
+    _, stderr = p.communicate()
+    if p.returncode != 0:
+        raise GitError("git failure", stderr)
+
+
+# NOTE: Shallow fetches with 'depth' do not work for every transport. See
+# TransportInfo.shallow.
+# NOTE: With a 'filter', e.g. b"blob:none", the repository becomes a partial
+# clone. git configures the remote as a promisor remote automatically. See
+# git_rev_list_missing() to fetch the missing objects later.
+# NOTE: The argument 'cwd' is the path to the git repository that receives the
+# objects. If it's None, the current work directory is used.
+def git_fetch(url: str, ref: bytes | None = None, cwd: bytes | None = None, depth: int | None = 1,
+              filter: bytes | None = None) -> bytes:
     cmd = ["git", "fetch", "-q", url]
     if ref is not None:
         cmd.append(ref)
 
-    # NOTE: Http transport which is currently used in the tests! And for dump
-    # the "--depth" argument does not work. So we need this hack for the tests.
-    # The git error message is
-    #     fatal: dumb http transport does not support shallow capabilities
-    # TODO implement this hack nicly!
-    # TODO No need for an env variable or argument. This code should
-    # automatically detect whether shallow cloes are working or not!
-    if os.environ.get("HACK_DISABLE_DEPTH_OPTIMIZATION", "0").strip() != "1":
-        cmd += ["--depth", "1"]
-    p = Popen(cmd, stderr=DEVNULL)
-    # NOTE If stderr==DEVNULL(no-tty) no progress is showing on the commandline
-    # Not getting the error is bad!
-    # TODO capture fetch error and forward to caller!
-    p.communicate()
+    if depth is not None:
+        cmd += ["--depth", "%d" % (depth,)]
+    if filter is not None:
+        cmd.append("--filter=" + filter.decode("ascii"))
+    # NOTE The error output is captured. It tells whether the remote rejected
+    # a capability. See downgrade_transport().
+    p = Popen(cmd, stderr=PIPE, cwd=cwd)
+    _, stderr = p.communicate()
     if p.returncode != 0:
         # TODO think about error handling!!
         # Maybe every subcommand should be able and allows to write to stderr
         # directly or forward to caller!
-        raise Exception("git failure: %d, %s" % (p.returncode, cmd))
+        raise GitError("git failure: %d, %s" % (p.returncode, cmd), stderr)
 
     # get SHA1 of fetched object
     # TODO Handle bare and non bare repos!
     # If multiple refs are fetch, the first one is used!
-    with open("FETCH_HEAD", "br") as f:
+    fetch_head_path = b"FETCH_HEAD" if cwd is None else join(cwd, b"FETCH_HEAD")
+    with open(fetch_head_path, "br") as f:
         sha1 = f.read().split(b"\t", 1)[0]
 
     assert is_sha1(sha1)
@@ -5,26 +5,28 @@
 import argparse
 import os
 import shutil
-import subprocess
 import sys
 import time
-from contextlib import chdir
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import chdir, contextmanager
+from dataclasses import dataclass, field
 from os.path import join
 from subprocess import DEVNULL, Popen
 
 # ----8<----
-from cache import CacheHelperGit, DownloadConfig
-from libconfig import (LineDataHeader, LineDataKeyValue, LineType,
-                       config_add_section2, config_drop_key2,
-                       config_drop_section_if_empty, config_parse2,
-                       config_set_key_value2, config_unparse2, empty_config_lines,
-                       split_with_ts_bytes)
+from cache import (CacheHelperArchive, CacheHelperGit, CloneConfig, DownloadConfig, RefsCache, get_cache_key,
+                   get_cache_root_abspath, get_refs_ttl, is_cache_root_shared, get_archive_suffix,
+                   get_cache_helper, get_cache_helper_for_cache, get_cache_max_size, check_and_parse_cache_max_size,
+                   mark_cache_used, list_caches, evict_caches, get_dir_size, CacheLock,
+                   lock_caches)
+from libconfig import (ConfigDocument, LineDataHeader, LineDataKeyValue, LineType,
+                       config_parse_sections_and_keys)
 # TODO main.py should not depend on any git command. They all should be in cache.py
 # or in a new super.py module
 from libgit import (get_name_from_repository_url, git_diff_in_dir,
-                    git_diff_name_only, git_ls_files_untracked, is_valid_revision,
-                    git_ls_files)
+                    git_status_porcelain_v2, StatusType, is_valid_revision,
+                    git_ls_files, git_read_tree_prefix, git_update_index_remove,
+                    git_get_common_dir)
 from util import AppException, ErrorCode, URLTypes, get_url_type
 from super import (find_superproject, SCMType, check_superproject_data,
                    check_and_get_superproject_from_checked_data, SuperprojectType,
@@ -46,9 +48,53 @@ def is_section_name(b):
     raise NotImplementedError()
 
 
+# Trie of the paths of all subprojects. Every node is a dict that maps a path
+# component to the child node. A node of a subproject contains the full path of
+# the subproject under the key None.
+# Lookups are O(depth of the path) and independent of the amount of
+# subprojects.
+class SubprojectIndex:
+    def __init__(self, subprojects: list[bytes]):
+        self._root: dict = {}
+        for subproject in subprojects:
+            node = self._root
+            for component in subproject.split(b"/"):
+                node = node.setdefault(component, {})
+            node[None] = subproject
+
+    # Returns the subproject that contains the path or is the path itself.
+    # NOTE: The path is relative to the toplevel directory of the
+    # superproject. A trailing slash is allowed.
+    def find(self, path: bytes) -> bytes | None:
+        node = self._root
+        for component in path.split(b"/"):
+            if None in node:
+                return node[None]
+            if component == b"":
+                continue
+            node = node.get(component)
+            if node is None:
+                return None
+        return node.get(None)
+
+    def __contains__(self, path: bytes) -> bool:
+        node = self._root
+        for component in path.split(b"/"):
+            node = node.get(component)
+            if node is None:
+                return False
+        return None in node
+
+
 @dataclass(frozen=True)
 class Config:
     subprojects: list[bytes]
+    # Built once from 'subprojects' to answer path lookups fast
+    subproject_index: SubprojectIndex = field(init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        # NOTE: Workaround to set a field of a frozen dataclass
+        object.__setattr__(self, "subproject_index", SubprojectIndex(self.subprojects))
 
 
 def parse_config(config_lines) -> Config:
@@ -74,12 +120,44 @@ def parse_config(config_lines) -> Config:
     return Config(subprojects)
 
 
+# Parsed config and metadata files of this process. The key is the absolute
+# path of the file. The value is the signature of the file and the parsed
+# result. If another process changes the file, the signature changes and the
+# file is parsed again. subpatch's own writes drop the entry with
+# forget_parsed_file().
+_parsed_files: dict[bytes, tuple[tuple[int, int, int], object]] = {}
+
+
+def get_file_signature(st: os.stat_result) -> tuple[int, int, int]:
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+# Returns parse(<file content>). The result is reused until the file changes.
+# So the result must not be modified by the caller.
+def read_parsed_file(path: bytes, parse):
+    abspath = os.path.abspath(path)
+    entry = _parsed_files.get(abspath)
+    if entry is not None and entry[0] == get_file_signature(os.stat(abspath)):
+        return entry[1]
+
+    with open(abspath, "br") as f:
+        signature = get_file_signature(os.fstat(f.fileno()))
+        result = parse(f.read())
+    _parsed_files[abspath] = (signature, result)
+    return result
+
+
+def forget_parsed_file(path: bytes) -> None:
+    _parsed_files.pop(os.path.abspath(path), None)
+
+
+def parse_config_data(data: bytes) -> Config:
+    return parse_config(config_parse_sections_and_keys(data))
+
+
 # Path can be absolute or relative
 def read_config(path: bytes) -> Config:
-    with open(path, "br") as f:
-        config_lines = config_parse2(split_with_ts_bytes(f.read()))
-
-    return parse_config(config_lines)
+    return read_parsed_file(path, parse_config_data)
 
 
 # Paths documentation and naming
@@ -188,12 +266,13 @@ class Metadata:
     object_id: bytes | None
     subtree_applied_index: bytes | None
     subtree_checksum: bytes | None
+    # Only this subdirectory of the upstream repository is integrated
+    subdir: bytes | None = None
 
 
 def read_metadata(path: bytes) -> Metadata:
     try:
-        with open(path, "br") as f:
-            lines = split_with_ts_bytes(f.read())
+        return read_parsed_file(path, parse_metadata)
     except FileNotFoundError:
         # TODO add note about which subproject is wrong!
         # TODO write commands to fix this issue.
@@ -201,13 +280,16 @@ def read_metadata(path: bytes) -> Metadata:
         raise AppException(ErrorCode.INVALID_STATE, "Metadata file for subproject not found."
                            " Drop subproject path from the subpatch config or add a subproject metadata file manually!.")
 
+
+def parse_metadata(data: bytes) -> Metadata:
     url = None
     revision = None
     object_id = None
     subtree_applied_index = None
     subtree_checksum = None
+    subdir = None
 
-    metadata_lines = config_parse2(lines)
+    metadata_lines = config_parse_sections_and_keys(data)
     for metadata_line in metadata_lines:
         # TODO only use url and revision in upstream section!
         if metadata_line.line_type == LineType.KEY_VALUE:
@@ -223,8 +305,10 @@ def read_metadata(path: bytes) -> Metadata:
                 subtree_applied_index = line_data.value
             elif line_data.key == b"checksum":
                 subtree_checksum = line_data.value
+            elif line_data.key == b"subdir":
+                subdir = line_data.value
 
-    return Metadata(url, revision, object_id, subtree_applied_index, subtree_checksum)
+    return Metadata(url, revision, object_id, subtree_applied_index, subtree_checksum, subdir)
 
 
 # Data class that contains most of the information that is in the subtree
@@ -277,6 +361,36 @@ def read_patches_dim(sub_paths: SubPaths, metadata: Metadata) -> PatchesDim:
     return PatchesDim(patches)
 
 
+# All dimensions of a subproject that are stored in files
+@dataclass(frozen=True)
+class SubprojectDims:
+    metadata: Metadata
+    subtree_dim: SubtreeDim
+    patches_dim: PatchesDim
+
+
+def read_subproject_dims(sub_paths: SubPaths) -> SubprojectDims:
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    return SubprojectDims(metadata, read_subtree_dim(metadata), read_patches_dim(sub_paths, metadata))
+
+
+# Maximum number of threads to read the files of the subprojects
+READ_JOBS = 16
+
+
+# Reads the metadata files and the patches directories of all subprojects in
+# parallel. Returns a dict from 'super_to_sub_relpath' to the dimensions. If
+# reading fails for multiple subprojects, the error of the first one in
+# 'sub_paths_list' is raised.
+def read_subprojects_dims(sub_paths_list: list[SubPaths]) -> dict[bytes, SubprojectDims]:
+    if len(sub_paths_list) <= 1:
+        dims_list = [read_subproject_dims(sub_paths) for sub_paths in sub_paths_list]
+    else:
+        with ThreadPoolExecutor(max_workers=min(READ_JOBS, len(sub_paths_list))) as executor:
+            dims_list = list(executor.map(read_subproject_dims, sub_paths_list))
+    return {sub_paths.super_to_sub_relpath: dims for sub_paths, dims in zip(sub_paths_list, dims_list)}
+
+
 def ensure_dims_are_consistent(subtree_dim: SubtreeDim, patches_dim: PatchesDim) -> None:
     if subtree_dim.applied_index is not None:
         if subtree_dim.applied_index < -1:
@@ -330,116 +444,103 @@ def ensure_superproject_is_git(superx):
 
 
 # TODO add argument to specific which type of cache to init.
-# TODO For now the function returns the path to the cache, but later the path
-# should be part of the SubPaths and maybe even be configurable!
-def do_cache_create(sub_paths: SubPaths, cache_helper: CacheHelperGit) -> bytes:
-    cwd_to_cache_relpath = join(sub_paths.cwd_to_sub_relpath, b"cache")
-    assert (not os.path.isdir(cwd_to_cache_relpath))
-    os.mkdir(cwd_to_cache_relpath)
-    cache_helper.create(cwd_to_cache_relpath)
-    return cwd_to_cache_relpath
-
-
-def do_unpack_with_cleanup(superx, super_paths, sub_paths, cwd_to_cache_relpath: bytes, cache_helper: CacheHelperGit,
-                           url: str, revision: str | None, object_id: bytes) -> None:
-    try:
-        do_unpack(superx, super_paths, sub_paths, cwd_to_cache_relpath, cache_helper, url, revision, object_id)
-    finally:
-        # NOTE: The code has to cleanup in the good and in the error case.
-        # NOTE: Removing the cache directory on every unpack is ok. Currently
-        # we don't support persistent cache directories.
-        # NOTE Now it's a bare repo!
-        assert (os.path.isdir(join(cwd_to_cache_relpath, b"objects")))
-        assert (os.path.isfile(join(cwd_to_cache_relpath, b"config")))
-        assert (os.path.isdir(cwd_to_cache_relpath))
-        # Need to use rmtree and not rmdir, because there are maybe more left
-        # over files and directories.
-        shutil.rmtree(cwd_to_cache_relpath)
+# NOTE: The cache is persistent. It's reused across runs and across subprojects
+# that share the same upstream URL. So only the delta has to be downloaded.
+# NOTE: The caller must hold the CacheLock of the cache.
+def do_cache_create(super_paths: SuperPaths, cache_helper: CacheHelperGit | CacheHelperArchive, url: str) -> bytes:
+    cache_abspath = get_cache_abspath(super_paths, url)
+    if not cache_helper.isCreated(cache_abspath):
+        os.makedirs(cache_abspath, exist_ok=True)
+        cache_helper.create(cache_abspath)
+    # The cache can use the objects of the superproject. But only if it's
+    # located inside the superproject. A shared cache must not depend on a
+    # single superproject.
+    if not is_cache_root_shared():
+        super_objects_abspath = join(git_get_common_dir(cwd=super_paths.super_abspath), b"objects")
+        cache_helper.use_superproject_objects(cache_abspath, super_objects_abspath)
+    mark_cache_used(cache_abspath)
+    return cache_abspath
+
+
+def get_cache_abspath(super_paths: SuperPaths, url: str) -> bytes:
+    return join(get_cache_root_abspath(super_paths.super_abspath), get_cache_key(url))
+
+
+# Keeps the disk usage of the caches bounded after they were used. The used
+# caches are compacted and, if SUBPATCH_CACHE_MAX_SIZE is set, the least
+# recently used other caches are removed.
+def do_cache_auto_gc(super_paths: SuperPaths, used_cache_abspaths: list[bytes]) -> None:
+    for cache_abspath in used_cache_abspaths:
+        with CacheLock(cache_abspath):
+            get_cache_helper_for_cache(cache_abspath).compact(cache_abspath)
+
+    max_size = get_cache_max_size()
+    if max_size is not None:
+        evict_caches(get_cache_root_abspath(super_paths.super_abspath), max_size, keep=used_cache_abspaths)
+
+
+# Remove the files from the working tree. Directories that are empty afterwards
+# are also removed, but never the directory 'base_abspath' itself. This is the
+# same behavior as 'git rm -f'.
+# NOTE: The paths are relative to 'base_abspath'.
+def remove_files_and_empty_dirs(base_abspath: bytes, relpaths: list[bytes]) -> None:
+    dirs = set()
+    for relpath in relpaths:
+        try:
+            os.unlink(join(base_abspath, relpath))
+        except FileNotFoundError:
+            # The file was already removed by the user in the working tree
+            pass
+        dirname = os.path.dirname(relpath)
+        while dirname != b"" and dirname not in dirs:
+            dirs.add(dirname)
+            dirname = os.path.dirname(dirname)
+
+    # Remove the deepest directories first
+    for dirname in sorted(dirs, key=len, reverse=True):
+        try:
+            os.rmdir(join(base_abspath, dirname))
+        except OSError:
+            # The directory is not empty or does not exist
+            pass
 
 
 # TODO consolide function arguments
-def do_unpack(superx, super_paths, sub_paths, cwd_to_cache_relpath: bytes, cache_helper: CacheHelperGit,
-              url: str, revision: str | None, object_id: bytes) -> None:
+def do_unpack(superx, super_paths, sub_paths, cache_abspath: bytes, cache_helper: CacheHelperGit | CacheHelperArchive,
+              url: str, revision: str | None, object_id: bytes, subdir: bytes | None = None) -> None:
     # TODO This function is very very hacky. Works for now!
 
-    # Quick and dirty performance improvement. Batch multiple paths together
-    class GitCommandBachter:
-        BATCH_COUNT = 5000
-
-        def __init__(self, cmd, folder):
-            self._args = []
-            self._cmd = cmd
-            self._folder = folder
-
-        def add_and_maybe_exec(self, arg):
-            self._args.append(arg)
-            if len(self._args) >= self.BATCH_COUNT:
-                self.exec_force()
-
-        def exec_force(self):
-            if len(self._args) == 0:
-                return
-            cmd = self._cmd + self._args
-            subprocess.run(cmd, check=True, cwd=self._folder)
-            self._args.clear()
-
     # Just quick and try remove and copy!
     # TODO convert this code to "superhelper" implementation
     # TODO This code is "subpatch subtree drop"
     with chdir(super_paths.super_abspath):
         # TODO ensure that there are no untracked changes. Subpatch should not
         # remove any work of the user by accident.
-        git_rm = GitCommandBachter(["git", "rm", "-q", "-f"], sub_paths.subproject_abspath)
         # TODO Add a custom/plumping command for that "subpatch subtree list"
         with chdir(sub_paths.super_to_sub_relpath):
             subtree_files_relpaths = git_ls_files()
-            # NOTE: git_ls_tree_in_dir() also lists files non-subtree files E.g.
-            # the folder "patches" and the file ".subproject". These must be
-            # skipped.
-            # TODO Move these special paths into a central location!
-            #   if filename in (b".git", b".subproject", b"cache", b"patches"):
-            for path in subtree_files_relpaths:
-                if path.startswith(b"patches/"):
-                    continue
-                if path == b".subproject":
-                    continue
-                git_rm.add_and_maybe_exec(path)
-
-        git_rm.exec_force()
+        # NOTE: git_ls_tree_in_dir() also lists files non-subtree files E.g.
+        # the folder "patches" and the file ".subproject". These must be
+        # skipped.
+        # TODO Move these special paths into a central location!
+        #   if filename in (b".git", b".subproject", b"cache", b"patches"):
+        subtree_files_relpaths = [path for path in subtree_files_relpaths
+                                  if not path.startswith(b"patches/") and path != b".subproject"]
 
-    # and extract
-    dest_relpath = b"out"
-    # NOTE: Fore now the dest_dir is clean, it does not contain, e.g. the
-    # ".git" folder! Thats the contract to the CacheHelper.
-    cache_helper.extract(cwd_to_cache_relpath, object_id, dest_relpath)
+        git_update_index_remove(subtree_files_relpaths, cwd=sub_paths.subproject_abspath)
+        remove_files_and_empty_dirs(sub_paths.subproject_abspath, subtree_files_relpaths)
 
-    # and move
-    # TODO Combine extract and move. Should, at least for git, in one go!
+    # and extract
+    # NOTE: The objects are imported directly into the object store of the
+    # superproject. So git can stage the tree without rehashing the files.
+    tree_id = cache_helper.extract(cache_abspath, object_id, super_paths.super_abspath, subdir)
 
     # TODO This code is "subpatch unpack" but even bit lower
     # TODO convert this code to "superhelper" implementation
     assert (os.path.isdir(sub_paths.cwd_to_sub_relpath))
     assert (not os.path.isdir(join(sub_paths.cwd_to_sub_relpath, b".git")))
-    dest_abspath = os.path.abspath(join(os.getcwdb(), cwd_to_cache_relpath, dest_relpath))
-    with chdir(dest_abspath):
-        git_add = GitCommandBachter(["git", "add", "-f"], super_paths.super_abspath)
-
-        for root, dirnames, files in os.walk(b"."):
-            for dirname in dirnames:
-                super_to_dest_relpath = join(sub_paths.super_to_sub_relpath, root, dirname)
-                dest_path = join(super_paths.super_abspath, super_to_dest_relpath)
-                os.makedirs(dest_path, exist_ok=True)
-
-            for filename in files:
-                src_path = join(root, filename)
-                super_to_dest_relpath = join(sub_paths.super_to_sub_relpath, root, filename)
-                dest_path = join(super_paths.super_abspath, super_to_dest_relpath)
-                os.rename(src_path, dest_path)
-                super_to_dest_relpath = join(sub_paths.super_to_sub_relpath, root, filename)
-
-                git_add.add_and_maybe_exec(super_to_dest_relpath)
-
-        git_add.exec_force()
+    with chdir(super_paths.super_abspath):
+        git_read_tree_prefix(tree_id, sub_paths.super_to_sub_relpath)
 
     # Hack for now:
     # The function get_sha1_for_subtree does not work if the subtree is empty
@@ -453,42 +554,53 @@ def do_unpack(superx, super_paths, sub_paths, cwd_to_cache_relpath: bytes, cache
         subtree_checksum = superx.helper.get_sha1_for_subtree(sub_paths.super_to_sub_relpath)
 
     # TODO subpatch subtree checksum --write does the same!
-    metadata_set_for_unpack(sub_paths, url, revision, object_id, subtree_checksum)
-
-    with chdir(super_paths.super_abspath):
-        superx.helper.add([sub_paths.metadata_abspath])
-
-
-def cmd_update(args, parser):
-    if args.path is None:
-        # TODO should also work when cwd is inside the subproject
-        raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "Must give path to subproject")
-
-    data = find_superproject()
-    checked_data = check_superproject_data(data)
-    superx = check_and_get_superproject_from_checked_data(checked_data)
-    ensure_superproject_is_configured(superx)
-    ensure_superproject_is_git(superx)
-    cwd_to_sub_relpath = os.fsencode(args.path)
-
-    super_paths = gen_super_paths(superx.path)
-    sub_paths = gen_sub_paths_from_cwd_and_relpath(super_paths, cwd_to_sub_relpath)
-
-    config = read_config(super_paths.config_abspath)
-
+    with chdir(super_paths.super_abspath), metadata_transaction(sub_paths, superx.helper) as m:
+        metadata_set_for_unpack(m, url, revision, object_id, subtree_checksum, subdir)
+
+
+# All data to update a single subproject. The network phase fills the cache
+# fields. The timings are in seconds.
+@dataclass
+class UpdateJob:
+    sub_paths: SubPaths
+    url: str
+    revision: str | None
+    subdir: bytes | None = None
+    bundle_path: bytes | None = None
+    # True if the integrated revision, url, subdir and subtree are the same as
+    # in the metadata. Then only the remote object id has to be checked.
+    unchanged: bool = False
+    metadata: Metadata | None = None
+    # Set if the remote object id is the integrated one. Then nothing has to be
+    # done.
+    skip: bool = False
+    # The cache helper for the type of the URL
+    cache_helper: CacheHelperGit | CacheHelperArchive | None = None
+    clone_config: CloneConfig | None = None
+    cache_abspath: bytes | None = None
+    object_id: bytes | None = None
+    fetch_time: float = 0.0
+    unpack_time: float = 0.0
+
+
+def prepare_update_job(superx, super_paths: SuperPaths, config: Config, sub_paths: SubPaths,
+                       url_arg: str | None, revision_arg: str | None, subdir_arg: bytes | None = None,
+                       bundle_path: bytes | None = None, dims: SubprojectDims | None = None) -> UpdateJob:
     # NOTE two different error cases:
     # * no subproject path in config
     # * no subproject file in directory (TODO add code for that)
     # TODO make this check generic!
-    if sub_paths.super_to_sub_relpath not in config.subprojects:
+    if sub_paths.super_to_sub_relpath not in config.subproject_index:
         x = sub_paths.super_to_sub_relpath.decode("utf8")
         raise AppException(ErrorCode.INVALID_ARGUMENT, "Path '%s' does not point to a subproject" % (x,))
 
-    metadata = read_metadata(sub_paths.metadata_abspath)
+    if dims is None:
+        dims = read_subproject_dims(sub_paths)
+    metadata = dims.metadata
 
-    if args.url is not None:
+    if url_arg is not None:
         # TODO verify URL
-        url = args.url
+        url = url_arg
     else:
         if metadata.url is None:
             # TODO this is an error case. There should always be an URL
@@ -499,15 +611,21 @@ def cmd_update(args, parser):
         else:
             url = metadata.url.decode("utf8")
 
-    if args.revision is not None:
+    if revision_arg is not None:
         # TODO verify revision
-        revision = args.revision
+        revision = revision_arg
     else:
         if metadata.revision is None:
             revision = None
         else:
             revision = metadata.revision.decode("utf8")
 
+    if subdir_arg is not None:
+        # An empty subdirectory integrates the whole repository again
+        subdir = None if subdir_arg == b"" else subdir_arg
+    else:
+        subdir = metadata.subdir
+
     assert isinstance(url, str)
     assert revision is None or isinstance(revision, str)
 
@@ -521,8 +639,8 @@ def cmd_update(args, parser):
     # TODO check that the subproject is in a clean state
 
     # For now check whether all patches are deapplied!
-    patches_dim = read_patches_dim(sub_paths, metadata)
-    subtree_dim = read_subtree_dim(metadata)
+    patches_dim = dims.patches_dim
+    subtree_dim = dims.subtree_dim
     ensure_dims_are_consistent(subtree_dim, patches_dim)
 
     if len(patches_dim.patches) > 0:
@@ -535,48 +653,187 @@ def cmd_update(args, parser):
             # TODO also check for linting issue, when default value is used!
             raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "subproject has patches applied. Please pop first!")
 
+    unchanged = (metadata.url is not None and metadata.url.decode("utf8") == url
+                 and (metadata.revision.decode("utf8") if metadata.revision is not None else None) == revision
+                 and metadata.subdir == subdir
+                 and metadata.object_id is not None and metadata.subtree_checksum is not None)
+
+    return UpdateJob(sub_paths, url, revision, subdir=subdir, bundle_path=bundle_path, unchanged=unchanged,
+                     metadata=metadata)
+
+
+# The first part of the network phase of the update: Resolve the revision in
+# the remote. If it still points to the integrated object, there is nothing to
+# fetch and to unpack. The cache is not used. The function must be thread
+# safe. It must not change the cwd.
+def do_update_resolve(super_paths: SuperPaths, job: UpdateJob) -> None:
+    cache_helper = job.cache_helper
+    assert cache_helper is not None
+    start = time.monotonic()
+    job.clone_config = cache_helper.resolve(DownloadConfig(url=job.url, revision=job.revision, subdir=job.subdir,
+                                                           bundle_path=job.bundle_path))
+    if job.unchanged:
+        assert job.metadata is not None
+        if job.clone_config.remote_object_id == job.metadata.object_id:
+            job.skip = True
+    job.fetch_time += time.monotonic() - start
+
+
+# The second part of the network phase of the update: Create the cache and
+# fetch into it. The function must be thread safe. It must not change the cwd.
+# NOTE: The caller must hold the CacheLock of the cache.
+def do_update_fetch(super_paths: SuperPaths, job: UpdateJob) -> None:
+    if job.skip:
+        return
+    cache_helper = job.cache_helper
+    assert cache_helper is not None
+    start = time.monotonic()
+    job.cache_abspath = do_cache_create(super_paths, cache_helper, job.url)
+
+    # subpatch cache fetch url -r version
+    assert job.metadata is not None
+    job.object_id = do_cache_fetch(cache_helper, job.cache_abspath, job.url, job.revision, job.clone_config, job.subdir,
+                                   job.metadata.object_id, job.bundle_path)
+    job.fetch_time += time.monotonic() - start
+
+
+# Call 'func' for all jobs in a pool of 'jobs' threads. Jobs that use the same
+# cache are processed one after the other in the same thread, because git does
+# not allow concurrent fetches into the same repository.
+def do_update_parallel(super_paths: SuperPaths, update_jobs: list[UpdateJob], jobs: int, func) -> None:
+    groups: dict[bytes, list[UpdateJob]] = {}
+    for job in update_jobs:
+        groups.setdefault(get_cache_key(job.url), []).append(job)
+
+    def process_group(group: list[UpdateJob]) -> None:
+        for job in group:
+            func(super_paths, job)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_group, group) for group in groups.values()]
+    # Raise the first error after all jobs are finished. Nothing was
+    # unpacked yet. So the superproject is not changed.
+    for future in futures:
+        future.result()
+
+
+def cmd_update(args, parser):
+    if args.all and len(args.paths) != 0:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Option '--all' cannot be used together with paths")
+    if not args.all and len(args.paths) == 0:
+        # TODO should also work when cwd is inside the subproject
+        raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "Must give path to subproject")
+    if args.jobs < 1:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "The number of jobs must be at least one")
+
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    ensure_superproject_is_git(superx)
+
+    super_paths = gen_super_paths(superx.path)
+
+    config = read_config(super_paths.config_abspath)
+
+    if args.all:
+        sub_paths_list = [gen_sub_paths_from_relpath(super_paths, path) for path in config.subprojects]
+    else:
+        sub_paths_list = [gen_sub_paths_from_cwd_and_relpath(super_paths, os.fsencode(path)) for path in args.paths]
+
+    # The output for a single subproject is printed while it is updated. For
+    # multiple subprojects the network phase runs in parallel first.
+    single = not args.all and len(args.paths) == 1
+
+    if not single and (args.url is not None or args.revision is not None or args.subdir is not None
+                       or args.from_bundle is not None):
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "Options '--url', '--revision', '--subdir' and '--from-bundle' can only be used with a single subproject")
+
+    if args.subdir is None:
+        subdir = None
+    elif args.subdir == "":
+        subdir = b""  # Drop the subdirectory from the metadata
+    else:
+        subdir = check_and_normalize_subdir(args.subdir)
+    bundle_path = None if args.from_bundle is None else check_and_get_bundle_abspath(args.from_bundle)
+
+    # Check all subprojects first. So an error does not leave the superproject
+    # in a partially updated state.
+    dims = read_subprojects_dims([sub_paths for sub_paths in sub_paths_list
+                                  if sub_paths.super_to_sub_relpath in config.subproject_index])
+    update_jobs = [prepare_update_job(superx, super_paths, config, sub_paths, args.url, args.revision, subdir,
+                                      bundle_path, dims.get(sub_paths.super_to_sub_relpath))
+                   for sub_paths in sub_paths_list]
+
+    # The subtree must also be unchanged to skip the update. E.g. the user may
+    # have staged changes in the subtree. Compute all checksums in one pass.
+    unchanged_jobs = [job for job in update_jobs if job.unchanged]
+    if len(unchanged_jobs) != 0:
+        with chdir(super_paths.super_abspath):
+            checksums = superx.helper.get_sha1_for_subtrees([job.sub_paths.super_to_sub_relpath for job in unchanged_jobs])
+        for job in unchanged_jobs:
+            assert job.metadata is not None
+            if checksums[job.sub_paths.super_to_sub_relpath] != job.metadata.subtree_checksum:
+                job.unchanged = False
+
     # TODO Move futher below to cache_create()
-    cache_helper = CacheHelperGit()
+    refs_cache = RefsCache(get_cache_root_abspath(super_paths.super_abspath), get_refs_ttl(), refresh=args.refresh)
+    for job in update_jobs:
+        job.cache_helper = get_cache_helper(job.url, refs_cache, refresh=args.refresh)
 
-    # TODO deapply all patches
+    if single:
+        do_update_resolve(super_paths, update_jobs[0])
+    else:
+        do_update_parallel(super_paths, update_jobs, args.jobs, do_update_resolve)
 
-    if not args.quiet:
-        # TODO printing is not correct. In case of an error, the newline is not
-        # printed!
-        print("Updating subproject '%s' from URL '%s' to revision '%s'..." %
-              (sub_paths.cwd_to_sub_relpath.decode("utf8"), url, cache_helper.get_revision_as_str(revision)),
-              end="")
-        sys.stdout.flush()
-
-    # subpatch download
-
-    # Optimizations:
-    # TODO if git, and revision is a commit or tag id, check that the new sha1/id
-    # is the same as the already integrated (not yet saved to config). If they are
-    # the same, no need to reintegrated!
-    # So do a pre-check with "git ls-remote"
-    # - Note: if there are subtree or exclude changes, update must still be done!
-    # TODO implement direct import into superproject optimization
-    #   And at best do not checkout, just import the git objects into the
-    #   current git and let git of the superproject/git check it out. git
-    #   should be super efficient about that.
-
-    # TODO Hardcoded assumption: The upstream is a git repo. So the cache is
-    # also a git repo.
-    cwd_to_cache_relpath = do_cache_create(sub_paths, cache_helper)
+    # Other subpatch processes may use the same caches at the same time. Hold
+    # the locks from the fetch until the unpack is finished. Otherwise another
+    # process could remove a cache in between, e.g. by 'cache gc'.
+    with lock_caches([get_cache_abspath(super_paths, job.url) for job in update_jobs if not job.skip]):
+        # TODO deapply all patches
 
-    # subpatch cache fetch url -r version
-    object_id = do_cache_fetch(cache_helper, cwd_to_cache_relpath, url, revision)
+        if not single:
+            do_update_parallel(super_paths, update_jobs, args.jobs, do_update_fetch)
 
-    # subpatch unpack
-    # TODO in case of an error, maybe cleanup also staging area
-    do_unpack_with_cleanup(superx, super_paths, sub_paths, cwd_to_cache_relpath, cache_helper, url, revision, object_id)
+        for job in update_jobs:
+            cache_helper = job.cache_helper
+            assert cache_helper is not None
+            if not args.quiet:
+                # TODO printing is not correct. In case of an error, the newline is not
+                # printed!
+                print("Updating subproject '%s' from URL '%s' to revision '%s'..." %
+                      (job.sub_paths.cwd_to_sub_relpath.decode("utf8"), job.url,
+                       cache_helper.get_revision_as_str(job.revision)),
+                      end="")
+                sys.stdout.flush()
+
+            # subpatch download
+            if single:
+                do_update_fetch(super_paths, job)
+
+            # subpatch unpack
+            # TODO in case of an error, maybe cleanup also staging area
+            if not job.skip:
+                assert job.cache_abspath is not None and job.object_id is not None
+                start = time.monotonic()
+                do_unpack(superx, super_paths, job.sub_paths, job.cache_abspath, cache_helper, job.url, job.revision,
+                          job.object_id, job.subdir)
+                job.unpack_time = time.monotonic() - start
+
+            # TODO reapply patches: subpatch push --all
+            # TODO only apply to the same index as before, not just all patches!
 
-    # TODO reapply patches: subpatch push --all
-    # TODO only apply to the same index as before, not just all patches!
+            if not args.quiet:
+                print(" Done.")
 
-    if not args.quiet:
-        print(" Done.")
+    do_cache_auto_gc(super_paths, [job.cache_abspath for job in update_jobs if job.cache_abspath is not None])
+
+    if not args.quiet and not single and len(update_jobs) != 0:
+        print("Timings (fetch/unpack):")
+        for job in update_jobs:
+            print("  %s: %.2fs/%.2fs" % (job.sub_paths.cwd_to_sub_relpath.decode("utf8"),
+                                         job.fetch_time, job.unpack_time))
 
     # TODO Think about the case when there are no changes in the subproject. Or
     # just no changes in the subtree. (e.g. just a rev/object_id update). Maybe
@@ -591,37 +848,86 @@ def cmd_update(args, parser):
     return 0
 
 
+# The subdirectory of the upstream repository must be a relative path inside
+# of the repository. Returns the normalized path without trailing slashes.
+def check_and_normalize_subdir(subdir: str) -> bytes:
+    subdir_bytes = subdir.encode("utf8").strip(b"/")
+    parts = subdir_bytes.split(b"/")
+    if subdir.startswith("/") or subdir_bytes == b"" or any(part in (b"", b".", b"..") for part in parts):
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "subdir '%s' is invalid" % (subdir,))
+    return subdir_bytes
+
+
+# Returns the absolute path of the bundle file. The path is relative to the
+# current work directory.
+def check_and_get_bundle_abspath(bundle: str) -> bytes:
+    bundle_abspath = os.path.abspath(os.fsencode(bundle))
+    if not os.path.isfile(bundle_abspath):
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Bundle file '%s' does not exist" % (bundle,))
+    return bundle_abspath
+
+
 # Argument config can be relpath or an abspath
 # TODO use other prefix "config_" for parser! prefix "config" is for the
 # subpatch config file.
 def config_add_subproject(config_path: bytes, super_to_sub_relpath: bytes) -> None:
+    config_document = read_config_document(config_path)
+
+    config_document.add_section(b"subprojects")
+    config_document.set_key_value(b"subprojects", b"path", super_to_sub_relpath, append=True)
+
+    write_file_atomically(config_path, config_document.unparse())
+
+
+# Returns an empty document if the file does not exist
+def read_config_document(path: bytes) -> ConfigDocument:
     try:
-        # TODO read as bytes instead of str type
-        with open(config_path, "br") as f:
-            config_lines = config_parse2(split_with_ts_bytes(f.read()))
+        with open(path, "br") as f:
+            return ConfigDocument(f.read())
     except FileNotFoundError:
-        config_lines = empty_config_lines()
+        return ConfigDocument()
 
-    config_lines = config_add_section2(config_lines, b"subprojects")
-    config_lines = config_set_key_value2(config_lines, b"subprojects", b"path", super_to_sub_relpath, append=True)
 
-    with open(config_path, "bw") as f:
-        # TODO parse and unparse are _not_ symmetric. Fix this
-        f.write(config_unparse2(config_lines))
+# Write the new file first and rename it. So a reader never sees a partial
+# file, even if subpatch is interrupted. If 'path' is a symbolic link, the
+# target of the link is replaced. The permissions of an existing file are
+# kept.
+def write_file_atomically(path: bytes, data: bytes, fsync: bool = False) -> None:
+    forget_parsed_file(path)
+    path = os.path.realpath(path)
+    forget_parsed_file(path)
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+    tmp_path = path + b".tmp%d" % (os.getpid(),)
+    try:
+        with open(tmp_path, "bw") as f:
+            if mode is not None:
+                os.fchmod(f.fileno(), mode)
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
 
 
 # TODO use CacheHelper instead of CacheHelperGit
-def do_cache_fetch(cache_helper: CacheHelperGit, cwd_to_cache_relpath: bytes, url: str, revision: str) -> bytes:
-    download_config = DownloadConfig(url=url, revision=revision)
+def do_cache_fetch(cache_helper: CacheHelperGit | CacheHelperArchive, cache_abspath: bytes, url: str, revision: str,
+                   clone_config: CloneConfig | None = None, subdir: bytes | None = None,
+                   integrated_object_id: bytes | None = None, bundle_path: bytes | None = None) -> bytes:
+    download_config = DownloadConfig(url=url, revision=revision, subdir=subdir, integrated_object_id=integrated_object_id,
+                                     bundle_path=bundle_path)
 
-    try:
-        return cache_helper.fetch(cwd_to_cache_relpath, download_config)
-    except Exception as e:
-        assert (os.path.isdir(cwd_to_cache_relpath))
-        # Need to use rmtree and not rmdir, because there are maybe more left
-        # over files and directories.
-        shutil.rmtree(cwd_to_cache_relpath)
-        raise e
+    # NOTE: In the error case the cache is not removed. It's persistent and
+    # still in a valid state.
+    return cache_helper.fetch(cache_abspath, download_config, clone_config)
 
 
 # Consolide into plumping commands
@@ -659,10 +965,17 @@ def cmd_add(args, parser):
             # TODO add reason why it's invalid
             raise AppException(ErrorCode.INVALID_ARGUMENT, "revision '%s' is invalid" % (revision,))
 
+    subdir = None if args.subdir is None else check_and_normalize_subdir(args.subdir)
+    bundle_path = None if args.from_bundle is None else check_and_get_bundle_abspath(args.from_bundle)
+
     # TODO check with ls-remote that remote is accessible
 
     if args.path is None:
         cwd_to_sub_relpath = get_name_from_repository_url(url)
+        # Use "foo-1.0" for the archive "foo-1.0.tar.gz"
+        archive_suffix = get_archive_suffix(cwd_to_sub_relpath)
+        if archive_suffix is not None:
+            cwd_to_sub_relpath = cwd_to_sub_relpath[:-len(archive_suffix)]
     else:
         cwd_to_sub_relpath = args.path
         # TODO split into path and name component
@@ -721,39 +1034,44 @@ def cmd_add(args, parser):
     # TODO in case of a later failure. Also revert this!
 
     # subpatch cache create --git
-    cache_helper = CacheHelperGit()
-    cwd_to_cache_relpath = do_cache_create(sub_paths, cache_helper)
+    cache_helper = get_cache_helper(url, RefsCache(get_cache_root_abspath(super_paths.super_abspath), get_refs_ttl(),
+                                                   refresh=args.refresh), refresh=args.refresh)
+    # Other subpatch processes may use the same cache at the same time
+    with CacheLock(get_cache_abspath(super_paths, url)):
+        cache_abspath = do_cache_create(super_paths, cache_helper, url)
+
+        # TODO in case of a later failure. Also revert this!
+
+        # NOTE: Design decision: The output is relative to the current working dir.
+        # The content of '%s' is the remote git name or the path relative to the
+        # current working dir. It's not relative to the top level dir of the git repo.
+        # TODO move this design decision to the website
+        if not args.quiet:
+            print("Adding subproject '%s' from URL '%s' at revision '%s'..." %
+                  (sub_paths.cwd_to_sub_relpath.decode("utf8"), url, cache_helper.get_revision_as_str(revision)),
+                  end="")
+            sys.stdout.flush()
 
-    # TODO in case of a later failure. Also revert this!
+        try:
+            # subpatch cache fetch url -r version
+            object_id = do_cache_fetch(cache_helper, cache_abspath, url, revision, subdir=subdir, bundle_path=bundle_path)
 
-    # NOTE: Design decision: The output is relative to the current working dir.
-    # The content of '%s' is the remote git name or the path relative to the
-    # current working dir. It's not relative to the top level dir of the git repo.
-    # TODO move this design decision to the website
-    if not args.quiet:
-        print("Adding subproject '%s' from URL '%s' at revision '%s'..." %
-              (sub_paths.cwd_to_sub_relpath.decode("utf8"), url, cache_helper.get_revision_as_str(revision)),
-              end="")
-        sys.stdout.flush()
+            # subpatch unpack
+            do_unpack(superx, super_paths, sub_paths, cache_abspath, cache_helper, url, revision, object_id, subdir)
+        except Exception as e:
+            # If there is any exception, still print the final new line character.
+            # Otherwise the error message that is printed is not beginning at the
+            # start of the line.
+            if not args.quiet:
+                print(" Failed.")
+                sys.stdout.flush()
+            raise e
+        else:
+            if not args.quiet:
+                print(" Done.")
+                # TODO is flush() also needed here?
 
-    try:
-        # subpatch cache fetch url -r version
-        object_id = do_cache_fetch(cache_helper, cwd_to_cache_relpath, url, revision)
-
-        # subpatch unpack
-        do_unpack_with_cleanup(superx, super_paths, sub_paths, cwd_to_cache_relpath, cache_helper, url, revision, object_id)
-    except Exception as e:
-        # If there is any exception, still print the final new line character.
-        # Otherwise the error message that is printed is not beginning at the
-        # start of the line.
-        if not args.quiet:
-            print(" Failed.")
-            sys.stdout.flush()
-        raise e
-    else:
-        if not args.quiet:
-            print(" Done.")
-            # TODO is flush() also needed here?
+    do_cache_auto_gc(super_paths, [cache_abspath])
 
     # TODO Idea "subpatch status" should print the info/help text. The status
     # command should be command to get help if a user is lost.
@@ -781,6 +1099,7 @@ def show_info(args) -> int:
 def do_configure(super_abspath: bytes, super_helper: SuperHelper) -> None:
     config_abspath = join(super_abspath, b".subpatch")
     assert not os.path.exists(config_abspath)
+    forget_parsed_file(config_abspath)
     with open(config_abspath, "bw"):
         pass
 
@@ -858,21 +1177,55 @@ def gen_super_paths(super_abspath: bytes) -> SuperPaths:
 
 
 def is_inside_subproject_and_return_path(config: Config, super_paths: SuperPaths) -> bytes | None:
-    # This algorithm was too simple. E.g the paths
-    #   ["subproject", "subproject-second"]
-    # with cwd "subproject/subdir", was not recognized correctly.
-    # Now the algorithm does not make a string compare, it converts the paths
-    # to list and compare the list entries.
-    super_to_cwd_relpath_parts = super_paths.super_to_cwd_relpath.split(b"/")
-    for relpath in config.subprojects:
-        # TODO assert that relpath is sane!
-        # TODO introduce naming convention. How are the parts of a path called?
-        # "parts", "path components" or "filenames"?
-        relpath_parts = relpath.split(b"/")
-        amount_of_same_components = min(len(relpath_parts), len(super_to_cwd_relpath_parts))
-        if relpath_parts[:amount_of_same_components] == super_to_cwd_relpath_parts[:amount_of_same_components]:
-            return relpath
-    return None
+    # NOTE: The lookup compares path components and not strings. So for the
+    # paths ["subproject", "subproject-second"] the cwd "subproject-second/subdir"
+    # is only inside the second subproject.
+    return config.subproject_index.find(super_paths.super_to_cwd_relpath)
+
+
+# Collects all modifications of the metadata of a subproject. The metadata
+# file is parsed once and written once by commit(). Use it with
+# metadata_transaction().
+class MetadataTransaction:
+    def __init__(self, sub_paths: SubPaths):
+        self.metadata_abspath = sub_paths.metadata_abspath
+        self._document = read_config_document(sub_paths.metadata_abspath)
+        self._changed = False
+
+    # Adds the section if it does not exist yet
+    def set(self, section_name: bytes, key: bytes, value: bytes) -> None:
+        self._document.add_section(section_name)
+        self._document.set_key_value(section_name, key, value)
+        self._changed = True
+
+    # Drops also the section if it's empty afterwards
+    def drop(self, section_name: bytes, key: bytes) -> None:
+        self._document.drop_key(section_name, key)
+        self._document.drop_section_if_empty(section_name)
+        self._changed = True
+
+    # Returns whether the metadata file was written
+    def commit(self, fsync: bool = False) -> bool:
+        if not self._changed:
+            return False
+        write_file_atomically(self.metadata_abspath, self._document.unparse(), fsync)
+        self._changed = False
+        return True
+
+
+# Usage:
+#     with metadata_transaction(sub_paths, superx.helper) as m:
+#         m.set(b"subtree", b"checksum", checksum)
+#
+# The metadata file is written at the end of the block. If there is an
+# exception in the block, the file is not touched. If a 'super_helper' is
+# given, the written file is also added to the superproject.
+@contextmanager
+def metadata_transaction(sub_paths: SubPaths, super_helper: SuperHelper | None = None, fsync: bool = False):
+    m = MetadataTransaction(sub_paths)
+    yield m
+    if m.commit(fsync) and super_helper is not None:
+        super_helper.add([sub_paths.metadata_abspath])
 
 
 # TODO currently this always uses "\t" for indention. Try to use the style
@@ -882,76 +1235,18 @@ def is_inside_subproject_and_return_path(config: Config, super_paths: SuperPaths
 # of the argument. If there is a trailing slash in the argument, then the
 # trailing slash is also in the config file. It's not sanitized. It's the
 # same behavior as 'git submodule' does.
-def metadata_set_for_unpack(sub_paths: SubPaths, url: str, revision: str | None, object_id: bytes,
-                            subtree_checksum: bytes | None = None) -> None:
-    try:
-        with open(sub_paths.metadata_abspath, "br") as f:
-            metadata_lines = config_parse2(split_with_ts_bytes(f.read()))
-    except FileNotFoundError:
-        metadata_lines = empty_config_lines()
-
-    metadata_lines = config_add_section2(metadata_lines, b"upstream")
-    metadata_lines = config_set_key_value2(metadata_lines, b"upstream", b"url", url.encode("utf8"))
+def metadata_set_for_unpack(m: MetadataTransaction, url: str, revision: str | None, object_id: bytes,
+                            subtree_checksum: bytes | None = None, subdir: bytes | None = None) -> None:
+    m.set(b"upstream", b"url", url.encode("utf8"))
     if revision is not None:
-        metadata_lines = config_set_key_value2(metadata_lines, b"upstream", b"revision", revision.encode("utf8"))
+        m.set(b"upstream", b"revision", revision.encode("utf8"))
+    if subdir is not None:
+        m.set(b"upstream", b"subdir", subdir)
+    else:
+        m.drop(b"upstream", b"subdir")
     if subtree_checksum is not None:
-        metadata_lines = config_add_section2(metadata_lines, b"subtree")
-        metadata_lines = config_set_key_value2(metadata_lines, b"subtree", b"checksum", subtree_checksum)
-    metadata_lines = config_set_key_value2(metadata_lines, b"upstream", b"objectId", object_id)
-
-    metadata_config = config_unparse2(metadata_lines)
-    with open(sub_paths.metadata_abspath, "bw") as f:
-        f.write(metadata_config)
-
-
-# TODO maybe use metadata_abspath instead of SubPaths
-# TODO Mabye this "metadata_*" is the new naming convention with verbs "set", "drop"
-def metadata_set_applied_index(sub_paths: SubPaths, applied_index: int) -> None:
-    try:
-        with open(sub_paths.metadata_abspath, "br") as f:
-            metadata_lines = config_parse2(split_with_ts_bytes(f.read()))
-    except FileNotFoundError:
-        metadata_lines = empty_config_lines()
-
-    metadata_lines = config_add_section2(metadata_lines, b"subtree")
-    metadata_lines = config_set_key_value2(metadata_lines, b"subtree", b"appliedIndex", b"%d" % (applied_index,))
-
-    metadata_config = config_unparse2(metadata_lines)
-    with open(sub_paths.metadata_abspath, "bw") as f:
-        f.write(metadata_config)
-
-
-# TODO maybe use metadata_abspath instead of SubPaths
-# TODO refactor with other update commands
-def metadata_set_subtree_checksum(sub_paths: SubPaths, subtree_checksum: bytes) -> None:
-    try:
-        with open(sub_paths.metadata_abspath, "br") as f:
-            metadata_lines = config_parse2(split_with_ts_bytes(f.read()))
-    except FileNotFoundError:
-        metadata_lines = empty_config_lines()
-
-    metadata_lines = config_add_section2(metadata_lines, b"subtree")
-    metadata_lines = config_set_key_value2(metadata_lines, b"subtree", b"checksum", subtree_checksum)
-
-    metadata_config = config_unparse2(metadata_lines)
-    with open(sub_paths.metadata_abspath, "bw") as f:
-        f.write(metadata_config)
-
-
-# TODO maybe use metadata_abspath instead of SubPaths
-def metadata_drop_applied_index(sub_paths: SubPaths) -> None:
-    try:
-        with open(sub_paths.metadata_abspath, "br") as f:
-            metadata_lines = config_parse2(split_with_ts_bytes(f.read()))
-    except FileNotFoundError:
-        metadata_lines = empty_config_lines()
-
-    metadata_lines = config_drop_key2(metadata_lines, b"subtree", b"appliedIndex")
-    metadata_lines = config_drop_section_if_empty(metadata_lines, b"subtree")
-
-    metadata_config = config_unparse2(metadata_lines)
-    with open(sub_paths.metadata_abspath, "bw") as f:
-        f.write(metadata_config)
+        m.set(b"subtree", b"checksum", subtree_checksum)
+    m.set(b"upstream", b"objectId", object_id)
 
 
 def is_cwd_toplevel_directory(super_paths: SuperPaths) -> bool:
@@ -1222,16 +1517,14 @@ def do_patch_applys(superx: Superproject, super_paths: SuperPaths, sub_paths: Su
         # TODO explain how to recover!
         raise Exception("git failure")
 
-    if to_applied_index == len(patches_dim.patches) - 1:
-        # Now all patches are applied. Drop the information from the metadata.
-        # The default value is that all (tracked) patches are applied!
-        metadata_drop_applied_index(sub_paths)
-    else:
-        metadata_set_applied_index(sub_paths, to_applied_index)
-
-    with chdir(super_paths.super_abspath):
-        # TODO here is not relative path used for git. This seems also to work!
-        superx.helper.add([sub_paths.metadata_abspath])
+    # TODO here is not relative path used for git. This seems also to work!
+    with chdir(super_paths.super_abspath), metadata_transaction(sub_paths, superx.helper) as m:
+        if to_applied_index == len(patches_dim.patches) - 1:
+            # Now all patches are applied. Drop the information from the metadata.
+            # The default value is that all (tracked) patches are applied!
+            m.drop(b"subtree", b"appliedIndex")
+        else:
+            m.set(b"subtree", b"appliedIndex", b"%d" % (to_applied_index,))
 
 
 def cmd_pop(args, parser):
@@ -1355,7 +1648,8 @@ def do_init(super_paths: SuperPaths, sub_paths: SubPaths, superx: Superproject)
                            "File '%s' already exists. Cannot add subproject!" % (sub_paths.metadata_abspath.decode("utf8"),))
 
     os.makedirs(sub_paths.cwd_to_sub_relpath)
-    with open(join(sub_paths.cwd_to_sub_relpath, b".subproject"), "bw"):
+    forget_parsed_file(sub_paths.metadata_abspath)
+    with open(sub_paths.metadata_abspath, "bw"):
         pass
 
     with chdir(super_paths.super_abspath):
@@ -1405,6 +1699,88 @@ def cmd_patches_list(args, parser):
     return 0
 
 
+# Writes the integrated revision of the subproject to a git bundle file. The
+# bundle can be used with '--from-bundle' on a machine without access to the
+# remote repository.
+def cmd_cache_export_bundle(args, parser):
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    ensure_superproject_is_git(superx)
+
+    super_paths = gen_super_paths(superx.path)
+    config = read_config(super_paths.config_abspath)
+    sub_paths = gen_sub_paths_from_cwd_and_relpath(super_paths, os.fsencode(args.path))
+
+    if sub_paths.super_to_sub_relpath not in config.subproject_index:
+        x = sub_paths.super_to_sub_relpath.decode("utf8")
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Path '%s' does not point to a subproject" % (x,))
+
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    if metadata.url is None or metadata.object_id is None:
+        # TODO This is not a INVALID_ARGUMENT, it's a state error
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Subproject has no integrated revision. So there is nothing to export!")
+
+    url = metadata.url.decode("utf8")
+    if get_archive_suffix(url) is not None:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Bundles can only be used for git repositories!")
+    revision = None if metadata.revision is None else metadata.revision.decode("utf8")
+    bundle_abspath = os.path.abspath(os.fsencode(args.bundle))
+
+    cache_helper = CacheHelperGit()
+    # NOTE: Relative URLs are relative to the toplevel directory of the
+    # superproject.
+    with chdir(super_paths.super_abspath), CacheLock(get_cache_abspath(super_paths, url)):
+        cache_abspath = do_cache_create(super_paths, cache_helper, url)
+        # The cache may not contain the integrated revision, e.g. if the
+        # subproject was added in another clone of the superproject.
+        if not cache_helper.has_commit(cache_abspath, metadata.object_id):
+            do_cache_fetch(cache_helper, cache_abspath, url, metadata.object_id.decode("ascii"), subdir=metadata.subdir)
+
+        cache_helper.export_bundle(cache_abspath, bundle_abspath, revision, metadata.object_id)
+
+    if not args.quiet:
+        print("Exported subproject '%s' at revision '%s' to bundle '%s'." %
+              (sub_paths.cwd_to_sub_relpath.decode("utf8"), cache_helper.get_revision_as_str(revision), args.bundle))
+
+    return 0
+
+
+# Compacts all caches of the superproject. If a maximum size is given, the
+# least recently used caches are removed until the size is not exceeded.
+def cmd_cache_gc(args, parser):
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_git(superx)
+
+    if args.max_size is not None:
+        max_size = check_and_parse_cache_max_size(args.max_size)
+    else:
+        max_size = get_cache_max_size()
+
+    super_paths = gen_super_paths(superx.path)
+    root_abspath = get_cache_root_abspath(super_paths.super_abspath)
+
+    for cache_abspath in list_caches(root_abspath):
+        with CacheLock(cache_abspath):
+            # Another process may have removed the cache in the meantime
+            if os.path.isdir(cache_abspath):
+                get_cache_helper_for_cache(cache_abspath).compact(cache_abspath)
+
+    if max_size is not None:
+        for cache_abspath, size in evict_caches(root_abspath, max_size):
+            if not args.quiet:
+                print("Removed cache '%s' (%d bytes)" % (os.path.basename(cache_abspath).decode("ascii"), size))
+
+    if not args.quiet:
+        caches = list_caches(root_abspath)
+        print("%d caches use %d bytes" % (len(caches), sum(get_dir_size(path) for path in caches)))
+
+    return 0
+
+
 def cmd_subtree_checksum(args, parser):
     if sum(1 for x in [args.write, args.verify, args.calc, args.get] if x) != 1:
         raise AppException(ErrorCode.INVALID_ARGUMENT, "You must exactly use one of --get, --calc, --write or --verify!")
@@ -1450,17 +1826,17 @@ def cmd_subtree_checksum(args, parser):
         checksum = superx.helper.get_sha1_for_subtree(sub_paths.super_to_sub_relpath)
 
         # TODO mabye this should also have an output to stdout?
-        metadata_set_subtree_checksum(sub_paths, checksum)
-
-        # TODO Other commands like add and update, add the file to the staging
-        # area. Maybe do the same here to be consistent.
+        # NOTE: Like add and update, the metadata file is added to the
+        # staging area.
+        with metadata_transaction(sub_paths, superx.helper) as m:
+            m.set(b"subtree", b"checksum", checksum)
 
         return 0
     else:
         assert False
 
 
-def do_status_subproject(super_paths: SuperPaths, subproject: bytes, changes) -> None:
+def do_status_subproject(subproject: bytes, dims: SubprojectDims, changes) -> None:
     # TODO Idea: make it valid markdown output
     # TODO Idea: For every cvs superproject (superhelper) make the output
     # like the cvs styled of console output. Subpach should look like git
@@ -1470,8 +1846,7 @@ def do_status_subproject(super_paths: SuperPaths, subproject: bytes, changes) ->
     # TODO use the term "dimensions" also in the output to make the
     # dimension for understandable for the user.
 
-    sub_paths = gen_sub_paths_from_relpath(super_paths, subproject)
-    metadata = read_metadata(sub_paths.metadata_abspath)
+    metadata = dims.metadata
 
     # TODO again some bytes to string decoding. Annoying!
     subproject_str = subproject.decode("utf8")
@@ -1490,8 +1865,8 @@ def do_status_subproject(super_paths: SuperPaths, subproject: bytes, changes) ->
         print("* has integrated object id: %s" % (metadata.object_id.decode("utf8"),))
 
     # Get count of patches for subproject and other information
-    patches_dim = read_patches_dim(sub_paths, metadata)
-    subtree_dim = read_subtree_dim(metadata)
+    patches_dim = dims.patches_dim
+    subtree_dim = dims.subtree_dim
     ensure_dims_are_consistent(subtree_dim, patches_dim)
 
     p = subproject_str
@@ -1593,32 +1968,20 @@ def cmd_status(args, parser):
         # TODO maybe add a plumbing command for that to expose to scripting!
         super_to_sub_relpath = os.path.normpath(super_to_sub_relpath)
 
-        if super_to_sub_relpath not in config.subprojects:
+        if super_to_sub_relpath not in config.subproject_index:
             raise AppException(ErrorCode.INVALID_ARGUMENT,
                                "Argument '%s' does not point to a subproject!" % (args.path,))
         subprojects = [super_to_sub_relpath]
+        subproject_index = SubprojectIndex(subprojects)
     else:
         # These are relative paths: super_to_sub_relpath
         subprojects = config.subprojects
+        subproject_index = config.subproject_index
 
     if len(subprojects) == 0:
         # Early return. Nothing to print!
         return 0
 
-    # TODO does the concept of staged and unstaged files als exists in other
-    # cvs systems
-    with chdir(super_paths.super_abspath):
-        # TODO make a test and use a real fix. For now just chdir to the
-        # toplevel repo, but `git diff` is affected by the diff.relative option
-        # that the user may have active or not.
-        diff_files_not_staged = git_diff_name_only()
-        diff_files_staged = git_diff_name_only(staged=True)
-
-    # NOTE git_ls_files_untracked() depends on the cwd for now! Cwd must be the
-    # root of the directory for now.
-    with chdir(super_paths.super_abspath):
-        ls_files_untrack = git_ls_files_untracked()
-
     # TODO refactor this struct and the following code to a function! And make
     # to interface for other cvs
     @dataclass
@@ -1631,20 +1994,27 @@ def cmd_status(args, parser):
     for path in subprojects:
         subproject_changes[path] = Changes()
 
-    for subproject in subprojects:
-        # TODO str vs bytes mismatch
-        changes = subproject_changes[subproject]
-
-        for path in ls_files_untrack:
-            if path.startswith(subproject + b"/"):
-                changes.untracked += 1
+    subprojects_dims = read_subprojects_dims([gen_sub_paths_from_relpath(super_paths, path) for path in subprojects])
 
-        for path in diff_files_staged:
-            if path.startswith(subproject + b"/"):
+    # TODO does the concept of staged and unstaged files als exists in other
+    # cvs systems
+    # NOTE: The paths in the output are always relative to the toplevel
+    # directory. So config options like diff.relative do not matter.
+    for entry in git_status_porcelain_v2(subprojects, cwd=super_paths.super_abspath):
+        subproject = subproject_index.find(entry.path)
+        if subproject is None:
+            continue
+        changes = subproject_changes[subproject]
+        if entry.status_type == StatusType.UNTRACKED:
+            changes.untracked += 1
+        elif entry.status_type == StatusType.IGNORED:
+            pass
+        else:
+            assert entry.xy is not None
+            # Unmerged entries are counted in both categories
+            if entry.xy[0:1] != b".":
                 changes.uncommitted += 1
-
-        for path in diff_files_not_staged:
-            if path.startswith(subproject + b"/"):
+            if entry.xy[1:2] != b".":
                 changes.unstaged += 1
 
     print("NOTE: The format of the output is human-readable and unstable. Do not use in scripts!")
@@ -1657,7 +2027,7 @@ def cmd_status(args, parser):
     for i, subproject in enumerate(subprojects):
         changes = subproject_changes[subproject]
 
-        do_status_subproject(super_paths, subproject, changes)
+        do_status_subproject(subproject, subprojects_dims[subproject], changes)
 
         if i + 1 < len(subprojects):
             # Add a empty line between the subprojects
@@ -1735,6 +2105,13 @@ def main_wrapped() -> int:
                             help="Specify the revision to integrate. Can be a branch name, tag name or commit id.")
     parser_add.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
                             help="Suppress output to stdout")
+    parser_add.add_argument("--refresh", action="store_true",
+                            help="Resolve the revision in the remote repository even if the cached result is recent. "
+                                 "Also try all fetch optimizations again")
+    parser_add.add_argument("--subdir", dest="subdir", type=str,
+                            help="Only integrate this subdirectory of the remote repository")
+    parser_add.add_argument("--from-bundle", dest="from_bundle", type=str,
+                            help="Take the revision from this git bundle file instead of the remote repository")
 
     # TODO maybe find better name than "sync"
     parser_sync = subparsers.add_parser("sync",
@@ -1746,12 +2123,23 @@ def main_wrapped() -> int:
     parser_update = subparsers.add_parser("update",
                                           help="Fetch and update a subproject")
     parser_update.set_defaults(func=cmd_update)
-    parser_update.add_argument(dest="path", type=str, default=None, nargs='?',
-                               help="path to subproject")
+    parser_update.add_argument(dest="paths", type=str, nargs='*',
+                               help="paths to subprojects")
+    parser_update.add_argument("--all", action="store_true",
+                               help="Update all subprojects")
+    parser_update.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                               help="Number of subprojects that are fetched in parallel. Defaults to 1.")
+    parser_update.add_argument("--refresh", action="store_true",
+                               help="Resolve the revisions in the remote repositories even if the cached results are recent. "
+                                    "Also try all fetch optimizations again")
     parser_update.add_argument("--url", dest="url", type=str,
                                help="URL or path to the remote git repo")
     parser_update.add_argument("-r", "--revision", dest="revision", type=str,
                                help="Specify the revision to integrate. Can be a branch name, tag name or commit id.")
+    parser_update.add_argument("--subdir", dest="subdir", type=str,
+                               help="Only integrate this subdirectory of the remote repository")
+    parser_update.add_argument("--from-bundle", dest="from_bundle", type=str,
+                               help="Take the revision from this git bundle file instead of the remote repository")
     parser_update.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
                                help="Suppress output to stdout")
 
@@ -1790,6 +2178,26 @@ def main_wrapped() -> int:
                                          help="Suppress output to stdout")
     parser_subtree_checksum.set_defaults(func=cmd_subtree_checksum)
 
+    parser_cache = subparsers.add_parser("cache",
+                                         help="Commands to modify/query the caches of the upstream repositories")
+    subparsers_cache = parser_cache.add_subparsers()
+    parser_cache_export_bundle = subparsers_cache.add_parser("export-bundle",
+                                                             help="Write the integrated revision of a subproject to a git bundle file")
+    parser_cache_export_bundle.add_argument(dest="path", type=str,
+                                            help="path to the subproject")
+    parser_cache_export_bundle.add_argument(dest="bundle", type=str,
+                                            help="path of the bundle file")
+    parser_cache_export_bundle.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                                            help="Suppress output to stdout")
+    parser_cache_export_bundle.set_defaults(func=cmd_cache_export_bundle)
+    parser_cache_gc = subparsers_cache.add_parser("gc",
+                                                  help="Compact the caches and remove the least recently used ones")
+    parser_cache_gc.add_argument("--max-size", dest="max_size", type=str,
+                                 help="Maximum size of all caches in bytes. Defaults to SUBPATCH_CACHE_MAX_SIZE.")
+    parser_cache_gc.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                                 help="Suppress output to stdout")
+    parser_cache_gc.set_defaults(func=cmd_cache_gc)
+
     parser_help = subparsers.add_parser("help",
                                         help="Also shows the help message")
     parser_help.set_defaults(func=cmd_help)
@@ -5,8 +5,9 @@ from enum import Enum
 from os.path import abspath, join
 
 # ----8<----
-from libgit import (git_add, git_diff_staged_shortstat, git_cat_file_pretty,
-                    git_hash_object_tree)
+from libgit import (git_add, git_diff_staged_shortstat, git_get_object_reader,
+                    git_hash_object_tree, serialize_tree_object, git_read_index,
+                    index_get_tree_ids, GitObjectWriter)
 from util import AppException, ErrorCode
 # ----8<----
 
@@ -194,6 +195,22 @@ class SuperHelperGit(SuperHelper):
     # subproject.
     # NOTE: This must take files in the index into account!
     def get_sha1_for_subtree(self, super_to_sub_relpath: bytes) -> bytes:
+        return self.get_sha1_for_subtrees([super_to_sub_relpath])[super_to_sub_relpath]
+
+    # Same as get_sha1_for_subtree(), but for multiple subprojects. The index
+    # file is only read once.
+    def get_sha1_for_subtrees(self, super_to_sub_relpaths: list[bytes]) -> dict[bytes, bytes]:
+        index = git_read_index()
+        if index is None:
+            # The index format is not supported. Fallback to git itself.
+            return {path: self.get_sha1_for_subtree_with_write_tree(path) for path in super_to_sub_relpaths}
+
+        writer = GitObjectWriter()
+        sha1s = index_get_tree_ids(index, super_to_sub_relpaths, writer, exclude_names=(b"patches", b".subproject"))
+        writer.flush()
+        return sha1s
+
+    def get_sha1_for_subtree_with_write_tree(self, super_to_sub_relpath: bytes) -> bytes:
         # TODO this function is just a hacky first version. There at least path
         # escaping any mabye other problems!
 
@@ -211,36 +228,9 @@ class SuperHelperGit(SuperHelper):
     # TODO refactor!!!!
     # TODO Move function to git.py. It's should not be part of the SuperHepler!
     def strip_tree_object(self, sha1: bytes) -> bytes:
-        tree_data_pretty = git_cat_file_pretty(sha1)
-
-        # The pretty format looks like
-        #    100644 blob bf252b96c379a66383f5ac9b605b1633bd39362e\ta
-        #    100644 blob bf252b96c379a66383f5ac9b605b1633bd39362e\tb
-
-        tree_data_pretty_stripped = []
-        for line in tree_data_pretty.split(b"\n"):
-            if line == b"":
-                continue
-            if line.endswith(b"\tpatches") or line.endswith(b"\t.subproject"):
-                pass
-            else:
-                tree_data_pretty_stripped.append(line)
-
-        # TODO git specifc stuff should be in the "git.py" file
-        # The binary format looks like
-        #    <mode in octal> <one space> <filename> <NULL byte> <SHA1 as bytes>
-
-        # Convert from pretty into binary format
-        new_tree_data = b""
-        for line in tree_data_pretty_stripped:
-            mode_type_sha1, path = line.split(b"\t", 1)
-            mode, _, sha1 = mode_type_sha1.split(b" ")
-            # Convert mode
-            if mode == b"040000":
-                mode = b"40000"
-            new_tree_data += mode + b" " + path + b"\0" + bytearray.fromhex(sha1.decode("ascii"))
-
-        return git_hash_object_tree(new_tree_data)
+        entries = git_get_object_reader().tree_entries(sha1)
+        entries = [entry for entry in entries if entry.name not in (b"patches", b".subproject")]
+        return git_hash_object_tree(serialize_tree_object(entries))
 
     # TODO argument 'stat' is kind of a hack for now!
     def get_diff_for_subtree(self, super_to_sub_relpath: bytes, stat: bool = False) -> bytes:
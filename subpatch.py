@@ -0,0 +1,5431 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+# SPDX-FileCopyrightText: Copyright (C) 2024 Stefan Lengfeld
+#
+# /// script
+# requires-python = ">=3.11"
+# dependencies = []
+# ///
+
+# bundler: file src/util.py
+
+from enum import Enum
+
+
+class URLTypes(Enum):
+    LOCAL_RELATIVE = 1
+    LOCAL_ABSOLUTE = 2
+    REMOTE = 3
+
+
+def get_url_type(url):
+    if len(url) == 0:
+        raise ValueError("The URL is empty!")
+
+    # TODO mabye using url parsing library?
+    # TODO Implemente "file://" prefix
+    if url.startswith("http"):
+        return URLTypes.REMOTE
+    elif url.startswith("git"):
+        return URLTypes.REMOTE
+    elif url.startswith("ssh"):
+        return URLTypes.REMOTE
+    if "://" in url:
+        raise NotImplementedError("The URL '%s' is not implemented yet" % (url,))
+
+    # Is mostly just a local path
+    if url[0] == "/":
+        return URLTypes.LOCAL_ABSOLUTE
+
+    return URLTypes.LOCAL_RELATIVE
+
+
+# TODO Write blogpost about common error categories, e.g. in HTTP and errno
+# E.g. there is also
+#  * invalid argument/Bad request
+#  * (generic) runtime error (maybe the same as IO error)
+#  * permission denied
+#  * NotImplemented/Does not exists
+class ErrorCode(Enum):
+    # TODO distinguish between "not implemented" and "not implemented __yet__"!
+    # Not implemented should mostly be a invalid argument then
+    NOT_IMPLEMENTED_YET = 2
+    SUPERPROJECT_NOT_FOUND = 3  # if no scm system found and no config found
+    SUPERPROJECT_NOT_CONFIGURED = 4
+    # The user has given an invalid argument on the command line
+    INVALID_ARGUMENT = 5
+    # TODO For now this is named INVALID_STATE. Maybe find better name.
+    INVALID_STATE = 7
+    # TODO remove this type. Every ErrorCode should support a message.
+    CUSTOM = 6
+
+
+class AppException(Exception):
+    def __init__(self, code, msg=None):
+        self._code = code
+        if msg is not None:
+            super().__init__(msg)
+        else:
+            super().__init__()
+
+    def get_code(self):
+        return self._code
+
+# bundler: file src/libconfig.py
+
+import bisect
+import re
+from collections.abc import Generator
+from dataclasses import dataclass
+from enum import Enum
+from typing import TypeAlias
+
+# TODO find better name for this library. It's a parser for the git config
+# styled ini files. But the name "config" conflicts with the "subpatch config".
+
+
+# Split with terminator semantics
+def split_with_ts(s):
+    len_s = len(s)
+    pos = 0
+    while pos < len_s:
+        new_pos = s.find("\n", pos)
+        if new_pos == -1:
+            # newline character not found anymore
+            new_pos = len_s - 1
+        yield s[pos:new_pos + 1]
+        pos = new_pos + 1
+
+
+# Same as split_with_ts_bytes(), but yields the tuple (offset, length) of
+# every line instead of copying the line into a new bytes object.
+def split_with_ts_offsets(s: bytes) -> Generator[tuple[int, int], None, None]:
+    len_s = len(s)
+    pos = 0
+    while pos < len_s:
+        new_pos = s.find(b"\n", pos)
+        if new_pos == -1:
+            # newline character not found anymore
+            new_pos = len_s - 1
+        yield pos, new_pos + 1 - pos
+        pos = new_pos + 1
+
+
+def split_with_ts_bytes(s: bytes) -> Generator[bytes, None, None]:
+    for offset, length in split_with_ts_offsets(s):
+        yield s[offset:offset + length]
+
+
+class LineType(Enum):
+    EMPTY = 1
+    COMMENT = 2
+    HEADER = 3  # TODO rename to SECTION_HEADER
+    # "man git-config" uses the nomenclature inconsistently. It uses 'name' and
+    # 'key' for the same thing.  We stick to "key" here. It's "key (name)".
+    KEY_VALUE = 4
+
+
+@dataclass(frozen=True)
+class LineDataKeyValue:
+    key: bytes
+    value: bytes
+
+
+@dataclass(frozen=True)
+class LineDataHeader:
+    section_name: bytes
+    subsection_name: bytes | None
+
+
+@dataclass(frozen=True)
+class LineDataEmpty:
+    pass
+
+
+@dataclass(frozen=True)
+class ConfigLine:
+    line_orig: bytes
+    # NOTE: Here I would really like to have rust enums. Actually the tagged
+    # union approach is just a work around.
+    # TODO hmm, maybe I should use "instanceof" instead?
+    line_type: LineType
+    line_data: LineDataKeyValue | LineDataHeader | LineDataEmpty
+
+
+GeneratorConfigLine: TypeAlias = Generator[ConfigLine, None, None]
+
+
+# Same as the whitespace characters of bytes.lstrip()
+_whitespace_re = re.compile(b"[ \t\n\r\x0b\x0c]*")
+
+
+# Returns the type of the line data[offset:end] without copying the line
+def config_get_line_type(data: bytes, offset: int, end: int) -> LineType:
+    match = _whitespace_re.match(data, offset, end)
+    assert match is not None
+    pos = match.end()
+    if pos == end:
+        return LineType.EMPTY
+    first_char = data[pos]
+    if first_char in (ord(b'#'), ord(b';')):
+        return LineType.COMMENT
+    elif first_char == ord(b'['):
+        return LineType.HEADER
+    # This is mostly a variable line
+    return LineType.KEY_VALUE
+
+
+# Scan the config file in 'data' and yield the tuple (offset, length,
+# line_type) for every line. The lines are not copied. Use
+# config_parse_line() to parse only the lines that are interesting.
+def config_scan(data: bytes) -> Generator[tuple[int, int, LineType], None, None]:
+    for offset, length in split_with_ts_offsets(data):
+        yield offset, length, config_get_line_type(data, offset, offset + length)
+
+
+# config format of git is descriped here
+#   https://git-scm.com/docs/git-config#_configuration_file
+#
+# Parse git-style config file.
+# See https://git-scm.com/docs/git-config
+# The syntax is described here:
+#    https://git-scm.com/docs/git-config/2.12.5#_syntax
+# Goal: The parsed result can be converted back to the lines object with a 1to1 mapping
+# NOTES:
+# - not supporting "[section.subsection]" syntax
+# - not supporting continouation lines yet
+# - not supporting comments at end of line yet.
+# - every line in lines, ends with a "\n" character
+#   Only the last line may not have a trailing "\n" character.
+# TODO add errors on invalid syntax
+def config_parse2(lines: Generator[bytes, None, None]) -> GeneratorConfigLine:
+    for line in lines:
+        yield config_parse_line(line, config_get_line_type(line, 0, len(line)))
+
+
+def config_parse_line(line: bytes, line_type: LineType) -> ConfigLine:
+    if line_type == LineType.HEADER:
+        # section start, like: "[section]\n"
+        # Parse section name
+        # TODO Check for valid section characters
+        inner_part = line.split(b'[', 1)[1].split(b']')[0]
+        if ord(b'"') in inner_part:
+            # There is a subsection:
+            #     [section  "subsection"]
+            section_name = inner_part.split(b'"')[0].strip()
+            subsection_name = inner_part.split(b'"', 2)[1]
+        else:
+            section_name = inner_part
+            subsection_name = None
+
+        return ConfigLine(line, LineType.HEADER, LineDataHeader(section_name, subsection_name))
+    elif line_type == LineType.KEY_VALUE:
+        #     key = value
+        parts = line.split(b"=", 1)
+        key = parts[0].strip()
+        value = parts[1].strip()
+        return ConfigLine(line, LineType.KEY_VALUE, LineDataKeyValue(key, value))
+
+    return ConfigLine(line, line_type, LineDataEmpty())
+
+
+# Same as config_parse2(), but only yields the header and key value lines.
+# Empty and comment lines are skipped without copying them.
+def config_parse_sections_and_keys(data: bytes) -> GeneratorConfigLine:
+    for offset, length, line_type in config_scan(data):
+        if line_type in (LineType.HEADER, LineType.KEY_VALUE):
+            yield config_parse_line(data[offset:offset + length], line_type)
+
+
+# Small hepler to get type rights for pyright
+def empty_config_lines() -> GeneratorConfigLine:
+    if False:
+        yield None
+
+
+def config_unparse2(config_lines: GeneratorConfigLine) -> bytes:
+    # TODO: This is really strange here. The data structure ConfigLine contains
+    # redundant information
+    return b"".join(config_line.line_orig for config_line in config_lines)
+
+
+# TODO add support for subsection
+# Requirement: section already exists
+# Optional arguments
+#  - "append": Whether to replace a existing key with the value or
+def config_set_key_value2(config_lines: GeneratorConfigLine, section_name: bytes, key: bytes, value: bytes,
+                          append: bool = False) -> GeneratorConfigLine:
+    # TODO sanitize 'key' and 'value'
+    # HACK: Use list to have a mutable value
+    was_emit = [False]
+
+    def emit():
+        if was_emit[0]:
+            return
+        # TODO adding \t is wired here. Maybe the config files does not use the
+        # indentation as convention.
+        yield ConfigLine(b"\t%s = %s\n" % (key, value), LineType.KEY_VALUE, LineDataKeyValue(key, value))
+        was_emit[0] = True
+
+    config_in_section = False
+    for config_line in config_lines:
+        if not config_in_section:
+            if config_line.line_type == LineType.HEADER:
+                line_data = config_line.line_data
+                assert isinstance(line_data, LineDataHeader)
+                # TODO support subsection!
+                if line_data.section_name == section_name and line_data.subsection_name is None:
+                    config_in_section = True
+            yield config_line
+        else:
+            if config_line.line_type == LineType.HEADER:
+                # New section starts
+                yield from emit()
+                # TODO check if the section has the same name!
+                config_in_section = False
+                yield config_line
+            elif config_line.line_type == LineType.KEY_VALUE:
+                line_data = config_line.line_data
+                assert isinstance(line_data, LineDataKeyValue)
+                if line_data.key == key:
+                    if append:
+                        # We have to append the value
+                        if line_data.value > value:
+                            yield from emit()
+                            yield config_line
+                        else:
+                            yield config_line
+                            yield from emit()
+                    else:
+                        # We have to replace the value
+                        yield from emit()
+                elif line_data.key > key:
+                    # The current key is bigger. Emit the key-value before it
+                    yield from emit()
+                    yield config_line
+                else:
+                    yield config_line
+            else:
+                yield config_line
+
+    if config_in_section:
+        yield from emit()
+    else:
+        if not was_emit[0]:
+            raise Exception("Error: No section with name '%s' found!" % (section_name.decode("utf8"),))
+
+
+def config_drop_key2(config_lines: GeneratorConfigLine, section_name: bytes, key: bytes) -> GeneratorConfigLine:
+    config_in_section = False
+    for config_line in config_lines:
+        if not config_in_section:
+            if config_line.line_type == LineType.HEADER:
+                line_data = config_line.line_data
+                assert isinstance(line_data, LineDataHeader)
+                # TODO support subsection!
+                if line_data.section_name == section_name and line_data.subsection_name is None:
+                    config_in_section = True
+            yield config_line
+        else:
+            if config_line.line_type == LineType.HEADER:
+                # New section starts
+                config_in_section = False
+                yield config_line
+            elif config_line.line_type == LineType.KEY_VALUE:
+                line_data = config_line.line_data
+                assert isinstance(line_data, LineDataKeyValue)
+                if line_data.key == key:
+                    # Key found. Do drop by not yielding it
+                    pass
+                else:
+                    yield config_line
+            else:
+                yield config_line
+
+
+def config_drop_section_if_empty(config_lines: GeneratorConfigLine, section_name: bytes) -> GeneratorConfigLine:
+    config_in_section = False
+    config_line_saved = None
+    for config_line in config_lines:
+        if not config_in_section:
+            if config_line.line_type == LineType.HEADER:
+                line_data = config_line.line_data
+                assert isinstance(line_data, LineDataHeader)
+                # TODO support subsection!
+                if line_data.section_name == section_name and line_data.subsection_name is None:
+                    # We have found the section!
+                    # So we don't yield it here, we have to wait for the first key in this section
+                    # Otherwise we can drop it
+                    config_in_section = True
+                    config_line_saved = config_line
+                else:
+                    yield config_line
+            else:
+                yield config_line
+        else:
+            if config_line.line_type == LineType.HEADER:
+                # New section starts
+                config_in_section = False
+                yield config_line
+            elif config_line.line_type == LineType.KEY_VALUE:
+                line_data = config_line.line_data
+                assert isinstance(line_data, LineDataKeyValue)
+                # Ok. We are in the section and we have found a key. So the section is not empty.
+                # So also yield the header line of this section, if not already done
+                if config_line_saved is not None:
+                    yield config_line_saved
+                    config_line_saved = None
+                yield config_line
+            else:
+                yield config_line
+
+
+def config_add_section2(config_lines: GeneratorConfigLine, section_name: bytes) -> GeneratorConfigLine:
+    # TODO find better name for 'was_emit'
+    was_emit = [False]
+
+    def emit():
+        if was_emit[0]:
+            return
+        yield ConfigLine(b"[%s]\n" % (section_name,), LineType.HEADER, LineDataHeader(section_name, None))
+        was_emit[0] = True
+
+    for config_line in config_lines:
+        if config_line.line_type == LineType.HEADER:
+            line_data = config_line.line_data
+            assert isinstance(line_data, LineDataHeader)
+            if line_data.section_name > section_name and line_data.subsection_name is None:
+                # The next section name is bigger. Emit here!
+                yield from emit()
+                yield config_line
+            elif line_data.section_name == section_name and line_data.subsection_name is None:
+                # This section matches exactly. The section already exists. So do nothing!
+                was_emit[0] = True
+                yield config_line
+            else:
+                yield config_line
+        else:
+            yield config_line
+
+    yield from emit()
+
+
+# A section in a ConfigDocument: The header line and all following lines up to
+# the next header. The lines before the first header are in a section without
+# a header.
+# Every key value line is stored as an entry together with the following
+# other lines, e.g. comments, up to the next key value line. The tuples (key,
+# value) of the entries are kept in a separate list. If the entries are
+# sorted, like in files that subpatch writes, the list is searched with
+# bisect. Otherwise, e.g. for files written by hand, the list is searched
+# linearly.
+class ConfigSection:
+    def __init__(self, header: ConfigLine | None):
+        self.header = header
+        # The lines before the first key value line
+        self._leading_lines: list[ConfigLine] = []
+        self._entries: list[list[ConfigLine]] = []
+        self._sort_keys: list[tuple[bytes, bytes]] = []
+        self._is_sorted = True
+
+    # Only used while parsing
+    def append_line(self, config_line: ConfigLine) -> None:
+        if config_line.line_type == LineType.KEY_VALUE:
+            line_data = config_line.line_data
+            assert isinstance(line_data, LineDataKeyValue)
+            sort_key = (line_data.key, line_data.value)
+            if len(self._sort_keys) > 0 and self._sort_keys[-1] > sort_key:
+                self._is_sorted = False
+            self._entries.append([config_line])
+            self._sort_keys.append(sort_key)
+        elif len(self._entries) > 0:
+            self._entries[-1].append(config_line)
+        else:
+            self._leading_lines.append(config_line)
+
+    def is_empty(self) -> bool:
+        return len(self._entries) == 0
+
+    # Returns the indexes of the entries with the key
+    def find_key(self, key: bytes) -> list[int]:
+        if self._is_sorted:
+            start = bisect.bisect_left(self._sort_keys, key, key=lambda sort_key: sort_key[0])
+            end = bisect.bisect_right(self._sort_keys, key, lo=start, key=lambda sort_key: sort_key[0])
+            return list(range(start, end))
+        return [i for i, (other_key, _) in enumerate(self._sort_keys) if other_key == key]
+
+    def get_value(self, index: int) -> bytes:
+        return self._sort_keys[index][1]
+
+    # Insert before the first bigger key or bigger value of the same key.
+    # Otherwise at the end of the section.
+    def insert(self, key: bytes, value: bytes, config_line: ConfigLine) -> None:
+        if self._is_sorted:
+            index = bisect.bisect_right(self._sort_keys, (key, value))
+        else:
+            index = len(self._sort_keys)
+            for i, (other_key, other_value) in enumerate(self._sort_keys):
+                if other_key > key or (other_key == key and other_value > value):
+                    index = i
+                    break
+        self._entries.insert(index, [config_line])
+        self._sort_keys.insert(index, (key, value))
+
+    # The caller must keep the order of the entries. So the value can only be
+    # replaced if it's the only entry of the key.
+    def replace(self, index: int, key: bytes, value: bytes, config_line: ConfigLine) -> None:
+        self._entries[index][0] = config_line
+        self._sort_keys[index] = (key, value)
+
+    # The other lines of a dropped entry are kept. They are moved to the
+    # previous entry.
+    def drop(self, indexes: list[int]) -> None:
+        for index in sorted(indexes, reverse=True):
+            other_lines = self._entries[index][1:]
+            del self._entries[index]
+            del self._sort_keys[index]
+            if index > 0:
+                self._entries[index - 1].extend(other_lines)
+            else:
+                self._leading_lines.extend(other_lines)
+
+    def config_lines(self) -> GeneratorConfigLine:
+        if self.header is not None:
+            yield self.header
+        yield from self._leading_lines
+        for entry in self._entries:
+            yield from entry
+
+
+# Parsed config file for multiple modifications. Unlike the generator
+# functions above, the file is parsed once into sections and there is an
+# index from the section name to the sections. Inside a section the keys are
+# found with bisect. See ConfigSection. So every modification only touches a
+# single section and the file is serialized once with unparse().
+# NOTE: The modifications have the same semantics as the generator functions
+# with two exceptions: An existing key is replaced at its position. And a
+# value is appended after all equal values.
+# TODO add support for subsection
+class ConfigDocument:
+    def __init__(self, data: bytes = b""):
+        self._sections = [ConfigSection(None)]
+        for config_line in config_parse2(split_with_ts_bytes(data)):
+            if config_line.line_type == LineType.HEADER:
+                self._sections.append(ConfigSection(config_line))
+            else:
+                self._sections[-1].append_line(config_line)
+        self._rebuild_section_index()
+
+    def _rebuild_section_index(self) -> None:
+        self._section_index: dict[bytes, list[ConfigSection]] = {}
+        for section in self._sections:
+            if section.header is None:
+                continue
+            line_data = section.header.line_data
+            assert isinstance(line_data, LineDataHeader)
+            if line_data.subsection_name is None:
+                self._section_index.setdefault(line_data.section_name, []).append(section)
+
+    def has_section(self, section_name: bytes) -> bool:
+        return section_name in self._section_index
+
+    def get_values(self, section_name: bytes, key: bytes) -> list[bytes]:
+        values = []
+        for section in self._section_index.get(section_name, []):
+            values.extend(section.get_value(index) for index in section.find_key(key))
+        return values
+
+    # Same as config_add_section2()
+    def add_section(self, section_name: bytes) -> None:
+        if section_name in self._section_index:
+            return
+
+        section = ConfigSection(ConfigLine(b"[%s]\n" % (section_name,), LineType.HEADER,
+                                           LineDataHeader(section_name, None)))
+        # Keep the sections sorted. Insert before the first bigger section.
+        pos = len(self._sections)
+        for i, other in enumerate(self._sections):
+            if other.header is None:
+                continue
+            line_data = other.header.line_data
+            assert isinstance(line_data, LineDataHeader)
+            if line_data.section_name > section_name and line_data.subsection_name is None:
+                pos = i
+                break
+        self._sections.insert(pos, section)
+        self._section_index[section_name] = [section]
+
+    # Same as config_set_key_value2(). The section must exist.
+    def set_key_value(self, section_name: bytes, key: bytes, value: bytes, append: bool = False) -> None:
+        sections = self._section_index.get(section_name)
+        if sections is None:
+            raise Exception("Error: No section with name '%s' found!" % (section_name.decode("utf8"),))
+
+        # TODO sanitize 'key' and 'value'
+        config_line = ConfigLine(b"\t%s = %s\n" % (key, value), LineType.KEY_VALUE, LineDataKeyValue(key, value))
+        section = sections[0]
+
+        if not append:
+            # Replace the first line of the key and drop all other lines of
+            # the key
+            for other in sections[1:]:
+                other.drop(other.find_key(key))
+            indexes = section.find_key(key)
+            if len(indexes) > 0:
+                section.drop(indexes[1:])
+                section.replace(indexes[0], key, value, config_line)
+                return
+
+        section.insert(key, value, config_line)
+
+    # Same as config_drop_key2()
+    def drop_key(self, section_name: bytes, key: bytes) -> None:
+        for section in self._section_index.get(section_name, []):
+            section.drop(section.find_key(key))
+
+    # Same as config_drop_section_if_empty(). Only the header line is dropped.
+    # Other lines, e.g. comments, are kept.
+    def drop_section_if_empty(self, section_name: bytes) -> None:
+        sections = self._section_index.get(section_name, [])
+        for section in sections:
+            if section.is_empty():
+                section.header = None
+        if any(section.header is None for section in sections):
+            self._rebuild_section_index()
+
+    def config_lines(self) -> GeneratorConfigLine:
+        for section in self._sections:
+            yield from section.config_lines()
+
+    def unparse(self) -> bytes:
+        return b"".join(config_line.line_orig for config_line in self.config_lines())
+
+# bundler: file src/libgit.py
+
+import atexit
+import hashlib
+import struct
+import threading
+import zlib
+from bisect import bisect_left
+from dataclasses import dataclass
+from enum import Enum
+from os.path import abspath, join
+from subprocess import PIPE
+# bundler: --8<-- was here
+
+# Git naming
+#  - object: something in the object store that has a SHA1
+#  - object type: type of the object. Can be blob, tree, commit or tag.
+#  - object id: the hash of the object (taken from the git source code)
+#  - ref: short for "reference", like branches and tags.
+#         Everything in the 'refs' folder/namespace
+#  - rev: short for "revision"
+#     "A revision parameter <rev> typically, but not necessarily, names a
+#     commit object." See 'man gitrevisions'
+#     E.g. a <sha1>, "HEAD", "x..y" or "main:file"
+
+
+def git_add(args):
+    assert len(args) >= 1
+    # NOTE: use "-f" here otherwise git honors ignored files and does not add
+    # all files!
+    # TODO add the force to the function signature
+    p = Popen(["git", "add", "-f"] + args)
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# TODO make staged an argument!
+def git_diff_staged_shortstat() -> bytes:
+    p = Popen(["git", "diff", "--staged", "--shortstat"], stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+    return stdout.rstrip(b"\n")
+
+
+# TODO Not used anymore. Maybe drop! But keep tests for code in super.py
+def git_diff_relative(staged=False) -> bytes:
+    cmd = ["git", "diff", "--relative"]
+    if staged:
+        cmd.append("--staged")
+    p = Popen(cmd, stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+    return stdout
+
+
+# As of git v2.9.0 these are all valid git objects
+OBJECT_TYPES = (b"blob", b"tree", b"commit", b"tag")
+
+
+class ObjectType(Enum):
+    BLOB = b"blob"
+    TREE = b"tree"
+    COMMIT = b"commit"
+    TAG = b"tag"
+
+
+@dataclass(frozen=True)
+class ObjectInfo:
+    object_id: bytes
+    object_type: ObjectType
+    size: int
+
+
+@dataclass(frozen=True)
+class TreeEntry:
+    mode: bytes
+    object_type: ObjectType
+    object_id: bytes
+    name: bytes
+
+
+# The binary format of a tree object is a list of entries without any
+# separation character. Every entry looks like
+#    <mode in octal> <one space> <filename> <NULL byte> <SHA1 as 20 bytes>
+def parse_tree_object(tree_data: bytes) -> list[TreeEntry]:
+    entries = []
+    pos = 0
+    while pos < len(tree_data):
+        space = tree_data.index(b" ", pos)
+        null = tree_data.index(b"\0", space)
+        mode = tree_data[pos:space]
+        name = tree_data[space + 1:null]
+        object_id = tree_data[null + 1:null + 21].hex().encode("ascii")
+        if mode == b"40000":
+            object_type = ObjectType.TREE
+        elif mode == b"160000":
+            object_type = ObjectType.COMMIT
+        else:
+            object_type = ObjectType.BLOB
+        entries.append(TreeEntry(mode, object_type, object_id, name))
+        pos = null + 21
+    return entries
+
+
+# Sort the entries in the order git requires for tree objects. Directories are
+# compared as if they have a trailing slash.
+def sort_tree_entries(entries: list[TreeEntry]) -> list[TreeEntry]:
+    def key(entry: TreeEntry) -> bytes:
+        if entry.object_type == ObjectType.TREE:
+            return entry.name + b"/"
+        return entry.name
+    return sorted(entries, key=key)
+
+
+# Inverse of parse_tree_object(). The entries must be already sorted.
+# NOTE: The mode must not be zero padded. It's not the same as the pretty
+# output! Use "40000" instead of "040000".
+def serialize_tree_object(entries: list[TreeEntry]) -> bytes:
+    return b"".join(entry.mode + b" " + entry.name + b"\0" + bytes.fromhex(entry.object_id.decode("ascii"))
+                    for entry in entries)
+
+
+# Compute the object id like "git hash-object" without writing the object
+def hash_object(object_type: ObjectType, data: bytes) -> bytes:
+    h = hashlib.sha1(b"%s %d\0" % (object_type.value, len(data)))
+    h.update(data)
+    return h.hexdigest().encode("ascii")
+
+
+# Type numbers of the objects in the pack format. See "man gitformat-pack"
+PACK_OBJECT_TYPES = {
+    ObjectType.COMMIT: 1,
+    ObjectType.TREE: 2,
+    ObjectType.BLOB: 3,
+    ObjectType.TAG: 4,
+}
+
+
+# Create a pack file (version 2) without any deltas
+def create_pack(objects: list[tuple[ObjectType, bytes]]) -> bytes:
+    parts = [b"PACK", (2).to_bytes(4, "big"), len(objects).to_bytes(4, "big")]
+    for object_type, data in objects:
+        # Header: type and size as a variable length integer. The first byte
+        # holds the type and the lower four bits of the size.
+        size = len(data)
+        header = bytearray()
+        byte = (PACK_OBJECT_TYPES[object_type] << 4) | (size & 0x0f)
+        size >>= 4
+        while size != 0:
+            header.append(byte | 0x80)
+            byte = size & 0x7f
+            size >>= 7
+        header.append(byte)
+        parts.append(bytes(header))
+        parts.append(zlib.compress(data))
+    pack = b"".join(parts)
+    return pack + hashlib.sha1(pack).digest()
+
+
+# Writer for objects into the object store of a git repository. The object
+# ids are computed in python. Objects are only collected and written with a
+# single "git unpack-objects" process on flush(). Objects that already exist in
+# the repository are skipped.
+class GitObjectWriter:
+    def __init__(self, cwd: bytes | None = None):
+        self._cwd = cwd
+        self._objects: dict[bytes, tuple[ObjectType, bytes]] = {}
+
+    def add(self, object_type: ObjectType, data: bytes) -> bytes:
+        object_id = hash_object(object_type, data)
+        if object_id not in self._objects:
+            self._objects[object_id] = (object_type, data)
+        return object_id
+
+    def flush(self) -> None:
+        reader = git_get_object_reader(self._cwd)
+        missing = [obj for object_id, obj in self._objects.items() if reader.info(object_id) is None]
+        self._objects.clear()
+        if len(missing) == 0:
+            return
+
+        p = Popen(["git", "unpack-objects", "-q"], stdin=PIPE, cwd=self._cwd)
+        p.communicate(create_pack(missing))
+        if p.returncode != 0:
+            raise Exception("git failure")
+
+
+# Reader for objects in the object store of a git repository. It keeps a
+# single "git cat-file --batch-command" process open. So reading multiple
+# objects costs one process and not one process per object.
+# NOTE: The process is started in 'cwd'. So revisions like "HEAD:./file" are
+# resolved relative to it.
+# NOTE: A reader must not be used by multiple threads at the same time.
+class GitObjectReader:
+    def __init__(self, cwd: bytes):
+        self._cwd = cwd
+        self._p: Popen | None = None
+
+    def _start(self) -> None:
+        # A process that has terminated, e.g. because the directory was not a
+        # git repository at the time, is just restarted.
+        if self._p is not None and self._p.poll() is None:
+            return
+        self._p = Popen(["git", "cat-file", "--batch-command"], stdin=PIPE, stdout=PIPE,
+                        stderr=DEVNULL, cwd=self._cwd)
+
+    def close(self) -> None:
+        if self._p is None:
+            return
+        try:
+            self._p.stdin.close()
+        except BrokenPipeError:
+            # The process has already terminated
+            pass
+        self._p.wait()
+        self._p.stdout.close()
+        self._p = None
+
+    # Returns the header line of the response or None if the object does not
+    # exist or the name is ambiguous.
+    def _request(self, command: bytes, rev: str | bytes) -> bytes | None:
+        if isinstance(rev, str):
+            rev = rev.encode("utf8")
+        if b"\n" in rev:
+            raise ValueError("Revision contains a newline character: %r" % (rev,))
+
+        self._start()
+        assert self._p is not None
+        try:
+            self._p.stdin.write(command + b" " + rev + b"\n")
+            self._p.stdin.flush()
+        except BrokenPipeError:
+            pass
+        header = self._p.stdout.readline()
+        if header == b"":
+            # Example stderr output:
+            #   fatal: not a git repository (or any of the parent directories): .git
+            self.close()
+            raise Exception("git failure")
+
+        header = header.rstrip(b"\n")
+        if header.endswith(b" missing") or header.endswith(b" ambiguous"):
+            return None
+        return header
+
+    def info(self, rev: str | bytes) -> ObjectInfo | None:
+        header = self._request(b"info", rev)
+        if header is None:
+            return None
+        object_id, object_type, size = header.split(b" ")
+        return ObjectInfo(object_id, ObjectType(object_type), int(size))
+
+    def contents(self, rev: str | bytes) -> tuple[ObjectInfo, bytes] | None:
+        header = self._request(b"contents", rev)
+        if header is None:
+            return None
+        object_id, object_type, size = header.split(b" ")
+        info = ObjectInfo(object_id, ObjectType(object_type), int(size))
+        assert self._p is not None
+        data = self._p.stdout.read(info.size + 1)
+        # The content is terminated by a newline character
+        assert len(data) == info.size + 1
+        return info, data[:-1]
+
+    def tree_entries(self, rev: str | bytes) -> list[TreeEntry]:
+        result = self.contents(rev)
+        if result is None:
+            raise Exception("git failure")
+        info, data = result
+        if info.object_type != ObjectType.TREE:
+            raise Exception("Object %s is not a tree object" % (info.object_id,))
+        return parse_tree_object(data)
+
+
+_object_readers: dict[bytes, GitObjectReader] = {}
+_object_readers_lock = threading.Lock()
+
+
+# Return the object reader for the repository in 'cwd'. If it's None, the
+# current work directory is used. The reader and its process is reused for all
+# later calls.
+def git_get_object_reader(cwd: bytes | None = None) -> GitObjectReader:
+    cwd = abspath(os.getcwdb() if cwd is None else cwd)
+    with _object_readers_lock:
+        reader = _object_readers.get(cwd)
+        if reader is None:
+            reader = GitObjectReader(cwd)
+            _object_readers[cwd] = reader
+    return reader
+
+
+# Closes the object reader of the repository in 'cwd', e.g. before the
+# repository is removed. A later git_get_object_reader() call starts a new one.
+def git_close_object_reader(cwd: bytes | None = None) -> None:
+    cwd = abspath(os.getcwdb() if cwd is None else cwd)
+    with _object_readers_lock:
+        reader = _object_readers.pop(cwd, None)
+    if reader is not None:
+        reader.close()
+
+
+@atexit.register
+def _close_object_readers() -> None:
+    for reader in _object_readers.values():
+        reader.close()
+    _object_readers.clear()
+
+
+# Returns the type of the git object
+# TODO naming 'rev' is incorrect. 'rev' is only for commit objects.
+def git_get_object_type(rev: str | bytes, cwd: bytes | None = None) -> ObjectType:
+    info = git_get_object_reader(cwd).info(rev)
+    if info is None:
+        # TODO Create a generic git error exception
+        raise Exception("failed here")
+
+    return info.object_type
+
+
+# Convert URLs. Examples:
+#     …bla/foo/.git/ -> "foo"
+#     …bla/foo.git/  -> "foo"
+#     …bla/foo       -> "foo"
+def get_name_from_repository_url(url: str):
+    if len(url) == 0:
+        raise ValueError("The URL is empty!")
+    url = url.rstrip("/")
+    if url.endswith(".git"):
+        url = url[:-4]
+    url = url.rstrip("/")
+    url = url.split("/")[-1]
+    return url
+
+
+# Check whether the 'rev' can be resolved to a valid object in the repository
+# NOTE:
+# - If this command is not exectued in a git repo, it raises an exception.
+def git_verify(rev: str | bytes, cwd: bytes | None = None) -> bool:
+    return git_get_object_reader(cwd).info(rev) is not None
+
+
+def is_valid_revision(revision: str) -> bool:
+    # TODO add more invalid and strange chars to this list
+    # TODO eval svn, git, ... for allow characters. What about umlauts?
+    strange_chars = ("\t", "\n", "\b")
+    for char in strange_chars:
+        if char in revision:
+            return False
+    return True
+
+
+# TODO add example of input
+# TODO add more tests, e.g. with syntax errors or duplicated refs.
+def parse_sha1_names(lines: bytes, sep=b' ') -> dict[bytes, bytes]:
+    # remove the last new line character
+    # Should only be one character
+    lines = lines.rstrip(b'\n')
+
+    # Ignore empty lines
+    lines1 = [line.split(sep) for line in lines.split(b'\n') if len(line) != 0]
+
+    for line in lines1:
+        if len(line) != 2:
+            raise Exception("Parsing error in line: sep = %s parts = %s" % (sep, line))
+    lines2 = [(name, sha1) for sha1, name in lines1]
+
+    # checks
+    for _, sha1 in lines2:
+        if not is_sha1(sha1):
+            raise ValueError("String is not a SHA1 sum: %r" % (sha1,))
+
+    return dict(lines2)
+
+
+def git_get_sha1(rev, cwd: bytes | None = None):
+    # NOTE: Special case for valid SHA1 sums. Even if the object for the
+    # SHA1 does not exist in the repo, it's return as a valid SHA1 If the
+    # rev is a too short SHA1, it's extend to a full SHA1 if a object with
+    # the short SHA1 exists in the repo.
+    if isinstance(rev, str):
+        rev = rev.encode("utf8")
+    if is_sha1(rev):
+        return rev
+
+    info = git_get_object_reader(cwd).info(rev)
+    if info is None:
+        raise Exception("error here TODO")
+
+    return info.object_id
+
+
+# Write the tree object into the repository and return the object id.
+# NOTE: See serialize_tree_object() for the binary format.
+def git_hash_object_tree(tree_data: bytes) -> bytes:
+    writer = GitObjectWriter()
+    object_id = writer.add(ObjectType.TREE, tree_data)
+    writer.flush()
+    return object_id
+
+
+# Same output as "git cat-file -p". Only the filenames of tree entries are
+# never quoted.
+def git_cat_file_pretty(rev: bytes) -> bytes:
+    result = git_get_object_reader().contents(rev)
+    if result is None:
+        raise Exception("error here")
+    info, data = result
+    if info.object_type != ObjectType.TREE:
+        return data
+
+    return b"".join(b"%06d %s %s\t%s\n" % (int(entry.mode), entry.object_type.value, entry.object_id, entry.name)
+                    for entry in parse_tree_object(data))
+
+
+# git_ls_remote ::  string(url) -> dict<ref_name, sha1>
+# Output contains branches, tags, tag-commitisch "^{}" and the HEAD.
+# With 'patterns' only the matching refs are listed. A pattern matches the
+# tail of a ref name, e.g. "main" matches "refs/heads/main". The patterns are
+# applied by git on the client side. They are not sent to the remote.
+# With 'heads' and/or 'tags' only the refs in "refs/heads/" and/or
+# "refs/tags/" are listed. With the git protocol v2 these are sent as the
+# 'ref-prefix' arguments to the remote. So the remote does not advertise other
+# refs, e.g. the "refs/pull/" or "refs/changes/" refs of code review systems.
+def git_ls_remote(url: str, patterns: list[str] | None = None,
+                  heads: bool = False, tags: bool = False) -> dict[bytes, bytes]:
+    # NOTE Subpress stderr output of 'ls-remote'. In case of a fetch failure
+    # stuff is written to stderr.
+
+    # NOTE: The options must be given before the url.
+    cmd = ["git", "ls-remote"]
+    if heads:
+        cmd += ["--heads"]
+    if tags:
+        cmd += ["--tags"]
+    cmd += [url]
+    if patterns is not None:
+        cmd += ["--"] + patterns
+    p = Popen(cmd, stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git ls-remote failed")
+
+    # Parse output
+    # The output of ls-remote uses the tab character as the separator. The
+    # show-ref command uses spaces.
+    return parse_sha1_names(stdout, sep=b'\t')
+
+
+# The capabilities of the remote repository that are relevant for fetching.
+#  - shallow: The remote supports shallow fetches, e.g. "--depth 1". For the
+#    dumb http transport git fails with
+#       fatal: dumb http transport does not support shallow capabilities
+#  - fetch_by_object_id: The remote allows to request objects by id that are
+#    not advertised by a ref. It's always the case for protocol v2. For
+#    protocol v0 the server must be configured with
+#    'uploadpack.allowReachableSHA1InWant' or 'uploadpack.allowAnySHA1InWant'.
+#  - filter: The remote supports partial clones, e.g. "--filter=blob:none".
+#    The server must be configured with 'uploadpack.allowFilter'. Otherwise
+#    git ignores the filter with a warning and fetches all objects.
+@dataclass(frozen=True)
+class TransportInfo:
+    shallow: bool
+    fetch_by_object_id: bool
+    filter: bool
+
+
+# Query the remote git repo and try to resolve the 'ref'.
+# E.g.
+#  - "main" -> "refs/heads/main"
+#  - "v1" -> "refs/tags/v1"
+# Notes:
+#  - function accepts ref as string, but returns a byte Object!
+#  - Only the candidate refs are listed. For a short name, e.g. "main", the
+#    remote advertises only the branches and tags.
+# Returns
+#  - None if ref could not be resolved
+#  - Otherwise the tuple of the full ref name and the object id it points to.
+#    For annotated tags it's the object id of the tag object.
+def git_ls_remote_guess_ref(url: str, ref_str: str) -> tuple[bytes, bytes] | None:
+    # A full ref name or "HEAD" can be outside of "refs/heads/" and
+    # "refs/tags/". Then the remote cannot filter by the prefixes.
+    short_name = ref_str != "HEAD" and not ref_str.startswith("refs/")
+    refs_sha1 = git_ls_remote(url, get_guess_ref_candidates(ref_str), heads=short_name, tags=short_name)
+    return guess_ref(refs_sha1, ref_str)
+
+
+def get_guess_ref_candidates(ref_str: str) -> list[str]:
+    return [ref_str, "refs/tags/" + ref_str, "refs/heads/" + ref_str]
+
+
+# Same as git_ls_remote_guess_ref(), but for already known refs, e.g. the refs
+# of a bundle.
+def guess_ref(refs_sha1: dict[bytes, bytes], ref_str: str) -> tuple[bytes, bytes] | None:
+    # The order of the candidates is the priority: Direct match, tag, branch
+    for candidate in get_guess_ref_candidates(ref_str):
+        ref = candidate.encode("utf8")
+        if ref in refs_sha1:
+            return ref, refs_sha1[ref]
+
+    return None
+
+
+# Parse the "-z" output of git commands
+# TODO rework as a generator
+def parse_z(b: bytes) -> list[bytes]:
+    if b == b"":
+        # Special case. b"".split(b"\0") is [b""], but
+        # we want a list without elements here.
+        return []
+
+    return b.rstrip(b"\0").split(b"\0")
+
+
+def git_diff_in_dir(top_dir, subdir, staged=False):
+    # TODO verify that top_dir is the toplevel dir in the repo
+    # -> Refactor to git object or class that checks the top_dir
+    # TODO check that subdir is a relative and a sane path!
+    cmd = ["git", "diff", "--name-only", "-z"]
+    if staged:
+        cmd += ["--staged"]
+    cmd += ["--", subdir]
+
+    p = Popen(cmd, stdout=PIPE, cwd=top_dir)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("error here")
+
+    return len(stdout) != 0
+
+
+# NOTE: argument and output is not cwd aware. It's always relative to the
+# toplevel of the git repository.
+def git_ls_tree_in_dir(subdir):
+    assert isinstance(subdir, bytes)
+
+    if subdir == b"":
+        subdir = b"."
+
+    p = Popen(["git", "ls-tree", "--full-tree", "-r", "--name-only", "-z", "HEAD", subdir],
+              stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("TODO error here")
+
+    return parse_z(stdout)
+
+
+# Remove the given paths from the index. The files in the working tree are
+# not touched. All paths are streamed to a single git process. So there is no
+# limit on the number of paths.
+# NOTE: The paths are relative to the directory 'cwd'.
+def git_update_index_remove(paths: list[bytes], cwd: bytes | None = None) -> None:
+    if len(paths) == 0:
+        return
+    p = Popen(["git", "update-index", "-z", "--force-remove", "--stdin"], stdin=PIPE, cwd=cwd)
+    p.communicate(b"".join(path + b"\0" for path in paths))
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Stage all entries of the tree object in the index below the directory
+# 'prefix' and write the files into the working tree. The objects are not
+# rehashed. Other files in the working tree are not touched.
+# NOTE: The prefix is relative to the toplevel directory.
+# NOTE: The index must not contain any entries below 'prefix'.
+def git_read_tree_prefix(tree_id: bytes, prefix: bytes) -> None:
+    p = Popen(["git", "read-tree", "-u", b"--prefix=" + prefix + b"/", tree_id])
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# NOTE:
+# * The 'git ls-files' is cmd aware. The caller should go into the right
+#   directory first.
+# * it also list files that are added to the index, but not yet commited.
+# * it does not list files that are removed and the deletion is stagged!
+def git_ls_files() -> list[bytes]:
+    p = Popen(["git", "ls-files", "-z"], stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("TODO error here")
+
+    return parse_z(stdout)
+
+
+def git_diff_name_only(staged=False):
+    # NOTE: "git diff" does not depend on the cwd inside the repo
+    cmd = ["git", "diff", "--name-only", "-z"]
+    if staged:
+        cmd += ["--staged"]
+
+    p = Popen(cmd, stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("error here")
+
+    return parse_z(stdout)
+
+
+# NOTE: This depends on the cwd for now. git ls-files has no option to force
+# listing files from the top level directory.
+# TODO fix that
+def git_ls_files_untracked():
+    # TODO refactor common code
+    # NOTE:
+    # - Use "--full-name" to make the paths relative to the toplevel
+    #   directory, not the current work directory.
+    # - Use "--no-empty-directory" to avoid printing dirs that contain only
+    #   ignored files.
+    p = Popen(["git", "ls-files", "--exclude-standard", "-o", "--directory", "-z", "--full-name", "--no-empty-directory"],
+              stdout=PIPE)
+    stdout, _ = p.communicate()
+
+    if p.returncode != 0:
+        raise Exception("error here")
+
+    return parse_z(stdout)
+
+
+class StatusType(Enum):
+    CHANGED = b"1"
+    RENAMED_OR_COPIED = b"2"
+    UNMERGED = b"u"
+    UNTRACKED = b"?"
+    IGNORED = b"!"
+
+
+@dataclass(frozen=True)
+class StatusEntry:
+    status_type: StatusType
+    # Two characters. The first one is the status in the index, the second one
+    # is the status in the working tree. A "." means unmodified. It's None for
+    # untracked and ignored files.
+    xy: bytes | None
+    # Relative to the toplevel directory. Untracked directories have a
+    # trailing slash.
+    path: bytes
+
+
+# Number of space separated fields before the path in the porcelain v2 format
+STATUS_FIELDS_BEFORE_PATH = {
+    StatusType.CHANGED: 8,
+    StatusType.RENAMED_OR_COPIED: 9,
+    StatusType.UNMERGED: 10,
+    StatusType.UNTRACKED: 1,
+    StatusType.IGNORED: 1,
+}
+
+
+# Run "git status --porcelain=v2 -z" for the given pathspecs and yield the
+# entries while git is still running. So the whole output is never in memory.
+# Untracked directories are reported as a single entry like "git ls-files -o
+# --directory" does.
+def git_status_porcelain_v2(pathspecs: list[bytes], cwd: bytes | None = None):
+    cmd = ["git", "status", "--porcelain=v2", "-z", "--untracked-files=normal", "--"] + pathspecs
+    p = Popen(cmd, stdout=PIPE, cwd=cwd)
+    assert p.stdout is not None
+
+    def records():
+        rest = b""
+        while True:
+            chunk = p.stdout.read(64 * 1024)
+            if chunk == b"":
+                break
+            records = (rest + chunk).split(b"\0")
+            rest = records.pop()
+            yield from records
+        assert rest == b""
+
+    try:
+        it = records()
+        for record in it:
+            status_type = StatusType(record[0:1])
+            fields = record.split(b" ", STATUS_FIELDS_BEFORE_PATH[status_type])
+            xy = None if status_type in (StatusType.UNTRACKED, StatusType.IGNORED) else fields[1]
+            if status_type == StatusType.RENAMED_OR_COPIED:
+                # The original path follows as the next record
+                next(it)
+            yield StatusEntry(status_type, xy, fields[-1])
+    finally:
+        p.stdout.close()
+        p.wait()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Returns the absolute path to the git directory that is shared by all
+# worktrees of the repository. For a normal repository it's the ".git" folder.
+def git_get_common_dir(cwd: bytes | None = None) -> bytes:
+    p = Popen(["git", "rev-parse", "--path-format=absolute", "--git-common-dir"], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+    return stdout.rstrip(b"\n")
+
+
+# Returns the path of the index file. It honors GIT_INDEX_FILE.
+# NOTE: The path is relative to the current work directory.
+def git_get_index_path() -> bytes:
+    p = Popen(["git", "rev-parse", "--git-path", "index"], stdout=PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+    return stdout.rstrip(b"\n")
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    path: bytes
+    mode: int
+    object_id: bytes
+    stage: int
+    intent_to_add: bool
+
+
+@dataclass(frozen=True)
+class GitIndex:
+    # Sorted by path like in the index file
+    entries: list[IndexEntry]
+    # The valid entries of the cached-tree extension. It maps the path of a
+    # directory to the object id of its tree. The toplevel directory is b"".
+    cache_tree: dict[bytes, bytes]
+
+
+INDEX_ENTRY_HEADER = struct.Struct(">10I20sH")
+INDEX_FLAG_EXTENDED = 0x4000
+INDEX_FLAG_STAGE_MASK = 0x3000
+INDEX_FLAG_STAGE_SHIFT = 12
+INDEX_EXTENDED_FLAG_INTENT_TO_ADD = 0x2000
+
+
+# Parse the "TREE" extension. The data is a list of directories in pre-order.
+# Every directory looks like
+#    <name> <NULL byte> <entry count> <space> <subtree count> <newline> <SHA1 as 20 bytes>
+# An entry count of -1 marks an invalid entry. Then there is no SHA1.
+def parse_index_cache_tree(data: bytes) -> dict[bytes, bytes]:
+    cache_tree = {}
+    # Stack of (path, remaining subtrees) of the parent directories
+    stack: list[list] = []
+    pos = 0
+    while pos < len(data):
+        null = data.index(b"\0", pos)
+        newline = data.index(b"\n", null)
+        name = data[pos:null]
+        entry_count, subtree_count = data[null + 1:newline].split(b" ")
+        pos = newline + 1
+
+        while len(stack) != 0 and stack[-1][1] == 0:
+            stack.pop()
+        if len(stack) == 0:
+            path = name  # The toplevel directory
+        else:
+            stack[-1][1] -= 1
+            path = name if stack[-1][0] == b"" else stack[-1][0] + b"/" + name
+
+        if int(entry_count) >= 0:
+            cache_tree[path] = data[pos:pos + 20].hex().encode("ascii")
+            pos += 20
+        stack.append([path, int(subtree_count)])
+    return cache_tree
+
+
+# Parse the index file of git. Supported are the versions 2, 3 and 4 and the
+# cached-tree extension. Other extensions are ignored.
+# Returns None for an index that is not supported, e.g. a split index. The
+# caller must fallback to a git command then.
+# See "man gitformat-index" for the format.
+def parse_index(data: bytes) -> GitIndex | None:
+    signature, version, count = struct.unpack_from(">4sII", data, 0)
+    if signature != b"DIRC":
+        raise Exception("Invalid index file")
+    if version not in (2, 3, 4):
+        return None
+
+    entries = []
+    pos = 12
+    path = b""
+    for _ in range(count):
+        fields = INDEX_ENTRY_HEADER.unpack_from(data, pos)
+        mode = fields[6]
+        object_id = fields[10].hex().encode("ascii")
+        flags = fields[11]
+        entry_start = pos
+        pos += INDEX_ENTRY_HEADER.size
+        extended_flags = 0
+        if version >= 3 and flags & INDEX_FLAG_EXTENDED:
+            extended_flags, = struct.unpack_from(">H", data, pos)
+            pos += 2
+
+        if version == 4:
+            # The path is prefix compressed. A variable length integer tells
+            # how many bytes of the previous path must be removed.
+            byte = data[pos]
+            pos += 1
+            strip = byte & 0x7f
+            while byte & 0x80:
+                byte = data[pos]
+                pos += 1
+                strip = ((strip + 1) << 7) | (byte & 0x7f)
+            null = data.index(b"\0", pos)
+            path = path[:len(path) - strip] + data[pos:null]
+            pos = null + 1
+        else:
+            null = data.index(b"\0", pos)
+            path = data[pos:null]
+            # Entries are padded with NULL bytes to a multiple of eight bytes
+            pos = entry_start + ((null - entry_start + 8) & ~7)
+
+        entries.append(IndexEntry(path, mode, object_id,
+                                  (flags & INDEX_FLAG_STAGE_MASK) >> INDEX_FLAG_STAGE_SHIFT,
+                                  bool(extended_flags & INDEX_EXTENDED_FLAG_INTENT_TO_ADD)))
+
+    cache_tree: dict[bytes, bytes] = {}
+    # The last 20 bytes are the checksum of the file
+    while pos < len(data) - 20:
+        signature, size = struct.unpack_from(">4sI", data, pos)
+        pos += 8
+        if signature == b"TREE":
+            cache_tree = parse_index_cache_tree(data[pos:pos + size])
+        elif signature in (b"link", b"sdir"):
+            # Split index and sparse index are not supported yet
+            return None
+        pos += size
+
+    return GitIndex(entries, cache_tree)
+
+
+# Read the index file of the repository in the current work directory.
+# Returns None if the index is not supported by parse_index().
+def git_read_index() -> GitIndex | None:
+    try:
+        with open(git_get_index_path(), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        # No file was added to the index yet
+        return GitIndex([], {})
+    return parse_index(data)
+
+
+# Build the tree object for the directory 'dir_path' from the index entries
+# in the range [start, end). All these entries are inside the directory.
+# Entries with a name in 'exclude_names' are skipped, but only in the directory
+# itself and not in the subdirectories.
+# Returns None if the tree is empty.
+def _build_tree_from_index(index: GitIndex, start: int, end: int, dir_path: bytes,
+                           writer: GitObjectWriter, exclude_names: tuple[bytes, ...]) -> bytes | None:
+    prefix_len = len(dir_path) + 1 if dir_path != b"" else 0
+    tree_entries = []
+    i = start
+    while i < end:
+        entry = index.entries[i]
+        relpath = entry.path[prefix_len:]
+        slash = relpath.find(b"/")
+        if slash == -1:
+            i += 1
+            if entry.intent_to_add:
+                # Like 'git write-tree'. These files are not in the tree.
+                continue
+            if entry.stage != 0:
+                raise Exception("The index contains unmerged entries")
+            if relpath in exclude_names:
+                continue
+            if entry.mode == 0o160000:
+                object_type = ObjectType.COMMIT
+            else:
+                object_type = ObjectType.BLOB
+            tree_entries.append(TreeEntry(b"%o" % (entry.mode,), object_type, entry.object_id, relpath))
+            continue
+
+        name = relpath[:slash]
+        subdir_path = entry.path[:prefix_len + slash]
+        # All entries of the subdirectory are in a row. The character "0" is
+        # the next character after "/".
+        subdir_end = bisect_left(index.entries, subdir_path + b"0", i, end, key=lambda e: e.path)
+        if name not in exclude_names:
+            tree_id = index.cache_tree.get(subdir_path)
+            if tree_id is None:
+                tree_id = _build_tree_from_index(index, i, subdir_end, subdir_path, writer, ())
+            if tree_id is not None:
+                tree_entries.append(TreeEntry(b"40000", ObjectType.TREE, tree_id, name))
+        i = subdir_end
+
+    if len(tree_entries) == 0:
+        return None
+    return writer.add(ObjectType.TREE, serialize_tree_object(sort_tree_entries(tree_entries)))
+
+
+# Returns the tree 'tree_id' without the gitlinks, i.e. the entries of
+# submodules. Trees that are empty afterwards are removed, too. Returns None if
+# nothing is left. Only the changed trees are added to the 'writer'.
+def tree_remove_gitlinks(reader: GitObjectReader, writer: GitObjectWriter, tree_id: bytes) -> bytes | None:
+    entries = []
+    changed = False
+    for entry in reader.tree_entries(tree_id):
+        if entry.object_type == ObjectType.COMMIT:
+            changed = True
+            continue
+        if entry.object_type == ObjectType.TREE:
+            subtree_id = tree_remove_gitlinks(reader, writer, entry.object_id)
+            if subtree_id is None:
+                changed = True
+                continue
+            if subtree_id != entry.object_id:
+                changed = True
+                entry = TreeEntry(entry.mode, entry.object_type, subtree_id, entry.name)
+        entries.append(entry)
+
+    if not changed:
+        return tree_id
+    if len(entries) == 0:
+        return None
+    # NOTE: The order of the entries is unchanged. So they are still sorted.
+    return writer.add(ObjectType.TREE, serialize_tree_object(entries))
+
+
+# Compute the tree object ids for the directories 'dir_paths' from the index.
+# It's like "git write-tree --prefix=<dir>" for every directory, but the index
+# is read only once. Valid entries of the cached-tree extension are reused.
+# The names in 'exclude_names' are skipped in the toplevel of every
+# directory. Missing tree objects are written by the 'writer'.
+# NOTE: The paths are relative to the toplevel directory of the repository.
+def index_get_tree_ids(index: GitIndex, dir_paths: list[bytes], writer: GitObjectWriter,
+                       exclude_names: tuple[bytes, ...] = ()) -> dict[bytes, bytes]:
+    tree_ids = {}
+    for dir_path in dir_paths:
+        if dir_path == b"":
+            start, end = 0, len(index.entries)
+        else:
+            start = bisect_left(index.entries, dir_path + b"/", key=lambda e: e.path)
+            end = bisect_left(index.entries, dir_path + b"0", start, key=lambda e: e.path)
+        if len(exclude_names) == 0 and dir_path in index.cache_tree:
+            tree_ids[dir_path] = index.cache_tree[dir_path]
+            continue
+        tree_id = _build_tree_from_index(index, start, end, dir_path, writer, exclude_names)
+        if tree_id is None:
+            tree_id = writer.add(ObjectType.TREE, b"")
+        tree_ids[dir_path] = tree_id
+    return tree_ids
+
+
+# :: void -> None or byte object (or raises an exception)
+# TODO currently unused. Maybe remove this function
+def git_get_toplevel():
+    p = Popen(["git", "rev-parse", "--show-toplevel"], stdout=PIPE, stderr=DEVNULL)
+    stdout, _ = p.communicate()
+    if p.returncode == 0:
+        return stdout.rstrip(b"\n")
+    elif p.returncode == 128:
+        # fatal: not a git repository (or any of the parent directories): .git
+        return None
+    else:
+        # TODO Create a generic git error exception
+        raise Exception("git failure")
+
+
+# NOTE This is cwd aware
+def git_clone(url, directory):
+    p = Popen(["git", "clone", "-q", url, directory])
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+def git_reset_hard(sha1):
+    p = Popen(["git", "reset", "-q", "--hard", sha1])
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+def is_sha1(sha1: bytes) -> bool:
+    assert isinstance(sha1, bytes)
+    if len(sha1) != 40:
+        return False
+    return all(0x30 <= c <= 0x39 or 0x61 <= c <= 0x66 for c in sha1)
+
+
+def git_init_bare(cwd: bytes | None = None) -> None:
+    p = Popen(["git", "init", "-q", "--bare"], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Returns the object ids of all objects that are reachable from 'object_id',
+# but are missing in the repository. In a partial clone these are the objects
+# that were omitted by the filter.
+# NOTE: The missing objects are not fetched lazily from the promisor remote.
+def git_rev_list_missing(object_id: bytes, cwd: bytes | None = None) -> list[bytes]:
+    p = Popen([b"git", b"rev-list", b"--objects", b"--missing=print", object_id], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+    return [line[1:] for line in stdout.splitlines() if line.startswith(b"?")]
+
+
+# Returns True if all objects that are reachable from the refs exist in the
+# repository. In a partial clone the objects that were omitted by the filter
+# are not missing.
+def git_fsck_connectivity(cwd: bytes | None = None) -> bool:
+    p = Popen(["git", "fsck", "--connectivity-only", "--no-dangling"], stdout=DEVNULL, stderr=DEVNULL, cwd=cwd)
+    p.communicate()
+    return p.returncode == 0
+
+
+# Fetch the missing objects of a partial clone from the promisor 'remote'.
+# It's the same command that git uses to fetch missing objects lazily, but
+# for all objects in one go. The object ids are passed on stdin, because
+# there can be a lot of them.
+# NOTE: The filter is needed. Otherwise the fetch of blobs fails in the
+# connectivity check.
+def git_fetch_missing_objects(remote: str, object_ids: list[bytes], cwd: bytes | None = None) -> None:
+    p = Popen(["git", "-c", "fetch.negotiationAlgorithm=noop", "fetch", "-q", "--no-tags",
+               "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin", remote],
+              stdin=PIPE, stderr=DEVNULL, cwd=cwd)
+    p.communicate(b"".join(object_id + b"\n" for object_id in object_ids))
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Write a bundle file that contains the 'refs' and all objects that are
+# reachable from them. 'refs' is a list of tuples (ref name, object id).
+# NOTE: The bundle is written by hand instead of "git bundle create", because
+# it does not need refs in the repository. And in a shallow repository "git
+# bundle create" works, but "git fetch" from the bundle fails. So use
+# git_bundle_unbundle() to read the bundle.
+# NOTE: In a partial clone missing objects are left out with
+# 'allow_missing'.
+def git_bundle_create(bundle_path: bytes, refs: list[tuple[bytes, bytes]], cwd: bytes | None = None,
+                      allow_missing: bool = False) -> None:
+    cmd = ["git", "pack-objects", "--stdout", "--revs", "-q"]
+    if allow_missing:
+        cmd.append("--missing=allow-promisor")
+    with open(bundle_path, "wb") as f:
+        f.write(b"# v2 git bundle\n")
+        for ref, object_id in refs:
+            f.write(b"%s %s\n" % (object_id, ref))
+        f.write(b"\n")
+        f.flush()
+        p = Popen(cmd, stdin=PIPE, stdout=f, cwd=cwd)
+        p.communicate(b"".join(object_id + b"\n" for _, object_id in refs))
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Store the objects of the bundle in the repository. Returns the refs of the
+# bundle. The refs are not created in the repository.
+# NOTE: Unlike "git fetch" there is no connectivity check. So commits of a
+# shallow repository can be imported. See git_mark_shallow().
+def git_bundle_unbundle(bundle_path: bytes, cwd: bytes | None = None) -> dict[bytes, bytes]:
+    p = Popen([b"git", b"bundle", b"unbundle", bundle_path], stdout=PIPE, stderr=DEVNULL, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+    return parse_sha1_names(stdout)
+
+
+# Returns the refs of the bundle. No repository is needed.
+def git_bundle_list_heads(bundle_path: bytes) -> dict[bytes, bytes]:
+    p = Popen([b"git", b"bundle", b"list-heads", bundle_path], stdout=PIPE, stderr=DEVNULL)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+    return parse_sha1_names(stdout)
+
+
+# Returns the object ids of the parents of the commit. The parent commits
+# itself do not need to exist.
+def git_get_commit_parents(commit_id: bytes, cwd: bytes | None = None) -> list[bytes]:
+    p = Popen([b"git", b"cat-file", b"commit", commit_id], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+    header, _, _ = stdout.partition(b"\n\n")
+    return [line[len(b"parent "):] for line in header.split(b"\n") if line.startswith(b"parent ")]
+
+
+# Marks the commit as shallow. Then git does not look for the parents of the
+# commit. This is needed for commits that are imported without their history.
+# NOTE: The argument is the path to the git directory, e.g. of a bare
+# repository.
+def git_mark_shallow(git_dir: bytes, commit_id: bytes) -> None:
+    shallow_path = join(git_dir, b"shallow")
+    try:
+        with open(shallow_path, "rb") as f:
+            shallow_commits = f.read().splitlines()
+    except FileNotFoundError:
+        shallow_commits = []
+    if commit_id in shallow_commits:
+        return
+    with open(shallow_path, "ab") as f:
+        f.write(commit_id + b"\n")
+
+
+# Create or overwrite the 'ref', e.g. b"refs/heads/main".
+def git_update_ref(ref: bytes, object_id: bytes, cwd: bytes | None = None) -> None:
+    p = Popen([b"git", b"update-ref", ref, object_id], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Runs "git gc --auto". git only packs and prunes objects if there are too many
+# loose objects or packs.
+# NOTE: The gc runs in the foreground. So the caller can measure the size of
+# the repository afterwards.
+def git_gc_auto(cwd: bytes | None = None) -> None:
+    p = Popen([b"git", b"-c", b"gc.autoDetach=false", b"gc", b"--auto", b"--quiet"], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Returns True if the commit or tag 'object_id' exists in the repository.
+# Unlike git_verify() a missing object is not fetched lazily from the promisor
+# remote in a partial clone.
+def git_commit_exists_locally(object_id: bytes, cwd: bytes | None = None) -> bool:
+    p = Popen([b"git", b"rev-list", b"--missing=print", b"--no-walk", object_id], stdout=DEVNULL, stderr=DEVNULL,
+              cwd=cwd)
+    p.communicate()
+    return p.returncode == 0
+
+
+# Adds the object directory 'objects_path' of another repository as an
+# alternate. Then all objects of the other repository are also available in
+# this repository. Nothing is done if the alternate already exists.
+# NOTE: The argument 'git_dir' is the path to the git directory, e.g. of a
+# bare repository. A relative 'objects_path' is relative to the object
+# directory of this repository.
+def git_add_alternate(git_dir: bytes, objects_path: bytes) -> None:
+    alternates_path = join(git_dir, b"objects", b"info", b"alternates")
+    try:
+        with open(alternates_path, "rb") as f:
+            alternates = f.read().splitlines()
+    except FileNotFoundError:
+        alternates = []
+    if objects_path in alternates:
+        return
+    with open(alternates_path, "ab") as f:
+        f.write(objects_path + b"\n")
+
+
+# Returns True if the repository uses the objects of other repositories.
+def git_has_alternates(git_dir: bytes) -> bool:
+    return os.path.isfile(join(git_dir, b"objects", b"info", b"alternates"))
+
+
+# Returns True if the repository is a partial clone. Then some objects can be
+# missing. See git_rev_list_missing().
+# NOTE: Objects that are fetched from a promisor remote are stored in packs
+# with an additional ".promisor" file.
+# NOTE: The argument is the path to the git directory, e.g. of a bare
+# repository.
+def git_has_promisor_packs(git_dir: bytes) -> bool:
+    try:
+        names = os.listdir(join(git_dir, b"objects", b"pack"))
+    except FileNotFoundError:
+        return False
+    return any(name.endswith(b".promisor") for name in names)
+
+
+# Returns the value of the config 'key' of the repository. Returns None if the
+# key is not set.
+def git_config_get(key: str, cwd: bytes | None = None) -> bytes | None:
+    p = Popen(["git", "config", "--get", key], stdout=PIPE, cwd=cwd)
+    stdout, _ = p.communicate()
+    if p.returncode == 1:
+        return None
+    if p.returncode != 0:
+        raise Exception("git failure")
+    return stdout.rstrip(b"\n")
+
+
+# Sets the config 'key' in the config file of the repository.
+def git_config_set(key: str, value: bytes, cwd: bytes | None = None) -> None:
+    p = Popen([b"git", b"config", b"--local", key.encode("ascii"), value], cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Removes the config 'key' from the config file of the repository. It's not an
+# error if the key is not set.
+def git_config_unset(key: str, cwd: bytes | None = None) -> None:
+    p = Popen(["git", "config", "--local", "--unset", key], cwd=cwd)
+    p.communicate()
+    # NOTE: git returns 5 if the key is not set
+    if p.returncode not in (0, 5):
+        raise Exception("git failure")
+
+
+# Fetch the objects with the given object ids from the repository at 'url'
+# into the repository in 'cwd'. The object ids can also point to tree objects.
+# No refs and no FETCH_HEAD are written. So the objects stay unreferenced until
+# the index or a commit references them.
+def git_fetch_objects(url: str | bytes, object_ids: list[bytes], cwd: bytes | None = None) -> None:
+    p = Popen(["git", "fetch", "-q", "--no-tags", "--no-write-fetch-head", url] + object_ids,
+              stderr=DEVNULL, cwd=cwd)
+    p.communicate()
+    if p.returncode != 0:
+        raise Exception("git failure")
+
+
+# Fetch only the commit or tag 'object_id' from the remote repository. Not
+# all servers allow to request an object by id if it's not advertised by a
+# ref. See TransportInfo.fetch_by_object_id. Returns False if the fetch is
+# rejected.
+def git_fetch_object_id(url: str, object_id: bytes, cwd: bytes | None = None, depth: int | None = 1,
+                        filter: bytes | None = None) -> bool:
+    cmd = [b"git", b"fetch", b"-q", url.encode("utf8"), object_id]
+    if depth is not None:
+        cmd += [b"--depth", b"%d" % (depth,)]
+    if filter is not None:
+        cmd.append(b"--filter=" + filter)
+    p = Popen(cmd, stderr=DEVNULL, cwd=cwd)
+    p.communicate()
+    return p.returncode == 0
+
+
+# NOTE: Shallow fetches with 'depth' do not work for every transport. See
+# TransportInfo.shallow.
+# NOTE: With a 'filter', e.g. b"blob:none", the repository becomes a partial
+# clone. git configures the remote as a promisor remote automatically. See
+# git_rev_list_missing() to fetch the missing objects later.
+# NOTE: The argument 'cwd' is the path to the git repository that receives the
+# objects. If it's None, the current work directory is used.
+def git_fetch(url: str, ref: bytes | None = None, cwd: bytes | None = None, depth: int | None = 1,
+              filter: bytes | None = None) -> bytes:
+    cmd = ["git", "fetch", "-q", url]
+    if ref is not None:
+        cmd.append(ref)
+
+    if depth is not None:
+        cmd += ["--depth", "%d" % (depth,)]
+    if filter is not None:
+        cmd.append("--filter=" + filter.decode("ascii"))
+    p = Popen(cmd, stderr=DEVNULL, cwd=cwd)
+    # NOTE If stderr==DEVNULL(no-tty) no progress is showing on the commandline
+    # Not getting the error is bad!
+    # TODO capture fetch error and forward to caller!
+    p.communicate()
+    if p.returncode != 0:
+        # TODO think about error handling!!
+        # Maybe every subcommand should be able and allows to write to stderr
+        # directly or forward to caller!
+        raise Exception("git failure: %d, %s" % (p.returncode, cmd))
+
+    # get SHA1 of fetched object
+    # TODO Handle bare and non bare repos!
+    # If multiple refs are fetch, the first one is used!
+    fetch_head_path = b"FETCH_HEAD" if cwd is None else join(cwd, b"FETCH_HEAD")
+    with open(fetch_head_path, "br") as f:
+        sha1 = f.read().split(b"\t", 1)[0]
+
+    assert is_sha1(sha1)
+    return sha1
+
+# bundler: file src/cache.py
+
+import fcntl
+import hashlib
+import os
+import socket
+import shutil
+import stat
+import tarfile
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, replace
+from typing import Any
+from os.path import join
+
+# bundler: --8<-- was here
+
+
+# TODO Make this of type "bytes". It's currentl 'str'.
+@dataclass(frozen=True)
+class DownloadConfig:
+    url: Any
+    revision: Any | None = None
+    # Only this subdirectory of the upstream repository is needed. If the
+    # remote supports it, the blobs of other directories are not downloaded.
+    subdir: bytes | None = None
+    # The object id of the revision that is already integrated in the
+    # superproject. E.g. the old revision when updating a subproject.
+    integrated_object_id: bytes | None = None
+    # Path to a git bundle file. If it's set, the objects are taken from the
+    # bundle instead of the remote repository. The URL is not contacted.
+    bundle_path: bytes | None = None
+
+
+@dataclass(frozen=True)
+class CloneConfig:
+    full_clone: bool
+    object_id: str | None = None
+    ref: bytes | None = None
+    # The object id that the revision points to in the remote repository. It's
+    # None if it's unknown.
+    remote_object_id: bytes | None = None
+
+
+def git_resolve_to_clone_config(url: str, revision: str | None, refs_cache: "RefsCache | None" = None) -> CloneConfig:
+    # Some heuristics to sort out branch, commit/tag id or tag
+    if revision is not None:
+
+        # TODO Clean type missmatch
+        assert isinstance(revision, str)
+        revision_bytes = revision.encode("utf8")
+
+        if is_sha1(revision_bytes):
+            # NOTE Commit ids are bad! You cannot download just a single
+            # commit id. You can only clone everything and hope that the commit id
+            # is in there!
+            # TODO Handle tag ids special. They can be looked up by "git
+            # ls-remote".
+            return CloneConfig(full_clone=True, object_id=revision, remote_object_id=revision_bytes)
+        else:
+            # It looks like a ref to a branch or tag. Try to resolve it
+            if refs_cache is None:
+                ref_resolved = git_ls_remote_guess_ref(url, revision)
+            else:
+                ref_resolved = refs_cache.resolve(url, revision, lambda: git_ls_remote_guess_ref(url, revision))
+            if ref_resolved is None:
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "The reference '%s' cannot be resolved to a branch or tag!" % (revision,))
+            ref, remote_object_id = ref_resolved
+            return CloneConfig(full_clone=False, ref=ref, remote_object_id=remote_object_id)
+    else:
+        # Use HEAD of remote repository
+        # TODO optimize this by looking at the output of "git ls-remote".
+        def query_head() -> tuple[bytes, bytes] | None:
+            object_id = git_ls_remote(url, ["HEAD"]).get(b"HEAD")
+            return None if object_id is None else (b"HEAD", object_id)
+
+        if refs_cache is None:
+            head_resolved = query_head()
+        else:
+            head_resolved = refs_cache.resolve(url, None, query_head)
+        return CloneConfig(full_clone=True, remote_object_id=None if head_resolved is None else head_resolved[1])
+
+
+# Returns the directory that contains the persistent caches of all upstream
+# repositories. The default location is inside the git directory of the
+# superproject. With the environment variable SUBPATCH_CACHE_DIR the caches can
+# be shared between multiple superprojects, e.g. "$XDG_CACHE_HOME/subpatch".
+def get_cache_root_abspath(super_abspath: bytes) -> bytes:
+    if is_cache_root_shared():
+        return os.path.abspath(os.fsencode(os.environ["SUBPATCH_CACHE_DIR"]))
+    return join(git_get_common_dir(cwd=super_abspath), b"subpatch-cache")
+
+
+# Returns True if the caches are shared between multiple superprojects
+def is_cache_root_shared() -> bool:
+    return len(os.environ.get("SUBPATCH_CACHE_DIR", "")) > 0
+
+
+# Normalize the URL, so the same upstream repository always results in the
+# same cache directory.
+# NOTE: Local relative paths are relative to the current work directory.
+def normalize_url(url: str) -> str:
+    url_type = get_url_type(url)
+    if url_type in (URLTypes.LOCAL_RELATIVE, URLTypes.LOCAL_ABSOLUTE):
+        return os.path.normpath(os.path.abspath(url))
+    return url.rstrip("/")
+
+
+def get_cache_key(url: str) -> bytes:
+    return hashlib.sha1(normalize_url(url).encode("utf8")).hexdigest().encode("ascii")
+
+
+# Returns the time in seconds that resolved refs are reused from the
+# RefsCache. It's configured with the environment variable SUBPATCH_REFS_TTL.
+# The default is 0. Then every revision is resolved in the remote repository.
+def get_refs_ttl() -> float:
+    value = os.environ.get("SUBPATCH_REFS_TTL", "0").strip()
+    try:
+        ttl = float(value)
+    except ValueError:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "SUBPATCH_REFS_TTL must be a number, but it's '%s'" % (value,))
+    return ttl
+
+
+# Returns the time in seconds to wait for the lock of a cache. It's configured
+# with the environment variable SUBPATCH_LOCK_TIMEOUT. The default is 600.
+def get_lock_timeout() -> float:
+    value = os.environ.get("SUBPATCH_LOCK_TIMEOUT", "600").strip()
+    try:
+        timeout = float(value)
+    except ValueError:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "SUBPATCH_LOCK_TIMEOUT must be a number, but it's '%s'" % (value,))
+    return timeout
+
+
+# Exclusive lock of a cache. Multiple subpatch processes on the same machine
+# can share the caches, e.g. parallel CI jobs with SUBPATCH_CACHE_DIR. The
+# lock file is located next to the cache directory. So it also protects the
+# creation and the removal of the cache.
+# NOTE: The lock is a fcntl lock on the lock file. The kernel releases it when
+# the process exits or crashes. So a lock file that is left over is never
+# stale. It's just reused. The lock file contains the pid and the hostname of
+# the last owner for the error message.
+# NOTE: The lock is not reentrant. Also two threads of the same process must
+# not lock the same cache.
+class CacheLock:
+    def __init__(self, cache_abspath: bytes, timeout: float | None = None):
+        self._path = cache_abspath + b".lock"
+        self._timeout = get_lock_timeout() if timeout is None else timeout
+        self._fd: int | None = None
+
+    # Returns False, if the lock is held by another process and 'blocking' is
+    # False.
+    def acquire(self, blocking: bool = True) -> bool:
+        assert self._fd is None
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self._timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not blocking:
+                    os.close(fd)
+                    return False
+                if time.monotonic() >= deadline:
+                    owner = os.pread(fd, 256, 0).decode("utf8", errors="replace").strip()
+                    os.close(fd)
+                    raise AppException(ErrorCode.INVALID_STATE,
+                                       "Timeout while waiting for the lock '%s'. It's held by '%s'."
+                                       % (os.fsdecode(self._path), owner))
+                time.sleep(0.1)
+
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, b"pid %d on %s\n" % (os.getpid(), socket.gethostname().encode("utf8")), 0)
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        assert self._fd is not None
+        # NOTE: Closing the file descriptor releases the lock. The lock file is
+        # not removed. Another process may already wait for it.
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self) -> "CacheLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+# Locks multiple caches. The locks are taken in a fixed order. So two processes
+# that need some of the same caches cannot deadlock.
+# NOTE: The caches must not be locked again in the same process while the locks
+# are held. The locks of two file descriptors exclude each other.
+@contextmanager
+def lock_caches(cache_abspaths: list[bytes], timeout: float | None = None):
+    with ExitStack() as stack:
+        for cache_abspath in sorted(set(cache_abspaths)):
+            stack.enter_context(CacheLock(cache_abspath, timeout))
+        yield
+
+
+# Returns the maximum size in bytes of all caches in the cache root directory.
+# It's configured with the environment variable SUBPATCH_CACHE_MAX_SIZE. The
+# default is None. Then the size is not bounded.
+def get_cache_max_size() -> int | None:
+    value = os.environ.get("SUBPATCH_CACHE_MAX_SIZE", "").strip()
+    if value == "":
+        return None
+    return check_and_parse_cache_max_size(value)
+
+
+def check_and_parse_cache_max_size(value: str) -> int:
+    try:
+        max_size = int(value)
+    except ValueError:
+        max_size = -1
+    if max_size < 0:
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "The maximum cache size must be a number of bytes, but it's '%s'" % (value,))
+    return max_size
+
+
+# The modification time of this file in a cache directory is the time of the
+# last use of the cache.
+LAST_USE_FILENAME = b"subpatch-last-use"
+
+
+def mark_cache_used(cache_abspath: bytes) -> None:
+    path = join(cache_abspath, LAST_USE_FILENAME)
+    with open(path, "ab"):
+        pass
+    os.utime(path)
+
+
+def get_cache_last_use(cache_abspath: bytes) -> float:
+    try:
+        return os.stat(join(cache_abspath, LAST_USE_FILENAME)).st_mtime
+    except FileNotFoundError:
+        # The cache was created before the file was introduced
+        return os.stat(cache_abspath).st_mtime
+
+
+# Returns the disk usage of all files in the directory in bytes
+def get_dir_size(dir_abspath: bytes) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(dir_abspath):
+        for filename in filenames:
+            size += os.lstat(join(dirpath, filename)).st_size
+    return size
+
+
+# Returns the paths of all caches in the cache root directory. The names of
+# the cache directories are the cache keys.
+def list_caches(root_abspath: bytes) -> list[bytes]:
+    try:
+        names = sorted(os.listdir(root_abspath))
+    except FileNotFoundError:
+        return []
+    return [join(root_abspath, name) for name in names if is_sha1(name) and os.path.isdir(join(root_abspath, name))]
+
+
+# Removes the least recently used caches until all caches together are not
+# bigger than 'max_size' bytes. The caches in 'keep' are never removed, e.g.
+# the caches that are used by the current command. Caches that are locked by
+# other processes are also not removed. Returns the removed caches as tuples
+# (path, size).
+def evict_caches(root_abspath: bytes, max_size: int, keep: list[bytes] | None = None) -> list[tuple[bytes, int]]:
+    keep = [] if keep is None else keep
+    caches = [(get_cache_last_use(path), path, get_dir_size(path)) for path in list_caches(root_abspath)]
+    total_size = sum(size for _, _, size in caches)
+
+    removed = []
+    for _, path, size in sorted(caches):
+        if total_size <= max_size:
+            break
+        if path in keep:
+            continue
+        lock = CacheLock(path)
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            # Another process may have removed the cache in the meantime
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            # Also forget the resolved refs of the URL. See RefsCache.
+            try:
+                os.unlink(path + b".refs")
+            except FileNotFoundError:
+                pass
+        finally:
+            lock.release()
+        total_size -= size
+        removed.append((path, size))
+    return removed
+
+
+# On-disk cache for the resolution of revisions in remote repositories. So
+# multiple 'add' and 'update' calls in a short time do not query the remote
+# again and again. There is a file per URL next to the cache repositories.
+# Every line contains a resolved revision:
+#    <time stamp> <tab> <revision> <tab> <ref> <tab> <object id> <newline>
+# For the HEAD of the remote repository the revision is empty.
+# NOTE: Only successful resolutions are cached.
+class RefsCache:
+    def __init__(self, root_abspath: bytes, ttl: float, refresh: bool = False):
+        self._root_abspath = root_abspath
+        self._ttl = ttl
+        # Ignore existing entries, but store the new results
+        self._refresh = refresh
+
+    def _get_path(self, url: str) -> bytes:
+        return join(self._root_abspath, get_cache_key(url) + b".refs")
+
+    def _read(self, url: str) -> dict[bytes, tuple[float, bytes, bytes]]:
+        entries = {}
+        try:
+            with open(self._get_path(url), "rb") as f:
+                for line in f.read().splitlines():
+                    parts = line.split(b"\t")
+                    if len(parts) != 4 or not is_sha1(parts[3]):
+                        continue  # Ignore broken lines
+                    timestamp, revision, ref, object_id = parts
+                    entries[revision] = (float(timestamp), ref, object_id)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _write(self, url: str, entries: dict[bytes, tuple[float, bytes, bytes]]) -> None:
+        os.makedirs(self._root_abspath, exist_ok=True)
+        path = self._get_path(url)
+        # Write the new file first and rename it. So a reader never sees a
+        # partial file.
+        tmp_path = path + b".tmp%d" % (os.getpid(),)
+        with open(tmp_path, "wb") as f:
+            for revision, (timestamp, ref, object_id) in entries.items():
+                f.write(b"%f\t%s\t%s\t%s\n" % (timestamp, revision, ref, object_id))
+        os.replace(tmp_path, path)
+
+    # Returns the cached tuple (ref, object id) for the revision if it's not
+    # older than the TTL. Otherwise 'query' is called to resolve the revision
+    # in the remote repository and the result is stored.
+    def resolve(self, url: str, revision: str | None, query) -> tuple[bytes, bytes] | None:
+        if self._ttl <= 0:
+            return query()
+
+        revision_bytes = b"" if revision is None else revision.encode("utf8")
+        now = time.time()
+        entries = self._read(url)
+        if not self._refresh and revision_bytes in entries:
+            timestamp, ref, object_id = entries[revision_bytes]
+            if 0 <= now - timestamp < self._ttl:
+                return ref, object_id
+
+        result = query()
+        if result is not None:
+            entries[revision_bytes] = (now, result[0], result[1])
+            self._write(url, entries)
+        return result
+
+
+# Name of the remote in the cache repository for partial clones
+PROMISOR_REMOTE_NAME = "origin"
+
+# Ref in the cache repository that points to the revision that is integrated
+# in the superproject. See DownloadConfig.integrated_object_id.
+INTEGRATED_REF = b"refs/subpatch/integrated"
+
+# Ref in the cache repository that points to the last fetched revision. The
+# fetched objects are not referenced otherwise. Then "git gc" would prune
+# them.
+FETCHED_REF = b"refs/subpatch/fetched"
+
+# Fetch without shallow fetches, partial clones and the fetch of objects by id.
+# Every remote supports it, even the dumb http transport.
+PLAIN_TRANSPORT = TransportInfo(shallow=False, fetch_by_object_id=False, filter=False)
+
+
+class CacheHelperGit:
+    def __init__(self, refs_cache: RefsCache | None = None, refresh: bool = False):
+        self._refs_cache = refs_cache
+        # Ignore the stored capabilities of the remote. See get_transport_info().
+        self._refresh = refresh
+
+    def get_revision_as_str(self, revision: str | None) -> str:
+        # The revision is of type Optional<str>. It's either None or a str.
+        # Convert to a printable string for stdout
+        if revision is None:
+            return "HEAD"
+        return revision
+
+    # TODO allow to use bare and non-bare git repositories
+    # NOTE "git submodule init" creates a bare repository in ".git/modules"
+    def create(self, cache_abspath: bytes) -> None:
+        assert os.path.isdir(cache_abspath)
+        git_init_bare(cwd=cache_abspath)
+        # TODO add are enfore that there is a cache-subpatch config file
+
+    def isCreated(self, cache_abspath: bytes) -> bool:
+        # Very simple check to test whether the cache directory contains a bare
+        # git repository.
+        # TODO also check for cache subpatch config file
+        return os.path.isfile(join(cache_abspath, b"config"))
+
+    # Resolve the revision in the remote repository without fetching anything
+    def resolve(self, download_config: DownloadConfig) -> CloneConfig:
+        if download_config.bundle_path is not None:
+            return self.resolve_bundle(download_config.bundle_path, download_config.revision)
+        return git_resolve_to_clone_config(download_config.url, download_config.revision, self._refs_cache)
+
+    # Same as git_resolve_to_clone_config(), but the refs are taken from the
+    # bundle file instead of the remote repository.
+    def resolve_bundle(self, bundle_path: bytes, revision: str | None) -> CloneConfig:
+        refs_sha1 = git_bundle_list_heads(bundle_path)
+        if revision is None:
+            if b"HEAD" not in refs_sha1:
+                raise AppException(ErrorCode.INVALID_ARGUMENT, "The bundle does not contain 'HEAD'!")
+            return CloneConfig(full_clone=False, ref=b"HEAD", remote_object_id=refs_sha1[b"HEAD"])
+
+        revision_bytes = revision.encode("utf8")
+        if is_sha1(revision_bytes):
+            # NOTE: The object id does not need to be a ref of the bundle. It
+            # can also be an object that is reachable from a ref.
+            return CloneConfig(full_clone=True, object_id=revision, remote_object_id=revision_bytes)
+
+        ref_resolved = guess_ref(refs_sha1, revision)
+        if ref_resolved is None:
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "The reference '%s' cannot be resolved to a branch or tag in the bundle!" % (revision,))
+        ref, remote_object_id = ref_resolved
+        return CloneConfig(full_clone=False, ref=ref, remote_object_id=remote_object_id)
+
+    # TODO return the object id here is maybe not correct, because it's not
+    # agnostic to other cache types.
+    # NOTE: return value is either a object_id of a tag or of a commit!
+    # NOTE: The 'clone_config' of a previous resolve() call can be passed to
+    # avoid querying the remote repository again.
+    def fetch(self, cache_abspath: bytes, download_config: DownloadConfig,
+              clone_config: CloneConfig | None = None) -> bytes:
+        # TODO clone only a single branch and maybe use --depth 1
+        #  - that is already partially implemented
+        url = download_config.url
+
+        if clone_config is None:
+            clone_config = self.resolve(download_config)
+
+        assert os.path.isabs(cache_abspath)
+
+        if download_config.bundle_path is not None:
+            object_id = self.fetch_from_bundle(cache_abspath, download_config.bundle_path, clone_config)
+            git_update_ref(FETCHED_REF, object_id, cwd=cache_abspath)
+            return object_id
+
+        # The cache is persistent and not located next to the current work
+        # directory. So relative local paths must be made absolute.
+        if get_url_type(url) == URLTypes.LOCAL_RELATIVE:
+            url = os.path.abspath(url)
+
+        try:
+            object_id = self.fetch_with_transport(cache_abspath, url, download_config, clone_config)
+            is_complete = self.has_all_objects(cache_abspath, object_id)
+        except AppException:
+            raise
+        except Exception:
+            # The missing objects of the alternate can also break the fetch.
+            # git fails in its connectivity check.
+            if not git_has_alternates(cache_abspath) or git_fsck_connectivity(cwd=cache_abspath):
+                raise
+            is_complete = False
+
+        # The cache uses the objects of the superproject. See
+        # use_superproject_objects(). If the superproject has removed some of
+        # them, e.g. by "git gc", they are missing in the cache. git does not
+        # fetch them again, because it assumes that the objects of the refs
+        # are complete. So the cache is created again without the alternate.
+        if not is_complete:
+            git_close_object_reader(cache_abspath)
+            shutil.rmtree(cache_abspath)
+            os.mkdir(cache_abspath)
+            self.create(cache_abspath)
+            mark_cache_used(cache_abspath)
+            object_id = self.fetch_with_transport(cache_abspath, url, download_config, clone_config)
+
+        git_update_ref(FETCHED_REF, object_id, cwd=cache_abspath)
+        return object_id
+
+    # The capabilities of the remote are not probed upfront. The fetch just
+    # uses them. If it fails, it's retried without any of them.
+    def fetch_with_transport(self, cache_abspath: bytes, url: str, download_config: DownloadConfig,
+                             clone_config: CloneConfig) -> bytes:
+        transport = self.get_transport_info(cache_abspath)
+        try:
+            object_id, transport = self.fetch_from_remote(cache_abspath, url, download_config, clone_config, transport)
+        except AppException:
+            raise
+        except Exception:
+            # E.g. the dumb http transport fails for the shallow fetch. But the
+            # failure can also have other causes, e.g. the network. So the
+            # stored capabilities are removed. If the retry fails, too, the
+            # next fetch tries all capabilities again.
+            git_config_unset("subpatch.transport", cwd=cache_abspath)
+            if transport == PLAIN_TRANSPORT:
+                raise
+            object_id, transport = self.fetch_from_remote(cache_abspath, url, download_config, clone_config,
+                                                          PLAIN_TRANSPORT)
+        self.set_transport_info(cache_abspath, transport)
+        return object_id
+
+    # Fetches the revision with the given capabilities of the remote. Returns
+    # the object id and the capabilities. A capability is dropped, if the
+    # remote rejected it, but the fetch succeeded nevertheless.
+    def fetch_from_remote(self, cache_abspath: bytes, url: str, download_config: DownloadConfig,
+                          clone_config: CloneConfig, transport: TransportInfo) -> tuple[bytes, TransportInfo]:
+        depth = 1 if transport.shallow else None
+        # For a subdirectory use a partial clone without blobs. The blobs of
+        # the subdirectory are fetched afterwards. This needs the fetch of
+        # objects by id.
+        filter = None
+        if download_config.subdir is not None and transport.filter and transport.fetch_by_object_id:
+            filter = b"blob:none"
+            # git needs a named remote to lazily fetch the missing objects.
+            # So from now on the cache fetches from the promisor remote.
+            url = self.configure_promisor_remote(url, cache_abspath)
+
+        # The files of the integrated revision are already in the object store
+        # of the superproject. If the cache uses it as an alternate, fetch
+        # only the commit of the integrated revision without trees and blobs.
+        # Objects that are not in the superproject anymore are fetched from
+        # the promisor remote later.
+        integrated_object_id = download_config.integrated_object_id
+        if integrated_object_id is not None:
+            if not self.has_commit(cache_abspath, integrated_object_id) and transport.shallow \
+                    and transport.filter and transport.fetch_by_object_id and git_has_alternates(cache_abspath):
+                remote = self.configure_promisor_remote(url, cache_abspath)
+                # NOTE: A failure is not an error. It's just an optimization.
+                git_fetch_object_id(remote, integrated_object_id, cwd=cache_abspath, depth=1, filter=b"tree:0")
+
+            # git only uses commits as 'have' in the negotiation, if a ref
+            # points to them. Then the remote only sends the objects that are
+            # new in the requested revision.
+            if self.has_commit(cache_abspath, integrated_object_id):
+                git_update_ref(INTEGRATED_REF, integrated_object_id, cwd=cache_abspath)
+
+        # There are three cases:
+        #   - full clone + with object id
+        #   - full clone + without object id
+        #   - fetch + with ref
+
+        if clone_config.full_clone:
+            if clone_config.object_id is None:
+                object_id = self.fetch_all_refs(url, cache_abspath, depth, filter)
+            else:
+                # If the remote allows it, fetch only the requested commit/tag.
+                # Otherwise fetch all refs and hope that the object id is in
+                # there.
+                object_id_bytes = clone_config.object_id.encode("ascii")
+                if not self.has_commit(cache_abspath, object_id_bytes):
+                    if not transport.fetch_by_object_id or \
+                            not git_fetch_object_id(url, object_id_bytes, cwd=cache_abspath, depth=depth, filter=filter):
+                        self.fetch_all_refs(url, cache_abspath, depth, filter)
+                        transport = replace(transport, fetch_by_object_id=False)
+
+                if not git_verify(clone_config.object_id, cwd=cache_abspath):
+                    raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                       "Object id '%s' does not point to a valid object!" % (clone_config.object_id,))
+
+                object_type = git_get_object_type(clone_config.object_id, cwd=cache_abspath)
+                if object_type not in (ObjectType.COMMIT, ObjectType.TAG):
+                    raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                       "Object id '%s' does not point to a commit or tag object!" % (clone_config.object_id,))
+                # The requested object_id exists and is a tag or commit. We can use it!
+                object_id = clone_config.object_id.encode("ascii")
+        else:
+            # TODO Rework DownloadConfig to avoid extra asser here
+            assert clone_config.ref is not None
+            remote_object_id = clone_config.remote_object_id
+            if remote_object_id is not None and self.has_commit(cache_abspath, remote_object_id):
+                # The object was already fetched into the persistent cache
+                # earlier. E.g. by another subproject with the same upstream.
+                object_id = remote_object_id
+            else:
+                object_id = git_fetch(url, clone_config.ref, cwd=cache_abspath, depth=depth, filter=filter)
+
+        # The cache may be a partial clone. Either by this fetch or by an
+        # earlier fetch for a subproject with a subdirectory. Then fetch the
+        # missing blobs that are needed for the extraction in one go.
+        if git_has_promisor_packs(cache_abspath):
+            tree_id = self.get_tree_id(cache_abspath, object_id, download_config.subdir)
+            missing_object_ids = git_rev_list_missing(tree_id, cwd=cache_abspath)
+            if len(missing_object_ids) > 0:
+                git_fetch_missing_objects(PROMISOR_REMOTE_NAME, missing_object_ids, cwd=cache_abspath)
+
+        return object_id, transport
+
+    # Imports the objects of the bundle into the cache. Nothing is fetched from
+    # the remote repository. So this works offline.
+    def fetch_from_bundle(self, cache_abspath: bytes, bundle_path: bytes, clone_config: CloneConfig) -> bytes:
+        assert clone_config.remote_object_id is not None
+        object_id = clone_config.remote_object_id
+
+        if not self.has_commit(cache_abspath, object_id):
+            refs_sha1 = git_bundle_unbundle(bundle_path, cwd=cache_abspath)
+            # The bundle may be exported from a shallow cache. Then the
+            # parents of the commits are missing and git must not look for
+            # them.
+            for ref_object_id in set(refs_sha1.values()):
+                commit_id = git_get_sha1(ref_object_id + b"^{commit}", cwd=cache_abspath)
+                parents = git_get_commit_parents(commit_id, cwd=cache_abspath)
+                if any(not git_commit_exists_locally(parent, cwd=cache_abspath) for parent in parents):
+                    git_mark_shallow(cache_abspath, commit_id)
+
+            if not git_commit_exists_locally(object_id, cwd=cache_abspath):
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "Object id '%s' is not contained in the bundle!" % (object_id.decode("ascii"),))
+
+        object_type = git_get_object_type(object_id, cwd=cache_abspath)
+        if object_type not in (ObjectType.COMMIT, ObjectType.TAG):
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "Object id '%s' does not point to a commit or tag object!" % (object_id.decode("ascii"),))
+        return object_id
+
+    # Writes a bundle file that contains the revision 'object_id'. The bundle
+    # can be used with fetch() on a machine without access to the remote
+    # repository. The name of the ref in the bundle is derived from the
+    # 'revision'. So it can be resolved with the same revision later.
+    # NOTE: If the cache is shallow, the bundle contains only the objects of
+    # the revision and not its history.
+    def export_bundle(self, cache_abspath: bytes, bundle_path: bytes, revision: str | None, object_id: bytes) -> None:
+        if revision is None:
+            ref = b"HEAD"
+        elif is_sha1(revision.encode("utf8")):
+            ref = b"refs/subpatch/" + object_id
+        elif revision.startswith("refs/"):
+            ref = revision.encode("utf8")
+        elif git_get_object_type(object_id, cwd=cache_abspath) == ObjectType.TAG:
+            ref = b"refs/tags/" + revision.encode("utf8")
+        else:
+            ref = b"refs/heads/" + revision.encode("utf8")
+
+        # In a partial clone the objects outside of the subdirectory are
+        # missing. They are not needed for the subproject.
+        git_bundle_create(bundle_path, [(ref, object_id)], cwd=cache_abspath,
+                          allow_missing=git_has_promisor_packs(cache_abspath))
+
+    # We have to fetch all remote refs (heads and tags), because we don't know
+    # in which refs the commit/tag(=object id) exists.
+    def fetch_all_refs(self, url: str, cache_abspath: bytes, depth: int | None, filter: bytes | None) -> bytes:
+        # NOTE: Use '+' to force the update of the refs. The cache is
+        # persistent and the remote refs can be rewritten since the last
+        # fetch.
+        return git_fetch(url, '+*:*', cwd=cache_abspath, depth=depth, filter=filter)
+
+    # Returns True if the commit or tag exists in the cache.
+    # NOTE: In a partial clone git would fetch a missing commit lazily with
+    # its whole history. So use a check without a lazy fetch.
+    def has_commit(self, cache_abspath: bytes, object_id: bytes) -> bool:
+        if git_has_promisor_packs(cache_abspath):
+            return git_commit_exists_locally(object_id, cwd=cache_abspath)
+        return git_verify(object_id, cwd=cache_abspath)
+
+    # Returns False if objects of the revision are missing in the cache. Only a
+    # cache with an alternate is checked. A partial clone fetches the missing
+    # objects from the promisor remote anyway.
+    def has_all_objects(self, cache_abspath: bytes, object_id: bytes) -> bool:
+        if not git_has_alternates(cache_abspath) or git_has_promisor_packs(cache_abspath):
+            return True
+        try:
+            return len(git_rev_list_missing(object_id + b"^{tree}", cwd=cache_abspath)) == 0
+        except Exception:
+            # E.g. the tree object itself is missing
+            return False
+
+    # Packs the objects of the cache, if there are too many loose objects or
+    # packs. Old objects that are not referenced anymore are pruned.
+    def compact(self, cache_abspath: bytes) -> None:
+        git_gc_auto(cwd=cache_abspath)
+
+    # Make the objects of the superproject available in the cache. See
+    # DownloadConfig.integrated_object_id.
+    # NOTE: The path is stored relative to the cache. So the superproject can
+    # be moved.
+    # NOTE: The cache depends on the objects of the superproject now. Nothing
+    # in the superproject keeps them alive. "git gc" in the superproject can
+    # remove them, e.g. after a rewrite of the history. Then fetch() detects
+    # the missing objects and creates the cache again.
+    def use_superproject_objects(self, cache_abspath: bytes, super_objects_abspath: bytes) -> None:
+        git_add_alternate(cache_abspath, os.path.relpath(super_objects_abspath, join(cache_abspath, b"objects")))
+
+    # Configures the remote repository as the promisor remote of a partial
+    # clone. Returns the name of the remote.
+    # NOTE: The name of the remote cannot be the URL itself. git cannot use
+    # local paths as names of promisor remotes.
+    def configure_promisor_remote(self, url: str, cache_abspath: bytes) -> str:
+        if git_config_get("remote.%s.url" % (PROMISOR_REMOTE_NAME,), cwd=cache_abspath) != url.encode("utf8"):
+            git_config_set("core.repositoryformatversion", b"1", cwd=cache_abspath)
+            git_config_set("extensions.partialClone", PROMISOR_REMOTE_NAME.encode("ascii"), cwd=cache_abspath)
+            git_config_set("remote.%s.url" % (PROMISOR_REMOTE_NAME,), url.encode("utf8"), cwd=cache_abspath)
+            git_config_set("remote.%s.promisor" % (PROMISOR_REMOTE_NAME,), b"true", cwd=cache_abspath)
+        return PROMISOR_REMOTE_NAME
+
+    # Returns the capabilities of the remote repository that worked for the
+    # last fetch. They are stored in the config of the cache repository as the
+    # value of 'subpatch.transport', e.g. "shallow fetch-by-object-id". For a
+    # new cache, after a failed fetch and with '--refresh' all capabilities are
+    # tried again.
+    def get_transport_info(self, cache_abspath: bytes) -> TransportInfo:
+        value = git_config_get("subpatch.transport", cwd=cache_abspath)
+        if value is None or self._refresh:
+            return TransportInfo(shallow=True, fetch_by_object_id=True, filter=True)
+
+        flags = value.split(b" ")
+        return TransportInfo(shallow=b"shallow" in flags, fetch_by_object_id=b"fetch-by-object-id" in flags,
+                             filter=b"filter" in flags)
+
+    def set_transport_info(self, cache_abspath: bytes, transport: TransportInfo) -> None:
+        flags = []
+        if transport.shallow:
+            flags.append(b"shallow")
+        if transport.fetch_by_object_id:
+            flags.append(b"fetch-by-object-id")
+        if transport.filter:
+            flags.append(b"filter")
+        git_config_set("subpatch.transport", b" ".join(flags), cwd=cache_abspath)
+
+    # Returns the object id of the tree of 'object_id' or of its subdirectory
+    # 'subdir'.
+    def get_tree_id(self, cache_abspath: bytes, object_id: bytes, subdir: bytes | None) -> bytes:
+        if subdir is None:
+            return git_get_sha1(object_id + b"^{tree}", cwd=cache_abspath)
+
+        info = git_get_object_reader(cache_abspath).info(object_id + b":" + subdir)
+        if info is None or info.object_type != ObjectType.TREE:
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "The subdirectory '%s' does not exist in the upstream revision!" % (subdir.decode("utf8"),))
+        return info.object_id
+
+    # Extracts all files of 'object_id' into the object store of the
+    # superproject. Returns the object id of the tree object that contains the
+    # files. The files are not checked out and the tree is not staged. If
+    # 'subdir' is given, only the files of this subdirectory are extracted.
+    # NOTE: Only the tree is imported, not the commit. The cache is a shallow
+    # repository and the superproject should not become one.
+    def extract(self, cache_abspath: bytes, object_id: bytes, super_abspath: bytes,
+                subdir: bytes | None = None) -> bytes:
+        tree_id = self.get_tree_id(cache_abspath, object_id, subdir)
+
+        git_fetch_objects(cache_abspath, [tree_id], cwd=super_abspath)
+
+        # The submodules of the upstream are not integrated. The superproject
+        # has no ".gitmodules" entries for them. So a gitlink in the index
+        # would be broken.
+        writer = GitObjectWriter(cwd=super_abspath)
+        stripped_tree_id = tree_remove_gitlinks(git_get_object_reader(super_abspath), writer, tree_id)
+        if stripped_tree_id is None:
+            stripped_tree_id = writer.add(ObjectType.TREE, b"")
+        writer.flush()
+        return stripped_tree_id
+
+
+# Returns the cache helper for an existing cache directory
+def get_cache_helper_for_cache(cache_abspath: bytes) -> "CacheHelperGit | CacheHelperArchive":
+    if CacheHelperArchive().isCreated(cache_abspath):
+        return CacheHelperArchive()
+    return CacheHelperGit()
+
+
+# File name suffixes of the supported archive types. Longer suffixes first,
+# because ".tar.gz" also ends with ".gz".
+ARCHIVE_SUFFIXES = (".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2", ".tar", ".zip")
+
+
+# Returns the archive suffix of the URL, e.g. ".tar.gz", or None if the URL
+# does not point to an archive.
+def get_archive_suffix(url: str) -> str | None:
+    for suffix in ARCHIVE_SUFFIXES:
+        if url.endswith(suffix):
+            return suffix
+    return None
+
+
+# Returns the cache helper for the type of the upstream URL. For now there are
+# only git repositories and archives.
+def get_cache_helper(url: str, refs_cache: RefsCache | None = None,
+                     refresh: bool = False) -> "CacheHelperGit | CacheHelperArchive":
+    if get_archive_suffix(url) is not None:
+        return CacheHelperArchive()
+    return CacheHelperGit(refs_cache, refresh)
+
+
+# Writes the blobs in batches. So the memory usage is bounded for big
+# archives.
+ARCHIVE_FLUSH_SIZE = 64 * 1024 * 1024
+
+
+# Cache for upstream projects that are released as archives, e.g. tarballs.
+# The cache contains the downloaded archive files. The object id of a
+# revision is the SHA-256 checksum of the archive file. A revision can be
+# given to pin the checksum. Then a changed archive is an error.
+class CacheHelperArchive:
+    def get_revision_as_str(self, revision: str | None) -> str:
+        if revision is None:
+            return "latest"
+        return revision
+
+    def create(self, cache_abspath: bytes) -> None:
+        assert os.path.isdir(cache_abspath)
+        os.makedirs(join(cache_abspath, b"archives"), exist_ok=True)
+
+    def isCreated(self, cache_abspath: bytes) -> bool:
+        return os.path.isdir(join(cache_abspath, b"archives"))
+
+    # The objects of the superproject are not useful for archives
+    def use_superproject_objects(self, cache_abspath: bytes, super_objects_abspath: bytes) -> None:
+        pass
+
+    # The archives are already compressed
+    def compact(self, cache_abspath: bytes) -> None:
+        pass
+
+    # Without a download the checksum is only known if it's pinned by the
+    # revision.
+    def resolve(self, download_config: DownloadConfig) -> CloneConfig:
+        revision = download_config.revision
+        if revision is None:
+            return CloneConfig(full_clone=True)
+        if not is_sha256(revision.encode("utf8")):
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "The revision of an archive must be its SHA-256 checksum, but it's '%s'!" % (revision,))
+        return CloneConfig(full_clone=True, object_id=revision, remote_object_id=revision.encode("ascii"))
+
+    def fetch(self, cache_abspath: bytes, download_config: DownloadConfig,
+              clone_config: CloneConfig | None = None) -> bytes:
+        if download_config.bundle_path is not None:
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "Bundles can only be used for git repositories!")
+
+        if clone_config is None:
+            clone_config = self.resolve(download_config)
+
+        assert os.path.isabs(cache_abspath)
+
+        expected_object_id = clone_config.remote_object_id
+        if expected_object_id is not None and self.get_archive_path(cache_abspath, expected_object_id) is not None:
+            return expected_object_id
+
+        url = download_config.url
+        suffix = get_archive_suffix(url)
+        assert suffix is not None
+
+        # Hash the archive while downloading it. Write it to a temporary file
+        # first. So the cache never contains a partial archive.
+        h = hashlib.sha256()
+        tmp_path = join(cache_abspath, b"archives", b"download.tmp%d" % (os.getpid(),))
+        try:
+            with self.open_url(url) as src, open(tmp_path, "wb") as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if len(chunk) == 0:
+                        break
+                    h.update(chunk)
+                    dst.write(chunk)
+            object_id = h.hexdigest().encode("ascii")
+            if expected_object_id is not None and object_id != expected_object_id:
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "The checksum of the archive is '%s', but '%s' is expected!" %
+                                   (object_id.decode("ascii"), expected_object_id.decode("ascii")))
+            os.replace(tmp_path, join(cache_abspath, b"archives", object_id + suffix.encode("ascii")))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        return object_id
+
+    # Opens a local file or a HTTP(S) URL for reading
+    def open_url(self, url: str):
+        try:
+            if get_url_type(url) == URLTypes.REMOTE:
+                if not url.startswith(("http://", "https://")):
+                    raise AppException(ErrorCode.NOT_IMPLEMENTED_YET,
+                                       "Archives can only be downloaded with HTTP or HTTPS!")
+                return urllib.request.urlopen(url)
+            return open(url, "rb")
+        except (OSError, urllib.error.URLError) as e:
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "Cannot download the archive '%s': %s" % (url, e))
+
+    # Returns the path of the archive in the cache or None if it's not
+    # downloaded yet.
+    def get_archive_path(self, cache_abspath: bytes, object_id: bytes) -> bytes | None:
+        for suffix in ARCHIVE_SUFFIXES:
+            path = join(cache_abspath, b"archives", object_id + suffix.encode("ascii"))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    # Streams the files of the archive into the object store of the
+    # superproject. The archive is not extracted to the filesystem. Returns the
+    # object id of the tree object that contains the files.
+    # NOTE: If all files are in a single toplevel directory, e.g.
+    # "project-1.0/", this directory is stripped. That is the common layout of
+    # release tarballs.
+    def extract(self, cache_abspath: bytes, object_id: bytes, super_abspath: bytes,
+                subdir: bytes | None = None) -> bytes:
+        archive_path = self.get_archive_path(cache_abspath, object_id)
+        if archive_path is None:
+            raise AppException(ErrorCode.INVALID_STATE,
+                               "The archive '%s' is not in the cache!" % (object_id.decode("ascii"),))
+
+        writer = GitObjectWriter(cwd=super_abspath)
+        if archive_path.endswith(b".zip"):
+            files = self.read_zip(archive_path, writer)
+        else:
+            files = self.read_tar(archive_path, writer)
+
+        toplevel_names = set(path.split(b"/", 1)[0] for path in files)
+        if len(toplevel_names) == 1 and all(b"/" in path for path in files):
+            files = {path.split(b"/", 1)[1]: entry for path, entry in files.items()}
+
+        if subdir is not None:
+            prefix = subdir + b"/"
+            files = {path[len(prefix):]: entry for path, entry in files.items() if path.startswith(prefix)}
+            if len(files) == 0:
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "The subdirectory '%s' does not exist in the upstream revision!" % (subdir.decode("utf8"),))
+
+        tree_id = self.write_tree(files, writer)
+        writer.flush()
+        return tree_id
+
+    # Returns a dict from the path of every file to a tuple (mode, blob id).
+    # The blobs are added to the 'writer'.
+    def read_tar(self, archive_path: bytes, writer: GitObjectWriter) -> dict[bytes, tuple[bytes, bytes]]:
+        files: dict[bytes, tuple[bytes, bytes]] = {}
+        pending_size = 0
+        # NOTE: The mode "r|*" reads the archive as a stream. The compression
+        # is detected automatically.
+        with tarfile.open(os.fsdecode(archive_path), mode="r|*") as tar:
+            for member in tar:
+                if member.isdir():
+                    continue
+                path = check_and_normalize_archive_path(member.name)
+                if member.issym():
+                    files[path] = (b"120000", writer.add(ObjectType.BLOB, os.fsencode(member.linkname)))
+                elif member.islnk():
+                    # A hard link points to a file that is earlier in the archive
+                    target = check_and_normalize_archive_path(member.linkname)
+                    if target not in files:
+                        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                           "The archive contains an invalid link '%s'!" % (member.name,))
+                    files[path] = files[target]
+                elif member.isfile():
+                    f = tar.extractfile(member)
+                    assert f is not None
+                    data = f.read()
+                    mode = b"100755" if member.mode & 0o111 else b"100644"
+                    files[path] = (mode, writer.add(ObjectType.BLOB, data))
+                    pending_size += len(data)
+                # Other types, e.g. device files, cannot be stored in git.
+
+                if pending_size >= ARCHIVE_FLUSH_SIZE:
+                    writer.flush()
+                    pending_size = 0
+        return files
+
+    def read_zip(self, archive_path: bytes, writer: GitObjectWriter) -> dict[bytes, tuple[bytes, bytes]]:
+        files: dict[bytes, tuple[bytes, bytes]] = {}
+        pending_size = 0
+        with zipfile.ZipFile(os.fsdecode(archive_path)) as zip_file:
+            for info in zip_file.infolist():
+                if info.is_dir():
+                    continue
+                path = check_and_normalize_archive_path(info.filename)
+                data = zip_file.read(info)
+                # The upper 16 bits contain the unix mode, if the archive was
+                # created on a unix system.
+                unix_mode = info.external_attr >> 16
+                if stat.S_ISLNK(unix_mode):
+                    mode = b"120000"
+                elif unix_mode & 0o111:
+                    mode = b"100755"
+                else:
+                    mode = b"100644"
+                files[path] = (mode, writer.add(ObjectType.BLOB, data))
+                pending_size += len(data)
+
+                if pending_size >= ARCHIVE_FLUSH_SIZE:
+                    writer.flush()
+                    pending_size = 0
+        return files
+
+    # Adds the tree objects for the files to the 'writer'. Returns the object
+    # id of the toplevel tree.
+    def write_tree(self, files: dict[bytes, tuple[bytes, bytes]], writer: GitObjectWriter) -> bytes:
+        entries = []
+        subdirs: dict[bytes, dict[bytes, tuple[bytes, bytes]]] = {}
+        for path, (mode, blob_id) in files.items():
+            name, sep, rest = path.partition(b"/")
+            if sep == b"":
+                entries.append(TreeEntry(mode, ObjectType.BLOB, blob_id, name))
+            else:
+                subdirs.setdefault(name, {})[rest] = (mode, blob_id)
+
+        for name, subdir_files in subdirs.items():
+            if name in files:
+                raise AppException(ErrorCode.INVALID_ARGUMENT,
+                                   "The archive contains '%s' as a file and a directory!" % (name.decode("utf8"),))
+            entries.append(TreeEntry(b"40000", ObjectType.TREE, self.write_tree(subdir_files, writer), name))
+
+        return writer.add(ObjectType.TREE, serialize_tree_object(sort_tree_entries(entries)))
+
+
+def is_sha256(checksum: bytes) -> bool:
+    return len(checksum) == 64 and all(c in b"0123456789abcdef" for c in checksum)
+
+
+# Paths in archives must be relative and must not leave the subproject.
+# Returns the normalized path, e.g. without "./".
+def check_and_normalize_archive_path(name: str) -> bytes:
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if name.startswith("/") or ".." in parts or len(parts) == 0 or ".git" in parts:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "The archive contains an invalid path '%s'!" % (name,))
+    return "/".join(parts).encode("utf8")
+
+# bundler: file src/super.py
+
+import os
+import stat
+from dataclasses import dataclass
+from enum import Enum
+from os.path import abspath, join
+
+# bundler: --8<-- was here
+
+# TODO For me it's not clear yet if this file should only contain the
+# SuperHelper implementations or more super stuff! Find a good seperation.
+
+
+class SCMType(Enum):
+    GIT = b"git"
+
+
+class SuperprojectType(Enum):
+    PLAIN = b"plain"
+    GIT = b"git"
+
+
+# NOTE: In both cases it's the path to the toplevel directory!
+@dataclass
+class FindSuperprojectData:
+    super_path: bytes | None = None
+    scm_type: SCMType | None = None
+    scm_path: bytes | None = None
+
+
+# Based on the current work directory search for a ".subpatch" file and SCM
+# system.
+#
+# TODO support svn, mercurial and others in the future
+# TODO thinking about symlinks!
+def find_superproject() -> FindSuperprojectData:
+    abs_cwd = abspath(os.getcwdb())
+
+    # TODO refactory this self-made and hacky approach of a directory walk
+    # The first element is empty, because of the absolute path.  But using a
+    # empty element in "join" does not work. It's the reverse operation!
+    assert abs_cwd[0] == ord("/")
+    abs_cwd_parts = os.path.normpath(abs_cwd).split(b"/")
+    assert abs_cwd_parts[0] == b""
+    abs_cwd_parts.pop(0)
+
+    statinfo = os.stat(abs_cwd)
+    assert stat.S_ISDIR(statinfo.st_mode)
+
+    cwd_st_dev = statinfo.st_dev
+
+    data = FindSuperprojectData()
+
+    while True:
+        abs_cur_path = join(b"/", *abs_cwd_parts)
+
+        statinfo = os.stat(abs_cur_path)
+        if statinfo.st_dev != cwd_st_dev:
+            # The directory walk leaves the current filesystem. This is a stop
+            # condition for now.
+            # TODO Maybe implement 'GIT_DISCOVERY_ACROSS_FILESYSTEM'
+            # See https://git-scm.com/docs/git.html#Documentation/git.txt-codeGITDISCOVERYACROSSFILESYSTEMcode
+            break
+
+        if data.super_path is None:
+            if os.path.exists(join(abs_cur_path, b".subpatch")):
+                # Configuration file found
+                data.super_path = abs_cur_path
+
+        if data.scm_type is None:
+            # NOTE Simple implementation. Check whether there is a ".git"
+            # folder next to it.
+            # Does not work for git-worktrees! ... really? TODO check it!
+            if os.path.exists(join(abs_cur_path, b".git")):
+                data.scm_type = SCMType.GIT
+                data.scm_path = abs_cur_path
+
+        if data.super_path is not None and data.scm_type is not None:
+            # If both is already found, stop the directory walk
+            break
+
+        if len(abs_cwd_parts) == 0:
+            break
+
+        abs_cwd_parts.pop()
+
+    return data
+
+
+# TODO There is still reduance in the structure!
+@dataclass(frozen=True)
+class CheckedSuperprojectData:
+    super_path: bytes
+    configured: bool
+    scm_type: SCMType | None
+
+
+# There can be four cases
+#  - no ".subpatch" config and no SCM
+#     -> function returns None
+#  - ".subpatch" config and no SCM
+#  - no ".subpach" config and SCM
+#  - ".subpach" config and SCM
+# For the last cases there are two sub-cases:
+#  - super_path matches scm_path
+#  - both paths do not match
+def check_superproject_data(data: FindSuperprojectData) -> CheckedSuperprojectData | None:
+    if data.scm_type is not None:
+        # There is a SCM tool
+        if data.super_path is None:
+            # And there is no subpatch config file
+            assert data.scm_path is not None
+            return CheckedSuperprojectData(data.scm_path, False, data.scm_type)
+        else:
+            # And there is a subpatch config file!
+
+            # Check if the paths match up:
+            if data.super_path != data.scm_path:
+                # TODO add text here!
+                # TODO rename "root" to "toplevel" to be consistent.
+                raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "subpatch config file is not at the root of the SCM repository!")
+
+            return CheckedSuperprojectData(data.super_path, True, data.scm_type)
+    else:
+        # Current working directory is not in a SCM system
+        if data.super_path is None:
+            # And there is no subpatch config file
+            return None
+        else:
+            # And there is a subpatch config file
+            return CheckedSuperprojectData(data.super_path, True, data.scm_type)
+
+
+# TODO clarify naming: path, filename, url
+# TODO clairfy name for remote git name and path/url
+
+class SuperHelper:
+    def add(self, paths: list[bytes]) -> None:
+        raise NotImplementedError()
+
+    def print_instructions_to_commit_and_inspect(self) -> None:
+        raise NotImplementedError()
+
+    def get_sha1_for_subtree(self, super_to_sub_relpath: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def get_diff_for_subtree(self, super_to_sub_relpath: bytes, stat: bool = False) -> bytes:
+        raise NotImplementedError()
+
+
+class SuperHelperPlain(SuperHelper):
+    def add(self, paths: list[bytes]) -> None:
+        # Nothing to do here. There is no SCM system. So the code can also not add
+        # files to the SCM
+        pass
+
+    def print_instructions_to_commit_and_inspect(self) -> None:
+        raise NotImplementedError("TODO think about this case!")
+
+    def get_sha1_for_subtree(self, super_to_sub_relpath: bytes) -> bytes:
+        raise NotImplementedError("TODO think about this case!")
+
+    def get_diff_for_subtree(self, super_to_sub_relpath: bytes, stat: bool = False) -> bytes:
+        raise NotImplementedError()
+
+
+# TODO think about the data structure every super_helper method gets!
+class SuperHelperGit(SuperHelper):
+    # Add the file in 'path' to the index
+    # TODO not all version control systems have the notion of a index!
+    def add(self, paths: list[bytes]) -> None:
+        git_add(paths)
+
+    def print_instructions_to_commit_and_inspect(self) -> None:
+        shortstat = git_diff_staged_shortstat()
+        if shortstat == b"":
+            print("Note: There are no changes in the subproject. Nothing to commit!")
+        else:
+            print("The following changes are recorded in the git index:")
+            print("%s" % (shortstat.decode("ascii"),))
+            print("- To inspect the changes, use `git status` and `git diff --staged`.")
+            print("- If you want to keep the changes, commit them with `git commit`.")
+            print("- If you want to revert the changes, execute `git reset --merge`.")
+
+    def print_configure_success(self) -> None:
+        print("The file .subpatch was created in the toplevel directory.")
+        print("Now use 'git commit' to finalized your change.")
+        # TODO maybe use the same help text as "add" and "update".
+
+    # Compute the checkums as a git sha1 for the subtree/worktree of the
+    # subproject.
+    # NOTE: This must take files in the index into account!
+    def get_sha1_for_subtree(self, super_to_sub_relpath: bytes) -> bytes:
+        return self.get_sha1_for_subtrees([super_to_sub_relpath])[super_to_sub_relpath]
+
+    # Same as get_sha1_for_subtree(), but for multiple subprojects. The index
+    # file is only read once.
+    def get_sha1_for_subtrees(self, super_to_sub_relpaths: list[bytes]) -> dict[bytes, bytes]:
+        index = git_read_index()
+        if index is None:
+            # The index format is not supported. Fallback to git itself.
+            return {path: self.get_sha1_for_subtree_with_write_tree(path) for path in super_to_sub_relpaths}
+
+        writer = GitObjectWriter()
+        sha1s = index_get_tree_ids(index, super_to_sub_relpaths, writer, exclude_names=(b"patches", b".subproject"))
+        writer.flush()
+        return sha1s
+
+    def get_sha1_for_subtree_with_write_tree(self, super_to_sub_relpath: bytes) -> bytes:
+        # TODO this function is just a hacky first version. There at least path
+        # escaping any mabye other problems!
+
+        # TODO maybe use "ls-tree -z" instead of "HEAD:<path>" syntax. Escaping is easier!
+        import subprocess
+        p = subprocess.Popen([b"git", b"write-tree", b"--prefix=" + super_to_sub_relpath], stdout=subprocess.PIPE)
+        stdout, _ = p.communicate()
+        if p.returncode != 0:
+            raise Exception("here")
+
+        sha1 = stdout.rstrip(b"\n")
+
+        return self.strip_tree_object(sha1)
+
+    # TODO refactor!!!!
+    # TODO Move function to git.py. It's should not be part of the SuperHepler!
+    def strip_tree_object(self, sha1: bytes) -> bytes:
+        entries = git_get_object_reader().tree_entries(sha1)
+        entries = [entry for entry in entries if entry.name not in (b"patches", b".subproject")]
+        return git_hash_object_tree(serialize_tree_object(entries))
+
+    # TODO argument 'stat' is kind of a hack for now!
+    def get_diff_for_subtree(self, super_to_sub_relpath: bytes, stat: bool = False) -> bytes:
+        # For the current staged files in the subtree, get a SHA1 sum of the
+        # tree object, without the ".subproject" and "patches changes"
+        subtree_staged_sha1 = self.get_sha1_for_subtree(super_to_sub_relpath)
+
+        subtree_head_sha1 = self.strip_tree_object(b"HEAD:" + super_to_sub_relpath)
+
+        import subprocess
+        cmd = [b"git", b"diff", "--relative", subtree_head_sha1, subtree_staged_sha1]
+        if stat:
+            cmd.append("--stat")
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        stdout, _ = p.communicate()
+        if p.returncode != 0:
+            raise Exception("here")
+
+        return stdout
+
+
+# TODO compare to CheckedSuperprojectData. It's very similiar, maybe refactor
+@dataclass(frozen=True)
+class Superproject:
+    path: bytes
+    helper: SuperHelper
+    configured: bool
+    typex: SuperprojectType   # TODO same information is in 'helper'. Refactor!
+
+
+def check_and_get_superproject_from_checked_data(checked_data: CheckedSuperprojectData | None) -> Superproject:
+    # TODO maybe move outside of this function
+    if checked_data is None:
+        # And there is no subpatch config file and no SCM
+        raise AppException(ErrorCode.SUPERPROJECT_NOT_FOUND)
+
+    if checked_data.scm_type is not None:
+        # There is a SCM tool
+        # And there is either a subpatch config file or not: See value of 'configured'
+        if checked_data.scm_type == SCMType.GIT:
+            super_type = SuperprojectType.GIT
+            helper = SuperHelperGit()
+        else:
+            raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "SCM tool '%s' not implemented yet" % (checked_data.scm_type,))
+    else:
+        # Current working directory is not in a SCM system.  But there is a
+        # config file. Ensured by the caller!
+        assert checked_data.configured
+        helper = SuperHelperPlain()
+        super_type = SuperprojectType.PLAIN
+
+    super_path = checked_data.super_path
+    configured = checked_data.configured
+
+    return Superproject(super_path, helper, configured, super_type)
+
+# bundler: file src/main.py
+
+
+import argparse
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import chdir, contextmanager
+from dataclasses import dataclass, field
+from os.path import join
+from subprocess import DEVNULL, Popen
+
+# bundler: --8<-- was here
+
+# See https://peps.python.org/pep-0440/ for details about the version format.
+# e.g. dashes "-" are not allowed and 'a' stands for 'alpha' release.
+__version__ = "0.1a6"
+
+# It's the SPDX identifier. See https://spdx.org/licenses/GPL-2.0-only.html
+__LICENSE__ = "GPL-2.0-only"
+
+
+# "Section names are case-insensitive. Only alphanumeric characters, - and .
+# are allowed in section names"
+def is_section_name(b):
+    raise NotImplementedError()
+
+
+# Trie of the paths of all subprojects. Every node is a dict that maps a path
+# component to the child node. A node of a subproject contains the full path of
+# the subproject under the key None.
+# Lookups are O(depth of the path) and independent of the amount of
+# subprojects.
+class SubprojectIndex:
+    def __init__(self, subprojects: list[bytes]):
+        self._root: dict = {}
+        for subproject in subprojects:
+            node = self._root
+            for component in subproject.split(b"/"):
+                node = node.setdefault(component, {})
+            node[None] = subproject
+
+    # Returns the subproject that contains the path or is the path itself.
+    # NOTE: The path is relative to the toplevel directory of the
+    # superproject. A trailing slash is allowed.
+    def find(self, path: bytes) -> bytes | None:
+        node = self._root
+        for component in path.split(b"/"):
+            if None in node:
+                return node[None]
+            if component == b"":
+                continue
+            node = node.get(component)
+            if node is None:
+                return None
+        return node.get(None)
+
+    def __contains__(self, path: bytes) -> bool:
+        node = self._root
+        for component in path.split(b"/"):
+            node = node.get(component)
+            if node is None:
+                return False
+        return None in node
+
+
+@dataclass(frozen=True)
+class Config:
+    subprojects: list[bytes]
+    # Built once from 'subprojects' to answer path lookups fast
+    subproject_index: SubprojectIndex = field(init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        # NOTE: Workaround to set a field of a frozen dataclass
+        object.__setattr__(self, "subproject_index", SubprojectIndex(self.subprojects))
+
+
+def parse_config(config_lines) -> Config:
+    subprojects = []
+
+    in_subprojects = False
+    for config_line in config_lines:
+        line_data = config_line.line_data
+        if config_line.line_type == LineType.HEADER:
+            assert isinstance(line_data, LineDataHeader)
+            if line_data.section_name == b"subprojects" and line_data.subsection_name is None:
+                in_subprojects = True
+            else:
+                in_subprojects = True
+        elif config_line.line_type == LineType.KEY_VALUE:
+            assert isinstance(line_data, LineDataKeyValue)
+            if in_subprojects:
+                if line_data.key == b"path":
+                    subprojects.append(line_data.value)
+        else:
+            pass
+
+    return Config(subprojects)
+
+
+# Parsed config and metadata files of this process. The key is the absolute
+# path of the file. The value is the signature of the file and the parsed
+# result. If another process changes the file, the signature changes and the
+# file is parsed again. subpatch's own writes drop the entry with
+# forget_parsed_file().
+_parsed_files: dict[bytes, tuple[tuple[int, int, int], object]] = {}
+
+
+def get_file_signature(st: os.stat_result) -> tuple[int, int, int]:
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+# Returns parse(<file content>). The result is reused until the file changes.
+# So the result must not be modified by the caller.
+def read_parsed_file(path: bytes, parse):
+    abspath = os.path.abspath(path)
+    entry = _parsed_files.get(abspath)
+    if entry is not None and entry[0] == get_file_signature(os.stat(abspath)):
+        return entry[1]
+
+    with open(abspath, "br") as f:
+        signature = get_file_signature(os.fstat(f.fileno()))
+        result = parse(f.read())
+    _parsed_files[abspath] = (signature, result)
+    return result
+
+
+def forget_parsed_file(path: bytes) -> None:
+    _parsed_files.pop(os.path.abspath(path), None)
+
+
+def parse_config_data(data: bytes) -> Config:
+    return parse_config(config_parse_sections_and_keys(data))
+
+
+# Path can be absolute or relative
+def read_config(path: bytes) -> Config:
+    return read_parsed_file(path, parse_config_data)
+
+
+# Paths documentation and naming
+#
+#     Example              ../folder/superproject/dirA/dirB/subproject/
+#                                                 ^^^^cwd
+#
+#     super_abspath:       ../folder/superproject
+#       other name: "top level directory" TODO unify
+#     config_abspath:      ../folder/superproject/.subpatch
+#     super_to_sub_relpath:                       dirA/dirB/subproject
+#     super_to_cwd_relpath:                       dirA
+#     cwd_to_sub_relpath:                              dirB/subproject
+#     sub_name:                                             subproject
+#
+#     TODO finalized this naming
+#     Note on path/filesystem nameing
+#      - path: "dir/test", "/dir/test"
+#      - file: a file in a filesystem!
+#      - filename: can be a dir name or a regular file name
+#     reduandent words:
+#      - maybe pathname
+#      - maybe dirname
+#
+# TODO test and fix all the edge cases
+#  e.g. cwd_to_sub_relpath="../symbolic-link/../../dir"
+#  - symbolic links
+#  - ".." pointing outside of repo
+@dataclass(frozen=True)
+class SuperPaths:
+    super_abspath: bytes
+    config_abspath: bytes  # TODO Maybe just have a single abspath in super_abspath
+    super_to_cwd_relpath: bytes
+
+
+# TODO is it "<object>_<verb>" or "<verb>_<object>"?
+#  "subprojects_parse" vs "parse_subprojects"
+#  ... -> then should should be "parse_config_parts_to_subprojects
+
+@dataclass(frozen=True)
+class SubPaths:
+    super_to_sub_relpath: bytes
+    cwd_to_sub_relpath: bytes  # Can be ".." or "../.." if cwd is inside a subproject
+    sub_name: bytes  # Can be b"" when subproject is at the toplevel directory (but this is not supported for now)
+    subproject_abspath: bytes
+    metadata_abspath: bytes  # Path to ".subproject" file
+    patches_abspath: bytes  # Path to "patches" directory
+
+
+def gen_sub_paths_from_relpath(super_paths: SuperPaths, super_to_sub_relpath: bytes) -> SubPaths:
+    # Returns a relative paht from the current work directory
+    cwd_to_sub_relpath = os.path.relpath(join(super_paths.super_abspath, super_to_sub_relpath))
+    if cwd_to_sub_relpath == b".":
+        cwd_to_sub_relpath = b""
+
+    return gen_sub_paths_internal(super_paths, super_to_sub_relpath, cwd_to_sub_relpath)
+
+
+def gen_sub_paths_from_cwd_and_relpath(super_paths: SuperPaths, cwd_to_sub_relpath: bytes) -> SubPaths:
+    # Sanitize input path
+    if cwd_to_sub_relpath != b"":
+        cwd_to_sub_relpath = os.path.relpath(cwd_to_sub_relpath)
+        if cwd_to_sub_relpath == b".":
+            cwd_to_sub_relpath = b""
+
+    super_to_sub_relpath = join(super_paths.super_to_cwd_relpath, cwd_to_sub_relpath)
+
+    return gen_sub_paths_internal(super_paths, super_to_sub_relpath, cwd_to_sub_relpath)
+
+
+def gen_sub_paths_internal(super_paths: SuperPaths, super_to_sub_relpath: bytes, cwd_to_sub_relpath: bytes) -> SubPaths:
+    # Remove trailing slash if there is any
+    # TODO is this correct? Does this makes sense?
+    if super_paths.super_to_cwd_relpath != b"":
+        super_to_sub_relpath = os.path.relpath(super_to_sub_relpath)
+
+    def my_join(a, b):
+        if a == b"":
+            return b
+        if b == b"":
+            return a
+        # If b contains ".." or "../..", strip path components, instead of
+        # adding ".."
+        return os.path.relpath(join(a, b))
+
+    assert super_to_sub_relpath == my_join(super_paths.super_to_cwd_relpath, cwd_to_sub_relpath)
+
+    sub_name = os.path.basename(super_to_sub_relpath)
+
+    subproject_abspath = join(super_paths.super_abspath, super_to_sub_relpath)
+
+    metadata_abspath = join(subproject_abspath, b".subproject")
+
+    patches_abspath = join(subproject_abspath, b"patches")
+
+    return SubPaths(super_to_sub_relpath, cwd_to_sub_relpath, sub_name, subproject_abspath, metadata_abspath, patches_abspath)
+
+
+@dataclass(frozen=True)
+class Metadata:
+    # TODO introduce seperation between sections (subtree, upstream, patches)
+    # TODO introduce boolean values whether header/sections exists. This can be
+    # a different case then the value exists.
+    url: bytes | None
+    revision: bytes | None
+    object_id: bytes | None
+    subtree_applied_index: bytes | None
+    subtree_checksum: bytes | None
+    # Only this subdirectory of the upstream repository is integrated
+    subdir: bytes | None = None
+
+
+def read_metadata(path: bytes) -> Metadata:
+    try:
+        return read_parsed_file(path, parse_metadata)
+    except FileNotFoundError:
+        # TODO add note about which subproject is wrong!
+        # TODO write commands to fix this issue.
+        # NOTE This state cannot/should not arise when subpatch commands are used.
+        raise AppException(ErrorCode.INVALID_STATE, "Metadata file for subproject not found."
+                           " Drop subproject path from the subpatch config or add a subproject metadata file manually!.")
+
+
+def parse_metadata(data: bytes) -> Metadata:
+    url = None
+    revision = None
+    object_id = None
+    subtree_applied_index = None
+    subtree_checksum = None
+    subdir = None
+
+    metadata_lines = config_parse_sections_and_keys(data)
+    for metadata_line in metadata_lines:
+        # TODO only use url and revision in upstream section!
+        if metadata_line.line_type == LineType.KEY_VALUE:
+            line_data = metadata_line.line_data
+            assert isinstance(line_data, LineDataKeyValue)
+            if line_data.key == b"url":
+                url = line_data.value
+            elif line_data.key == b"revision":
+                revision = line_data.value
+            elif line_data.key == b"objectId":
+                object_id = line_data.value
+            elif line_data.key == b"appliedIndex":
+                subtree_applied_index = line_data.value
+            elif line_data.key == b"checksum":
+                subtree_checksum = line_data.value
+            elif line_data.key == b"subdir":
+                subdir = line_data.value
+
+    return Metadata(url, revision, object_id, subtree_applied_index, subtree_checksum, subdir)
+
+
+# Data class that contains most of the information that is in the subtree
+# dimension of a subproject. The actuall files in the subtree are left out!
+@dataclass(frozen=True)
+class SubtreeDim:
+    # Range: -1 <= applied_index < len(patches)
+    # - -1 := no applied patch
+    # -  0 := first patch applied,
+    # -  1 := second patch applied,
+    #   ...
+    # The default value is None for "all tracked patches are applied"
+    applied_index: int | None
+    # TODO Use SHA1 Checksum type instead of 'bytes'
+    checksum: bytes   # Default value is b"", which means that the subtree is unpopulated
+
+
+# TODO prefix "read" is wrong. It's correct for "read_metadata", but here nothing is read from disk!
+def read_subtree_dim(metadata: Metadata) -> SubtreeDim:
+    if metadata.subtree_applied_index is not None:
+        # TODO add error when value is not an int!
+        applied_index = int(metadata.subtree_applied_index)
+    else:
+        applied_index = None
+
+    if metadata.subtree_checksum is None:
+        checksum = b""  # Use default value
+    else:
+        # TODO Check checksum that it's a valid SHA1 sum
+        checksum = metadata.subtree_checksum
+
+    return SubtreeDim(applied_index, checksum)
+
+
+# Data class that contains most of the information that is in the patches
+# dimension of a subproject.
+@dataclass(frozen=True)
+class PatchesDim:
+    patches: list[bytes]
+
+
+def read_patches_dim(sub_paths: SubPaths, metadata: Metadata) -> PatchesDim:
+    try:
+        patches = os.listdir(sub_paths.patches_abspath)
+        patches = [p for p in patches if p.endswith(b".patch")]
+        patches.sort()
+    except FileNotFoundError:
+        patches = []
+
+    return PatchesDim(patches)
+
+
+# All dimensions of a subproject that are stored in files
+@dataclass(frozen=True)
+class SubprojectDims:
+    metadata: Metadata
+    subtree_dim: SubtreeDim
+    patches_dim: PatchesDim
+
+
+def read_subproject_dims(sub_paths: SubPaths) -> SubprojectDims:
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    return SubprojectDims(metadata, read_subtree_dim(metadata), read_patches_dim(sub_paths, metadata))
+
+
+# Maximum number of threads to read the files of the subprojects
+READ_JOBS = 16
+
+
+# Reads the metadata files and the patches directories of all subprojects in
+# parallel. Returns a dict from 'super_to_sub_relpath' to the dimensions. If
+# reading fails for multiple subprojects, the error of the first one in
+# 'sub_paths_list' is raised.
+def read_subprojects_dims(sub_paths_list: list[SubPaths]) -> dict[bytes, SubprojectDims]:
+    if len(sub_paths_list) <= 1:
+        dims_list = [read_subproject_dims(sub_paths) for sub_paths in sub_paths_list]
+    else:
+        with ThreadPoolExecutor(max_workers=min(READ_JOBS, len(sub_paths_list))) as executor:
+            dims_list = list(executor.map(read_subproject_dims, sub_paths_list))
+    return {sub_paths.super_to_sub_relpath: dims for sub_paths, dims in zip(sub_paths_list, dims_list)}
+
+
+def ensure_dims_are_consistent(subtree_dim: SubtreeDim, patches_dim: PatchesDim) -> None:
+    if subtree_dim.applied_index is not None:
+        if subtree_dim.applied_index < -1:
+            raise AppException(ErrorCode.INVALID_STATE,
+                               "Value of appliedIndex is smaller than -1. Metadata is inconsistent!")
+        if subtree_dim.applied_index >= len(patches_dim.patches):
+            raise AppException(ErrorCode.INVALID_STATE,
+                               "Value of appliedIndex is bigger than the count of patches. Metadata is inconsistent!")
+
+
+def nocommand(args, parser) -> int:
+    parser.print_help(file=sys.stderr)
+    return 2  # TODO why 2?
+
+
+def cmd_help(args, parser) -> int:
+    parser.print_help()
+    return 0
+
+
+# TODO clarify naming: path, filename, url
+# TODO clairfy name for remote git name and path/url
+
+# Naming:
+# Variable names:
+#  - url: The URL for a git/svn/.. repository or tarball.
+#      Can be a http, git or file URL. Or just a local path.
+#    Variant:
+#       url: The subproject's URL, e.g. to clone/download
+#
+# subpatch naming
+#  - "config" or "subpatch config". Is the name of the config in the
+#    ".subpatch" file at the toplevel of the superproject.
+#    TODO add to glossary
+#  - "subproject": Idea: Is only the local directory and config
+#                  Not the remote repository
+
+
+def ensure_superproject_is_configured(superx):
+    # Design decision:
+    # Having a empty ".subpatch" config file is something different than having
+    # no config file. It means that subptach is not yet configured for the project.
+    # TODO document this design decision somewhere else!
+    if not superx.configured:
+        raise AppException(ErrorCode.SUPERPROJECT_NOT_CONFIGURED)
+
+
+def ensure_superproject_is_git(superx):
+    if superx.typex != SuperprojectType.GIT:
+        raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "This feature currently works only in a git superproject!")
+
+
+# TODO add argument to specific which type of cache to init.
+# NOTE: The cache is persistent. It's reused across runs and across subprojects
+# that share the same upstream URL. So only the delta has to be downloaded.
+# NOTE: The caller must hold the CacheLock of the cache.
+def do_cache_create(super_paths: SuperPaths, cache_helper: CacheHelperGit | CacheHelperArchive, url: str) -> bytes:
+    cache_abspath = get_cache_abspath(super_paths, url)
+    if not cache_helper.isCreated(cache_abspath):
+        os.makedirs(cache_abspath, exist_ok=True)
+        cache_helper.create(cache_abspath)
+    # The cache can use the objects of the superproject. But only if it's
+    # located inside the superproject. A shared cache must not depend on a
+    # single superproject.
+    if not is_cache_root_shared():
+        super_objects_abspath = join(git_get_common_dir(cwd=super_paths.super_abspath), b"objects")
+        cache_helper.use_superproject_objects(cache_abspath, super_objects_abspath)
+    mark_cache_used(cache_abspath)
+    return cache_abspath
+
+
+def get_cache_abspath(super_paths: SuperPaths, url: str) -> bytes:
+    return join(get_cache_root_abspath(super_paths.super_abspath), get_cache_key(url))
+
+
+# Keeps the disk usage of the caches bounded after they were used. The used
+# caches are compacted and, if SUBPATCH_CACHE_MAX_SIZE is set, the least
+# recently used other caches are removed.
+def do_cache_auto_gc(super_paths: SuperPaths, used_cache_abspaths: list[bytes]) -> None:
+    for cache_abspath in used_cache_abspaths:
+        with CacheLock(cache_abspath):
+            get_cache_helper_for_cache(cache_abspath).compact(cache_abspath)
+
+    max_size = get_cache_max_size()
+    if max_size is not None:
+        evict_caches(get_cache_root_abspath(super_paths.super_abspath), max_size, keep=used_cache_abspaths)
+
+
+# Remove the files from the working tree. Directories that are empty afterwards
+# are also removed, but never the directory 'base_abspath' itself. This is the
+# same behavior as 'git rm -f'.
+# NOTE: The paths are relative to 'base_abspath'.
+def remove_files_and_empty_dirs(base_abspath: bytes, relpaths: list[bytes]) -> None:
+    dirs = set()
+    for relpath in relpaths:
+        try:
+            os.unlink(join(base_abspath, relpath))
+        except FileNotFoundError:
+            # The file was already removed by the user in the working tree
+            pass
+        dirname = os.path.dirname(relpath)
+        while dirname != b"" and dirname not in dirs:
+            dirs.add(dirname)
+            dirname = os.path.dirname(dirname)
+
+    # Remove the deepest directories first
+    for dirname in sorted(dirs, key=len, reverse=True):
+        try:
+            os.rmdir(join(base_abspath, dirname))
+        except OSError:
+            # The directory is not empty or does not exist
+            pass
+
+
+# TODO consolide function arguments
+def do_unpack(superx, super_paths, sub_paths, cache_abspath: bytes, cache_helper: CacheHelperGit | CacheHelperArchive,
+              url: str, revision: str | None, object_id: bytes, subdir: bytes | None = None) -> None:
+    # TODO This function is very very hacky. Works for now!
+
+    # Just quick and try remove and copy!
+    # TODO convert this code to "superhelper" implementation
+    # TODO This code is "subpatch subtree drop"
+    with chdir(super_paths.super_abspath):
+        # TODO ensure that there are no untracked changes. Subpatch should not
+        # remove any work of the user by accident.
+        # TODO Add a custom/plumping command for that "subpatch subtree list"
+        with chdir(sub_paths.super_to_sub_relpath):
+            subtree_files_relpaths = git_ls_files()
+        # NOTE: git_ls_tree_in_dir() also lists files non-subtree files E.g.
+        # the folder "patches" and the file ".subproject". These must be
+        # skipped.
+        # TODO Move these special paths into a central location!
+        #   if filename in (b".git", b".subproject", b"cache", b"patches"):
+        subtree_files_relpaths = [path for path in subtree_files_relpaths
+                                  if not path.startswith(b"patches/") and path != b".subproject"]
+
+        git_update_index_remove(subtree_files_relpaths, cwd=sub_paths.subproject_abspath)
+        remove_files_and_empty_dirs(sub_paths.subproject_abspath, subtree_files_relpaths)
+
+    # and extract
+    # NOTE: The objects are imported directly into the object store of the
+    # superproject. So git can stage the tree without rehashing the files.
+    tree_id = cache_helper.extract(cache_abspath, object_id, super_paths.super_abspath, subdir)
+
+    # TODO This code is "subpatch unpack" but even bit lower
+    # TODO convert this code to "superhelper" implementation
+    assert (os.path.isdir(sub_paths.cwd_to_sub_relpath))
+    assert (not os.path.isdir(join(sub_paths.cwd_to_sub_relpath, b".git")))
+    with chdir(super_paths.super_abspath):
+        git_read_tree_prefix(tree_id, sub_paths.super_to_sub_relpath)
+
+    # Hack for now:
+    # The function get_sha1_for_subtree does not work if the subtree is empty
+    # (=no files tracked by git in it). So just create and add a file for the moment.
+    # This case only happens, when the upstream projet has a empty file tree. This is
+    # also a rare case. Someone would say this would be even a error case and should
+    # be reported to the user (with an option to override the error).
+    # TODO add argument to allow empty subtrees in the upstream repo.
+    # TODO fix get_sha1_for_subtree()!
+    with chdir(super_paths.super_abspath):
+        subtree_checksum = superx.helper.get_sha1_for_subtree(sub_paths.super_to_sub_relpath)
+
+    # TODO subpatch subtree checksum --write does the same!
+    with chdir(super_paths.super_abspath), metadata_transaction(sub_paths, superx.helper) as m:
+        metadata_set_for_unpack(m, url, revision, object_id, subtree_checksum, subdir)
+
+
+# All data to update a single subproject. The network phase fills the cache
+# fields. The timings are in seconds.
+@dataclass
+class UpdateJob:
+    sub_paths: SubPaths
+    url: str
+    revision: str | None
+    subdir: bytes | None = None
+    bundle_path: bytes | None = None
+    # True if the integrated revision, url, subdir and subtree are the same as
+    # in the metadata. Then only the remote object id has to be checked.
+    unchanged: bool = False
+    metadata: Metadata | None = None
+    # Set if the remote object id is the integrated one. Then nothing has to be
+    # done.
+    skip: bool = False
+    # The cache helper for the type of the URL
+    cache_helper: CacheHelperGit | CacheHelperArchive | None = None
+    clone_config: CloneConfig | None = None
+    cache_abspath: bytes | None = None
+    object_id: bytes | None = None
+    fetch_time: float = 0.0
+    unpack_time: float = 0.0
+
+
+def prepare_update_job(superx, super_paths: SuperPaths, config: Config, sub_paths: SubPaths,
+                       url_arg: str | None, revision_arg: str | None, subdir_arg: bytes | None = None,
+                       bundle_path: bytes | None = None, dims: SubprojectDims | None = None) -> UpdateJob:
+    # NOTE two different error cases:
+    # * no subproject path in config
+    # * no subproject file in directory (TODO add code for that)
+    # TODO make this check generic!
+    if sub_paths.super_to_sub_relpath not in config.subproject_index:
+        x = sub_paths.super_to_sub_relpath.decode("utf8")
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Path '%s' does not point to a subproject" % (x,))
+
+    if dims is None:
+        dims = read_subproject_dims(sub_paths)
+    metadata = dims.metadata
+
+    if url_arg is not None:
+        # TODO verify URL
+        url = url_arg
+    else:
+        if metadata.url is None:
+            # TODO this is an error case. There should always be an URL
+            # TODO but actually this might depend on the Cache/SubHelper. Maybe
+            # there is an implementetion that does not need a URL.  Or maybe the
+            # field should be mandertory.
+            url = None
+        else:
+            url = metadata.url.decode("utf8")
+
+    if revision_arg is not None:
+        # TODO verify revision
+        revision = revision_arg
+    else:
+        if metadata.revision is None:
+            revision = None
+        else:
+            revision = metadata.revision.decode("utf8")
+
+    if subdir_arg is not None:
+        # An empty subdirectory integrates the whole repository again
+        subdir = None if subdir_arg == b"" else subdir_arg
+    else:
+        subdir = metadata.subdir
+
+    assert isinstance(url, str)
+    assert revision is None or isinstance(revision, str)
+
+    # NOTE staged changes in the subtree of the subproject are ok. We assume that the
+    # subproject is in a clean/sane state. E.g. the user has deapplyed some or all patches.
+    # Untrack changes are _not_ ok. It's mostly means that the subproject is not clean.
+    if git_diff_in_dir(superx.path, sub_paths.super_to_sub_relpath):
+        # TODO add more explanations and commands to fix!
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "There are unstaged changes in the subproject.")
+
+    # TODO check that the subproject is in a clean state
+
+    # For now check whether all patches are deapplied!
+    patches_dim = dims.patches_dim
+    subtree_dim = dims.subtree_dim
+    ensure_dims_are_consistent(subtree_dim, patches_dim)
+
+    if len(patches_dim.patches) > 0:
+        # TODO refactor common code with cmd_pop,push
+        if subtree_dim.applied_index is None:
+            applied_index = len(patches_dim.patches) - 1
+        else:
+            applied_index = subtree_dim.applied_index
+        if applied_index != -1:
+            # TODO also check for linting issue, when default value is used!
+            raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "subproject has patches applied. Please pop first!")
+
+    unchanged = (metadata.url is not None and metadata.url.decode("utf8") == url
+                 and (metadata.revision.decode("utf8") if metadata.revision is not None else None) == revision
+                 and metadata.subdir == subdir
+                 and metadata.object_id is not None and metadata.subtree_checksum is not None)
+
+    return UpdateJob(sub_paths, url, revision, subdir=subdir, bundle_path=bundle_path, unchanged=unchanged,
+                     metadata=metadata)
+
+
+# The first part of the network phase of the update: Resolve the revision in
+# the remote. If it still points to the integrated object, there is nothing to
+# fetch and to unpack. The cache is not used. The function must be thread
+# safe. It must not change the cwd.
+def do_update_resolve(super_paths: SuperPaths, job: UpdateJob) -> None:
+    cache_helper = job.cache_helper
+    assert cache_helper is not None
+    start = time.monotonic()
+    job.clone_config = cache_helper.resolve(DownloadConfig(url=job.url, revision=job.revision, subdir=job.subdir,
+                                                           bundle_path=job.bundle_path))
+    if job.unchanged:
+        assert job.metadata is not None
+        if job.clone_config.remote_object_id == job.metadata.object_id:
+            job.skip = True
+    job.fetch_time += time.monotonic() - start
+
+
+# The second part of the network phase of the update: Create the cache and
+# fetch into it. The function must be thread safe. It must not change the cwd.
+# NOTE: The caller must hold the CacheLock of the cache.
+def do_update_fetch(super_paths: SuperPaths, job: UpdateJob) -> None:
+    if job.skip:
+        return
+    cache_helper = job.cache_helper
+    assert cache_helper is not None
+    start = time.monotonic()
+    job.cache_abspath = do_cache_create(super_paths, cache_helper, job.url)
+
+    # subpatch cache fetch url -r version
+    assert job.metadata is not None
+    job.object_id = do_cache_fetch(cache_helper, job.cache_abspath, job.url, job.revision, job.clone_config, job.subdir,
+                                   job.metadata.object_id, job.bundle_path)
+    job.fetch_time += time.monotonic() - start
+
+
+# Call 'func' for all jobs in a pool of 'jobs' threads. Jobs that use the same
+# cache are processed one after the other in the same thread, because git does
+# not allow concurrent fetches into the same repository.
+def do_update_parallel(super_paths: SuperPaths, update_jobs: list[UpdateJob], jobs: int, func) -> None:
+    groups: dict[bytes, list[UpdateJob]] = {}
+    for job in update_jobs:
+        groups.setdefault(get_cache_key(job.url), []).append(job)
+
+    def process_group(group: list[UpdateJob]) -> None:
+        for job in group:
+            func(super_paths, job)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_group, group) for group in groups.values()]
+    # Raise the first error after all jobs are finished. Nothing was
+    # unpacked yet. So the superproject is not changed.
+    for future in futures:
+        future.result()
+
+
+def cmd_update(args, parser):
+    if args.all and len(args.paths) != 0:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Option '--all' cannot be used together with paths")
+    if not args.all and len(args.paths) == 0:
+        # TODO should also work when cwd is inside the subproject
+        raise AppException(ErrorCode.NOT_IMPLEMENTED_YET, "Must give path to subproject")
+    if args.jobs < 1:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "The number of jobs must be at least one")
+
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    ensure_superproject_is_git(superx)
+
+    super_paths = gen_super_paths(superx.path)
+
+    config = read_config(super_paths.config_abspath)
+
+    if args.all:
+        sub_paths_list = [gen_sub_paths_from_relpath(super_paths, path) for path in config.subprojects]
+    else:
+        sub_paths_list = [gen_sub_paths_from_cwd_and_relpath(super_paths, os.fsencode(path)) for path in args.paths]
+
+    # The output for a single subproject is printed while it is updated. For
+    # multiple subprojects the network phase runs in parallel first.
+    single = not args.all and len(args.paths) == 1
+
+    if not single and (args.url is not None or args.revision is not None or args.subdir is not None
+                       or args.from_bundle is not None):
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "Options '--url', '--revision', '--subdir' and '--from-bundle' can only be used with a single subproject")
+
+    if args.subdir is None:
+        subdir = None
+    elif args.subdir == "":
+        subdir = b""  # Drop the subdirectory from the metadata
+    else:
+        subdir = check_and_normalize_subdir(args.subdir)
+    bundle_path = None if args.from_bundle is None else check_and_get_bundle_abspath(args.from_bundle)
+
+    # Check all subprojects first. So an error does not leave the superproject
+    # in a partially updated state.
+    dims = read_subprojects_dims([sub_paths for sub_paths in sub_paths_list
+                                  if sub_paths.super_to_sub_relpath in config.subproject_index])
+    update_jobs = [prepare_update_job(superx, super_paths, config, sub_paths, args.url, args.revision, subdir,
+                                      bundle_path, dims.get(sub_paths.super_to_sub_relpath))
+                   for sub_paths in sub_paths_list]
+
+    # The subtree must also be unchanged to skip the update. E.g. the user may
+    # have staged changes in the subtree. Compute all checksums in one pass.
+    unchanged_jobs = [job for job in update_jobs if job.unchanged]
+    if len(unchanged_jobs) != 0:
+        with chdir(super_paths.super_abspath):
+            checksums = superx.helper.get_sha1_for_subtrees([job.sub_paths.super_to_sub_relpath for job in unchanged_jobs])
+        for job in unchanged_jobs:
+            assert job.metadata is not None
+            if checksums[job.sub_paths.super_to_sub_relpath] != job.metadata.subtree_checksum:
+                job.unchanged = False
+
+    # TODO Move futher below to cache_create()
+    refs_cache = RefsCache(get_cache_root_abspath(super_paths.super_abspath), get_refs_ttl(), refresh=args.refresh)
+    for job in update_jobs:
+        job.cache_helper = get_cache_helper(job.url, refs_cache, refresh=args.refresh)
+
+    if single:
+        do_update_resolve(super_paths, update_jobs[0])
+    else:
+        do_update_parallel(super_paths, update_jobs, args.jobs, do_update_resolve)
+
+    # Other subpatch processes may use the same caches at the same time. Hold
+    # the locks from the fetch until the unpack is finished. Otherwise another
+    # process could remove a cache in between, e.g. by 'cache gc'.
+    with lock_caches([get_cache_abspath(super_paths, job.url) for job in update_jobs if not job.skip]):
+        # TODO deapply all patches
+
+        if not single:
+            do_update_parallel(super_paths, update_jobs, args.jobs, do_update_fetch)
+
+        for job in update_jobs:
+            cache_helper = job.cache_helper
+            assert cache_helper is not None
+            if not args.quiet:
+                # TODO printing is not correct. In case of an error, the newline is not
+                # printed!
+                print("Updating subproject '%s' from URL '%s' to revision '%s'..." %
+                      (job.sub_paths.cwd_to_sub_relpath.decode("utf8"), job.url,
+                       cache_helper.get_revision_as_str(job.revision)),
+                      end="")
+                sys.stdout.flush()
+
+            # subpatch download
+            if single:
+                do_update_fetch(super_paths, job)
+
+            # subpatch unpack
+            # TODO in case of an error, maybe cleanup also staging area
+            if not job.skip:
+                assert job.cache_abspath is not None and job.object_id is not None
+                start = time.monotonic()
+                do_unpack(superx, super_paths, job.sub_paths, job.cache_abspath, cache_helper, job.url, job.revision,
+                          job.object_id, job.subdir)
+                job.unpack_time = time.monotonic() - start
+
+            # TODO reapply patches: subpatch push --all
+            # TODO only apply to the same index as before, not just all patches!
+
+            if not args.quiet:
+                print(" Done.")
+
+    do_cache_auto_gc(super_paths, [job.cache_abspath for job in update_jobs if job.cache_abspath is not None])
+
+    if not args.quiet and not single and len(update_jobs) != 0:
+        print("Timings (fetch/unpack):")
+        for job in update_jobs:
+            print("  %s: %.2fs/%.2fs" % (job.sub_paths.cwd_to_sub_relpath.decode("utf8"),
+                                         job.fetch_time, job.unpack_time))
+
+    # TODO Think about the case when there are no changes in the subproject. Or
+    # just no changes in the subtree. (e.g. just a rev/object_id update). Maybe
+    # the user wants to know that. So maybe subpatch should have a exit code
+    # for that.
+
+    if not args.quiet:
+        # TODO Idea "subpatch status" should print the info/help text. The status
+        # command should be command to get help if a user is lost.
+        superx.helper.print_instructions_to_commit_and_inspect()
+
+    return 0
+
+
+# The subdirectory of the upstream repository must be a relative path inside
+# of the repository. Returns the normalized path without trailing slashes.
+def check_and_normalize_subdir(subdir: str) -> bytes:
+    subdir_bytes = subdir.encode("utf8").strip(b"/")
+    parts = subdir_bytes.split(b"/")
+    if subdir.startswith("/") or subdir_bytes == b"" or any(part in (b"", b".", b"..") for part in parts):
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "subdir '%s' is invalid" % (subdir,))
+    return subdir_bytes
+
+
+# Returns the absolute path of the bundle file. The path is relative to the
+# current work directory.
+def check_and_get_bundle_abspath(bundle: str) -> bytes:
+    bundle_abspath = os.path.abspath(os.fsencode(bundle))
+    if not os.path.isfile(bundle_abspath):
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Bundle file '%s' does not exist" % (bundle,))
+    return bundle_abspath
+
+
+# Argument config can be relpath or an abspath
+# TODO use other prefix "config_" for parser! prefix "config" is for the
+# subpatch config file.
+def config_add_subproject(config_path: bytes, super_to_sub_relpath: bytes) -> None:
+    config_document = read_config_document(config_path)
+
+    config_document.add_section(b"subprojects")
+    config_document.set_key_value(b"subprojects", b"path", super_to_sub_relpath, append=True)
+
+    write_file_atomically(config_path, config_document.unparse())
+
+
+# Returns an empty document if the file does not exist
+def read_config_document(path: bytes) -> ConfigDocument:
+    try:
+        with open(path, "br") as f:
+            return ConfigDocument(f.read())
+    except FileNotFoundError:
+        return ConfigDocument()
+
+
+# Write the new file first and rename it. So a reader never sees a partial
+# file, even if subpatch is interrupted. If 'path' is a symbolic link, the
+# target of the link is replaced. The permissions of an existing file are
+# kept.
+def write_file_atomically(path: bytes, data: bytes, fsync: bool = False) -> None:
+    forget_parsed_file(path)
+    path = os.path.realpath(path)
+    forget_parsed_file(path)
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+    tmp_path = path + b".tmp%d" % (os.getpid(),)
+    try:
+        with open(tmp_path, "bw") as f:
+            if mode is not None:
+                os.fchmod(f.fileno(), mode)
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+# TODO use CacheHelper instead of CacheHelperGit
+def do_cache_fetch(cache_helper: CacheHelperGit | CacheHelperArchive, cache_abspath: bytes, url: str, revision: str,
+                   clone_config: CloneConfig | None = None, subdir: bytes | None = None,
+                   integrated_object_id: bytes | None = None, bundle_path: bytes | None = None) -> bytes:
+    download_config = DownloadConfig(url=url, revision=revision, subdir=subdir, integrated_object_id=integrated_object_id,
+                                     bundle_path=bundle_path)
+
+    # NOTE: In the error case the cache is not removed. It's persistent and
+    # still in a valid state.
+    return cache_helper.fetch(cache_abspath, download_config, clone_config)
+
+
+# Consolide into plumping commands
+#   subpatch configure (--auto)
+#   subpatch init <subproject path>
+#   subpatch subtree clean --verify # tricky, cannot be really done before or must he handcoded!
+#   subpatch download
+#     - subpatch cache create --type=git   # --autoremove'
+#     - subpatch cache fetch <url> -r <rev>
+#   subpatch unpack   # honors "--autoremove"
+#     - subpatch subtree drop
+#     - subpatch cache extract  # does the cp/mv
+#     - add files to staging area!
+#     - subpatch subtree checksum write
+#     - subpatch upstream add url -r <rev> -o <id>
+def cmd_add(args, parser):
+    if args.url is None:
+        # TODO make error message nicer
+        raise Exception("Not the correct amount of args")
+
+    if args.path is not None:
+        # The optional path argument was given. Make some checks
+        if len(args.path) == 0:
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "path is empty")
+        # TODO But something like "/./././" is also invalid"
+        # TODO disallow absolute paths
+        # TODO think about relative paths, whether the must be relative to the
+        # remote origin url! Repo and git-submodule do that
+
+    revision: str | None = args.revision
+    url = args.url
+
+    if revision is not None:
+        if not is_valid_revision(revision):
+            # TODO add reason why it's invalid
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "revision '%s' is invalid" % (revision,))
+
+    subdir = None if args.subdir is None else check_and_normalize_subdir(args.subdir)
+    bundle_path = None if args.from_bundle is None else check_and_get_bundle_abspath(args.from_bundle)
+
+    # TODO check with ls-remote that remote is accessible
+
+    if args.path is None:
+        cwd_to_sub_relpath = get_name_from_repository_url(url)
+        # Use "foo-1.0" for the archive "foo-1.0.tar.gz"
+        archive_suffix = get_archive_suffix(cwd_to_sub_relpath)
+        if archive_suffix is not None:
+            cwd_to_sub_relpath = cwd_to_sub_relpath[:-len(archive_suffix)]
+    else:
+        cwd_to_sub_relpath = args.path
+        # TODO split into path and name component
+        # sanitize path. Remove double slashes trailing slash
+        # and paths that are outside of the repository
+        # - For now just remove trailing slashes
+        # TODO same checks are needed for `cmd_init`
+        cwd_to_sub_relpath = cwd_to_sub_relpath.rstrip("/")
+
+    url_type = get_url_type(url)
+
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_git(superx)
+
+    super_paths = gen_super_paths(superx.path)
+
+    # TODO remove additional encode() here.
+    sub_paths = gen_sub_paths_from_cwd_and_relpath(super_paths, cwd_to_sub_relpath.encode("utf8"))
+
+    if url_type == URLTypes.LOCAL_RELATIVE:
+        # Check the current work directory of the call is the top level
+        # directory of the repository. If not, a relative path on the
+        # command line is not relative to the top level directory and must be
+        # converted. This conversion is a bit complex and error prone.  So
+        # just enforce (like also git does) that the current work directory
+        # is the top level repository in that case.
+        # TODO This is a invalid argument execption
+        if not is_cwd_toplevel_directory(super_paths):
+            raise AppException(ErrorCode.CUSTOM,
+                               "When using relative repository URLs, you current work directory "
+                               "must be the toplevel folder of the superproject!")
+    elif url_type == URLTypes.LOCAL_ABSOLUTE:
+        # TODO add reason why it's not supported
+        raise AppException(ErrorCode.CUSTOM, "Absolute local paths to a remote repository are not supported!")
+
+    # TODO check that git repo has nothing in the index!
+    # But some changes are ok:
+    # TODO add tests that adds a subproject after a "git rm -r" to the same folder.
+    # So the changes are in the filesystem and in the index, but not committed yet.
+    # This should work
+
+    # subpatch configure
+    if not superx.configured:
+        do_configure(superx.path, superx.helper)
+
+    # NOTE: At this point subpatch is using the git staging area as a
+    # rollback/revert mechansim. If something fails in the next code lines,
+    # the user (and the tests) can revert with "git revert".
+    # TODO maybe make this built-in!
+    # TODO add notes how to revert if anything of the following fails!
+
+    # subpatch init <path>
+    do_init(super_paths, sub_paths, superx)
+    # TODO in case of a later failure. Also revert this!
+
+    # subpatch cache create --git
+    cache_helper = get_cache_helper(url, RefsCache(get_cache_root_abspath(super_paths.super_abspath), get_refs_ttl(),
+                                                   refresh=args.refresh), refresh=args.refresh)
+    # Other subpatch processes may use the same cache at the same time
+    with CacheLock(get_cache_abspath(super_paths, url)):
+        cache_abspath = do_cache_create(super_paths, cache_helper, url)
+
+        # TODO in case of a later failure. Also revert this!
+
+        # NOTE: Design decision: The output is relative to the current working dir.
+        # The content of '%s' is the remote git name or the path relative to the
+        # current working dir. It's not relative to the top level dir of the git repo.
+        # TODO move this design decision to the website
+        if not args.quiet:
+            print("Adding subproject '%s' from URL '%s' at revision '%s'..." %
+                  (sub_paths.cwd_to_sub_relpath.decode("utf8"), url, cache_helper.get_revision_as_str(revision)),
+                  end="")
+            sys.stdout.flush()
+
+        try:
+            # subpatch cache fetch url -r version
+            object_id = do_cache_fetch(cache_helper, cache_abspath, url, revision, subdir=subdir, bundle_path=bundle_path)
+
+            # subpatch unpack
+            do_unpack(superx, super_paths, sub_paths, cache_abspath, cache_helper, url, revision, object_id, subdir)
+        except Exception as e:
+            # If there is any exception, still print the final new line character.
+            # Otherwise the error message that is printed is not beginning at the
+            # start of the line.
+            if not args.quiet:
+                print(" Failed.")
+                sys.stdout.flush()
+            raise e
+        else:
+            if not args.quiet:
+                print(" Done.")
+                # TODO is flush() also needed here?
+
+    do_cache_auto_gc(super_paths, [cache_abspath])
+
+    # TODO Idea "subpatch status" should print the info/help text. The status
+    # command should be command to get help if a user is lost.
+    if not args.quiet:
+        superx.helper.print_instructions_to_commit_and_inspect()
+
+    # TODO Maybe prepare a commit/patch/change message
+
+    return 0
+
+
+def show_version(args) -> int:
+    print("subpatch version %s" % (__version__,))
+    return 0
+
+
+def show_info(args) -> int:
+    print("homepage:  https://subpatch.net")
+    print("git repo:  https://github.com/lengfeld/subpatch")
+    print("license:   %s" % (__LICENSE__,))
+    # TODO add GPL license text/note
+    return 0
+
+
+def do_configure(super_abspath: bytes, super_helper: SuperHelper) -> None:
+    config_abspath = join(super_abspath, b".subpatch")
+    assert not os.path.exists(config_abspath)
+    forget_parsed_file(config_abspath)
+    with open(config_abspath, "bw"):
+        pass
+
+    with chdir(super_abspath):
+        super_helper.add([b".subpatch"])
+
+
+# TODO implement option to unconfigure a superproject
+# TODO unconfiguring should only be possible if all subprojects are removed!
+def cmd_configure(args, parser):
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+
+    if checked_data is None:
+        # There is no config file and no SCM
+        # TODO implement with "subpatch configure --here"
+        raise AppException(ErrorCode.NOT_IMPLEMENTED_YET,
+                           "No SCM found. Cannot configure. '--here' not implemented yet!")
+    elif checked_data.configured:
+        # Nothing to do, the superproject is already configured.
+        if not args.quiet:
+            print("The file .subpatch already exists. Nothing to do!")
+    else:
+        # There is no ".subpatch" file (=the superproject is not configured)
+
+        # TODO Use check_and_get_superproject_from_checked_data to get rid of
+        # SCMType.GIT here in main.py
+        if checked_data.scm_type == SCMType.GIT:
+            # TODO see above. Use other function to switch between super implementations.
+            super_helper = SuperHelperGit()
+
+            do_configure(checked_data.super_path, super_helper)
+
+            if not args.quiet:
+                super_helper.print_configure_success()
+        else:
+            # Unsupported SCMType
+            raise AppException(ErrorCode.NOT_IMPLEMENTED_YET,
+                               "SCM not supported. Currently subpatch only supports git")
+
+    return 0
+
+
+# TODO Document own internal path library
+#  - e.g. b"" is the same as b"." and the later is not used!
+# TODO add tests
+def is_relpath(path):
+    if len(path) == 0:
+        return True
+    if path[0] == ord("/"):
+        return False
+    return True
+
+
+# NOTE: It's the inverse of is_relpath()
+# TODO add tests
+def is_abspath(path):
+    if len(path) == 0:
+        return False
+    if path[0] != ord("/"):
+        return False
+    return True
+
+
+def gen_super_paths(super_abspath: bytes) -> SuperPaths:
+    assert is_abspath(super_abspath)
+
+    cwd_abspath = os.path.abspath(os.getcwdb())
+    assert cwd_abspath.startswith(super_abspath)
+    super_to_cwd_relpath = cwd_abspath[len(super_abspath) + 1:]
+
+    config_abspath = join(super_abspath, b".subpatch")
+
+    return SuperPaths(super_abspath, config_abspath, super_to_cwd_relpath)
+
+
+def is_inside_subproject_and_return_path(config: Config, super_paths: SuperPaths) -> bytes | None:
+    # NOTE: The lookup compares path components and not strings. So for the
+    # paths ["subproject", "subproject-second"] the cwd "subproject-second/subdir"
+    # is only inside the second subproject.
+    return config.subproject_index.find(super_paths.super_to_cwd_relpath)
+
+
+# Collects all modifications of the metadata of a subproject. The metadata
+# file is parsed once and written once by commit(). Use it with
+# metadata_transaction().
+class MetadataTransaction:
+    def __init__(self, sub_paths: SubPaths):
+        self.metadata_abspath = sub_paths.metadata_abspath
+        self._document = read_config_document(sub_paths.metadata_abspath)
+        self._changed = False
+
+    # Adds the section if it does not exist yet
+    def set(self, section_name: bytes, key: bytes, value: bytes) -> None:
+        self._document.add_section(section_name)
+        self._document.set_key_value(section_name, key, value)
+        self._changed = True
+
+    # Drops also the section if it's empty afterwards
+    def drop(self, section_name: bytes, key: bytes) -> None:
+        self._document.drop_key(section_name, key)
+        self._document.drop_section_if_empty(section_name)
+        self._changed = True
+
+    # Returns whether the metadata file was written
+    def commit(self, fsync: bool = False) -> bool:
+        if not self._changed:
+            return False
+        write_file_atomically(self.metadata_abspath, self._document.unparse(), fsync)
+        self._changed = False
+        return True
+
+
+# Usage:
+#     with metadata_transaction(sub_paths, superx.helper) as m:
+#         m.set(b"subtree", b"checksum", checksum)
+#
+# The metadata file is written at the end of the block. If there is an
+# exception in the block, the file is not touched. If a 'super_helper' is
+# given, the written file is also added to the superproject.
+@contextmanager
+def metadata_transaction(sub_paths: SubPaths, super_helper: SuperHelper | None = None, fsync: bool = False):
+    m = MetadataTransaction(sub_paths)
+    yield m
+    if m.commit(fsync) and super_helper is not None:
+        super_helper.add([sub_paths.metadata_abspath])
+
+
+# TODO currently this always uses "\t" for indention. Try to use the style
+# that is already used in the subpatch file. E.g. four-spaces, two-spaces
+# or no-spaces.
+# NOTE: DDX/Design decision: The URL is taken as a verbatim copy
+# of the argument. If there is a trailing slash in the argument, then the
+# trailing slash is also in the config file. It's not sanitized. It's the
+# same behavior as 'git submodule' does.
+def metadata_set_for_unpack(m: MetadataTransaction, url: str, revision: str | None, object_id: bytes,
+                            subtree_checksum: bytes | None = None, subdir: bytes | None = None) -> None:
+    m.set(b"upstream", b"url", url.encode("utf8"))
+    if revision is not None:
+        m.set(b"upstream", b"revision", revision.encode("utf8"))
+    if subdir is not None:
+        m.set(b"upstream", b"subdir", subdir)
+    else:
+        m.drop(b"upstream", b"subdir")
+    if subtree_checksum is not None:
+        m.set(b"subtree", b"checksum", subtree_checksum)
+    m.set(b"upstream", b"objectId", object_id)
+
+
+def is_cwd_toplevel_directory(super_paths: SuperPaths) -> bool:
+    return super_paths.super_to_cwd_relpath == b""
+
+
+# TODO add "-z" option to be safe againts any chars in the path
+# TODO add escpaing for "evil" chars in non "-z" output
+# TODO add not about plumbing command
+def cmd_list(args, parser) -> int:
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    super_paths = gen_super_paths(superx.path)
+
+    config = read_config(super_paths.config_abspath)
+
+    for path in config.subprojects:
+        # TODO Maybe avoid the decoded and encode dance
+        print("%s" % (path.decode("utf8"),))
+
+    return 0
+
+
+def checks_for_cmds_with_single_subproject(enforce_cwd_is_subproject=True) -> tuple[Superproject, SuperPaths, SubPaths]:
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    ensure_superproject_is_git(superx)
+
+    # Check whether the current cwd is inside a subproject
+    super_paths = gen_super_paths(superx.path)
+    config = read_config(super_paths.config_abspath)
+
+    # NOTE: This function can be used to select the subproject based on cwd!
+    # TODO Refactor!
+    super_to_sub_relpath = is_inside_subproject_and_return_path(config, super_paths)
+    if super_to_sub_relpath is None:
+        # TODO decided whether a wrong work directory is a invalid argument or a runtime error!
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Current work directory must be inside a subproject!")
+
+    if enforce_cwd_is_subproject:
+        # NOTE: There is a nicer way to get get this information.
+        # is_inside_subproject_and_return_path() already knows whether cwd is
+        # at the subproject or not!
+        if len(super_to_sub_relpath) == len(super_paths.super_to_cwd_relpath):
+            assert super_to_sub_relpath == super_paths.super_to_cwd_relpath
+            pass  # It's the same directory
+        else:
+            assert len(super_to_sub_relpath) < len(super_paths.super_to_cwd_relpath)
+            assert super_paths.super_to_cwd_relpath.startswith(super_to_sub_relpath)
+            #  l = len(super_to_sub_relpath)
+            #  p = super_paths.super_to_cwd_relpath
+            #  assert p[l] == ord("/")
+            #  sub_to_cwd_relpath = p[l + 1:]
+            #  # NOTE: above code is just for later refactoring!
+
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "Current work directory must be the toplevel directory of the subproject for now!")
+
+    sub_paths = gen_sub_paths_from_relpath(super_paths, super_to_sub_relpath)
+
+    return superx, super_paths, sub_paths
+
+
+# NOTE: Must be executed in the subprojects work tree
+# TODO look at quilt. Mabye "apply" is the wrong term. But it would match "git apply"
+# TODO Support applying multiple patches at once. Git also supports this.
+def cmd_apply(args, parser):
+    if args.path is None:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Must give a path to a patch file")
+
+    if not os.path.isfile(args.path):
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Path '%s' must point to a file!" % (args.path,))
+
+    superx, super_paths, sub_paths = checks_for_cmds_with_single_subproject()
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    subtree_dim = read_subtree_dim(metadata)
+    patches_dim = read_patches_dim(sub_paths, metadata)
+    ensure_dims_are_consistent(subtree_dim, patches_dim)
+
+    if subtree_dim.applied_index is not None:
+        # TODO Maybe check for linting error when default value is used!
+        # TODO add message how to resolve it
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Cannot apply new patch. Not all tracked patches are applied!")
+
+    patch_filename = os.path.basename(args.path.encode("utf8"))
+
+    if patch_filename in patches_dim.patches:
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "The filename '%s' must be unique. There is already a patch with the same name!" %
+                           (patch_filename.decode("utf8"),))
+
+    # TODO Add DDx that patch file names must be in order for now!
+    # TODO make DD: wether to keep name/number of patch or to rename/renumber it
+
+    # TODO ugly code to check that the new patch file is sorted latest
+    patches_new_sorted = sorted(patches_dim.patches + [patch_filename])
+    if patches_new_sorted[-1] != patch_filename:
+        # TODO add more info out to resolve the issue!
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "The patch filenames must be in order. The new patch filename '%s' does not sort latest!" %
+                           (patch_filename.decode("utf8"),))
+
+    # Test whether the patch applies to the working tree
+    # TODO refactor direct git call to to superproject helper!
+    git_apply_args = ["git", "apply", "--allow-empty", "--index",
+                      "--directory=%s" % (sub_paths.super_to_sub_relpath.decode("utf8"),), args.path]
+    p = Popen(git_apply_args + ["--check"], stderr=DEVNULL)
+    p.communicate()
+    if p.returncode != 0:
+        if p.returncode == 1:
+            # TODO print infos how to test yourself and how to fix
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "The patch '%s' does not apply to the working tree." % (patch_filename.decode("utf8"),))
+        else:
+            raise Exception("git failure")
+
+    p = Popen(git_apply_args)
+    p.communicate()
+    if p.returncode != 0:
+        # TODO add a nicer error message
+        raise Exception("git failure")
+
+    # TODO write this code nicer!
+    if not os.path.exists(sub_paths.patches_abspath):
+        os.makedirs(sub_paths.patches_abspath)
+
+    shutil.copy(args.path.encode("utf8"), sub_paths.patches_abspath)
+    super_to_patch_relpath = join(sub_paths.super_to_sub_relpath, b"patches", patch_filename)
+
+    # TODO Thing about releative paths for SuperHelper
+    with chdir(super_paths.super_abspath):
+        superx.helper.add([super_to_patch_relpath])
+
+    # For now cmd_apply only works when all tracked patches are applied. So the
+    # code here does not need to update the 'appliedIndex' in the metadata.
+    # Before "cmd_apply" all tracked patches are applied and after "cmd_apply"
+    # all tracked patches are applied. The only differences is that there is
+    # one additional patch now.
+
+    if not args.quiet:
+        # TODO The output convetion is wrong here. It should be relative and
+        # the path to the subproject is not relative to the cwd here!
+        print("Applied patch '%s' successfully!" % (args.path,))
+        superx.helper.print_instructions_to_commit_and_inspect()
+
+    return 0
+
+
+def cmd_sync(args, parser):
+    superx, super_paths, sub_paths = checks_for_cmds_with_single_subproject()
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    subtree_dim = read_subtree_dim(metadata)
+    patches_dim = read_patches_dim(sub_paths, metadata)
+    ensure_dims_are_consistent(subtree_dim, patches_dim)
+
+    if len(patches_dim.patches) == 0:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "There is no current patch.")
+    else:
+        if subtree_dim.applied_index is None:
+            # Ok case! There is at least one tracked patch and all patches are
+            # applied! So there is a current patch!
+            applied_index = len(patches_dim.patches) - 1
+        elif subtree_dim.applied_index == -1:
+            # TODO this is an invalid state or argument
+            # TODO add explanation how to fix it!
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "There is no current patch.")
+        else:
+            applied_index = subtree_dim.applied_index
+
+    # index checked by ensure_dims_are_consistent()
+    patch_filename = patches_dim.patches[applied_index]
+    patch_abspath = join(sub_paths.patches_abspath, patch_filename)
+    patch_tmp_abspath = patch_abspath + b".tmp"
+
+    # HACK for now nore
+    # NOTE: we only want to have the diff of the subtree, not the "patches" dir and the ".subproject" file
+    with chdir(super_paths.super_abspath):
+        subtree_diff = superx.helper.get_diff_for_subtree(sub_paths.super_to_sub_relpath)
+        subtree_stat = superx.helper.get_diff_for_subtree(sub_paths.super_to_sub_relpath, stat=True)
+
+    # TODO cleanup tmpfile on exception
+    # TODO move this to a patch file library
+    with open(patch_abspath, "br") as f_old, open(patch_tmp_abspath, "bw") as f_new:
+        before_diff = True
+        after_diff = False
+        for line in f_old:
+            if before_diff:
+                if line == b"---\n":
+                    f_new.write(line)
+                    # Write out the new diff
+                    before_diff = False
+                    f_new.write(subtree_stat)
+                    f_new.write(b"\n")
+                    f_new.write(subtree_diff)
+                else:
+                    # Write out the line as is
+                    f_new.write(line)
+            else:
+                if not after_diff:
+                    # Not yet after the original diff
+                    if line == b"-- \n":
+                        after_diff = True
+                        # Write this line out
+                        f_new.write(line)
+                    else:
+                        # drop this line, because it's the old diff
+                        pass
+                else:
+                    # After the original diff, write out the original banner
+                    f_new.write(line)
+
+    os.rename(patch_tmp_abspath, patch_abspath)
+
+    with chdir(super_paths.super_abspath):
+        # TODO use relative paths. It feels nicer.
+        superx.helper.add([patch_abspath])
+
+    if not args.quiet:
+        print("Syncing patch '%s' from stagging area." % (patch_filename.decode("utf8"),))
+        # TODO make printout with superx.helper
+        # NOTE This print out now clobbers a lot of the output of very command.
+        # At some point the user knows it and this is just visual clutter.
+        # Maybe have a config option to suppress it?
+        # superx.helper.print_instructions_to_commit_and_inspect()
+
+    return 0
+
+
+# TODO Parts of this function must be moved to super.py
+def do_patch_applys(superx: Superproject, super_paths: SuperPaths, sub_paths: SubPaths,
+                    patches_dim: PatchesDim, from_applied_index: int, to_applied_index: int, quiet: bool) -> None:
+    assert to_applied_index < len(patches_dim.patches)
+    assert from_applied_index < len(patches_dim.patches)
+    assert from_applied_index != to_applied_index
+    assert from_applied_index >= -1
+    assert to_applied_index >= -1
+
+    args = ["git", "apply", "--allow-empty", "--index",
+            "--directory=%s" % (sub_paths.super_to_sub_relpath.decode("utf8"),)]
+
+    # index checked by ensure_dims_are_consistent()
+    if from_applied_index > to_applied_index:
+        # Popping patches
+        indexes = range(from_applied_index, to_applied_index, - 1)
+        reverse = True
+    else:
+        # Pushing patches
+        indexes = range(from_applied_index + 1, to_applied_index + 1)
+        reverse = False
+
+    if reverse:
+        args.append("--reverse")
+
+    for i in indexes:
+        patch_filename = patches_dim.patches[i]
+        patch_abspath = join(sub_paths.patches_abspath, patch_filename)
+        # TODO avoid abspath dance in the future. Code should be rel-path safe
+        args.append(patch_abspath)
+
+    # TODO check whether patchs applys fully before applying
+    p = Popen(args)
+    p.communicate()
+    if p.returncode != 0:
+        # TODO explain how to recover!
+        raise Exception("git failure")
+
+    # TODO here is not relative path used for git. This seems also to work!
+    with chdir(super_paths.super_abspath), metadata_transaction(sub_paths, superx.helper) as m:
+        if to_applied_index == len(patches_dim.patches) - 1:
+            # Now all patches are applied. Drop the information from the metadata.
+            # The default value is that all (tracked) patches are applied!
+            m.drop(b"subtree", b"appliedIndex")
+        else:
+            m.set(b"subtree", b"appliedIndex", b"%d" % (to_applied_index,))
+
+
+def cmd_pop(args, parser):
+    superx, super_paths, sub_paths = checks_for_cmds_with_single_subproject()
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    subtree_dim = read_subtree_dim(metadata)
+    patches_dim = read_patches_dim(sub_paths, metadata)
+    ensure_dims_are_consistent(subtree_dim, patches_dim)
+
+    # TODO same code in cmd_push. Maybe combine!
+    if subtree_dim.applied_index is None:
+        applied_index = len(patches_dim.patches) - 1
+    else:
+        applied_index = subtree_dim.applied_index
+
+    if args.all:
+        # NOTE: If there are no patches, "-a" exists successfully!
+        if len(patches_dim.patches) == 0:
+            print("The subproject does not track at least one patch. Nothing to pop!")
+            return 0
+        else:
+            if applied_index == -1:
+                print("No patches are applied. Nothing to pop!")
+                return 0
+
+        do_patch_applys(superx, super_paths, sub_paths, patches_dim, applied_index, -1, args.quiet)
+
+        if not args.quiet:
+            count_of_patches = applied_index + 1
+            print("Poped %d patches successfully!" % (count_of_patches,))
+    else:
+        if len(patches_dim.patches) == 0:
+            # TODO Is this a INVALID_ARGUMENT or not a INVALID_STATE error!?!
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "The subproject does not track at least one patch. Nothing to pop!")
+        else:
+            if applied_index == -1:
+                raise AppException(ErrorCode.INVALID_ARGUMENT, "No patches are applied. Nothing to pop!")
+
+        do_patch_applys(superx, super_paths, sub_paths, patches_dim, applied_index, applied_index - 1, args.quiet)
+
+        if not args.quiet:
+            patch_filename = patches_dim.patches[applied_index]
+            print("Poped patch '%s' successfully!" % (patch_filename.decode("utf8"),))
+
+    if not args.quiet:
+        superx.helper.print_instructions_to_commit_and_inspect()
+
+    return 0
+
+
+def cmd_push(args, parser):
+    superx, super_paths, sub_paths = checks_for_cmds_with_single_subproject()
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    subtree_dim = read_subtree_dim(metadata)
+    patches_dim = read_patches_dim(sub_paths, metadata)
+    ensure_dims_are_consistent(subtree_dim, patches_dim)
+
+    if subtree_dim.applied_index is None:
+        applied_index = len(patches_dim.patches) - 1
+    else:
+        applied_index = subtree_dim.applied_index
+
+    if args.all:
+        if len(patches_dim.patches) == 0:
+            # TODO should this be printed to stderr?
+            print("The subproject does not track at least one patch. Nothing to push!")
+            return 0
+        else:
+            if applied_index == len(patches_dim.patches) - 1:
+                print("All patches are applied. Nothing to push!")
+                return 0
+
+        do_patch_applys(superx, super_paths, sub_paths, patches_dim, applied_index, len(patches_dim.patches) - 1, args.quiet)
+        if not args.quiet:
+            count_of_patches = len(patches_dim.patches) - applied_index - 1
+            print("Pushed %d patches successfully!" % (count_of_patches,))
+    else:
+        if len(patches_dim.patches) == 0:
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "The subproject does not track at least one patch. Nothing to push!")
+        else:
+            if applied_index == len(patches_dim.patches) - 1:
+                raise AppException(ErrorCode.INVALID_ARGUMENT, "All patches are applied. Nothing to push!")
+
+        do_patch_applys(superx, super_paths, sub_paths, patches_dim, applied_index, applied_index + 1, args.quiet)
+
+        if not args.quiet:
+            patch_filename = patches_dim.patches[applied_index]
+            print("Pushed patch '%s' successfully!" % (patch_filename.decode("utf8"),))
+
+    if not args.quiet:
+        superx.helper.print_instructions_to_commit_and_inspect()
+
+    return 0
+
+
+def do_init(super_paths: SuperPaths, sub_paths: SubPaths, superx: Superproject) -> None:
+    # TODO check path argument
+    # - Should not point outside the superproject
+    # - should not point inside a existing subproject.
+
+    if sub_paths.super_to_sub_relpath == b"":
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "Subproject path is empty. Cannot create subproject at toplevel directory for now!")
+
+    if os.path.exists(sub_paths.cwd_to_sub_relpath):
+        # There is already a directory
+        # TODO add message how to solve the problem
+        # TODO just a empty dir should be ok!
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "Directory '%s' already exists. Cannot add subproject!" % (sub_paths.cwd_to_sub_relpath.decode("utf8"),))
+
+    if os.path.exists(sub_paths.metadata_abspath):
+        # There is already a subproject at this place
+        # TODO write this check better
+        # TODO also check git index if there is a file
+        # TODO explain what can be done: Either remove the dir or use another name!
+        # TODO fix decode utf8. Should the the system default encoding!
+        # TODO add tests for this!
+        # TODO Add ErrorCode for invalid state of superproject.
+        raise AppException(ErrorCode.INVALID_ARGUMENT,
+                           "File '%s' already exists. Cannot add subproject!" % (sub_paths.metadata_abspath.decode("utf8"),))
+
+    os.makedirs(sub_paths.cwd_to_sub_relpath)
+    forget_parsed_file(sub_paths.metadata_abspath)
+    with open(sub_paths.metadata_abspath, "bw"):
+        pass
+
+    with chdir(super_paths.super_abspath):
+        superx.helper.add([sub_paths.metadata_abspath])
+
+    config_add_subproject(super_paths.config_abspath, sub_paths.super_to_sub_relpath)
+    with chdir(super_paths.super_abspath):
+        superx.helper.add([b".subpatch"])
+
+
+def cmd_init(args, parser) -> int:
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    # TODO for the simple command init, we maybe can relax this required even now!
+    ensure_superproject_is_git(superx)
+    super_paths = gen_super_paths(superx.path)
+
+    # TODO ensure that paths are normalized!
+    cwd_to_sub_relpath = args.path.rstrip("/").encode("utf8")
+    sub_paths = gen_sub_paths_from_cwd_and_relpath(super_paths, cwd_to_sub_relpath)
+
+    do_init(super_paths, sub_paths, superx)
+
+    if not args.quiet:
+        print("Subproject '%s' initialized." % (cwd_to_sub_relpath.decode("utf8"),))
+        superx.helper.print_instructions_to_commit_and_inspect()
+
+    return 0
+
+
+def cmd_patches_list(args, parser):
+    superx, super_paths, sub_paths = checks_for_cmds_with_single_subproject()
+
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    patches_dim = read_patches_dim(sub_paths, metadata)
+
+    for patch in patches_dim.patches:
+        # TODO fix encoding
+        # TODO should the output the path to the patch file or just the name of the patch file?
+        # TODO should skipped/non-skipped state be shown here?
+        # NOTE: the applied or not applied state cannot be shown, because the
+        # information is in the subtree dimension
+        print(patch.decode("utf8"))
+
+    return 0
+
+
+# Writes the integrated revision of the subproject to a git bundle file. The
+# bundle can be used with '--from-bundle' on a machine without access to the
+# remote repository.
+def cmd_cache_export_bundle(args, parser):
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    ensure_superproject_is_git(superx)
+
+    super_paths = gen_super_paths(superx.path)
+    config = read_config(super_paths.config_abspath)
+    sub_paths = gen_sub_paths_from_cwd_and_relpath(super_paths, os.fsencode(args.path))
+
+    if sub_paths.super_to_sub_relpath not in config.subproject_index:
+        x = sub_paths.super_to_sub_relpath.decode("utf8")
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Path '%s' does not point to a subproject" % (x,))
+
+    metadata = read_metadata(sub_paths.metadata_abspath)
+    if metadata.url is None or metadata.object_id is None:
+        # TODO This is not a INVALID_ARGUMENT, it's a state error
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Subproject has no integrated revision. So there is nothing to export!")
+
+    url = metadata.url.decode("utf8")
+    if get_archive_suffix(url) is not None:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "Bundles can only be used for git repositories!")
+    revision = None if metadata.revision is None else metadata.revision.decode("utf8")
+    bundle_abspath = os.path.abspath(os.fsencode(args.bundle))
+
+    cache_helper = CacheHelperGit()
+    # NOTE: Relative URLs are relative to the toplevel directory of the
+    # superproject.
+    with chdir(super_paths.super_abspath), CacheLock(get_cache_abspath(super_paths, url)):
+        cache_abspath = do_cache_create(super_paths, cache_helper, url)
+        # The cache may not contain the integrated revision, e.g. if the
+        # subproject was added in another clone of the superproject.
+        if not cache_helper.has_commit(cache_abspath, metadata.object_id):
+            do_cache_fetch(cache_helper, cache_abspath, url, metadata.object_id.decode("ascii"), subdir=metadata.subdir)
+
+        cache_helper.export_bundle(cache_abspath, bundle_abspath, revision, metadata.object_id)
+
+    if not args.quiet:
+        print("Exported subproject '%s' at revision '%s' to bundle '%s'." %
+              (sub_paths.cwd_to_sub_relpath.decode("utf8"), cache_helper.get_revision_as_str(revision), args.bundle))
+
+    return 0
+
+
+# Compacts all caches of the superproject. If a maximum size is given, the
+# least recently used caches are removed until the size is not exceeded.
+def cmd_cache_gc(args, parser):
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_git(superx)
+
+    if args.max_size is not None:
+        max_size = check_and_parse_cache_max_size(args.max_size)
+    else:
+        max_size = get_cache_max_size()
+
+    super_paths = gen_super_paths(superx.path)
+    root_abspath = get_cache_root_abspath(super_paths.super_abspath)
+
+    for cache_abspath in list_caches(root_abspath):
+        with CacheLock(cache_abspath):
+            # Another process may have removed the cache in the meantime
+            if os.path.isdir(cache_abspath):
+                get_cache_helper_for_cache(cache_abspath).compact(cache_abspath)
+
+    if max_size is not None:
+        for cache_abspath, size in evict_caches(root_abspath, max_size):
+            if not args.quiet:
+                print("Removed cache '%s' (%d bytes)" % (os.path.basename(cache_abspath).decode("ascii"), size))
+
+    if not args.quiet:
+        caches = list_caches(root_abspath)
+        print("%d caches use %d bytes" % (len(caches), sum(get_dir_size(path) for path in caches)))
+
+    return 0
+
+
+def cmd_subtree_checksum(args, parser):
+    if sum(1 for x in [args.write, args.verify, args.calc, args.get] if x) != 1:
+        raise AppException(ErrorCode.INVALID_ARGUMENT, "You must exactly use one of --get, --calc, --write or --verify!")
+
+    superx, super_paths, sub_paths = checks_for_cmds_with_single_subproject()
+
+    if args.calc:
+        checksum = superx.helper.get_sha1_for_subtree(sub_paths.super_to_sub_relpath)
+        print(checksum.decode("ascii"))
+        return 0
+    elif args.get:
+        metadata = read_metadata(sub_paths.metadata_abspath)
+
+        if metadata.subtree_checksum is None:
+            # TODO This is not a INVALID_ARGUMENT, it's a state error
+            # It's an ok state, because the subtree can be unpopluated
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "Subtree is unpopulated. So there is no checksum!")
+
+        print(metadata.subtree_checksum.decode("ascii"))
+        return 0
+    elif args.verify:
+        checksum = superx.helper.get_sha1_for_subtree(sub_paths.super_to_sub_relpath)
+        metadata = read_metadata(sub_paths.metadata_abspath)
+
+        if metadata.subtree_checksum is None:
+            # TODO is this a runtime error or an invalid argument?
+            raise AppException(ErrorCode.INVALID_ARGUMENT, "No checksum in metadata found!")
+
+        # TODO document exit codes
+        # TODO maybe use abbrev versions of the checksum as git does!
+        if checksum == metadata.subtree_checksum:
+            if not args.quiet:
+                checksum_str = checksum.decode("ascii")
+                print(f"Subtree's checksum {checksum_str} matches the metdata!")
+            return 0
+        else:
+            if not args.quiet:
+                checksum_str = checksum.decode("ascii")
+                metadata_checksum_str = metadata.subtree_checksum.decode("ascii")
+                print(f"Subtree's checksum {checksum_str} does not match checksum {metadata_checksum_str} in the metadata.")
+            return 1
+    elif args.write:
+        checksum = superx.helper.get_sha1_for_subtree(sub_paths.super_to_sub_relpath)
+
+        # TODO mabye this should also have an output to stdout?
+        # NOTE: Like add and update, the metadata file is added to the
+        # staging area.
+        with metadata_transaction(sub_paths, superx.helper) as m:
+            m.set(b"subtree", b"checksum", checksum)
+
+        return 0
+    else:
+        assert False
+
+
+def do_status_subproject(subproject: bytes, dims: SubprojectDims, changes) -> None:
+    # TODO Idea: make it valid markdown output
+    # TODO Idea: For every cvs superproject (superhelper) make the output
+    # like the cvs styled of console output. Subpach should look like git
+    # for git superprojects. And look like svn for svn superprojects.
+    # NOTE: these two ideas are conflicting!
+
+    # TODO use the term "dimensions" also in the output to make the
+    # dimension for understandable for the user.
+
+    metadata = dims.metadata
+
+    # TODO again some bytes to string decoding. Annoying!
+    subproject_str = subproject.decode("utf8")
+
+    # TODO Think about other cvs systems
+    print("# subproject at '%s'" % (subproject_str,))
+    print("")
+
+    # TODO add upstream dimensions
+    if metadata.url is not None:
+        print("* was integrated from URL: %s" % (metadata.url.decode("utf8"),))
+    if metadata.revision is not None:
+        print("* has integrated revision: %s" % (metadata.revision.decode("utf8"),))
+        # TODO Maybe included whether it "tracks a branch" or it was a git tag
+    if metadata.object_id is not None:
+        print("* has integrated object id: %s" % (metadata.object_id.decode("utf8"),))
+
+    # Get count of patches for subproject and other information
+    patches_dim = dims.patches_dim
+    subtree_dim = dims.subtree_dim
+    ensure_dims_are_consistent(subtree_dim, patches_dim)
+
+    p = subproject_str
+
+    # NOTE Listing the modified files seems to much like "git status".
+    # There is already "git status". The output just referneces the git
+    # commands To inspect the changes.
+
+    if subtree_dim.checksum == b"":
+        print("""\
+* Subtree is unpopulated""")
+
+    if changes.untracked > 0:
+        print("""\
+* There are n=%d untracked files and/or directories:
+    - To see them execute:
+        `git status %s`
+        `git ls-files --exclude-standard -o %s`
+    - Use `git add %s` to add all of them
+    - Use `git add %s/<filename>` to just add some of them
+    - Use `rm <filename>` to remove them"""
+              % (changes.untracked, p, p, p, p))
+
+    if changes.unstaged > 0:
+        print("""\
+* There are n=%d modified files not staged for commit:
+    - To see them execute:
+        `git status %s` or
+        `git diff %s`
+    - Use `git add %s` to update what will be committed
+    - Use `git restore %s` to discard changes in working directory"""
+              % (changes.unstaged, p, p, p, p))
+
+    if changes.uncommitted > 0:
+        # TODO check git restore
+        print("""\
+* There are n=%d modified files that are staged, but not committed:
+    - To see them execute:
+        `git status %s` or
+        `git diff --staged %s`
+    - Use `git commit %s` to commit the changes
+    - Use `git restore --staged %s` to unstage"""
+              % (changes.uncommitted, p, p, p, p))
+        # TODO check restore staged
+        # TODO add command "git restore --staged --worktree -- xxxpath/"
+        # to remove changes staged in the index from the index and the
+        # working tree But leave changes in the working tree/unstaged
+        # untouched This helps because it does ot leave new files in the
+        # working tree as "git restore --staged" will done.
+
+    patches_count = len(patches_dim.patches)
+    if patches_count != 0:
+        print("* There are n=%d patches." % (patches_count,))
+        if subtree_dim.applied_index is None:
+            pass
+        else:
+            if subtree_dim.applied_index + 1 == patches_count:
+                pass  # TODO May make this a linting error, because default value is used!
+            else:
+                # TODO Maybe call this a "rebase" operation if not all patches are applied.
+                print("* There are only n=%d patches applied." % (subtree_dim.applied_index + 1,))
+                print("    - Use `subpatch push` to apply the next tracked patch to the subtree")
+
+        # TODO implement subpatch patch list
+        # print("    - Use `subpatch patches list` to list them")
+
+
+# TODO add note that the output of "status" is not an API/plumbing. Should not be used in scripts
+def cmd_status(args, parser):
+    # TODO allow the cwd to select the subproject
+    # TODO add plumbing commands for scripts!
+    # TODO add colorscheme for output, e.g. like git status does
+    # TODO handle stdout fd is pipe/file and not tty.
+
+    data = find_superproject()
+    checked_data = check_superproject_data(data)
+    superx = check_and_get_superproject_from_checked_data(checked_data)
+    ensure_superproject_is_configured(superx)
+    ensure_superproject_is_git(superx)
+
+    super_paths = gen_super_paths(superx.path)
+
+    if not is_cwd_toplevel_directory(super_paths):
+        print_warning = True
+    else:
+        print_warning = False
+
+    config = read_config(super_paths.config_abspath)
+
+    if args.path is not None:
+        # TODO use sys default/argument encoding
+        path_bytes = args.path.encode("utf8")
+        path_relpath = os.path.relpath(path_bytes)
+        super_to_sub_relpath = join(super_paths.super_to_cwd_relpath, path_relpath)
+
+        # Normalize path. e.g. remove "." or ".." from the path!
+        # TODO make this a common function and test it. Also the function
+        # is_inside_subproject_and_return_path() does something similar!
+        # TODO maybe add a plumbing command for that to expose to scripting!
+        super_to_sub_relpath = os.path.normpath(super_to_sub_relpath)
+
+        if super_to_sub_relpath not in config.subproject_index:
+            raise AppException(ErrorCode.INVALID_ARGUMENT,
+                               "Argument '%s' does not point to a subproject!" % (args.path,))
+        subprojects = [super_to_sub_relpath]
+        subproject_index = SubprojectIndex(subprojects)
+    else:
+        # These are relative paths: super_to_sub_relpath
+        subprojects = config.subprojects
+        subproject_index = config.subproject_index
+
+    if len(subprojects) == 0:
+        # Early return. Nothing to print!
+        return 0
+
+    # TODO refactor this struct and the following code to a function! And make
+    # to interface for other cvs
+    @dataclass
+    class Changes:
+        untracked: int = 0
+        unstaged: int = 0
+        uncommitted: int = 0
+
+    subproject_changes = {}
+    for path in subprojects:
+        subproject_changes[path] = Changes()
+
+    subprojects_dims = read_subprojects_dims([gen_sub_paths_from_relpath(super_paths, path) for path in subprojects])
+
+    # TODO does the concept of staged and unstaged files als exists in other
+    # cvs systems
+    # NOTE: The paths in the output are always relative to the toplevel
+    # directory. So config options like diff.relative do not matter.
+    for entry in git_status_porcelain_v2(subprojects, cwd=super_paths.super_abspath):
+        subproject = subproject_index.find(entry.path)
+        if subproject is None:
+            continue
+        changes = subproject_changes[subproject]
+        if entry.status_type == StatusType.UNTRACKED:
+            changes.untracked += 1
+        elif entry.status_type == StatusType.IGNORED:
+            pass
+        else:
+            assert entry.xy is not None
+            # Unmerged entries are counted in both categories
+            if entry.xy[0:1] != b".":
+                changes.uncommitted += 1
+            if entry.xy[1:2] != b".":
+                changes.unstaged += 1
+
+    print("NOTE: The format of the output is human-readable and unstable. Do not use in scripts!")
+    print("NOTE: The format is markdown currently. Will mostly change in the future.")
+    if print_warning:
+        print("WARNING: The current working directory is not the toplevel directory of the superproject.")
+        print("WARNING: The paths in this console output are wrong (for now)!")
+    print("")
+
+    for i, subproject in enumerate(subprojects):
+        changes = subproject_changes[subproject]
+
+        do_status_subproject(subproject, subprojects_dims[subproject], changes)
+
+        if i + 1 < len(subprojects):
+            # Add a empty line between the subprojects
+            print("")
+
+    return 0
+
+
+def main_wrapped() -> int:
+    # TODO maybe add 'epilog' again
+    parser = argparse.ArgumentParser(description='Adding subprojects into a git repo, the superproject.')
+    parser.add_argument("--version", "-v", dest="version",
+                        action="store_true", default=False,
+                        help="Show version of program")
+    parser.add_argument("--info", dest="info",
+                        action="store_true", default=False,
+                        help="Show more information, like homepage, repo and license")
+
+    subparsers = parser.add_subparsers()
+
+    parser_configure = subparsers.add_parser("configure",
+                                             help="Configure the superproject to use subpatch")
+    parser_configure.set_defaults(func=cmd_configure)
+    parser_configure.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                                  help="Suppress output to stdout")
+
+    parser_init = subparsers.add_parser("init",
+                                        help="Init a subproject inside the superproject. Normaly done by subpatch add automatically.")
+    parser_init.set_defaults(func=cmd_init)
+    parser_init.add_argument(dest="path", type=str,
+                             help="Path to new subproject")
+    parser_init.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                             help="Suppress output to stdout")
+
+    # TODO add argument to track a patch, but do not push/apply it.
+    # -> would be the a command like "subpatch patch add <filename>", since it
+    #    only uses the patch dimension.
+    # The comamnd "subpatch apply" is a combination of
+    #    "subpatch patch add <filename>" and
+    #    "git apply <filename> == subpatch subtree apply <filename>"
+    # TODO maybe the term apply is wrong here ... no it's not. git also uses apply!
+    parser_apply = subparsers.add_parser("apply",
+                                         help="Apply a patch to the subtree and add to patch list")
+    parser_apply.set_defaults(func=cmd_apply)
+    parser_apply.add_argument(dest="path", type=str,
+                              help="Path to patch file")
+    parser_apply.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                              help="Suppress output to stdout")
+
+    # TODO think about exit code!
+    parser_pop = subparsers.add_parser("pop",
+                                       help="Remove current patch from the subtree")
+    parser_pop.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                            help="Suppress output to stdout")
+    parser_pop.add_argument("-a", "--all", action=argparse.BooleanOptionalAction,
+                            help="Remove all patches")
+    parser_pop.set_defaults(func=cmd_pop)
+
+    parser_push = subparsers.add_parser("push",
+                                        help="Apply the next patch to the subtree")
+    parser_push.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                             help="Suppress output to stdout")
+    parser_push.add_argument("-a", "--all", action=argparse.BooleanOptionalAction,
+                             help="Apply all patches")
+    parser_push.set_defaults(func=cmd_push)
+
+    parser_add = subparsers.add_parser("add",
+                                       help="Fetch and add a subproject")
+    parser_add.set_defaults(func=cmd_add)
+    parser_add.add_argument(dest="url", type=str,
+                            help="URL or path to git repo")
+    parser_add.add_argument(dest="path", type=str, default=None, nargs='?',
+                            help="Add subproject a path (not use the repo name)")
+    parser_add.add_argument("-r", "--revision", dest="revision", type=str,
+                            help="Specify the revision to integrate. Can be a branch name, tag name or commit id.")
+    parser_add.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                            help="Suppress output to stdout")
+    parser_add.add_argument("--refresh", action="store_true",
+                            help="Resolve the revision in the remote repository even if the cached result is recent. "
+                                 "Also try all fetch optimizations again")
+    parser_add.add_argument("--subdir", dest="subdir", type=str,
+                            help="Only integrate this subdirectory of the remote repository")
+    parser_add.add_argument("--from-bundle", dest="from_bundle", type=str,
+                            help="Take the revision from this git bundle file instead of the remote repository")
+
+    # TODO maybe find better name than "sync"
+    parser_sync = subparsers.add_parser("sync",
+                                        help="Update diff of the current patch from the staging area")
+    parser_sync.set_defaults(func=cmd_sync)
+    parser_sync.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                             help="Suppress output to stdout")
+
+    parser_update = subparsers.add_parser("update",
+                                          help="Fetch and update a subproject")
+    parser_update.set_defaults(func=cmd_update)
+    parser_update.add_argument(dest="paths", type=str, nargs='*',
+                               help="paths to subprojects")
+    parser_update.add_argument("--all", action="store_true",
+                               help="Update all subprojects")
+    parser_update.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                               help="Number of subprojects that are fetched in parallel. Defaults to 1.")
+    parser_update.add_argument("--refresh", action="store_true",
+                               help="Resolve the revisions in the remote repositories even if the cached results are recent. "
+                                    "Also try all fetch optimizations again")
+    parser_update.add_argument("--url", dest="url", type=str,
+                               help="URL or path to the remote git repo")
+    parser_update.add_argument("-r", "--revision", dest="revision", type=str,
+                               help="Specify the revision to integrate. Can be a branch name, tag name or commit id.")
+    parser_update.add_argument("--subdir", dest="subdir", type=str,
+                               help="Only integrate this subdirectory of the remote repository")
+    parser_update.add_argument("--from-bundle", dest="from_bundle", type=str,
+                               help="Take the revision from this git bundle file instead of the remote repository")
+    parser_update.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                               help="Suppress output to stdout")
+
+    parser_status = subparsers.add_parser("status",
+                                          help="Prints a summary of all or one subprojects")
+    parser_status.set_defaults(func=cmd_status)
+    parser_status.add_argument(dest="path", type=str, default=None, nargs='?',
+                               help="path to a subproject")
+
+    parser_list = subparsers.add_parser("list",
+                                        help="List all subprojects")
+    parser_list.set_defaults(func=cmd_list)
+
+    parser_patches = subparsers.add_parser("patches",
+                                           help="Commands to modify/query the subprojects patches")
+    subparsers_patches = parser_patches.add_subparsers()
+    parser_patches_list = subparsers_patches.add_parser("list",
+                                                        help="List tracked patches in the subproject")
+    parser_patches_list.set_defaults(func=cmd_patches_list)
+
+    parser_subtree = subparsers.add_parser("subtree",
+                                           help="Commands to modify/query the subprojects subtree")
+    subparsers_subtree = parser_subtree.add_subparsers()
+    parser_subtree_checksum = subparsers_subtree.add_parser("checksum",
+                                                            help="Commands to modify/query the checksum of the subtree")
+    # TODO these options are actually commands. It's only allowed to give on option! refactor!
+    parser_subtree_checksum.add_argument("--calc", dest="calc", action=argparse.BooleanOptionalAction,
+                                         help="tbd")
+    parser_subtree_checksum.add_argument("--verify", dest="verify", action=argparse.BooleanOptionalAction,
+                                         help="tbd")
+    parser_subtree_checksum.add_argument("--write", dest="write", action=argparse.BooleanOptionalAction,
+                                         help="tbd")
+    parser_subtree_checksum.add_argument("--get", dest="get", action=argparse.BooleanOptionalAction,
+                                         help="tbd")
+    parser_subtree_checksum.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                                         help="Suppress output to stdout")
+    parser_subtree_checksum.set_defaults(func=cmd_subtree_checksum)
+
+    parser_cache = subparsers.add_parser("cache",
+                                         help="Commands to modify/query the caches of the upstream repositories")
+    subparsers_cache = parser_cache.add_subparsers()
+    parser_cache_export_bundle = subparsers_cache.add_parser("export-bundle",
+                                                             help="Write the integrated revision of a subproject to a git bundle file")
+    parser_cache_export_bundle.add_argument(dest="path", type=str,
+                                            help="path to the subproject")
+    parser_cache_export_bundle.add_argument(dest="bundle", type=str,
+                                            help="path of the bundle file")
+    parser_cache_export_bundle.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                                            help="Suppress output to stdout")
+    parser_cache_export_bundle.set_defaults(func=cmd_cache_export_bundle)
+    parser_cache_gc = subparsers_cache.add_parser("gc",
+                                                  help="Compact the caches and remove the least recently used ones")
+    parser_cache_gc.add_argument("--max-size", dest="max_size", type=str,
+                                 help="Maximum size of all caches in bytes. Defaults to SUBPATCH_CACHE_MAX_SIZE.")
+    parser_cache_gc.add_argument("-q", "--quiet", action=argparse.BooleanOptionalAction,
+                                 help="Suppress output to stdout")
+    parser_cache_gc.set_defaults(func=cmd_cache_gc)
+
+    parser_help = subparsers.add_parser("help",
+                                        help="Also shows the help message")
+    parser_help.set_defaults(func=cmd_help)
+
+    args = parser.parse_args()
+
+    # Just for testing. A bit ugly to have this in the production code.
+    signal_file_path = os.environ.get("HANG_FOR_TEST", "")
+    if len(signal_file_path) > 0:
+        with open(signal_file_path, "bw") as f:
+            f.write(b"")
+        time.sleep(100)
+
+    if args.version:
+        ret = show_version(args)
+    elif args.info:
+        ret = show_info(args)
+    else:
+        # Workaround for help
+        if hasattr(args, "func"):
+            ret = args.func(args, parser)
+        else:
+            ret = nocommand(args, parser)
+
+    return ret
+
+
+def main() -> int:
+    try:
+        ret = main_wrapped()
+
+        # For some functions I have forgotten to add a return statement. Catch
+        # this bug here!
+        assert ret is not None
+
+        return ret
+    except AppException as e:
+        # TODO allow to append a generic error message for all messages, not only for invalid argument.
+        if e._code == ErrorCode.NOT_IMPLEMENTED_YET:
+            # TODO the message should show the github issue url!
+            print("Error: Feature not implemented yet: %s" % (e,), file=sys.stderr)
+        elif e._code == ErrorCode.SUPERPROJECT_NOT_FOUND:
+            # TODO add steps to resolve the issue. e.g. touching the file
+            print("Error: No superproject found!", file=sys.stderr)
+        elif e._code == ErrorCode.SUPERPROJECT_NOT_CONFIGURED:
+            # TODO add steps to resolve the issue. e.g. touching the file
+            # TODO rework error message, Word subpatch should not be included
+            print("Error: subpatch not yet configured for superproject!", file=sys.stderr)
+        elif e._code == ErrorCode.INVALID_ARGUMENT:
+            # TODO change structure of errors. It contains two colons now.
+            # Looks ugly.
+            print("Error: Invalid argument: %s" % (e,), file=sys.stderr)
+        elif e._code == ErrorCode.INVALID_STATE:
+            # TODO change structure of errors. It contains two colons now.
+            # Looks ugly.
+            print("Error: Invalid state: %s" % (e,), file=sys.stderr)
+        elif e._code == ErrorCode.CUSTOM:
+            print("Error: %s" % (e,), file=sys.stderr)
+        else:
+            assert False
+        return 4
+    except KeyboardInterrupt:
+        print("Interrupted!", file=sys.stderr)
+        # TODO What is the correct/best error code?
+        return 3
+
+
+if __name__ == '__main__':
+    sys.exit(main())
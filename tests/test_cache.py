@@ -2,17 +2,28 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # SPDX-FileCopyrightText: Copyright (C) 2024 Stefan Lengfeld
 
+import hashlib
+import io
+import os
 import sys
+import tarfile
 import unittest
+import zipfile
+from contextlib import chdir
 from os import mkdir
-from os.path import dirname, join, realpath
+from os.path import abspath, dirname, join, realpath
 from helpers import (TestCaseTempFolder, TestCaseHelper, create_and_chdir, Git,
-                     create_git_repo_with_branches_and_tags)
+                     create_git_repo_with_branches_and_tags, touch)
+from localwebserver import FileRequestHandler, LocalWebserver
 
 path = realpath(__file__)
 sys.path.append(join(dirname(path), "../src"))
 
-from cache import CacheHelperGit, DownloadConfig
+from libgit import GitError, git_cat_file_pretty, git_config_get, git_config_set, git_get_sha1, git_rev_list_missing, git_verify
+from util import AppException
+from cache import (CacheHelperArchive, CacheHelperGit, CloneConfig, DownloadConfig, RefsCache, get_cache_helper,
+                   get_cache_key, normalize_url, evict_caches, list_caches, mark_cache_used, CacheLock,
+                   lock_caches)
 
 
 # TODO Add tests for all different Cache Helpers types
@@ -20,11 +31,11 @@ from cache import CacheHelperGit, DownloadConfig
 class TestCacheHelperGit(TestCaseTempFolder, TestCaseHelper):
     def test_create(self):
         cache_helper = CacheHelperGit()
-        cwd_to_cache_relpath = b"cache"
-        mkdir(cwd_to_cache_relpath)
-        self.assertFalse(cache_helper.isCreated(cwd_to_cache_relpath))
-        cache_helper.create(cwd_to_cache_relpath)
-        self.assertTrue(cache_helper.isCreated(cwd_to_cache_relpath))
+        cache_abspath = abspath(b"cache")
+        mkdir(cache_abspath)
+        self.assertFalse(cache_helper.isCreated(cache_abspath))
+        cache_helper.create(cache_abspath)
+        self.assertTrue(cache_helper.isCreated(cache_abspath))
 
     def test_fetch(self):
         with create_and_chdir("upstream"):
@@ -35,31 +46,473 @@ class TestCacheHelperGit(TestCaseTempFolder, TestCaseHelper):
             tag_commit_id = git.get_sha1("v1^{commit}")
 
         cache_helper = CacheHelperGit()
-        cwd_to_cache_relpath = b"cache"
-        mkdir(cwd_to_cache_relpath)
-        cache_helper.create(cwd_to_cache_relpath)
+        cache_abspath = abspath(b"cache")
+        mkdir(cache_abspath)
+        cache_helper.create(cache_abspath)
 
         download_config = DownloadConfig("upstream", "main")
-        object_id = cache_helper.fetch(cwd_to_cache_relpath, download_config)
+        object_id = cache_helper.fetch(cache_abspath, download_config)
         self.assertEqual(object_id, head_id)
 
         download_config = DownloadConfig("upstream", "v1")
-        object_id = cache_helper.fetch(cwd_to_cache_relpath, download_config)
+        object_id = cache_helper.fetch(cache_abspath, download_config)
         self.assertEqual(object_id, tag_id)
 
         download_config = DownloadConfig(url="upstream")
-        object_id = cache_helper.fetch(cwd_to_cache_relpath, download_config)
+        object_id = cache_helper.fetch(cache_abspath, download_config)
         self.assertEqual(object_id, head_id)
 
         # TODO Document and find out the correct path for relative local paths
         download_config = DownloadConfig(url="upstream")
-        object_id = cache_helper.fetch(cwd_to_cache_relpath, download_config)
+        object_id = cache_helper.fetch(cache_abspath, download_config)
         self.assertEqual(object_id, head_id)
 
         download_config = DownloadConfig(url="upstream", revision=tag_commit_id.decode("ascii"))
-        object_id = cache_helper.fetch(cwd_to_cache_relpath, download_config)
+        object_id = cache_helper.fetch(cache_abspath, download_config)
         self.assertEqual(object_id, tag_commit_id)
 
+    def test_fetch_object_id(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+            git = Git()
+            commit_id = git.get_sha1("v1^{commit}")
+
+        cache_helper = CacheHelperGit()
+        cache_abspath = abspath(b"cache")
+        mkdir(cache_abspath)
+        cache_helper.create(cache_abspath)
+
+        download_config = DownloadConfig(url="upstream", revision=commit_id.decode("ascii"))
+        object_id = cache_helper.fetch(cache_abspath, download_config)
+        self.assertEqual(object_id, commit_id)
+
+        # Only the commit was fetched. Not all branches and tags.
+        with chdir(cache_abspath):
+            p = git.call(["for-each-ref", "--format=%(refname)"], capture_stdout=True)
+            self.assertEqual(p.stdout, b"refs/subpatch/fetched\n")
+
+            # The capabilities of the remote are remembered
+            p = git.call(["config", "subpatch.transport"], capture_stdout=True)
+            self.assertEqual(p.stdout, b"shallow fetch-by-object-id filter\n")
+
+        # A tree object is not valid
+        download_config = DownloadConfig(url="upstream", revision=git_get_sha1(commit_id + b"^{tree}", cwd=cache_abspath).decode("ascii"))
+        with self.assertRaises(AppException) as context:
+            cache_helper.fetch(cache_abspath, download_config)
+        self.assertEqual(str(context.exception), "Object id '%s' does not point to a commit or tag object!" % (download_config.revision,))
+
+    def test_transport(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+            git = Git()
+            commit_id = git.get_sha1("main~1")
+
+        cache_abspath = abspath(b"cache")
+        mkdir(cache_abspath)
+        CacheHelperGit().create(cache_abspath)
+
+        def get_transport(cache_abspath=cache_abspath):
+            return git_config_get("subpatch.transport", cwd=cache_abspath)
+
+        # With the protocol v0 the remote rejects the fetch of an object id
+        # that is not advertised by a ref. Then all refs are fetched.
+        git_config_set("protocol.version", b"0", cwd=cache_abspath)
+        download_config = DownloadConfig(url="upstream", revision=commit_id.decode("ascii"))
+        self.assertEqual(CacheHelperGit().fetch(cache_abspath, download_config), commit_id)
+        self.assertEqual(get_transport(), b"shallow filter")
+
+        # A fetch that fails for another reason keeps the stored capabilities,
+        # e.g. the ref was deleted after it was resolved or the remote is not
+        # reachable. For a new cache nothing is stored.
+        deleted_ref_config = CloneConfig(full_clone=False, ref=b"refs/heads/deleted")
+        with self.assertRaises(GitError):
+            CacheHelperGit().fetch(cache_abspath, DownloadConfig(url="upstream"), deleted_ref_config)
+        self.assertEqual(get_transport(), b"shallow filter")
+        clone_config = CloneConfig(full_clone=False, ref=b"refs/heads/main")
+        with self.assertRaises(GitError):
+            CacheHelperGit().fetch(cache_abspath, DownloadConfig(url=abspath("does-not-exist")), clone_config)
+        self.assertEqual(get_transport(), b"shallow filter")
+
+        new_cache_abspath = abspath(b"new-cache")
+        mkdir(new_cache_abspath)
+        CacheHelperGit().create(new_cache_abspath)
+        with self.assertRaises(GitError):
+            CacheHelperGit().fetch(new_cache_abspath, DownloadConfig(url="upstream"), deleted_ref_config)
+        self.assertIsNone(get_transport(new_cache_abspath))
+
+        # The dumb http transport supports none of the capabilities. The fetch
+        # is retried without them.
+        with chdir("upstream"):
+            git.call(["update-server-info"])
+        http_cache_abspath = abspath(b"http-cache")
+        mkdir(http_cache_abspath)
+        CacheHelperGit().create(http_cache_abspath)
+        download_config = DownloadConfig(url="http://localhost:7000/upstream/.git/", revision="main")
+        with LocalWebserver(7000, FileRequestHandler):
+            CacheHelperGit().fetch(http_cache_abspath, download_config)
+        self.assertEqual(get_transport(http_cache_abspath), b"")
+
+        # The stored capabilities are used. With 'refresh' all capabilities
+        # are tried again.
+        git_config_set("protocol.version", b"2", cwd=cache_abspath)
+        git_config_set("subpatch.transport", b"", cwd=cache_abspath)
+        download_config = DownloadConfig(url="upstream", revision="v1")
+        CacheHelperGit().fetch(cache_abspath, download_config)
+        self.assertEqual(get_transport(), b"")
+        CacheHelperGit(refresh=True).fetch(cache_abspath, download_config)
+        self.assertEqual(get_transport(), b"shallow fetch-by-object-id filter")
+
+    def test_missing_superproject_objects(self):
+        with create_and_chdir("upstream"):
+            git = Git()
+            git.init()
+            touch("big", b"big" * 1000)
+            git.add("big")
+            git.commit("first commit")
+            first_id = git.get_sha1("HEAD")
+            big_blob_id = git.get_sha1("HEAD:big")
+            touch("small", b"small")
+            git.add("small")
+            git.commit("second commit")
+            second_id = git.get_sha1("HEAD")
+
+        cache_helper = CacheHelperGit()
+
+        # Returns a cache that misses the big blob, because the superproject
+        # has removed it.
+        def create_broken_cache(name, download_config):
+            # The superproject contains the first commit. git uses the refs
+            # of the alternate as the 'have' commits in the negotiation.
+            super_abspath = abspath(name + b"-superproject")
+            git.call(["init", "-q", super_abspath])
+            git.call(["-C", super_abspath, "fetch", "-q", abspath("upstream"), first_id.decode("ascii")])
+            git.call(["-C", super_abspath, "update-ref", "refs/keep", first_id])
+
+            cache_abspath = abspath(name)
+            mkdir(cache_abspath)
+            cache_helper.create(cache_abspath)
+            cache_helper.use_superproject_objects(cache_abspath, join(super_abspath, b".git/objects"))
+            self.assertEqual(cache_helper.fetch(cache_abspath, download_config), second_id)
+
+            # The superproject removes the objects, e.g. by "git gc". The
+            # blob was not downloaded into the cache.
+            git.call(["-C", super_abspath, "update-ref", "-d", "refs/keep"])
+            git.call(["-C", super_abspath, "gc", "-q", "--prune=now"])
+            self.assertEqual(git_rev_list_missing(second_id + b"^{tree}", cwd=cache_abspath), [big_blob_id])
+            return cache_abspath
+
+        # The cache is created again without the superproject objects
+        download_config = DownloadConfig(url="upstream", revision="master")
+        cache_abspath = create_broken_cache(b"cache", download_config)
+        self.assertEqual(cache_helper.fetch(cache_abspath, download_config), second_id)
+        self.assertFalse(os.path.isfile(join(cache_abspath, b"objects/info/alternates")))
+        self.assertTrue(git_verify(big_blob_id, cwd=cache_abspath))
+
+        # A partial clone fetches the missing blob from the remote
+        with chdir("upstream"):
+            git.call(["config", "uploadpack.allowFilter", "true"])
+        download_config = DownloadConfig(url="upstream", revision="master", integrated_object_id=first_id)
+        cache_abspath = create_broken_cache(b"partial-cache", download_config)
+        self.assertEqual(cache_helper.fetch(cache_abspath, download_config), second_id)
+        self.assertTrue(os.path.isfile(join(cache_abspath, b"objects/info/alternates")))
+        self.assertEqual(git_rev_list_missing(second_id + b"^{tree}", cwd=cache_abspath), [])
+
+        # Also for the fetch of a new revision
+        with chdir("upstream"):
+            git.call(["config", "uploadpack.allowFilter", "false"])
+        download_config = DownloadConfig(url="upstream", revision="master")
+        cache_abspath = create_broken_cache(b"other-cache", download_config)
+        with chdir("upstream"):
+            touch("small", b"changed")
+            git.add("small")
+            git.commit("third commit")
+            third_id = git.get_sha1("HEAD")
+        self.assertEqual(cache_helper.fetch(cache_abspath, download_config), third_id)
+        self.assertFalse(os.path.isfile(join(cache_abspath, b"objects/info/alternates")))
+        self.assertEqual(git_rev_list_missing(third_id + b"^{tree}", cwd=cache_abspath), [])
+
+    def test_bundle(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+            git = Git()
+            tag_id = git.get_sha1("v1")
+
+        cache_helper = CacheHelperGit()
+        cache_abspath = abspath(b"cache")
+        mkdir(cache_abspath)
+        cache_helper.create(cache_abspath)
+        object_id = cache_helper.fetch(cache_abspath, DownloadConfig("upstream", "v1"))
+        self.assertEqual(object_id, tag_id)
+        cache_helper.export_bundle(cache_abspath, abspath(b"v1.bundle"), "v1", object_id)
+
+        other_cache_abspath = abspath(b"other-cache")
+        mkdir(other_cache_abspath)
+        cache_helper.create(other_cache_abspath)
+        download_config = DownloadConfig("does-not-exist", "v1", bundle_path=abspath(b"v1.bundle"))
+        self.assertEqual(cache_helper.resolve(download_config).ref, b"refs/tags/v1")
+        object_id = cache_helper.fetch(other_cache_abspath, download_config)
+        self.assertEqual(object_id, tag_id)
+        with chdir(other_cache_abspath):
+            self.assertTrue(git.object_exists(tag_id + b"^{tree}"))
+
+        # The object id of the tag is also valid
+        download_config = DownloadConfig("does-not-exist", tag_id.decode("ascii"), bundle_path=abspath(b"v1.bundle"))
+        self.assertEqual(cache_helper.fetch(other_cache_abspath, download_config), tag_id)
+
+    def test_resolve(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+            git = Git()
+            head_id = git.get_sha1("HEAD")
+            tag_id = git.get_sha1("v1")
+
+        cache_helper = CacheHelperGit()
+        clone_config = cache_helper.resolve(DownloadConfig("upstream", "v1"))
+        self.assertEqual(clone_config.ref, b"refs/tags/v1")
+        self.assertEqual(clone_config.remote_object_id, tag_id)
+
+        clone_config = cache_helper.resolve(DownloadConfig("upstream"))
+        self.assertTrue(clone_config.full_clone)
+        self.assertEqual(clone_config.remote_object_id, head_id)
+
+        clone_config = cache_helper.resolve(DownloadConfig("upstream", tag_id.decode("ascii")))
+        self.assertEqual(clone_config.remote_object_id, tag_id)
+
+    def test_extract(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+
+        cache_helper = CacheHelperGit()
+        cache_abspath = abspath(b"cache")
+        mkdir(cache_abspath)
+        cache_helper.create(cache_abspath)
+        object_id = cache_helper.fetch(cache_abspath, DownloadConfig("upstream", "v1"))
+
+        with create_and_chdir("super"):
+            git = Git()
+            git.init()
+            super_abspath = abspath(b".")
+
+        # The cache is persistent. Extracting multiple times must work.
+        for _ in range(2):
+            tree_id = cache_helper.extract(cache_abspath, object_id, super_abspath)
+            with chdir(super_abspath):
+                self.assertTrue(git.object_exists(tree_id))
+                self.assertTrue(git_cat_file_pretty(tree_id).endswith(b"\tfile\n"))
+
+
+def create_tar(path: str, files: list[tuple[str, bytes, int]], mode: str = "w:gz") -> None:
+    with tarfile.open(path, mode) as tar:
+        for name, data, file_mode in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = file_mode
+            tar.addfile(info, io.BytesIO(data))
+
+
+class TestCacheHelperArchive(TestCaseTempFolder, TestCaseHelper):
+    def create_cache_and_super(self) -> tuple[bytes, bytes]:
+        cache_abspath = abspath(b"cache")
+        mkdir(cache_abspath)
+        CacheHelperArchive().create(cache_abspath)
+        with create_and_chdir("super"):
+            Git().init()
+        return cache_abspath, abspath(b"super")
+
+    def test_get_cache_helper(self):
+        self.assertIsInstance(get_cache_helper("https://example.com/foo-1.0.tar.gz"), CacheHelperArchive)
+        self.assertIsInstance(get_cache_helper("../foo.zip"), CacheHelperArchive)
+        self.assertIsInstance(get_cache_helper("https://example.com/foo.git"), CacheHelperGit)
+
+    def test_fetch_and_extract_tar(self):
+        create_tar("foo-1.0.tar.xz", [("foo-1.0/a", b"a", 0o644),
+                                      ("foo-1.0/bin/run", b"#!/bin/sh\n", 0o755),
+                                      ("foo-1.0/src/b/c", b"c", 0o644)], mode="w:xz")
+        with open("foo-1.0.tar.xz", "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest().encode("ascii")
+
+        cache_helper = CacheHelperArchive()
+        cache_abspath, super_abspath = self.create_cache_and_super()
+        object_id = cache_helper.fetch(cache_abspath, DownloadConfig("foo-1.0.tar.xz"))
+        self.assertEqual(object_id, checksum)
+        self.assertFileExists(join(cache_abspath, b"archives", checksum + b".tar.xz"))
+
+        # The toplevel directory is stripped
+        tree_id = cache_helper.extract(cache_abspath, object_id, super_abspath)
+        with chdir(super_abspath):
+            p = Git().call(["ls-tree", "-r", "--format=%(objectmode) %(path)", tree_id], capture_stdout=True)
+            self.assertEqual(p.stdout, b"100644 a\n100755 bin/run\n100644 src/b/c\n")
+
+    def test_pinned_checksum(self):
+        create_tar("foo.tar.gz", [("a", b"a", 0o644)])
+        with open("foo.tar.gz", "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+
+        cache_helper = CacheHelperArchive()
+        cache_abspath, _ = self.create_cache_and_super()
+        self.assertEqual(cache_helper.fetch(cache_abspath, DownloadConfig("foo.tar.gz", checksum)),
+                         checksum.encode("ascii"))
+
+        with self.assertRaises(AppException) as context:
+            cache_helper.fetch(cache_abspath, DownloadConfig("foo.tar.gz", "0" * 64))
+        self.assertEqual(str(context.exception),
+                         "The checksum of the archive is '%s', but '%s' is expected!" % (checksum, "0" * 64))
+
+        with self.assertRaises(AppException) as context:
+            cache_helper.fetch(cache_abspath, DownloadConfig("foo.tar.gz", "v1"))
+        self.assertEqual(str(context.exception), "The revision of an archive must be its SHA-256 checksum, but it's 'v1'!")
+
+    def test_zip(self):
+        with zipfile.ZipFile("foo.zip", "w") as zip_file:
+            zip_file.writestr("dir/file", b"content")
+            zip_file.writestr("other", b"other")
+
+        cache_helper = CacheHelperArchive()
+        cache_abspath, super_abspath = self.create_cache_and_super()
+        object_id = cache_helper.fetch(cache_abspath, DownloadConfig("foo.zip"))
+        tree_id = cache_helper.extract(cache_abspath, object_id, super_abspath, subdir=b"dir")
+        with chdir(super_abspath):
+            self.assertEqual(git_cat_file_pretty(tree_id),
+                             b"100644 blob 6b584e8ece562ebffc15d38808cd6b98fc3d97ea\tfile\n")
+
+    def test_invalid_path(self):
+        create_tar("evil.tar", [("../evil", b"evil", 0o644)], mode="w")
+
+        cache_helper = CacheHelperArchive()
+        cache_abspath, super_abspath = self.create_cache_and_super()
+        object_id = cache_helper.fetch(cache_abspath, DownloadConfig("evil.tar"))
+        with self.assertRaises(AppException) as context:
+            cache_helper.extract(cache_abspath, object_id, super_abspath)
+        self.assertEqual(str(context.exception), "The archive contains an invalid path '../evil'!")
+
+
+class TestCacheKey(TestCaseTempFolder):
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url("https://example.com/repo/"), "https://example.com/repo")
+        self.assertEqual(normalize_url("https://example.com/repo"), "https://example.com/repo")
+        self.assertEqual(normalize_url("../a/./repo"), abspath("../a/repo"))
+        self.assertEqual(normalize_url("/a/../repo/"), "/repo")
+
+    def test_get_cache_key(self):
+        self.assertEqual(get_cache_key("repo"), get_cache_key("./repo/"))
+        self.assertNotEqual(get_cache_key("repo"), get_cache_key("other"))
+        self.assertEqual(len(get_cache_key("https://example.com/repo")), 40)
+
+
+class TestEvictCaches(TestCaseTempFolder, TestCaseHelper):
+    def test_evict_caches(self):
+        root_abspath = abspath(b"root")
+        paths = [join(root_abspath, key) for key in (b"a" * 40, b"b" * 40, b"c" * 40)]
+        for i, path in enumerate(paths):
+            os.makedirs(path)
+            with open(join(path, b"data"), "wb") as f:
+                f.write(b"x" * 100)
+            mark_cache_used(path)
+            # The first cache is the least recently used
+            os.utime(join(path, b"subpatch-last-use"), (1000 + i, 1000 + i))
+        with open(paths[0] + b".refs", "wb"):
+            pass
+        # Other files are not caches
+        os.makedirs(join(root_abspath, b"other"))
+
+        self.assertEqual(list_caches(root_abspath), paths)
+        self.assertEqual(evict_caches(root_abspath, 300), [])
+
+        # The first cache is kept. So the second one is removed.
+        self.assertEqual(evict_caches(root_abspath, 250, keep=[paths[0]]), [(paths[1], 100)])
+        self.assertEqual(list_caches(root_abspath), [paths[0], paths[2]])
+
+        self.assertEqual(evict_caches(root_abspath, 100), [(paths[0], 100)])
+        self.assertEqual(list_caches(root_abspath), [paths[2]])
+        self.assertFileDoesNotExist(paths[0] + b".refs")
+
+        self.assertEqual(evict_caches(abspath(b"does-not-exist"), 0), [])
+
+
+class TestCacheLock(TestCaseTempFolder):
+    def test_lock(self):
+        cache_abspath = join(abspath(b"root"), b"a" * 40)
+        lock = CacheLock(cache_abspath)
+        self.assertTrue(lock.acquire())
+        with open(cache_abspath + b".lock", "rb") as f:
+            self.assertTrue(f.read().startswith(b"pid %d on " % (os.getpid(),)))
+
+        # The lock is exclusive. Also for the same process.
+        other_lock = CacheLock(cache_abspath, timeout=0.2)
+        self.assertFalse(other_lock.acquire(blocking=False))
+        with self.assertRaises(AppException) as context:
+            other_lock.acquire()
+        self.assertIn("Timeout while waiting for the lock", str(context.exception))
+        self.assertIn("It's held by 'pid %d on " % (os.getpid(),), str(context.exception))
+
+        # A left over lock file is reused
+        lock.release()
+        with other_lock:
+            self.assertFalse(lock.acquire(blocking=False))
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+        # Locked caches are not removed
+        os.makedirs(cache_abspath)
+        with lock:
+            self.assertEqual(evict_caches(abspath(b"root"), 0), [])
+
+    def test_lock_caches(self):
+        cache_a = join(abspath(b"root"), b"a" * 40)
+        cache_b = join(abspath(b"root"), b"b" * 40)
+        # The same cache can be given multiple times
+        with lock_caches([cache_b, cache_a, cache_b]):
+            self.assertFalse(CacheLock(cache_a).acquire(blocking=False))
+            self.assertFalse(CacheLock(cache_b).acquire(blocking=False))
+
+        with CacheLock(cache_b):
+            # Already taken locks are released, if a later lock fails
+            with self.assertRaises(AppException):
+                with lock_caches([cache_a, cache_b], timeout=0.2):
+                    pass
+            lock = CacheLock(cache_a)
+            self.assertTrue(lock.acquire(blocking=False))
+            lock.release()
+
+
+class TestRefsCache(TestCaseTempFolder):
+    def test_resolve(self):
+        calls = []
+
+        def query():
+            calls.append(1)
+            return b"refs/heads/main", b"a" * 40
+
+        cache = RefsCache(abspath(b"cache"), 60)
+        self.assertEqual(cache.resolve("url", "main", query), (b"refs/heads/main", b"a" * 40))
+        self.assertEqual(cache.resolve("url", "main", query), (b"refs/heads/main", b"a" * 40))
+        self.assertEqual(len(calls), 1)
+
+        # Other revisions and other urls are not cached yet
+        cache.resolve("url", None, query)
+        cache.resolve("other-url", "main", query)
+        self.assertEqual(len(calls), 3)
+
+        # Refresh ignores the cached result
+        RefsCache(abspath(b"cache"), 60, refresh=True).resolve("url", "main", query)
+        self.assertEqual(len(calls), 4)
+
+        # TTL of zero disables the cache
+        RefsCache(abspath(b"cache"), 0).resolve("url", "main", query)
+        self.assertEqual(len(calls), 5)
+
+    def test_negative_results_are_not_cached(self):
+        calls = []
+
+        def query():
+            calls.append(1)
+            return None
+
+        cache = RefsCache(abspath(b"cache"), 60)
+        self.assertIsNone(cache.resolve("url", "main", query))
+        self.assertIsNone(cache.resolve("url", "main", query))
+        self.assertEqual(len(calls), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
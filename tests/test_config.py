@@ -9,11 +9,12 @@ from os.path import dirname, join, realpath
 path = realpath(__file__)
 sys.path.append(join(dirname(path), "../"))
 
-from src.libconfig import (ConfigLine, LineDataEmpty, LineDataHeader,
+from src.libconfig import (ConfigDocument, ConfigLine, LineDataEmpty, LineDataHeader,
                            LineDataKeyValue, LineType, config_add_section2,
                            config_drop_key2, config_drop_section_if_empty,
-                           config_parse2, config_set_key_value2, config_unparse2,
-                           split_with_ts, split_with_ts_bytes)
+                           config_parse2, config_parse_sections_and_keys,
+                           config_scan, config_set_key_value2, config_unparse2,
+                           split_with_ts, split_with_ts_bytes, split_with_ts_offsets)
 
 
 class TestSplitWithTs(unittest.TestCase):
@@ -33,6 +34,13 @@ class TestSplitWithTs(unittest.TestCase):
         self.assertEqual([b"x\n", b"y"], list(split_with_ts_bytes(b"x\ny")))
         self.assertEqual([b"x\n", b"y\n"], list(split_with_ts_bytes(b"x\ny\n")))
 
+    def test_split_with_ts_offsets(self):
+        self.assertEqual([], list(split_with_ts_offsets(b"")))
+        self.assertEqual([(0, 1)], list(split_with_ts_offsets(b"\n")))
+        self.assertEqual([(0, 1)], list(split_with_ts_offsets(b"x")))
+        self.assertEqual([(0, 2), (2, 1)], list(split_with_ts_offsets(b"x\ny")))
+        self.assertEqual([(0, 2), (2, 3)], list(split_with_ts_offsets(b"x\nyz\n")))
+
 
 class TestConfigParse2(unittest.TestCase):
     def compare(self, config, config_lines_expected):
@@ -73,6 +81,32 @@ key=value
 """)
 
 
+class TestConfigScan(unittest.TestCase):
+    def test_scan(self):
+        config = b"""\
+# comment
+ \t
+[name]
+\tkey = value
+ ; comment"""
+        self.assertEqual(list(config_scan(config)), [(0, 10, LineType.COMMENT),
+                                                     (10, 3, LineType.EMPTY),
+                                                     (13, 7, LineType.HEADER),
+                                                     (20, 13, LineType.KEY_VALUE),
+                                                     (33, 10, LineType.COMMENT)])
+
+    def test_parse_sections_and_keys(self):
+        config = b"""\
+# comment
+
+[name]
+\tkey = value
+"""
+        self.assertEqual(list(config_parse_sections_and_keys(config)),
+                         [ConfigLine(b"[name]\n", LineType.HEADER, LineDataHeader(b"name", None)),
+                          ConfigLine(b"\tkey = value\n", LineType.KEY_VALUE, LineDataKeyValue(b"key", b"value"))])
+
+
 class TestConfigDropKey(unittest.TestCase):
     def compare(self, section, key, config, config_expected):
         config_lines = config_parse2(split_with_ts_bytes(config))
@@ -278,5 +312,159 @@ class TestConfigAddSection2(unittest.TestCase):
 """)
 
 
+class TestConfigDocument(unittest.TestCase):
+    def test_unparse(self):
+        config = b"""\
+# comment
+[a]
+\tkey = value
+[b "sub"]
+
+\tkey = value
+"""
+        self.assertEqual(ConfigDocument(config).unparse(), config)
+        self.assertEqual(ConfigDocument().unparse(), b"")
+
+    def test_get_values(self):
+        document = ConfigDocument(b"""\
+[a]
+key = 1
+[b]
+key = 2
+[a]
+key = 3
+""")
+        self.assertTrue(document.has_section(b"a"))
+        self.assertFalse(document.has_section(b"c"))
+        self.assertEqual(document.get_values(b"a", b"key"), [b"1", b"3"])
+        self.assertEqual(document.get_values(b"a", b"other"), [])
+        self.assertEqual(document.get_values(b"c", b"key"), [])
+
+    def test_add_section(self):
+        document = ConfigDocument(b"""\
+[a]
+[c]
+""")
+        document.add_section(b"b")
+        document.add_section(b"a")
+        document.add_section(b"d")
+        self.assertEqual(document.unparse(), b"""\
+[a]
+[b]
+[c]
+[d]
+""")
+
+    def test_set_key_value(self):
+        document = ConfigDocument(b"""\
+[a]
+[b]
+a = 1
+c = 3
+[c]
+""")
+        document.set_key_value(b"b", b"b", b"2")
+        self.assertEqual(document.unparse(), b"""\
+[a]
+[b]
+a = 1
+\tb = 2
+c = 3
+[c]
+""")
+        with self.assertRaises(Exception):
+            document.set_key_value(b"d", b"key", b"value")
+
+    def test_set_key_value_replace(self):
+        document = ConfigDocument(b"""\
+[section]
+a = 1
+key = 1
+key = 2
+c = 3
+""")
+        document.set_key_value(b"section", b"key", b"3")
+        self.assertEqual(document.unparse(), b"""\
+[section]
+a = 1
+\tkey = 3
+c = 3
+""")
+
+    def test_set_key_value_append(self):
+        document = ConfigDocument(b"""\
+[section]
+key = 1
+key = 3
+""")
+        document.set_key_value(b"section", b"key", b"2", append=True)
+        document.set_key_value(b"section", b"key", b"3", append=True)
+        self.assertEqual(document.get_values(b"section", b"key"), [b"1", b"2", b"3", b"3"])
+
+    def test_unsorted_section(self):
+        # Files written by hand may not be sorted. The keys are still found.
+        document = ConfigDocument(b"""\
+[section]
+c = 3
+a = 1
+c = 4
+""")
+        self.assertEqual(document.get_values(b"section", b"c"), [b"3", b"4"])
+        document.set_key_value(b"section", b"b", b"2")
+        document.set_key_value(b"section", b"c", b"5")
+        self.assertEqual(document.unparse(), b"""\
+[section]
+\tb = 2
+\tc = 5
+a = 1
+""")
+
+    def test_drop_keeps_other_lines(self):
+        document = ConfigDocument(b"""\
+[section]
+# leading comment
+a = 1
+# comment after a
+b = 2
+# comment after b
+c = 3
+""")
+        document.drop_key(b"section", b"b")
+        document.drop_key(b"section", b"a")
+        self.assertEqual(document.unparse(), b"""\
+[section]
+# leading comment
+# comment after a
+# comment after b
+c = 3
+""")
+
+    def test_multiple_modifications(self):
+        document = ConfigDocument()
+        document.add_section(b"upstream")
+        document.set_key_value(b"upstream", b"url", b"http://localhost/")
+        document.set_key_value(b"upstream", b"revision", b"main")
+        document.add_section(b"subtree")
+        document.set_key_value(b"subtree", b"appliedIndex", b"0")
+        document.set_key_value(b"upstream", b"url", b"http://localhost/other")
+        self.assertEqual(document.unparse(), b"""\
+[subtree]
+\tappliedIndex = 0
+[upstream]
+\trevision = main
+\turl = http://localhost/other
+""")
+
+        document.drop_key(b"subtree", b"appliedIndex")
+        document.drop_section_if_empty(b"subtree")
+        document.drop_section_if_empty(b"upstream")
+        self.assertFalse(document.has_section(b"subtree"))
+        self.assertEqual(document.unparse(), b"""\
+[upstream]
+\trevision = main
+\turl = http://localhost/other
+""")
+
+
 if __name__ == '__main__':
     unittest.main()
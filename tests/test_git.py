@@ -5,6 +5,7 @@
 import os
 import sys
 import unittest
+from subprocess import PIPE, Popen
 from contextlib import chdir
 from os.path import dirname, join, realpath
 
@@ -21,7 +22,14 @@ from src.libgit import (ObjectType, get_name_from_repository_url, git_diff_in_di
                         git_ls_remote_guess_ref, git_ls_tree_in_dir, git_verify,
                         is_sha1, is_valid_revision, parse_sha1_names, parse_z,
                         git_hash_object_tree, git_cat_file_pretty, git_ls_files,
-                        git_diff_relative, git_diff_staged_shortstat)
+                        git_diff_relative, git_diff_staged_shortstat,
+                        git_update_index_remove, GitObjectReader, ObjectInfo,
+                        TreeEntry, GitObjectWriter, hash_object, parse_tree_object,
+                        serialize_tree_object, sort_tree_entries, git_read_index,
+                        index_get_tree_ids, git_status_porcelain_v2, StatusEntry,
+                        StatusType, git_config_get, git_config_set,
+                        git_get_object_reader, tree_remove_gitlinks,
+                        TransportInfo, downgrade_transport)
 
 
 class TestGit(TestCaseTempFolder):
@@ -160,6 +168,12 @@ class TestGit(TestCaseTempFolder):
         self.assertEqual(b"e85c40dcd26466c0052323eb767d1a44ef0a12c1",
                          refs_sha1[b"refs/tags/v1.1"])
 
+        # Only the matching refs are returned
+        with chdir("remote"):
+            refs_sha1 = git_ls_remote(".", ["v1", "refs/heads/main"])
+        self.assertEqual([b'refs/heads/main', b'refs/tags/v1'],
+                         list(refs_sha1))
+
     def test_ls_files(self):
         git = Git()
         git.init()
@@ -214,14 +228,52 @@ dddddddddddddddddddddddddddddddddddddddd\trefs/tags/v0.1a2^{}
         with create_and_chdir("remote"):
             create_git_repo_with_branches_and_tags()
 
-            self.assertEqual(b"refs/heads/main",
+            sha1_main = b"449e289b617c25c95868658a580b6c52fb817f4d"
+            sha1_v1 = b"20650350f66b12d5c34194a90c5b0a6e2771e8a5"
+            self.assertEqual((b"refs/heads/main", sha1_main),
                              git_ls_remote_guess_ref(".", "main"))
-            self.assertEqual(b"refs/heads/main",
+            self.assertEqual((b"refs/heads/main", sha1_main),
                              git_ls_remote_guess_ref(".", "refs/heads/main"))
-            self.assertEqual(b"refs/tags/v1",
+            self.assertEqual((b"refs/tags/v1", sha1_v1),
                              git_ls_remote_guess_ref(".", "v1"))
             self.assertEqual(None, git_ls_remote_guess_ref(".", "v3"))
 
+    def test_git_ls_remote_guess_ref_ref_prefixes(self):
+        with create_and_chdir("remote"):
+            create_git_repo_with_branches_and_tags()
+            # Like the refs of pull requests on a code review system
+            git = Git()
+            git.call(["update-ref", "refs/pull/1/head", "HEAD"])
+
+        def get_trace_lines(ref_str):
+            trace_path = realpath("trace")
+            env = dict(os.environ)
+            os.environ["GIT_TRACE_PACKET"] = trace_path
+            try:
+                ref_resolved = git_ls_remote_guess_ref("file://" + realpath("remote"), ref_str)
+            finally:
+                os.environ.clear()
+                os.environ.update(env)
+            with open(trace_path, "rb") as f:
+                trace = f.read()
+            os.remove(trace_path)
+            return ref_resolved, trace
+
+        # For a short name only the heads and tags prefixes are sent to the
+        # remote. The remote does not advertise other refs.
+        ref_resolved, trace = get_trace_lines("main")
+        self.assertEqual(b"refs/heads/main", ref_resolved[0])
+        self.assertIn(b"version 2", trace)
+        ref_prefixes = [line.split(b"ref-prefix ")[1] for line in trace.splitlines()
+                        if b"ls-remote> ref-prefix " in line]
+        self.assertEqual([b"refs/heads/", b"refs/tags/"], sorted(ref_prefixes))
+        self.assertNotIn(b"refs/pull/1/head", trace)
+
+        # A full ref name is not filtered by the prefixes
+        ref_resolved, trace = get_trace_lines("refs/pull/1/head")
+        self.assertEqual(b"refs/pull/1/head", ref_resolved[0])
+        self.assertNotIn(b"ref-prefix", trace)
+
     def test_git_verify(self):
         # TODO Exception should be replaced with a git specifc exception
         self.assertRaises(Exception, git_verify, "main")
@@ -262,6 +314,15 @@ dddddddddddddddddddddddddddddddddddddddd\trefs/tags/v0.1a2^{}
         self.assertEqual([], git_diff_name_only())
         self.assertEqual([b"a", b"b/c"], git_diff_name_only(staged=True))
 
+    def test_downgrade_transport(self):
+        transport = TransportInfo(shallow=True, fetch_by_object_id=True, filter=True)
+        self.assertEqual(downgrade_transport(transport, b"fatal: couldn't find remote ref refs/heads/gone\n"),
+                         transport)
+        self.assertEqual(downgrade_transport(transport, b"fatal: remote error: upload-pack: not our ref 1234\n"),
+                         TransportInfo(shallow=True, fetch_by_object_id=False, filter=True))
+        self.assertEqual(downgrade_transport(transport, b"fatal: dumb http transport does not support shallow capabilities\n"),
+                         TransportInfo(shallow=False, fetch_by_object_id=False, filter=False))
+
     def test_git_ls_files_untracked(self):
         git = Git()
         git.init()
@@ -391,6 +452,24 @@ dddddddddddddddddddddddddddddddddddddddd\trefs/tags/v0.1a2^{}
             self.assertEqual([b"dir/a"], git_ls_tree_in_dir(b"dir"))
             self.assertEqual([], git_ls_tree_in_dir(b"does-not-exists-dir"))
 
+    def test_git_update_index_remove(self):
+        git = Git()
+        git.init()
+
+        mkdir("dir")
+        touch("dir/a")
+        touch("dir/b")
+        touch("c")
+        git.add("dir")
+        git.add("c")
+        git.commit("add files")
+
+        git_update_index_remove([])
+        git_update_index_remove([b"a"], cwd=b"dir")
+        self.assertEqual(git.diff_staged_files(), [b"D\tdir/a"])
+        # The working tree is not touched
+        self.assertTrue(os.path.isfile("dir/a"))
+
     def test_git_get_sha1(self):
         git = Git()
         git.init()
@@ -648,6 +727,178 @@ class TestGitHashObjectTree(TestCaseTempFolder, TestCaseHelper):
                          b"040000 tree 4b825dc642cb6eb9a060e54bf8d69288fbee4904\ta\n")
 
 
+class TestGitTreeCodec(TestCaseTempFolder):
+    def test_sort_serialize_and_parse(self):
+        blob = b"bf252b96c379a66383f5ac9b605b1633bd39362e"
+        tree = b"4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+        entries = [TreeEntry(b"100644", ObjectType.BLOB, blob, b"a.c"),
+                   TreeEntry(b"40000", ObjectType.TREE, tree, b"a"),
+                   TreeEntry(b"100644", ObjectType.BLOB, blob, b"a-b")]
+        # Directories are sorted as "a/". So "a-b" < "a.c" < "a/"
+        entries = sort_tree_entries(entries)
+        self.assertEqual([entry.name for entry in entries], [b"a-b", b"a.c", b"a"])
+
+        tree_data = serialize_tree_object(entries)
+        self.assertEqual(parse_tree_object(tree_data), entries)
+
+    def test_hash_object(self):
+        self.assertEqual(hash_object(ObjectType.BLOB, b""), b"e69de29bb2d1d6434b8b29ae775ad8c2e48c5391")
+        self.assertEqual(hash_object(ObjectType.TREE, b""), b"4b825dc642cb6eb9a060e54bf8d69288fbee4904")
+
+    def test_writer(self):
+        git = Git()
+        git.init()
+
+        writer = GitObjectWriter()
+        # Sizes that need multi byte headers in the pack format
+        blob_ids = [writer.add(ObjectType.BLOB, b"x" * size) for size in (0, 15, 16, 5000, 100000)]
+        # Adding the same content twice is fine
+        self.assertEqual(writer.add(ObjectType.BLOB, b""), blob_ids[0])
+        for blob_id in blob_ids:
+            self.assertFalse(git.object_exists(blob_id))
+
+        writer.flush()
+        for blob_id, size in zip(blob_ids, (0, 15, 16, 5000, 100000)):
+            self.assertTrue(git.object_exists(blob_id))
+            self.assertEqual(git.cat_file(blob_id), b"x" * size)
+
+        # Writing existing objects again does nothing
+        writer.add(ObjectType.BLOB, b"x" * 15)
+        writer.flush()
+
+    def test_tree_remove_gitlinks(self):
+        git = Git()
+        git.init()
+        touch("file", b"content")
+        git.add("file")
+        git.commit("first commit")
+        commit_id = git.get_sha1("HEAD").decode("ascii")
+        tree_id = git.get_sha1("HEAD^{tree}")
+        reader = git_get_object_reader()
+        writer = GitObjectWriter()
+
+        # Nothing to remove
+        self.assertEqual(tree_remove_gitlinks(reader, writer, tree_id), tree_id)
+
+        git.call(["update-index", "--add", "--cacheinfo", "160000,%s,sub/smdir" % (commit_id,)])
+        git.call(["update-index", "--add", "--cacheinfo", "160000,%s,smtop" % (commit_id,)])
+        git.commit("add submodules")
+        # The directory "sub" is empty without the submodule
+        self.assertEqual(tree_remove_gitlinks(reader, writer, git.get_sha1("HEAD^{tree}")), tree_id)
+        self.assertIsNone(tree_remove_gitlinks(reader, writer, git.get_sha1("HEAD:sub")))
+
+
+class TestGitIndex(TestCaseTempFolder):
+    def write_tree(self, git, prefix):
+        return git.call(["write-tree", "--prefix=" + prefix], capture_stdout=True).stdout.rstrip(b"\n")
+
+    def create_repo(self):
+        git = Git()
+        git.init()
+        for path in ("a", "b/c", "b/d/e", "b/d/f", "b.x/g", "h/i"):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            touch(path, path.encode("ascii"))
+        git.add(".")
+        git.commit("add files")
+        return git
+
+    def test_empty(self):
+        git = Git()
+        git.init()
+        index = git_read_index()
+        self.assertEqual(index.entries, [])
+
+        writer = GitObjectWriter()
+        self.assertEqual(index_get_tree_ids(index, [b"dir"], writer),
+                         {b"dir": b"4b825dc642cb6eb9a060e54bf8d69288fbee4904"})
+
+    def test_versions(self):
+        git = self.create_repo()
+        # Change the index after the commit to invalidate parts of the
+        # cached-tree extension.
+        touch("b/d/e", b"changed")
+        git.add("b/d/e")
+        # Files that are only intended to be added are not part of the tree
+        touch("b/new")
+        git.call(["add", "-N", "b/new"])
+
+        # NOTE: Git keeps version 3 instead of 2, because the "intent to add"
+        # flag needs extended flags. The other tests use version 2.
+        for version in ("2", "3", "4"):
+            git.call(["update-index", "--index-version", version])
+            index = git_read_index()
+            self.assertEqual([e.path for e in index.entries],
+                             [b"a", b"b.x/g", b"b/c", b"b/d/e", b"b/d/f", b"b/new", b"h/i"])
+            self.assertEqual([e.intent_to_add for e in index.entries],
+                             [False, False, False, False, False, True, False])
+            self.assertNotIn(b"b", index.cache_tree)
+            self.assertIn(b"h", index.cache_tree)
+
+            writer = GitObjectWriter()
+            tree_ids = index_get_tree_ids(index, [b"", b"b", b"b/d", b"h"], writer)
+            writer.flush()
+            for path, tree_id in tree_ids.items():
+                self.assertEqual(tree_id, self.write_tree(git, path.decode("ascii")))
+                self.assertTrue(git.object_exists(tree_id))
+
+    def test_exclude_names(self):
+        git = self.create_repo()
+        index = git_read_index()
+        writer = GitObjectWriter()
+        tree_ids = index_get_tree_ids(index, [b"b"], writer, exclude_names=(b"c",))
+        writer.flush()
+        self.assertEqual(git_cat_file_pretty(tree_ids[b"b"]),
+                         b"040000 tree %s\td\n" % (self.write_tree(git, "b/d"),))
+
+    def test_unmerged_entries(self):
+        git = self.create_repo()
+        p = Popen(["git", "update-index", "--index-info"], stdin=PIPE)
+        p.communicate(b"100644 %s 1\tb/c\n" % (git.get_sha1("HEAD:a"),))
+        self.assertEqual(p.returncode, 0)
+        index = git_read_index()
+        self.assertIn(1, [e.stage for e in index.entries if e.path == b"b/c"])
+        self.assertRaises(Exception, index_get_tree_ids, index, [b"b"], GitObjectWriter())
+
+
+class TestGitStatus(TestCaseTempFolder):
+    def test_git_status_porcelain_v2(self):
+        git = Git()
+        git.init()
+        mkdir("dir")
+        touch("dir/a", b"a")
+        touch("dir/b with space", b"b")
+        touch("c", b"c")
+        git.add(".")
+        git.commit("add files")
+
+        touch("dir/a", b"changed")
+        git.call(["mv", "dir/b with space", "dir/renamed"])
+        touch("c", b"changed")
+        git.add("c")
+        touch("c", b"changed again")
+        mkdir("dir/untracked")
+        touch("dir/untracked/x")
+
+        self.assertEqual(list(git_status_porcelain_v2([])), [
+            StatusEntry(StatusType.CHANGED, b"MM", b"c"),
+            StatusEntry(StatusType.CHANGED, b".M", b"dir/a"),
+            StatusEntry(StatusType.RENAMED_OR_COPIED, b"R.", b"dir/renamed"),
+            StatusEntry(StatusType.UNTRACKED, None, b"dir/untracked/"),
+        ])
+        self.assertEqual(list(git_status_porcelain_v2([b"c"])), [
+            StatusEntry(StatusType.CHANGED, b"MM", b"c"),
+        ])
+
+
+class TestGitConfig(TestCaseTempFolder):
+    def test_git_config(self):
+        git = Git()
+        git.init()
+        self.assertIsNone(git_config_get("subpatch.test"))
+        git_config_set("subpatch.test", b"a b")
+        self.assertEqual(git_config_get("subpatch.test"), b"a b")
+
+
 class TestGitDiff(TestCaseTempFolder):
     @classmethod
     def setUp(cls):
@@ -715,6 +966,35 @@ index 0835e4f..49ab42f 100644
         self.assertEqual(git_diff_staged_shortstat(), b" 2 files changed, 2 insertions(+), 2 deletions(-)")
 
 
+class TestGitObjectReader(TestCaseTempFolder):
+    def test_reader(self):
+        reader = GitObjectReader(os.getcwdb())
+        # Not a git repository yet
+        self.assertRaises(Exception, reader.info, b"HEAD")
+
+        # The process is restarted after the failure
+        git = Git()
+        git.init()
+        mkdir("dir")
+        touch("dir/a", b"content")
+        touch("b")
+        git.add("dir/a")
+        git.add("b")
+        git.commit("add a and b")
+
+        self.assertEqual(reader.info(b"HEAD:dir/a"),
+                         ObjectInfo(b"6b584e8ece562ebffc15d38808cd6b98fc3d97ea", ObjectType.BLOB, 7))
+        self.assertEqual(reader.info(b"HEAD:does-not-exist"), None)
+        self.assertEqual(reader.info("00" * 20), None)
+        self.assertEqual(reader.contents(b"HEAD:dir/a"),
+                         (ObjectInfo(b"6b584e8ece562ebffc15d38808cd6b98fc3d97ea", ObjectType.BLOB, 7), b"content"))
+        self.assertEqual(reader.tree_entries(b"HEAD^{tree}"), [
+            TreeEntry(b"100644", ObjectType.BLOB, b"e69de29bb2d1d6434b8b29ae775ad8c2e48c5391", b"b"),
+            TreeEntry(b"40000", ObjectType.TREE, b"86ff0fb64bd3d140399bda2cdf26c85444a791db", b"dir")])
+        self.assertRaises(Exception, reader.tree_entries, b"HEAD")
+        reader.close()
+
+
 class TestGitCatFilePretty(TestCaseTempFolder):
     @classmethod
     def setUp(cls):
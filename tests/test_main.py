@@ -17,7 +17,9 @@ sys.path.append(join(dirname(path), "../src"))
 from util import AppException, ErrorCode
 from main import (config_add_subproject, gen_sub_paths_from_cwd_and_relpath,
                   gen_sub_paths_from_relpath, gen_super_paths, read_metadata,
-                  Metadata, checks_for_cmds_with_single_subproject)
+                  Metadata, checks_for_cmds_with_single_subproject,
+                  SubprojectIndex, metadata_transaction, read_config,
+                  read_subprojects_dims, PatchesDim, SubtreeDim, write_file_atomically)
 
 
 class TestReadMetadata(TestCaseTempFolder, TestCaseHelper):
@@ -44,6 +46,26 @@ class TestReadMetadata(TestCaseTempFolder, TestCaseHelper):
                                   b"-1",
                                   b"202864b6621f6ed6b9e81e558a05e02264b665f3"))
 
+    def test_parsed_once(self):
+        touch(".subproject", b"[upstream]\n\turl = a\n")
+        metadata = read_metadata(b".subproject")
+        self.assertIs(read_metadata(os.path.abspath(b".subproject")), metadata)
+
+        # Changes of other processes are detected
+        touch(".subproject", b"[upstream]\n\turl = bc\n")
+        self.assertEqual(read_metadata(b".subproject").url, b"bc")
+
+
+class TestReadConfig(TestCaseTempFolder, TestCaseHelper):
+    def test_own_writes(self):
+        touch(".subpatch", b"")
+        config = read_config(b".subpatch")
+        self.assertEqual(config.subprojects, [])
+        self.assertIs(read_config(b".subpatch"), config)
+
+        config_add_subproject(b".subpatch", b"a/b")
+        self.assertEqual(read_config(b".subpatch").subprojects, [b"a/b"])
+
 
 class TestConfigAddSubproject(TestCaseTempFolder, TestCaseHelper):
     def test_empty(self):
@@ -73,6 +95,105 @@ class TestConfigAddSubproject(TestCaseTempFolder, TestCaseHelper):
 """)
 
 
+class TestWriteFileAtomically(TestCaseTempFolder, TestCaseHelper):
+    def test_new_file(self):
+        write_file_atomically(b"file", b"content")
+        self.assertFileContent("file", b"content")
+        self.assertEqual(os.listdir("."), ["file"])
+
+    def test_keep_mode(self):
+        touch("file", b"old")
+        os.chmod("file", 0o600)
+        write_file_atomically(b"file", b"new")
+        self.assertFileContent("file", b"new")
+        self.assertEqual(os.stat("file").st_mode & 0o7777, 0o600)
+
+    def test_symbolic_link(self):
+        touch("target", b"old")
+        os.symlink("target", "link")
+        write_file_atomically(b"link", b"new")
+        self.assertTrue(os.path.islink("link"))
+        self.assertFileContent("target", b"new")
+
+
+class TestMetadataTransaction(TestCaseTempFolder, TestCaseHelper):
+    class SuperHelperRecorder:
+        def __init__(self):
+            self.added = []
+
+        def add(self, paths):
+            self.added.append(paths)
+
+    def test_single_write(self):
+        os.mkdir("sub")
+        touch("sub/.subproject", b"""\
+[subtree]
+\tappliedIndex = 0
+[upstream]
+\turl = http://localhost/
+""")
+        sub_paths = gen_sub_paths_from_relpath(gen_super_paths(os.getcwdb()), b"sub")
+        super_helper = self.SuperHelperRecorder()
+        with metadata_transaction(sub_paths, super_helper) as m:
+            m.set(b"upstream", b"revision", b"main")
+            m.drop(b"subtree", b"appliedIndex")
+            m.set(b"subtree", b"checksum", b"1234")
+            # Nothing is written before the end of the block
+            self.assertFileContent("sub/.subproject", b"""\
+[subtree]
+\tappliedIndex = 0
+[upstream]
+\turl = http://localhost/
+""")
+
+        self.assertFileContent("sub/.subproject", b"""\
+[subtree]
+\tchecksum = 1234
+[upstream]
+\trevision = main
+\turl = http://localhost/
+""")
+        self.assertEqual(super_helper.added, [[sub_paths.metadata_abspath]])
+        self.assertEqual(os.listdir("sub"), [".subproject"])
+
+    def test_exception(self):
+        os.mkdir("sub")
+        touch("sub/.subproject", b"")
+        sub_paths = gen_sub_paths_from_relpath(gen_super_paths(os.getcwdb()), b"sub")
+        super_helper = self.SuperHelperRecorder()
+        with self.assertRaises(ValueError):
+            with metadata_transaction(sub_paths, super_helper) as m:
+                m.set(b"upstream", b"url", b"http://localhost/")
+                raise ValueError()
+
+        self.assertFileContent("sub/.subproject", b"")
+        self.assertEqual(super_helper.added, [])
+
+
+class TestReadSubprojectsDims(TestCaseTempFolder):
+    def test_multiple_subprojects(self):
+        for i in range(3):
+            os.makedirs("sub%d/patches" % (i,))
+            touch("sub%d/.subproject" % (i,), b"[subtree]\n\tappliedIndex = %d\n" % (i - 1,))
+            for j in range(i):
+                touch("sub%d/patches/%04d.patch" % (i, j))
+        touch("sub2/patches/not-a-patch")
+
+        super_paths = gen_super_paths(os.getcwdb())
+        sub_paths_list = [gen_sub_paths_from_relpath(super_paths, b"sub%d" % (i,)) for i in range(3)]
+        dims = read_subprojects_dims(sub_paths_list)
+        self.assertEqual(list(dims.keys()), [b"sub0", b"sub1", b"sub2"])
+        self.assertEqual(dims[b"sub0"].subtree_dim, SubtreeDim(-1, b""))
+        self.assertEqual(dims[b"sub0"].patches_dim, PatchesDim([]))
+        self.assertEqual(dims[b"sub2"].metadata.subtree_applied_index, b"1")
+        self.assertEqual(dims[b"sub2"].patches_dim, PatchesDim([b"0000.patch", b"0001.patch"]))
+
+        os.remove("sub1/.subproject")
+        with self.assertRaises(AppException) as context:
+            read_subprojects_dims(sub_paths_list)
+        self.assertEqual(context.exception.get_code(), ErrorCode.INVALID_STATE)
+
+
 class TestGenSuperPaths(TestCaseTempFolder):
     def test_multiple_level_of_subdirectories(self):
         super_abspath = os.getcwdb()
@@ -101,6 +222,26 @@ class TestGenSuperPaths(TestCaseTempFolder):
             self.assertEqual(paths.super_to_cwd_relpath, b"sub1/sub2/sub3/sub4")
 
 
+class TestSubprojectIndex(TestCaseTempFolder):
+    def test_find_and_contains(self):
+        index = SubprojectIndex([b"subproject", b"subproject-second", b"dir/sub"])
+        self.assertEqual(index.find(b"subproject"), b"subproject")
+        self.assertEqual(index.find(b"subproject/"), b"subproject")
+        self.assertEqual(index.find(b"subproject/a/b"), b"subproject")
+        self.assertEqual(index.find(b"subproject-second/a"), b"subproject-second")
+        self.assertEqual(index.find(b"dir/sub/a/"), b"dir/sub")
+        self.assertEqual(index.find(b"dir"), None)
+        self.assertEqual(index.find(b"dir/"), None)
+        self.assertEqual(index.find(b"dir/other"), None)
+        self.assertEqual(index.find(b"sub"), None)
+
+        self.assertIn(b"subproject", index)
+        self.assertIn(b"dir/sub", index)
+        self.assertNotIn(b"dir", index)
+        self.assertNotIn(b"subproject/a", index)
+        self.assertNotIn(b"other", index)
+
+
 class TestChecksForCmdsWithSingleSubproject(TestCaseTempFolder):
     def test_two_subprojects_with_same_prefix(self):
         # TODO This test sets up the config and metadata files manually. There
@@ -143,6 +284,23 @@ class TestChecksForCmdsWithSingleSubproject(TestCaseTempFolder):
             self.assertEqual(super_paths.super_to_cwd_relpath, b"subproject-second/subdir")
             self.assertEqual(sub_paths.super_to_sub_relpath, b"subproject-second")
 
+    def test_cwd_is_parent_of_subproject(self):
+        touch(".subpatch", b"""\
+[subprojects]
+\tpath = dir/subproject
+""")
+        os.mkdir(".git")
+        os.makedirs("dir/subproject")
+        touch("dir/subproject/.subproject", b"")
+
+        with chdir("dir"):
+            with self.assertRaises(AppException) as context:
+                checks_for_cmds_with_single_subproject()
+            self.assertEqual(str(context.exception), "Current work directory must be inside a subproject!")
+        with chdir("dir/subproject"):
+            superx, super_paths, sub_paths = checks_for_cmds_with_single_subproject()
+            self.assertEqual(sub_paths.super_to_sub_relpath, b"dir/subproject")
+
 
 class TestGenSubPaths(TestCaseTempFolder):
     def test_gen_sub_paths_from_relpath(self):
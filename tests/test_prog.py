@@ -2,8 +2,13 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # SPDX-FileCopyrightText: Copyright (C) 2024 Stefan Lengfeld
 
+import fcntl
+import glob
+import hashlib
 import os
+import shutil
 import sys
+import tarfile
 import unittest
 from contextlib import chdir
 from copy import deepcopy
@@ -26,15 +31,13 @@ SUBPATCH_PATH = os.environ.get("TEST_BIN_PATH", join(dirname(path), "../src/main
 
 
 class TestSubpatch:
-    def run_subpatch(self, args, stderr=None, stdout=None, hack=False):
+    def run_subpatch(self, args, stderr=None, stdout=None, extra_env=None):
         if os.environ.get("DEBUG", "0") == "1":
             print("Running subpatch command: %s" % (args,), file=sys.stderr)
 
-        # TODO This hack is so bad. Variable/function names are bad and not
-        # nicly implemented
         env = deepcopy(os.environ)
-        if hack:
-            env["HACK_DISABLE_DEPTH_OPTIMIZATION"] = "1"
+        if extra_env is not None:
+            env.update(extra_env)
         p = Popen([SUBPATCH_PATH] + args, stdout=stdout, stderr=stderr, env=env)
         stdout_output, stderr_output = p.communicate()
         # TODO This overwrites a member variable!
@@ -53,6 +56,12 @@ class TestSubpatch:
         p.stderr = stderr_output
         return p
 
+    # Returns the paths of the caches in the superproject in the current work
+    # directory. The lock files next to the caches are skipped.
+    def get_cache_paths(self) -> list[bytes]:
+        root = b".git/subpatch-cache"
+        return sorted(join(root, name) for name in os.listdir(root) if os.path.isdir(join(root, name)))
+
     def run_subpatch_ok(self, args, stderr=None, stdout=None):
         p = self.run_subpatch(args, stderr=stderr, stdout=stdout)
         self.assertEqual(p.returncode, 0)
@@ -965,6 +974,127 @@ class TestCmdAdd(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
 \turl = ../upstream
 """)
 
+    def test_persistent_cache(self):
+        create_super_and_upstream()
+
+        with chdir("superproject"):
+            self.run_subpatch_ok(["add", "-q", "../upstream", "dirA"])
+            self.run_subpatch_ok(["add", "-q", "../upstream", "dirB"])
+
+            # Both subprojects share the same upstream URL. So there is only a
+            # single cache and it's not removed after the add.
+            self.assertEqual(len(self.get_cache_paths()), 1)
+            self.assertFileDoesNotExist("dirA/cache")
+            self.assertFileContent("dirB/hello", b"content")
+
+    def test_archive(self):
+        def create_archive(content):
+            with create_and_chdir("upstream-1.0"):
+                touch("file", content)
+            with tarfile.open("upstream-1.0.tar.gz", "w:gz") as tar:
+                tar.add("upstream-1.0")
+            shutil.rmtree("upstream-1.0")
+            with open("upstream-1.0.tar.gz", "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+
+        checksum = create_archive(b"first")
+
+        with LocalWebserver(7000, FileRequestHandler), create_and_chdir("superproject"):
+            git = Git()
+            git.init()
+            p = self.run_subpatch(["add", "../upstream-1.0.tar.gz"], stdout=PIPE)
+            self.assertEqual(p.returncode, 0)
+            self.assertIn(b"Adding subproject 'upstream-1.0' from URL '../upstream-1.0.tar.gz' at revision 'latest'... Done",
+                          p.stdout)
+            # The toplevel directory of the archive is stripped
+            self.assertFileContent("upstream-1.0/file", b"first")
+            self.assertIn(b"\tobjectId = %s\n" % (checksum.encode("ascii"),), git.cat_file(":upstream-1.0/.subproject"))
+            git.commit("add subproject")
+
+            # Archives can also be downloaded with HTTP. The webserver only
+            # listens on the IPv6 loopback address.
+            self.run_subpatch_ok(["add", "-q", "http://[::1]:7000/upstream-1.0.tar.gz", "from-http"])
+            self.assertFileContent("from-http/file", b"first")
+            git.commit("add second subproject")
+
+            with chdir(".."):
+                new_checksum = create_archive(b"second")
+
+            # The revision pins the checksum of the archive
+            p = self.run_subpatch(["update", "-q", "-r", "0" * 64, "upstream-1.0"], stderr=PIPE)
+            self.assertEqual(p.returncode, 4)
+            self.assertEqual(b"Error: Invalid argument: The checksum of the archive is '%s', but '%s' is expected!\n"
+                             % (new_checksum.encode("ascii"), b"0" * 64), p.stderr)
+
+            self.run_subpatch_ok(["update", "-q", "upstream-1.0"])
+            self.assertFileContent("upstream-1.0/file", b"second")
+
+            p = self.run_subpatch(["cache", "export-bundle", "upstream-1.0", "../bundle"], stderr=PIPE)
+            self.assertEqual(p.returncode, 4)
+            self.assertEqual(b"Error: Invalid argument: Bundles can only be used for git repositories!\n", p.stderr)
+
+    def test_subdir(self):
+        with create_and_chdir("upstream"):
+            git = Git()
+            git.init()
+            # Allow partial clones
+            git.call(["config", "uploadpack.allowFilter", "true"])
+            os.makedirs("a/b")
+            touch("a/b/file", b"content")
+            touch("other", b"other")
+            git.add("a/b/file")
+            git.add("other")
+            git.commit("first commit")
+            other_blob_id = git.get_sha1("HEAD:other")
+
+        with create_and_chdir("superproject"):
+            git = Git()
+            git.init()
+
+            p = self.run_subpatch(["add", "../upstream", "--subdir", "/a"], stderr=PIPE)
+            self.assertEqual(4, p.returncode)
+            self.assertEqual(b"Error: Invalid argument: subdir '/a' is invalid\n", p.stderr)
+
+            p = self.run_subpatch(["add", "../upstream", "--subdir", "does-not-exist"], stderr=PIPE)
+            self.assertEqual(4, p.returncode)
+            self.assertEqual(b"Error: Invalid argument: The subdirectory 'does-not-exist' does not exist in the upstream revision!\n",
+                             p.stderr)
+            git.remove_staged_changes()
+
+            self.run_subpatch_ok(["add", "-q", "../upstream", "--subdir", "a/"])
+            self.assertFileContent("upstream/b/file", b"content")
+            self.assertFileDoesNotExist("upstream/other")
+            self.assertIn(b"\tsubdir = a\n", git.cat_file(":upstream/.subproject"))
+
+            # Only the blobs of the subdirectory are downloaded
+            cache_path = self.get_cache_paths()[0]
+            # NOTE: "git cat-file -e" would fetch the missing blob lazily.
+            with chdir(cache_path):
+                p = git.call(["cat-file", "--batch-check=%(objectname)", "--batch-all-objects"], capture_stdout=True)
+                self.assertNotIn(other_blob_id, p.stdout.splitlines())
+            git.commit("add subproject")
+
+        with chdir("upstream"):
+            git = Git()
+            touch("a/b/file", b"new-content")
+            touch("other", b"new-other")
+            git.add("a/b/file")
+            git.add("other")
+            git.commit("second commit")
+
+        with chdir("superproject"):
+            # The subdirectory is taken from the metadata
+            self.run_subpatch_ok(["update", "-q", "upstream"])
+            self.assertFileContent("upstream/b/file", b"new-content")
+            self.assertFileDoesNotExist("upstream/other")
+
+            # An empty subdirectory integrates the whole repository again
+            self.run_subpatch_ok(["update", "-q", "upstream", "--subdir", ""])
+            self.assertFileContent("upstream/a/b/file", b"new-content")
+            self.assertFileContent("upstream/other", b"new-other")
+            self.assertFileDoesNotExist("upstream/b")
+            self.assertNotIn(b"subdir", git.cat_file(":upstream/.subproject"))
+
     def test_gitignore_in_subproject(self):
         # Testing for a bug. There was a "-f" missing for "git add".
         with create_and_chdir("upstream"):
@@ -1039,7 +1169,7 @@ class TestCmdAdd(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
             with create_and_chdir("subdir"):
                 # NOTE: This also tests that "/.git/" is not used as the local
                 # directory name.
-                p = self.run_subpatch(["add", "http://localhost:7000/upstream/.git/", "subproject"], stdout=PIPE, hack=True)
+                p = self.run_subpatch(["add", "http://localhost:7000/upstream/.git/", "subproject"], stdout=PIPE)
                 self.assertEqual(p.returncode, 0)
                 self.assertIn(b"Adding subproject 'subproject' from URL 'http://localhost:7000/upstream/.git/' "
                               b"at revision 'HEAD'... Done",
@@ -1089,6 +1219,30 @@ The following changes are recorded in the git index:
 \turl = ../upstream
 """)
 
+    def test_add_with_submodules_in_upstream(self):
+        create_super_and_upstream()
+        with chdir("upstream"):
+            git = Git()
+            # Gitlinks of submodules. One in a directory without other files.
+            commit_id = git.get_sha1("HEAD").decode("ascii")
+            git.call(["update-index", "--add", "--cacheinfo", "160000,%s,sub/smdir" % (commit_id,)])
+            git.call(["update-index", "--add", "--cacheinfo", "160000,%s,smtop" % (commit_id,)])
+            git.commit("add submodules")
+
+        with chdir("superproject"):
+            git = Git()
+            self.run_subpatch_ok(["add", "-q", "../upstream", "subproject"])
+
+            # The submodules are dropped. The subtree checksum is the same as
+            # without them.
+            self.assertEqual(git.diff_staged_files(),
+                             [b"A\t.subpatch",
+                              b"A\tsubproject/.subproject",
+                              b"A\tsubproject/hello"])
+            self.assertIn(b"\tchecksum = 202864b6621f6ed6b9e81e558a05e02264b665f3\n",
+                          git.call(["show", ":subproject/.subproject"], capture_stdout=True).stdout)
+            self.assertFalse(os.path.exists("subproject/sub"))
+
     def test_add_with_extra_path_but_empty(self):
         create_super_and_upstream()
         with chdir("superproject"):
@@ -1312,6 +1466,75 @@ The following changes are recorded in the git index:
             git.remove_staged_changes()
 
 
+class TestCmdCache(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
+    def test_gc(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+        shutil.copytree("upstream", "other")
+
+        with create_and_chdir("superproject"):
+            git = Git()
+            git.init()
+            self.run_subpatch_ok(["add", "-q", "../upstream", "subA"])
+            self.assertEqual(len(self.get_cache_paths()), 1)
+
+            # The cache of the other subproject is removed automatically. The
+            # cache that is used by the command is always kept.
+            p = self.run_subpatch(["add", "-q", "../other", "subB"], extra_env={"SUBPATCH_CACHE_MAX_SIZE": "1"})
+            self.assertEqual(0, p.returncode)
+            caches = self.get_cache_paths()
+            self.assertEqual(len(caches), 1)
+            self.assertTrue(os.path.isdir(join(caches[0], b"objects")))
+
+            # The last fetched revision is referenced. So "git gc" does not
+            # prune it.
+            with chdir(caches[0]):
+                p = git.call(["for-each-ref", "--format=%(refname)"], capture_stdout=True)
+                self.assertIn(b"refs/subpatch/fetched\n", p.stdout)
+
+            p = self.run_subpatch(["cache", "gc"], stdout=PIPE)
+            self.assertEqual(0, p.returncode)
+            self.assertRegex(p.stdout, b"^1 caches use [0-9]+ bytes\n$")
+
+            p = self.run_subpatch(["cache", "gc", "--max-size", "0"], stdout=PIPE)
+            self.assertEqual(0, p.returncode)
+            self.assertRegex(p.stdout, b"^Removed cache '%s' \\([0-9]+ bytes\\)\n0 caches use 0 bytes\n$"
+                             % (os.path.basename(caches[0]),))
+            self.assertEqual(self.get_cache_paths(), [])
+
+            p = self.run_subpatch(["cache", "gc", "--max-size", "1G"], stderr=PIPE)
+            self.assertEqual(4, p.returncode)
+            self.assertEqual(b"Error: Invalid argument: The maximum cache size must be a number of bytes, but it's '1G'\n",
+                             p.stderr)
+
+    def test_shared_cache_with_parallel_processes(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+
+        env = deepcopy(os.environ)
+        env["SUBPATCH_CACHE_DIR"] = os.path.abspath("cache")
+        processes = []
+        for i in range(4):
+            with create_and_chdir("superproject%d" % (i,)):
+                Git().init()
+                processes.append(Popen([SUBPATCH_PATH, "add", "-q", "../upstream", "subproject"], env=env,
+                                       stdout=DEVNULL, stderr=DEVNULL))
+        for i, p in enumerate(processes):
+            p.communicate()
+            self.assertEqual(0, p.returncode)
+            self.assertFileContent("superproject%d/subproject/file" % (i,), b"change on main")
+
+        # A process waits for the lock. If it's held too long, it's an error.
+        lock_paths = glob.glob("cache/*.lock")
+        self.assertEqual(len(lock_paths), 1)
+        with open(lock_paths[0], "rb") as f, chdir("superproject0"):
+            fcntl.flock(f, fcntl.LOCK_EX)
+            p = self.run_subpatch(["update", "-q", "-r", "v1", "subproject"], stderr=PIPE,
+                                  extra_env={"SUBPATCH_CACHE_DIR": env["SUBPATCH_CACHE_DIR"], "SUBPATCH_LOCK_TIMEOUT": "0.2"})
+            self.assertEqual(4, p.returncode)
+            self.assertIn(b"Error: Invalid state: Timeout while waiting for the lock", p.stderr)
+
+
 class TestCmdConfigure(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
     def test_subpatch_config_does_not_match_scm(self):
         git = Git()
@@ -1490,6 +1713,10 @@ class TestCmdSubtreeChecksum(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
             p = self.run_subpatch_ok(["subtree", "checksum", "--get"], stdout=PIPE)
             self.assertEqual(p.stdout, checksum_new)
 
+            # The metadata file is staged
+            p = git.call(["diff", "--name-only"], capture_stdout=True)
+            self.assertEqual(p.stdout, b"")
+
 
 class TestCmdUpdate(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
     def test_some_errors_cases(self):
@@ -1561,6 +1788,205 @@ class TestCmdUpdate(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
             self.assertFileExists("0001-add-extra-file.patch")
             git.call(["reset", "--hard", "HEAD^", "-q"])
 
+    def test_skip_unchanged_upstream(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+
+        with create_and_chdir("superproject"):
+            git = Git()
+            git.init()
+            self.run_subpatch_ok(["add", "-q", "-r", "main", "../upstream", "subproject"])
+            git.commit("add subproject")
+            shutil.rmtree(".git/subpatch-cache")
+
+            # The remote branch still points to the integrated commit. Nothing
+            # is fetched. So the cache is not created again.
+            p = self.run_subpatch(["update", "subproject"], stdout=PIPE)
+            self.assertEqual(0, p.returncode)
+            self.assertEqual(p.stdout, b"""\
+Updating subproject 'subproject' from URL '../upstream' to revision 'main'... Done.
+Note: There are no changes in the subproject. Nothing to commit!
+""")
+            self.assertFileDoesNotExist(".git/subpatch-cache")
+
+            # Changes in the subtree are reverted by the update
+            touch("subproject/file", b"local change")
+            git.add("subproject/file")
+            self.run_subpatch_ok(["update", "-q", "subproject"])
+            self.assertFileContent("subproject/file", b"change on main")
+            self.assertEqual(git.diff_staged_files(), [])
+
+        with chdir("upstream"):
+            git = Git()
+            touch("file", b"new change on main")
+            git.add("file")
+            git.commit("new change on main")
+
+        with chdir("superproject"):
+            git = Git()
+            self.run_subpatch_ok(["update", "-q", "subproject"])
+            self.assertFileContent("subproject/file", b"new change on main")
+
+    def test_fetch_only_new_objects(self):
+        with create_and_chdir("upstream"):
+            git = Git()
+            git.init()
+            # Allow partial clones
+            git.call(["config", "uploadpack.allowFilter", "true"])
+            touch("big", b"big" * 1000)
+            git.add("big")
+            git.commit("first commit")
+            git.tag("v1", "v1")
+            big_blob_id = git.get_sha1("HEAD:big")
+            touch("small", b"small")
+            git.add("small")
+            git.commit("second commit")
+
+        with create_and_chdir("superproject"):
+            git = Git()
+            git.init()
+            self.run_subpatch_ok(["add", "-q", "-r", "v1", "../upstream", "subproject"])
+            git.commit("add subproject")
+            # Start with an empty cache, e.g. in a new clone of the superproject.
+            shutil.rmtree(".git/subpatch-cache")
+
+            # NOTE: Keep all fetched objects in packs. Otherwise git does not
+            # write objects that already exist and the test cannot see what
+            # was downloaded.
+            p = self.run_subpatch(["update", "-q", "-r", "master", "subproject"],
+                                  extra_env={"GIT_CONFIG_COUNT": "1",
+                                             "GIT_CONFIG_KEY_0": "transfer.unpackLimit",
+                                             "GIT_CONFIG_VALUE_0": "1"})
+            self.assertEqual(0, p.returncode)
+            self.assertFileContent("subproject/small", b"small")
+            self.assertFileContent("subproject/big", b"big" * 1000)
+
+            # The object of the file "big" is in the superproject already. It
+            # was not downloaded into the cache again.
+            cache_path = self.get_cache_paths()[0]
+            self.assertFileContent(join(cache_path, b"objects/info/alternates"), b"../../../objects\n")
+            with chdir(join(cache_path, b"objects")):
+                object_ids = [prefix + name for prefix in os.listdir(b".") if len(prefix) == 2
+                              for name in os.listdir(prefix)]
+                for idx in glob.glob("pack/*.idx"):
+                    with open(idx, "rb") as f:
+                        p = Popen(["git", "show-index"], stdin=f, stdout=PIPE)
+                        stdout, _ = p.communicate()
+                    object_ids += [line.split(b" ")[1] for line in stdout.splitlines()]
+            self.assertGreater(len(object_ids), 0)
+            self.assertNotIn(big_blob_id, object_ids)
+
+    def test_from_bundle(self):
+        with create_and_chdir("upstream"):
+            create_git_repo_with_branches_and_tags()
+
+        with create_and_chdir("superproject"):
+            git = Git()
+            git.init()
+            self.run_subpatch_ok(["add", "-q", "-r", "v1", "../upstream", "subproject"])
+            git.commit("add subproject")
+
+            p = self.run_subpatch(["cache", "export-bundle", "subproject", "../v1.bundle"], stdout=PIPE)
+            self.assertEqual(0, p.returncode)
+            self.assertEqual(b"Exported subproject 'subproject' at revision 'v1' to bundle '../v1.bundle'.\n", p.stdout)
+
+            self.run_subpatch_ok(["update", "-q", "-r", "v1-stable", "subproject"])
+            git.commit("update subproject")
+            # Start with an empty cache. The revision is fetched again.
+            shutil.rmtree(".git/subpatch-cache")
+            self.run_subpatch_ok(["cache", "export-bundle", "-q", "subproject", "../stable.bundle"])
+
+        # The remote repository is not needed anymore
+        shutil.rmtree("upstream")
+
+        with create_and_chdir("other-superproject"):
+            git = Git()
+            git.init()
+
+            p = self.run_subpatch(["add", "-q", "-r", "v2", "--from-bundle", "../v1.bundle", "../upstream", "subproject"],
+                                  stderr=PIPE)
+            self.assertEqual(4, p.returncode)
+            self.assertEqual(b"Error: Invalid argument: The reference 'v2' cannot be resolved to a branch or tag in the bundle!\n",
+                             p.stderr)
+            git.remove_staged_changes()
+
+            self.run_subpatch_ok(["add", "-q", "-r", "v1", "--from-bundle", "../v1.bundle", "../upstream", "subproject"])
+            self.assertFileContent("subproject/file", b"initial")
+            self.assertIn(b"\turl = ../upstream\n", git.cat_file(":subproject/.subproject"))
+            git.commit("add subproject")
+
+            p = self.run_subpatch(["update", "-q", "-r", "v1-stable", "--from-bundle", "../does-not-exist.bundle",
+                                   "subproject"], stderr=PIPE)
+            self.assertEqual(4, p.returncode)
+            self.assertEqual(b"Error: Invalid argument: Bundle file '../does-not-exist.bundle' does not exist\n", p.stderr)
+
+            self.run_subpatch_ok(["update", "-q", "-r", "v1-stable", "--from-bundle", "../stable.bundle", "subproject"])
+            self.assertFileContent("subproject/file", b"change on stable")
+
+    def test_update_all(self):
+        self.create_upstream()
+        with create_and_chdir("upstream2"):
+            create_git_repo_with_branches_and_tags()
+
+        with create_and_chdir("superproject"):
+            git = Git()
+            git.init()
+            self.run_subpatch_ok(["add", "-q", "-r", "v1", "../upstream", "subA"])
+            self.run_subpatch_ok(["add", "-q", "-r", "v1", "../upstream", "subB"])
+            self.run_subpatch_ok(["add", "-q", "-r", "v1", "../upstream2", "subC"])
+            # NOTE: Enforce the order of the subprojects in the config
+            touch(".subpatch", b"""\
+[subprojects]
+\tpath = subA
+\tpath = subB
+\tpath = subC
+""")
+            git.add(".subpatch")
+            git.commit("add subprojects")
+
+            p = self.run_subpatch(["update", "--all", "subA"], stderr=PIPE)
+            self.assertEqual(4, p.returncode)
+            self.assertEqual(b"Error: Invalid argument: Option '--all' cannot be used together with paths\n", p.stderr)
+
+            p = self.run_subpatch(["update", "subA", "subB", "-r", "v2"], stderr=PIPE)
+            self.assertEqual(4, p.returncode)
+            self.assertEqual(b"Error: Invalid argument: Options '--url', '--revision', '--subdir' and '--from-bundle' can"
+                             b" only be used with a single subproject\n", p.stderr)
+
+            # Change the revisions in the metadata directly
+            for path, revision in ((b"subA", b"v2"), (b"subC", b"v2")):
+                with open(path + b"/.subproject", "rb") as f:
+                    content = f.read()
+                touch(path + b"/.subproject", content.replace(b"revision = v1", b"revision = " + revision))
+                git.add(path + b"/.subproject")
+            git.commit("change revisions")
+
+            p = self.run_subpatch(["update", "--all", "-j", "2"], stdout=PIPE)
+            self.assertEqual(0, p.returncode)
+            lines = p.stdout.split(b"\n")
+            self.assertEqual(lines[0:3], [
+                b"Updating subproject 'subA' from URL '../upstream' to revision 'v2'... Done.",
+                b"Updating subproject 'subB' from URL '../upstream' to revision 'v1'... Done.",
+                b"Updating subproject 'subC' from URL '../upstream2' to revision 'v2'... Done.",
+            ])
+            self.assertEqual(lines[3], b"Timings (fetch/unpack):")
+            self.assertTrue(lines[4].startswith(b"  subA: "))
+            self.assertTrue(lines[6].startswith(b"  subC: "))
+            self.assertEqual(git.diff_staged_files(),
+                             [b"M\tsubA/.subproject",
+                              b"M\tsubA/dir/b",
+                              b"M\tsubA/dir/c",
+                              b"D\tsubA/dir/d",
+                              b"A\tsubA/dir/e",
+                              b"M\tsubC/.subproject",
+                              b"M\tsubC/file"])
+            git.remove_staged_changes()
+
+            # Same result with a list of paths
+            p = self.run_subpatch(["update", "-q", "subA", "subC"])
+            self.assertEqual(0, p.returncode)
+            self.assertEqual(len(git.diff_staged_files()), 7)
+
     def test_simple_update(self):
         self.create_upstream()
 
@@ -1722,19 +2148,19 @@ The following changes are recorded in the git index:
         with LocalWebserver(7000, FileRequestHandler), create_and_chdir("superproject"):
             git = Git()
             git.init()
-            p = self.run_subpatch(["add", "-q", "-r", "v1", "http://localhost:7000/upstream/.git/", "dir/subproject"], hack=True)
+            p = self.run_subpatch(["add", "-q", "-r", "v1", "http://localhost:7000/upstream/.git/", "dir/subproject"])
             self.assertEqual(p.returncode, 0)
             git.commit("add subproject")
 
             # Get reference diff
-            p = self.run_subpatch(["update", "-q", "dir/subproject", "-r", "v2"], hack=True)
+            p = self.run_subpatch(["update", "-q", "dir/subproject", "-r", "v2"])
             self.assertEqual(p.returncode, 0)
 
             diff_ok = git.diff(staged=True)
             git.remove_staged_changes()
 
             with chdir("dir"):
-                p = self.run_subpatch(["update", "subproject", "-r", "v2"], stdout=PIPE, hack=True)
+                p = self.run_subpatch(["update", "subproject", "-r", "v2"], stdout=PIPE)
                 self.assertEqual(p.returncode, 0)
                 # NOTE: Path in output is relative to the current work directory!
                 self.assertEqual(p.stdout, b"""\
@@ -1883,9 +2309,6 @@ class TestMerges(TestCaseHelper, TestSubpatch, TestCaseTempFolder):
             git.add("file_a")
             git.add("file_b")
             self.run_subpatch_ok(["subtree", "checksum", "--write"])
-            # TODO I was confused that "subtree checksum --write" does _not_ staged the modified file.
-            # Find a common pattern, whether subpatch stages all changes or no changes or ...!
-            git.add(".subproject")
             git.commit("add subproject")
         p = git.call(["ls-tree", "-r", "HEAD"], capture_stdout=True)
         self.assertEqual(p.stdout, b"""\
@@ -157,6 +157,23 @@ class TestSuperHelperGit(TestCaseTempFolder):
 040000 tree f966952d7e0715683ee935d201cd4ab22736c831\tsubdir
 """)
 
+    def test_get_sha1_for_subtrees(self):
+        git = Git()
+        git.init()
+
+        for subproject in ("a", "b/c"):
+            os.makedirs(subproject)
+            touch(subproject + "/hello")
+            touch(subproject + "/.subproject")
+        git.add(".")
+
+        super_helper = SuperHelperGit()
+        sha1s = super_helper.get_sha1_for_subtrees([b"a", b"b/c"])
+        self.assertEqual(sha1s, {b"a": b"f966952d7e0715683ee935d201cd4ab22736c831",
+                                 b"b/c": b"f966952d7e0715683ee935d201cd4ab22736c831"})
+        # Same result as the fallback with "git write-tree"
+        self.assertEqual(super_helper.get_sha1_for_subtree_with_write_tree(b"b/c"), sha1s[b"b/c"])
+
     def test_get_diff_for_subtree(self):
         git = Git()
         git.init()